@@ -1,17 +1,28 @@
 import os
 import sys
 import json
+import atexit
 import logging
 import re
 import random
-from collections import defaultdict
+import bisect
+import hmac
+import queue
+import sqlite3
+import time as _time
+from collections import OrderedDict, defaultdict, deque
+from collections.abc import Mapping, MutableMapping, MutableSet
+from types import MappingProxyType
 from uuid import uuid4
 from datetime import datetime, timezone, time, timedelta
-from threading import Thread
-from typing import Dict, List, Optional, Tuple
+from functools import lru_cache, wraps
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Thread, Lock, local
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
 
 import pytz
-from flask import Flask, request
+from flask import Flask, jsonify, request
 from apscheduler.schedulers.background import BackgroundScheduler
 from telegram import (
     Update,
@@ -27,10 +38,13 @@ from telegram import (
 
 import firebase_admin
 from firebase_admin import credentials, firestore
-from google.api_core.exceptions import FailedPrecondition
+from google.api_core.exceptions import FailedPrecondition, InvalidArgument, NotFound, PermissionDenied
 
 from telegram.ext import (
     Updater,
+    Dispatcher,
+    ExtBot,
+    JobQueue,
     MessageHandler,
     Filters,
     MessageFilter,
@@ -38,7 +52,9 @@ from telegram.ext import (
     CommandHandler,
     CallbackQueryHandler,
     DispatcherHandlerStop,
+    TypeHandler,
 )
+from telegram.utils.request import Request
 
 
 class FuncMessageFilter(MessageFilter):
@@ -52,7 +68,18 @@ class FuncMessageFilter(MessageFilter):
 # =================== إعدادات أساسية ===================
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-DATA_FILE = "suqya_users.json"
+DATA_FILE = "suqya_users.json"  # الملف القديم؛ يُستورد مرة واحدة إلى LOCAL_STORE_FILE
+# مجلد ملفات التشغيل (SQLite وجداول التوجيه)، خارج مجلد الكود ومستثنى في .gitignore
+DATA_DIR = os.getenv("DATA_DIR", "data")
+os.makedirs(DATA_DIR, exist_ok=True)
+
+
+def _data_path(name: str) -> str:
+    return os.path.join(DATA_DIR, name)
+
+
+# ":memory:" = بدون حفظ على القرص (لأدوات القياس فقط؛ تضيع التعديلات عند إعادة التشغيل)
+LOCAL_STORE_FILE = os.getenv("LOCAL_STORE_FILE", _data_path("suqya_users.db"))
 PORT = int(os.getenv("PORT", 10000))
 WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
 AUDIO_STORAGE_CHANNEL_ID = str(os.getenv("AUDIO_STORAGE_CHANNEL_ID", "-1003269735721"))
@@ -72,15 +99,203 @@ SUPERVISOR_ID = 1745150161  # المشرفة
 
 # ملف اللوج
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=getattr(logging, LOG_LEVEL, logging.INFO),
-)
+# text: السطر المعتاد، json: كائن JSON واحد لكل سطر (مع أي حقول تُمرر في extra)
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").strip().lower()
+# الكتابة الفعلية للوج في خيط مستقل حتى لا ينتظر التحديث على I/O
+LOG_ASYNC = os.getenv("LOG_ASYNC", "1") == "1"
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+# نسبة الاحتفاظ برسائل INFO/DEBUG لكل فئة، مثال: "BOOKS=0.1,ATTEND=0.5,*=1"
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "")
+# أقصى عدد مرات لنفس رسالة INFO/DEBUG (نفس مكان الاستدعاء ونفس القالب) في الدقيقة؛ 0 = بلا حد
+# WARNING وما فوقها لا تُحذف أبداً
+LOG_REPEAT_LIMIT_PER_MINUTE = int(os.getenv("LOG_REPEAT_LIMIT_PER_MINUTE", 0))
+
+LOG_TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+# الفئة من وسم بداية الرسالة: "[BOOKS][...]" أو "🟢 ATTEND_START | ..."
+LOG_CATEGORY_PATTERN = re.compile(r"^\W*\[?([A-Z][A-Z0-9]+)[\]_]")
+LOG_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "category", "suppressed"}
+
+
+def _parse_log_sampling(raw: str) -> Dict[str, float]:
+    rates = {}
+    for part in raw.split(","):
+        name, _, value = part.partition("=")
+        try:
+            rates[name.strip()] = min(1.0, max(0.0, float(value)))
+        except ValueError:
+            continue
+    return rates
+
+
+def _log_category(record: logging.LogRecord) -> str:
+    category = getattr(record, "category", None)
+    if category:
+        return category
+    match = LOG_CATEGORY_PATTERN.match(record.msg) if isinstance(record.msg, str) else None
+    return match.group(1) if match else record.name
+
+
+class LogSamplingFilter(logging.Filter):
+    """عيّنة من INFO/DEBUG لكل فئة وحد لتكرار نفس الرسالة؛ يعمل قبل الطابور فالمحذوف لا يكلف شيئاً"""
+
+    def __init__(self, rates: Dict[str, float], repeat_limit: int, window_seconds: float = 60.0):
+        super().__init__()
+        self.rates = rates
+        self.repeat_limit = repeat_limit
+        self.window_seconds = window_seconds
+        # (الملف، السطر، قالب الرسالة) -> [بداية النافذة، العدد]
+        self._repeats: Dict[Tuple[str, int, str], List[float]] = {}
+        self._next_prune = 0.0
+        self._lock = Lock()
+        self.dropped = {"sampled": 0, "repeated": 0, "queue_full": 0}
+
+    def count_dropped(self, reason: str):
+        with self._lock:
+            self.dropped[reason] += 1
+
+    def dropped_snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.dropped)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.category = _log_category(record)
+        if record.levelno >= logging.WARNING:
+            return True
+        if self.rates:
+            rate = self.rates.get(record.category, self.rates.get("*", 1.0))
+            if rate < 1.0 and random.random() >= rate:
+                self.count_dropped("sampled")
+                return False
+        if not self.repeat_limit:
+            return True
+
+        # القالب لا النص المنسق: رسائل f-string المختلفة لا تتشارك حداً واحداً، و"%s" المتكررة تتشاركه
+        key = (record.pathname, record.lineno, str(record.msg))
+        now = record.created
+        with self._lock:
+            if now >= self._next_prune:
+                self._prune(now)
+            window = self._repeats.get(key)
+            if window is None or now - window[0] >= self.window_seconds:
+                suppressed = max(0, int(window[1]) - self.repeat_limit) if window else 0
+                self._repeats[key] = [now, 1]
+                if suppressed:
+                    # أول سطر في النافذة الجديدة يحمل عدد ما حُذف في السابقة
+                    record.suppressed = suppressed
+                return True
+            window[1] += 1
+            if window[1] > self.repeat_limit:
+                self.dropped["repeated"] += 1  # القفل ممسوك هنا
+                return False
+        return True
+
+    def _prune(self, now: float):
+        # يُستدعى تحت القفل؛ النوافذ المنتهية تُحذف حتى لا يكبر القاموس مع كل رسالة f-string مختلفة
+        for key in [k for k, window in self._repeats.items() if now - window[0] >= self.window_seconds]:
+            del self._repeats[key]
+        self._next_prune = now + self.window_seconds
+
+
+class JsonLogFormatter(logging.Formatter):
+    """سطر JSON لكل رسالة: حقول ثابتة + ما يُمرر في extra"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "category": getattr(record, "category", record.name),
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in LOG_RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextLogFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        return f"{text} (+{suppressed} مكرر محذوف)" if suppressed else text
+
+
+class AsyncLogHandler(QueueHandler):
+    """يضع السجل في الطابور فقط؛ التنسيق والكتابة في خيط QueueListener"""
+
+    def __init__(self, log_queue: queue.Queue, log_filter: LogSamplingFilter, fallback: logging.Handler):
+        super().__init__(log_queue)
+        self._log_filter = log_filter
+        self._fallback = fallback
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # دمج الوسائط الآن لأن الكائنات قد تتغير قبل أن يصل السجل لخيط الكتابة
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if record.levelno >= logging.WARNING:
+                # التحذيرات والأخطاء لا تُحذف: تُكتب مباشرة في هذا الخيط
+                self._fallback.handle(record)
+                return
+            self._log_filter.count_dropped("queue_full")
+
+
+LOG_FILTER = LogSamplingFilter(_parse_log_sampling(LOG_SAMPLING), LOG_REPEAT_LIMIT_PER_MINUTE)
+LOG_LISTENER = None
+
+
+def configure_logging():
+    """إعداد اللوج: التنسيق (نص/JSON) والعينات وطابور الكتابة غير المتزامن"""
+    global LOG_LISTENER
+    formatter = JsonLogFormatter() if LOG_FORMAT == "json" else TextLogFormatter(LOG_TEXT_FORMAT)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    handler = stream_handler
+    if LOG_ASYNC:
+        log_queue = queue.Queue(maxsize=max(1, LOG_QUEUE_SIZE))
+        handler = AsyncLogHandler(log_queue, LOG_FILTER, stream_handler)
+        LOG_LISTENER = QueueListener(log_queue, stream_handler)
+        LOG_LISTENER.start()
+        # تفريغ ما تبقى في الطابور عند الإغلاق
+        atexit.register(LOG_LISTENER.stop)
+    handler.addFilter(LOG_FILTER)
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+
+
+configure_logging()
 logger = logging.getLogger(__name__)
 
 WEBHOOK_TIMEOUT = int(os.getenv("WEBHOOK_TIMEOUT", 15))
 WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
 
+# طابور تحديثات Webhook: يستقبل Flask التحديث ويعالجه العمال في الخلفية
+# lanes: تحديثات المستخدم الواحد بالترتيب على مسار واحد، والمستخدمون المختلفون بالتوازي
+# direct: المعالجة المباشرة داخل طلب Flask (السلوك القديم)
+DISPATCH_MODE = os.getenv("DISPATCH_MODE", "lanes").strip().lower()
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 8))
+UPDATE_QUEUE_MAXSIZE = int(os.getenv("UPDATE_QUEUE_MAXSIZE", 1000))
+UPDATE_ENQUEUE_TIMEOUT = float(os.getenv("UPDATE_ENQUEUE_TIMEOUT", 2))
+
 # ضبط اتصال البوت لتحمل عدد أكبر من الاتصالات
 REQUEST_KWARGS = {
     "read_timeout": WEBHOOK_TIMEOUT,
@@ -91,6 +306,25 @@ REQUEST_KWARGS = {
 USER_CACHE_TTL_SECONDS = int(os.getenv("USER_CACHE_TTL_SECONDS", 60))
 LAST_ACTIVE_UPDATE_INTERVAL_SECONDS = int(os.getenv("LAST_ACTIVE_UPDATE_INTERVAL_SECONDS", 60))
 
+# قياس عمليات Firestore/Telegram لكل معالج (مسار /metrics) — معطل افتراضياً
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "0") == "1"
+SLOW_UPDATE_MS = float(os.getenv("SLOW_UPDATE_MS", 1500))
+SLOW_UPDATE_LOG_SIZE = int(os.getenv("SLOW_UPDATE_LOG_SIZE", 50))
+# مسار /slow يكشف معرفات المعالجات وتفاصيل التحديثات؛ فارغ = المسار معطل
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# إعدادات ناقل أحداث النقاط والمستويات
+EVENT_BUS_WORKERS = int(os.getenv("EVENT_BUS_WORKERS", 2))
+EVENT_NOTIFY_WINDOW_SECONDS = float(os.getenv("EVENT_NOTIFY_WINDOW_SECONDS", 2))
+
+# الإعدادات العامة: listener (مستمع Firestore) أو poll (فحص حقل version دورياً) أو off
+CONFIG_REFRESH_MODE = os.getenv("CONFIG_REFRESH_MODE", "listener").strip().lower()
+CONFIG_POLL_SECONDS = float(os.getenv("CONFIG_POLL_SECONDS", 30))
+
+# بدء التشغيل: التحديثات التي تصل قبل انتهاء التحميل تنتظر حتى هذه المدة ثم تُعالج على أي حال
+STARTUP_GATE_TIMEOUT_SECONDS = float(os.getenv("STARTUP_GATE_TIMEOUT_SECONDS", 60))
+STARTUP_WORKERS = int(os.getenv("STARTUP_WORKERS", 4))
+
 # =================== خادم ويب بسيط لـ Render ===================
 
 app = Flask(__name__)
@@ -101,38 +335,330 @@ dispatcher = None
 job_queue = None
 IS_RUNNING = True
 
+
+def attach_dispatcher(new_dispatcher, new_job_queue=None):
+    """ربط Dispatcher جاهز (مثلاً ببوت وهمي في أدوات الحمل) بدل إنشائه من Updater"""
+    global dispatcher, job_queue
+    dispatcher = new_dispatcher
+    job_queue = new_job_queue
+
 @app.route("/")
 def index():
     return "Suqya Al-Kawther bot is running ✅"
 
+@app.route("/metrics")
+def metrics():
+    return prometheus_metrics(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@app.route("/slow")
+def slow_updates():
+    token = request.headers.get("X-Metrics-Token") or request.args.get("token") or ""
+    if not METRICS_TOKEN or not hmac.compare_digest(token, METRICS_TOKEN):
+        return "not found", 404
+    return jsonify(slow_update_log())
+
 @app.route(f"/{BOT_TOKEN}", methods=["POST"])
 def webhook_handler():
-    """معالجة تحديثات الـ Webhook من Telegram"""
+    """استقبال تحديثات الـ Webhook من Telegram ووضعها في الطابور"""
     if request.method == "POST":
-        try:
-            payload = request.get_json(force=True)
-            update = Update.de_json(payload, dispatcher.bot)
-            update_type = (
-                "channel_post"
-                if update.channel_post
-                else "callback_query"
-                if update.callback_query
-                else "message"
-                if update.message
-                else "unknown"
-            )
-            logger.info(
-                "📥 Webhook update received | type=%s | update_id=%s",
-                update_type,
-                getattr(update, "update_id", ""),
-            )
-            dispatcher.process_update(update)
+        payload = request.get_json(force=True, silent=True)
+        if not isinstance(payload, dict) or not isinstance(payload.get("update_id"), int):
+            logger.warning("⚠️ تحديث Webhook غير صالح")
+            return "bad request", 400
+        if DISPATCH_MODE == "direct":
+            try:
+                dispatcher.process_update(Update.de_json(payload, dispatcher.bot))
+            except Exception as e:
+                logger.error(f"خطأ في معالجة webhook: {e}")
+                return "error", 500
             return "ok", 200
-        except Exception as e:
-            logger.error(f"خطأ في معالجة webhook: {e}")
-            return "error", 500
+        if not enqueue_update(payload):
+            # الطابور ممتلئ: نطلب من Telegram إعادة المحاولة لاحقاً بدل تكديس الطلبات
+            return "busy", 503
+        return "ok", 200
     return "ok", 200
 
+
+# =================== طابور تحديثات Webhook ===================
+
+UPDATE_QUEUES: List[queue.Queue] = []
+UPDATE_QUEUE_LOCK = Lock()
+UPDATE_STATS_LOCK = Lock()
+UPDATE_QUEUE_STATS = {
+    "enqueued": 0,
+    "processed": 0,
+    "rejected": 0,
+    "failed": 0,
+    "last_lag_ms": 0.0,
+    "max_lag_ms": 0.0,
+    "total_lag_ms": 0.0,
+}
+
+
+def _update_lane_key(item) -> int:
+    """مفتاح المسار: معرف المستخدم أولاً (حالات المحادثة مخزنة لكل مستخدم) ثم المحادثة"""
+    if isinstance(item, Update):
+        if item.effective_user:
+            return item.effective_user.id
+        if item.effective_chat:
+            return item.effective_chat.id
+        return item.update_id or 0
+
+    for field in ("message", "edited_message", "callback_query", "inline_query", "my_chat_member", "chat_member"):
+        sender = (item.get(field) or {}).get("from") or {}
+        if sender.get("id") is not None:
+            return int(sender["id"])
+    for field in ("channel_post", "edited_channel_post"):
+        chat = (item.get(field) or {}).get("chat") or {}
+        if chat.get("id") is not None:
+            return int(chat["id"])
+    return int(item.get("update_id", 0))
+
+
+def _start_update_workers():
+    with UPDATE_QUEUE_LOCK:
+        if UPDATE_QUEUES:
+            return
+        workers = max(1, UPDATE_WORKERS)
+        per_worker = max(1, UPDATE_QUEUE_MAXSIZE // workers)
+        queues = [queue.Queue(maxsize=per_worker) for _ in range(workers)]
+        for idx, q in enumerate(queues):
+            Thread(target=_update_worker, args=(q,), name=f"update-lane-{idx}", daemon=True).start()
+        UPDATE_QUEUES.extend(queues)
+        logger.info("✅ تم تشغيل %s مسار لمعالجة التحديثات", workers)
+
+
+def _lane_for(key: int) -> queue.Queue:
+    if not UPDATE_QUEUES:
+        _start_update_workers()
+    return UPDATE_QUEUES[int(key) % len(UPDATE_QUEUES)]
+
+
+def enqueue_update(item, timeout: Optional[float] = UPDATE_ENQUEUE_TIMEOUT) -> bool:
+    """إضافة تحديث (JSON خام أو Update) لمسار مستخدمه"""
+    try:
+        _lane_for(_update_lane_key(item)).put((_time.monotonic(), item), timeout=timeout)
+    except queue.Full:
+        _count_update_stat("rejected")
+        update_id = item.update_id if isinstance(item, Update) else item.get("update_id")
+        logger.warning("⚠️ طابور التحديثات ممتلئ، تم رفض update_id=%s", update_id)
+        return False
+    _count_update_stat("enqueued")
+    return True
+
+
+def run_on_user_lane(user_id: int, task, *args, **kwargs):
+    """
+    تنفيذ مهمة تعدّل حالة مستخدم على مساره نفسه حتى لا تتداخل مع تحديثاته.
+    لا تنتظر أبداً: المستدعي قد يكون عامل نفس المسار، فإذا كان المسار ممتلئاً تُنفذ المهمة في الخلفية.
+    """
+    if DISPATCH_MODE != "lanes" or not user_id:
+        task(*args, **kwargs)
+        return
+    try:
+        _lane_for(user_id).put_nowait((_time.monotonic(), (task, args, kwargs)))
+    except queue.Full:
+        logger.warning("⚠️ مسار المستخدم %s ممتلئ، تُنفذ المهمة في الخلفية", user_id)
+        run_after_response(task, *args, **kwargs)
+
+
+def hand_off_timer_task(user_id: int, task, *args):
+    """من دوال عجلة المؤقتات: تسليم المهمة لمسار المستخدم أو للخلفية، وليس تنفيذها في خيط النبضة"""
+    if DISPATCH_MODE == "lanes" and user_id:
+        run_on_user_lane(user_id, task, *args)
+    else:
+        run_after_response(task, *args)
+
+
+class LaneDispatcher(Dispatcher):
+    """
+    Dispatcher يرسل كل تحديث إلى مسار مستخدمه (DISPATCH_MODE=lanes) أو يعالجه مباشرة
+    داخل نطاق سجل المستخدم (direct). المعالجة الفعلية في dispatch_update.
+    """
+
+    def process_update(self, update):
+        if not isinstance(update, Update):
+            # أخطاء Polling وما شابه تمر على معالجة PTB كما هي
+            super().process_update(update)
+        elif DISPATCH_MODE == "lanes":
+            # انتظار محدود: مسار ممتلئ لا يوقف خيط الاستقبال؛ التحديث المرفوض يُحتسب ويُسجل في enqueue_update
+            enqueue_update(update)
+        else:
+            _process_update_scoped(update)
+
+    def dispatch_update(self, update):
+        super().process_update(update)
+
+
+def build_updater() -> Updater:
+    """Updater مبني على LaneDispatcher بدل Dispatcher الذي ينشئه Updater افتراضياً"""
+    workers = 4
+    request = Request(con_pool_size=workers + 4, **REQUEST_KWARGS)
+    lane_dispatcher = LaneDispatcher(
+        ExtBot(BOT_TOKEN, request=request),
+        queue.Queue(),
+        workers=workers,
+        job_queue=JobQueue(),
+    )
+    lane_dispatcher.job_queue.set_dispatcher(lane_dispatcher)
+    return Updater(dispatcher=lane_dispatcher, workers=None)
+
+
+def _install_dispatch_lanes():
+    """تشغيل عمال المسارات؛ LaneDispatcher يرسل إليها التحديثات في وضع lanes"""
+    if dispatcher is None:
+        return
+    if not isinstance(dispatcher, LaneDispatcher):
+        logger.warning("⚠️ Dispatcher ليس LaneDispatcher؛ تحديثات Polling لن تمر على المسارات")
+    if DISPATCH_MODE == "lanes":
+        _start_update_workers()
+
+
+def _count_update_stat(name: str, value: float = 1):
+    with UPDATE_STATS_LOCK:
+        UPDATE_QUEUE_STATS[name] += value
+
+
+def _update_worker(q: queue.Queue):
+    while True:
+        received_at, item = q.get()
+        lag_ms = (_time.monotonic() - received_at) * 1000
+        with UPDATE_STATS_LOCK:
+            UPDATE_QUEUE_STATS["last_lag_ms"] = lag_ms
+            UPDATE_QUEUE_STATS["total_lag_ms"] += lag_ms
+            if lag_ms > UPDATE_QUEUE_STATS["max_lag_ms"]:
+                UPDATE_QUEUE_STATS["max_lag_ms"] = lag_ms
+        try:
+            if isinstance(item, tuple):
+                task, args, kwargs = item
+                task(*args, **kwargs)
+                continue
+            update = item if isinstance(item, Update) else Update.de_json(item, dispatcher.bot)
+            logger.debug("📥 update | update_id=%s | lag_ms=%.1f", update.update_id, lag_ms)
+            _process_update_scoped(update)
+            _count_update_stat("processed")
+        except Exception as e:
+            _count_update_stat("failed")
+            logger.error(f"خطأ في معالجة عنصر من مسار التحديثات: {e}")
+        finally:
+            q.task_done()
+
+
+def update_queue_metrics() -> Dict:
+    depths = [q.qsize() for q in UPDATE_QUEUES]
+    with UPDATE_STATS_LOCK:
+        stats = dict(UPDATE_QUEUE_STATS)
+    processed = stats["processed"]
+    return {
+        **stats,
+        "depth": sum(depths),
+        "depth_per_worker": depths,
+        "capacity": sum(q.maxsize for q in UPDATE_QUEUES),
+        "avg_lag_ms": stats["total_lag_ms"] / processed if processed else 0.0,
+    }
+
+# =================== عجلة المؤقتات ===================
+
+TIMER_TICK_SECONDS = float(os.getenv("TIMER_TICK_SECONDS", "0.5"))
+TIMER_WHEEL_SLOTS = int(os.getenv("TIMER_WHEEL_SLOTS", "512"))
+
+
+class TimerWheel:
+    """عجلة مؤقتات مجزأة: جدولة وإلغاء O(1) بمفتاح، تديرها نبضة واحدة متكررة.
+
+    المؤقت يُخزن في الخانة (نبضة_الاستحقاق % عدد_الخانات)، والنبضة تفحص خانة واحدة فقط.
+    الدوال المسجلة تُنفذ في خيط النبضة، لذا تسلّم العمل فقط (run_after_response أو hand_off_timer_task)
+    ولا تنتظر طابوراً ولا تنفذ I/O.
+    """
+
+    def __init__(self, tick_seconds: float, slots: int):
+        self.tick_seconds = tick_seconds
+        self.slots: List[Dict] = [{} for _ in range(max(1, slots))]
+        self._index: Dict = {}  # key -> slot
+        self._lock = Lock()
+        self._ticks = 0
+        self._started_at = 0.0
+        self._thread = None
+        self.fired = 0
+        self.cancelled = 0
+
+    def _ensure_running(self):
+        if self._thread is None:
+            self._started_at = _time.monotonic()
+            self._thread = Thread(target=self._run, name="timer-wheel", daemon=True)
+            self._thread.start()
+
+    def schedule(self, key, delay: float, callback, *args):
+        """جدولة (أو إعادة جدولة) المؤقت صاحب المفتاح key بعد delay ثانية"""
+        ticks = max(1, int(-(-delay // self.tick_seconds)))
+        with self._lock:
+            self._ensure_running()
+            self._cancel_locked(key)
+            due_tick = self._ticks + ticks
+            slot = due_tick % len(self.slots)
+            self.slots[slot][key] = (due_tick, callback, args)
+            self._index[key] = slot
+
+    def cancel(self, key) -> bool:
+        with self._lock:
+            if self._cancel_locked(key):
+                self.cancelled += 1
+                return True
+            return False
+
+    def _cancel_locked(self, key) -> bool:
+        slot = self._index.pop(key, None)
+        if slot is None:
+            return False
+        self.slots[slot].pop(key, None)
+        return True
+
+    def is_pending(self, key) -> bool:
+        return key in self._index
+
+    def _run(self):
+        while True:
+            _time.sleep(self.tick_seconds)
+            # تعويض النبضات الفائتة إذا تأخر الخيط (ضغط على المعالج مثلاً)
+            target = int((_time.monotonic() - self._started_at) / self.tick_seconds)
+            while self._ticks < target:
+                self._advance()
+
+    def _advance(self):
+        with self._lock:
+            self._ticks += 1
+            bucket = self.slots[self._ticks % len(self.slots)]
+            due = [(key, entry) for key, entry in bucket.items() if entry[0] <= self._ticks]
+            for key, _ in due:
+                del bucket[key]
+                self._index.pop(key, None)
+            self.fired += len(due)
+        for key, (_, callback, args) in due:
+            try:
+                callback(*args)
+            except Exception as e:
+                logger.error("❌ خطأ في مؤقت %s: %s", key, e)
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            keys = list(self._index)
+            fired, cancelled = self.fired, self.cancelled
+        by_kind: Dict[str, int] = defaultdict(int)
+        for key in keys:
+            by_kind[str(key[0] if isinstance(key, tuple) else key)] += 1
+        return {
+            "pending": len(keys),
+            "pending_by_kind": dict(by_kind),
+            "fired": fired,
+            "cancelled": cancelled,
+            "tick_seconds": self.tick_seconds,
+            "slots": len(self.slots),
+        }
+
+
+TIMER_WHEEL = TimerWheel(TIMER_TICK_SECONDS, TIMER_WHEEL_SLOTS)
+
+
 def run_flask():
     """تشغيل Flask لمعالجة Webhook (Blocking)"""
     logger.info(f"🌐 تشغيل Flask على المنفذ {PORT}...")
@@ -145,6 +671,436 @@ def run_flask():
 # =================== تخزين البيانات ===================
 
 
+class LocalStore:
+    """
+    التخزين المحلي عند عدم توفر Firestore: SQLite بوضع WAL وصف لكل مستخدم،
+    فحفظ مستخدم واحد يكتب سجله فقط بدل إعادة كتابة الملف كاملاً، ولا يفسد عند انقطاع العملية.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = Lock()
+        self.conn = None
+        # بصمة آخر نسخة محفوظة لكل مفتاح، لتخطي السجلات التي لم تتغير
+        self.digests: Dict[str, int] = {}
+
+    def _connect(self):
+        # يُستدعى تحت القفل؛ الفتح مؤجل لأول استخدام (لا I/O عند الاستيراد)
+        if self.conn is None:
+            conn = sqlite3.connect(self.path or ":memory:", check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS records (key TEXT PRIMARY KEY, doc TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self.conn = conn
+            self._import_legacy_json()
+        return self.conn
+
+    def _import_legacy_json(self):
+        """استيراد suqya_users.json مرة واحدة إذا كان المخزن فارغاً (الملف نفسه لا يُحذف)"""
+        if not os.path.exists(DATA_FILE):
+            return
+        if self.conn.execute("SELECT 1 FROM records LIMIT 1").fetchone():
+            return
+        try:
+            with open(DATA_FILE, "r", encoding="utf-8") as f:
+                legacy = json.load(f)
+        except Exception as e:
+            logger.error(f"❌ تعذر استيراد {DATA_FILE} إلى المخزن المحلي: {e}")
+            return
+        self._write_many(legacy.items())
+        logger.info(f"✅ تم استيراد {len(legacy)} سجل من {DATA_FILE} إلى {self.path or 'الذاكرة'}")
+
+    def _write_many(self, items) -> int:
+        rows = []
+        now = _time.time()
+        for key, record in items:
+            key = str(key)
+            doc = json.dumps(record, ensure_ascii=False, default=str)
+            digest = hash(doc)
+            if self.digests.get(key) == digest:
+                continue
+            rows.append((key, doc, now, digest))
+        if not rows:
+            return 0
+        conn = self.conn
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO records (key, doc, updated_at) VALUES (?, ?, ?)",
+                [row[:3] for row in rows],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        for key, _, _, digest in rows:
+            self.digests[key] = digest
+        return len(rows)
+
+    def load_all(self) -> Dict[str, Dict]:
+        with self.lock:
+            conn = self._connect()
+            loaded = {}
+            for key, doc in conn.execute("SELECT key, doc FROM records"):
+                loaded[key] = json.loads(doc)
+                self.digests[key] = hash(doc)
+            return loaded
+
+    def get(self, key) -> Optional[Dict]:
+        with self.lock:
+            row = self._connect().execute("SELECT doc FROM records WHERE key = ?", (str(key),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key, record: Dict):
+        """حفظ سجل واحد (تكلفته بحجم السجل فقط)"""
+        with self.lock:
+            self._connect()
+            self._write_many([(key, record)])
+
+    def sync(self, records: Dict[str, Dict]) -> int:
+        """حفظ السجلات التي تغيرت فقط منذ آخر حفظ، في معاملة واحدة"""
+        with self.lock:
+            self._connect()
+            return self._write_many(list(records.items()))
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+LOCAL_STORE = LocalStore(LOCAL_STORE_FILE)
+atexit.register(LOCAL_STORE.close)
+
+
+def load_data_local():
+    """تحميل كل السجلات من المخزن المحلي إلى data"""
+    global data
+    data = LOCAL_STORE.load_all()
+    return data
+
+
+def save_data_local(key=None):
+    """حفظ سجل واحد في المخزن المحلي، أو كل السجلات المتغيرة إذا لم يُحدد المفتاح"""
+    try:
+        if key is not None and str(key) in data:
+            LOCAL_STORE.put(key, data[str(key)])
+        else:
+            LOCAL_STORE.sync(data)
+    except Exception as e:
+        logger.error(f"خطأ في حفظ البيانات محلياً: {e}")
+
+
+# =================== طابور الكتابات المحلي (outbox) ===================
+
+# كتابات Firestore التي فشلت (أو جاءت بينما توجد كتابات معلقة) تُحفظ على القرص وتُعاد بالترتيب
+# ":memory:" = بدون حفظ على القرص (لأدوات القياس فقط؛ تضيع الكتابات المعلقة عند إعادة التشغيل)
+OUTBOX_FILE = os.getenv("OUTBOX_FILE", _data_path("suqya_outbox.db"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 12))
+OUTBOX_BACKOFF_BASE_SECONDS = float(os.getenv("OUTBOX_BACKOFF_BASE_SECONDS", 1))
+OUTBOX_BACKOFF_MAX_SECONDS = float(os.getenv("OUTBOX_BACKOFF_MAX_SECONDS", 300))
+# الكتابات ذات التحويلات (Increment/ArrayUnion...) تُكتب مع وثيقة علامة باسم مفتاحها في نفس الدفعة،
+# فإذا نجحت وضاع الرد لا تُطبق مرة ثانية عند إعادتها. العلامات خارج سجلات المستخدمين
+# وتُحذف بسياسة TTL في Firestore على الحقل expire_at
+OUTBOX_MARKERS_COLLECTION = "outbox_markers"
+OUTBOX_MARKER_TTL_DAYS = int(os.getenv("OUTBOX_MARKER_TTL_DAYS", 7))
+# أخطاء لن تنجح بإعادة المحاولة؛ تذهب مباشرة إلى الكتابات الموقوفة
+OUTBOX_PERMANENT_ERRORS = (NotFound, InvalidArgument, PermissionDenied)
+
+
+def _encode_outbox_value(value):
+    """تحويل قيم Firestore الخاصة (Increment، SERVER_TIMESTAMP...) إلى JSON قابل للحفظ"""
+    if value is firestore.SERVER_TIMESTAMP:
+        return {"__fs__": "server_timestamp"}
+    if value is firestore.DELETE_FIELD:
+        return {"__fs__": "delete"}
+    if isinstance(value, firestore.Increment):
+        return {"__fs__": "increment", "value": value.value}
+    if isinstance(value, firestore.ArrayUnion):
+        return {"__fs__": "array_union", "values": [_encode_outbox_value(v) for v in value.values]}
+    if isinstance(value, firestore.ArrayRemove):
+        return {"__fs__": "array_remove", "values": [_encode_outbox_value(v) for v in value.values]}
+    if isinstance(value, datetime):
+        return {"__fs__": "datetime", "value": value.isoformat()}
+    if isinstance(value, dict):
+        return {str(k): _encode_outbox_value(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode_outbox_value(v) for v in value]
+    return value
+
+
+def _decode_outbox_value(value):
+    if isinstance(value, list):
+        return [_decode_outbox_value(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    kind = value.get("__fs__")
+    if kind == "server_timestamp":
+        return firestore.SERVER_TIMESTAMP
+    if kind == "delete":
+        return firestore.DELETE_FIELD
+    if kind == "increment":
+        return firestore.Increment(value["value"])
+    if kind == "array_union":
+        return firestore.ArrayUnion(_decode_outbox_value(value["values"]))
+    if kind == "array_remove":
+        return firestore.ArrayRemove(_decode_outbox_value(value["values"]))
+    if kind == "datetime":
+        return datetime.fromisoformat(value["value"])
+    return {k: _decode_outbox_value(v) for k, v in value.items()}
+
+
+def _document_from_path(path: str):
+    """users/123/heart_memos/abc -> مرجع الوثيقة"""
+    parts = path.split("/")
+    ref = db.collection(parts[0]).document(parts[1])
+    for i in range(2, len(parts), 2):
+        ref = ref.collection(parts[i]).document(parts[i + 1])
+    return ref
+
+
+def _has_transforms(payload: Dict) -> bool:
+    for value in payload.values():
+        if isinstance(value, (firestore.Increment, firestore.ArrayUnion, firestore.ArrayRemove)):
+            return True
+        if isinstance(value, dict) and _has_transforms(value):
+            return True
+    return False
+
+
+def _apply_document_write(ref, op: str, payload: Dict, marker_key: Optional[str] = None):
+    if marker_key is None:
+        if op == "update":
+            ref.update(payload)
+        elif op == "merge":
+            ref.set(payload, merge=True)
+        else:
+            ref.set(payload)
+        return
+
+    batch = db.batch()
+    if op == "update":
+        batch.update(ref, payload)
+    else:
+        batch.set(ref, payload, merge=op == "merge")
+    batch.set(
+        db.collection(OUTBOX_MARKERS_COLLECTION).document(marker_key),
+        {"path": ref.path, "expire_at": datetime.now(timezone.utc) + timedelta(days=OUTBOX_MARKER_TTL_DAYS)},
+    )
+    batch.commit()
+
+
+class WriteOutbox:
+    """
+    طابور كتابات دائم (SQLite بوضع WAL) يُفرغه خيط خلفي مع تأخير أسّي عند الفشل.
+    الترتيب محفوظ لكل وثيقة: كتابة متعثرة تؤخر كتابات وثيقتها فقط لا باقي المستخدمين.
+    كل كتابة لها مفتاح idempotency؛ إضافة نفس المفتاح مرتين لا تكررها.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = Lock()
+        self.conn = None
+        self.pending_docs: Dict[str, int] = defaultdict(int)
+        self.depth = 0
+        self.dead = 0
+        self.stats = {"enqueued": 0, "replayed": 0, "retries": 0, "dead_lettered": 0}
+        self.wakeup = Event()
+        self.thread = None
+
+    def _connect(self):
+        # يُستدعى تحت القفل
+        if self.conn is None:
+            conn = sqlite3.connect(self.path or ":memory:", check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT UNIQUE NOT NULL, op TEXT NOT NULL, "
+                "path TEXT NOT NULL, payload TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+                "next_at REAL NOT NULL DEFAULT 0, dead INTEGER NOT NULL DEFAULT 0, last_error TEXT, "
+                "created_at REAL NOT NULL)"
+            )
+            # ما بقي من التشغيل السابق
+            for path, count in conn.execute("SELECT path, COUNT(*) FROM outbox WHERE dead = 0 GROUP BY path"):
+                self.pending_docs[path] += count
+                self.depth += count
+            self.dead = conn.execute("SELECT COUNT(*) FROM outbox WHERE dead = 1").fetchone()[0]
+            self.conn = conn
+        return self.conn
+
+    def enqueue(self, op: str, path: str, payload: Dict, key: Optional[str] = None, dead_error: Optional[str] = None) -> str:
+        """إضافة كتابة للطابور؛ مع dead_error تُحفظ موقوفة مباشرة (للمراجعة) ولا تُعاد"""
+        key = key or uuid4().hex
+        encoded = json.dumps(_encode_outbox_value(payload), ensure_ascii=False, default=str)
+        dead = 1 if dead_error else 0
+        with self.lock:
+            cursor = self._connect().execute(
+                "INSERT OR IGNORE INTO outbox (key, op, path, payload, dead, last_error, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, op, path, encoded, dead, dead_error, _time.time()),
+            )
+            if cursor.rowcount and dead:
+                self.dead += 1
+                self.stats["dead_lettered"] += 1
+            elif cursor.rowcount:
+                self.pending_docs[path] += 1
+                self.depth += 1
+                self.stats["enqueued"] += 1
+        if not dead:
+            self.wakeup.set()
+        return key
+
+    def has_pending(self, path: Optional[str] = None) -> bool:
+        if path is None:
+            return self.depth > 0
+        return self.pending_docs.get(path, 0) > 0
+
+    def _forget(self, path: str):
+        # يُستدعى تحت القفل
+        self.depth -= 1
+        self.pending_docs[path] -= 1
+        if self.pending_docs[path] <= 0:
+            del self.pending_docs[path]
+
+    def _replay(self, key: str, op: str, path: str, payload: Dict):
+        ref = _document_from_path(path)
+        marker_key = None
+        if _has_transforms(payload):
+            # كتابة بتحويلات: إن وُجدت علامتها فقد طُبقت قبل ضياع الرد
+            if db.collection(OUTBOX_MARKERS_COLLECTION).document(key).get().exists:
+                return
+            marker_key = key
+        _apply_document_write(ref, op, payload, marker_key)
+
+    def _next_due(self):
+        """أقدم كتابة مستحقة لكل وثيقة؛ يرجع (الصف أو None، أقل انتظار للصفوف المؤجلة أو None)"""
+        now = _time.time()
+        blocked = set()
+        min_wait = None
+        with self.lock:
+            rows = self._connect().execute(
+                "SELECT seq, key, op, path, payload, attempts, next_at FROM outbox WHERE dead = 0 ORDER BY seq"
+            )
+            for row in rows:
+                path, next_at = row[3], row[6]
+                if path in blocked:
+                    continue
+                # الكتابات التالية لنفس الوثيقة تنتظر هذه الكتابة
+                blocked.add(path)
+                if next_at <= now:
+                    return row, None
+                wait_seconds = next_at - now
+                min_wait = wait_seconds if min_wait is None else min(min_wait, wait_seconds)
+        return None, min_wait
+
+    def drain_once(self) -> Optional[float]:
+        """محاولة أقدم كتابة مستحقة؛ يرجع ثواني الانتظار قبل المحاولة التالية (None = الطابور فارغ)"""
+        row, wait_seconds = self._next_due()
+        if row is None:
+            return wait_seconds
+        seq, key, op, path, payload, attempts, next_at = row
+
+        try:
+            self._replay(key, op, path, _decode_outbox_value(json.loads(payload)))
+        except Exception as e:
+            attempts += 1
+            with self.lock:
+                if attempts >= OUTBOX_MAX_ATTEMPTS or isinstance(e, OUTBOX_PERMANENT_ERRORS):
+                    self._connect().execute(
+                        "UPDATE outbox SET dead = 1, attempts = ?, last_error = ? WHERE seq = ?",
+                        (attempts, str(e)[:500], seq),
+                    )
+                    self._forget(path)
+                    self.dead += 1
+                    self.stats["dead_lettered"] += 1
+                    logger.error(f"❌ أُوقفت كتابة {op} على {path} بعد {attempts} محاولة: {e}")
+                    return 0
+                delay = min(OUTBOX_BACKOFF_MAX_SECONDS, OUTBOX_BACKOFF_BASE_SECONDS * 2 ** (attempts - 1))
+                delay *= random.uniform(0.8, 1.2)
+                self._connect().execute(
+                    "UPDATE outbox SET attempts = ?, next_at = ?, last_error = ? WHERE seq = ?",
+                    (attempts, _time.time() + delay, str(e)[:500], seq),
+                )
+                self.stats["retries"] += 1
+            logger.warning("⚠️ فشلت إعادة كتابة %s (محاولة %s)، المحاولة التالية بعد %.1f ث: %s", path, attempts, delay, e)
+            # باقي الوثائق لا تنتظر هذه الكتابة
+            return 0
+
+        with self.lock:
+            self._connect().execute("DELETE FROM outbox WHERE seq = ?", (seq,))
+            self._forget(path)
+            self.stats["replayed"] += 1
+        return 0
+
+    def _run(self):
+        while True:
+            try:
+                wait_seconds = self.drain_once()
+            except Exception as e:
+                logger.error(f"❌ خطأ في مفرّغ طابور الكتابات: {e}", exc_info=True)
+                wait_seconds = OUTBOX_BACKOFF_BASE_SECONDS
+            if wait_seconds == 0:
+                continue
+            self.wakeup.wait(wait_seconds)
+            self.wakeup.clear()
+
+    def start(self):
+        with self.lock:
+            self._connect()
+            if self.thread is not None:
+                return
+            self.thread = Thread(target=self._run, name="outbox-drainer", daemon=True)
+            self.thread.start()
+        if self.depth:
+            logger.info(f"📮 طابور الكتابات: {self.depth} كتابة معلقة من التشغيل السابق")
+
+    def metrics(self) -> Dict:
+        with self.lock:
+            return dict(self.stats, depth=self.depth, dead=self.dead)
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+WRITE_OUTBOX = WriteOutbox(OUTBOX_FILE)
+atexit.register(WRITE_OUTBOX.close)
+
+
+def start_outbox_drainer():
+    if firestore_available():
+        WRITE_OUTBOX.start()
+
+
+def write_through_outbox(op: str, path: str, payload: Dict, key: Optional[str] = None) -> bool:
+    """
+    كتابة وثيقة في Firestore مباشرة، أو في الطابور المحلي إذا فشلت أو كانت لنفس الوثيقة كتابات سابقة
+    معلقة (حتى لا تسبقها). يرجع True إذا كُتبت مباشرة؛ في الحالتين تعتبر الكتابة مقبولة.
+    """
+    key = key or uuid4().hex
+    if WRITE_OUTBOX.has_pending(path):
+        WRITE_OUTBOX.enqueue(op, path, payload, key)
+        return False
+    try:
+        # علامة المفتاح تُكتب مع التحويل نفسه، فإعادة الكتابة بعد مهلة ضائعة لا تكرر Increment
+        _apply_document_write(_document_from_path(path), op, payload, key if _has_transforms(payload) else None)
+        return True
+    except OUTBOX_PERMANENT_ERRORS as e:
+        logger.error(f"❌ كتابة {path} مرفوضة ولن تُعاد: {e}")
+        WRITE_OUTBOX.enqueue(op, path, payload, key, dead_error=str(e)[:500])
+        return False
+    except Exception as e:
+        logger.warning(f"⚠️ فشلت كتابة {path} مباشرة، حُفظت في طابور الكتابات: {e}")
+        WRITE_OUTBOX.enqueue(op, path, payload, key)
+        return False
+
+
 # تعريف data كـ dictionary فارغ في البداية
 data = {}
 # مؤشر لتتبع مصدر البيانات (Firestore أو ملف محلي)
@@ -182,35 +1138,34 @@ def load_data():
         except Exception as e:
             logger.error(f"❌ خطأ في تحميل المستخدمين من Firestore: {e}")
 
-    # Fallback: التحميل من الملف المحلي
-    if not os.path.exists(DATA_FILE):
-        return {}
+    # Fallback: التحميل من المخزن المحلي
     try:
         DATA_LOADED_FROM_FIRESTORE = False
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        return LOCAL_STORE.load_all()
     except Exception as e:
         logger.error(f"Error loading data: {e}")
         return {}
 
 
-def save_data():
+def save_data(key=None):
     """
-    دالة متوافقة مع الكود القديم - تحفظ جميع المستخدمين في Firestore
+    دالة متوافقة مع الكود القديم - تحفظ المستخدمين في Firestore (أو المخزن المحلي)؛
+    مع key يُحفظ ذلك السجل فقط.
     """
     if not firestore_available():
         # حفظ محلي كـ fallback
-        try:
-            with open(DATA_FILE, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            logger.error(f"خطأ في حفظ البيانات محلياً: {e}")
+        save_data_local(key)
         return
     
     try:
-        # حفظ جميع المستخدمين في Firestore
+        # حفظ جميع المستخدمين (أو المستخدم المحدد) في Firestore
         saved_count = 0
-        for user_id_str, user_data in data.items():
+        debug_enabled = logger.isEnabledFor(logging.DEBUG)
+        if key is not None:
+            items = [(str(key), data[str(key)])] if str(key) in data else []
+        else:
+            items = data.items()
+        for user_id_str, user_data in items:
             # تجاهل المفاتيح غير الرقمية
             if user_id_str.startswith("_") or user_id_str == "GLOBAL_KEY":
                 continue
@@ -220,13 +1175,14 @@ def save_data():
                 doc_ref = db.collection(USERS_COLLECTION).document(user_id_str)
                 doc_ref.set(user_data, merge=True)
                 saved_count += 1
-                logger.info(f"✅ تم حفظ بيانات المستخدم {user_id} في Firestore (عدد الحقول: {len(user_data)})")
+                if debug_enabled:
+                    logger.debug("✅ تم حفظ بيانات المستخدم %s في Firestore (عدد الحقول: %s)", user_id, len(user_data))
             except ValueError:
                 continue
             except Exception as e:
                 logger.error(f"❌ خطأ في حفظ المستخدم {user_id_str}: {e}")
         
-        if saved_count > 0:
+        if saved_count > 0 and key is None:
             logger.info(f"✅ تم حفظ {saved_count} مستخدم في Firestore")
                 
     except Exception as e:
@@ -259,14 +1215,23 @@ def initialize_firebase():
     except Exception as e:
         logger.error(f"❌ خطأ في تهيئة Firebase: {e}")
 
-initialize_firebase()
+# الاتصال يتم في start_bot عبر connect_storage؛ الاستيراد نفسه بلا أي I/O
+db = None
 
-try:
-    db = firestore.client()
-    logger.info("✅ تم الاتصال بـ Firestore بنجاح")
-except Exception as e:
-    logger.error(f"❌ خطأ في الاتصال بـ Firestore: {e}")
-    db = None
+
+def connect_storage():
+    """تهيئة Firebase وإنشاء عميل Firestore مرة واحدة (لا يستبدل عميلاً محقوناً)"""
+    global db
+    if db is not None:
+        return db
+    initialize_firebase()
+    try:
+        db = firestore.client()
+        logger.info("✅ تم الاتصال بـ Firestore بنجاح")
+    except Exception as e:
+        logger.error(f"❌ خطأ في الاتصال بـ Firestore: {e}")
+        db = None
+    return db
 
 
 def firestore_available():
@@ -274,6 +1239,12 @@ def firestore_available():
     return db is not None
 
 
+def set_storage_backend(client):
+    """حقن عميل التخزين: Firestore الحقيقي أو بديل في الذاكرة (tools/fakes.py) لقياس الأداء"""
+    global db
+    db = client
+
+
 def _is_cache_fresh(user_id: str, now: datetime) -> bool:
     """يتحقق من صلاحية الكاش للمستخدم"""
     cached_at = USER_CACHE_TIMESTAMPS.get(user_id)
@@ -286,58 +1257,458 @@ def _remember_cache(user_id: str, record: Dict, fetched_at: datetime):
     """تحديث الكاش المحلي ووقت آخر تحميل"""
     data[user_id] = record
     USER_CACHE_TIMESTAMPS[user_id] = fetched_at
+    if USER_INDEX_READY and user_id.isdigit():
+        _index_user(int(user_id), bool(record.get("is_banned", False)))
+
+
+# =================== سياق التحديث: قراءة سجل المستخدم مرة واحدة ===================
+
+class UpdateScope:
+    """حالة التحديث الجاري في الخيط الحالي"""
+
+    __slots__ = ("update_type", "resolved", "reads", "firestore_reads", "handlers", "ops")
+
+    def __init__(self, update_type: str):
+        self.update_type = update_type
+        self.resolved = set()
+        self.reads = 0
+        self.firestore_reads = 0
+        # تُملأ فقط عند تفعيل METRICS_ENABLED
+        self.handlers: List[str] = []
+        self.ops: Dict[str, int] = {}
+
+
+UPDATE_SCOPE = local()
+RECORD_READ_STATS: Dict[str, Dict] = {}
+RECORD_READ_STATS_LOCK = Lock()
+
+
+def _update_type(update) -> str:
+    """نوع التحديث لتجميع عدد القراءات (message:text، callback_query:COURSES ...)"""
+    if not isinstance(update, Update):
+        return "other"
+    if update.callback_query:
+        match = re.match(r"[A-Za-z]+", update.callback_query.data or "")
+        return f"callback_query:{match.group(0)}" if match else "callback_query"
+    if update.message:
+        return "message:text" if update.message.text else "message:media"
+    for field in ("edited_message", "channel_post", "my_chat_member", "chat_member", "inline_query"):
+        if getattr(update, field, None):
+            return field
+    return "other"
+
+
+def _process_update_scoped(update):
+    """تمرير التحديث للـ Dispatcher داخل نطاق يتشارك فيه كل المعالجين سجل المستخدم"""
+    if not STARTUP_READY.is_set():
+        # المعالجات مسجلة لكن تحميل المستخدمين وفهرس الحظر لم ينته بعد
+        STARTUP_READY.wait(STARTUP_GATE_TIMEOUT_SECONDS)
+    scope = UpdateScope(_update_type(update))
+    UPDATE_SCOPE.current = scope
+    started = _time.perf_counter()
+    try:
+        if isinstance(dispatcher, LaneDispatcher):
+            dispatcher.dispatch_update(update)
+        else:
+            dispatcher.process_update(update)
+    finally:
+        UPDATE_SCOPE.current = None
+        if METRICS_ENABLED:
+            _note_update_duration(update, scope, (_time.perf_counter() - started) * 1000)
+        with RECORD_READ_STATS_LOCK:
+            stats = RECORD_READ_STATS.setdefault(
+                scope.update_type,
+                {"updates": 0, "reads": 0, "firestore_reads": 0, "max_reads": 0},
+            )
+            stats["updates"] += 1
+            stats["reads"] += scope.reads
+            stats["firestore_reads"] += scope.firestore_reads
+            stats["max_reads"] = max(stats["max_reads"], scope.reads)
 
 
-def _throttled_last_active_update(user_id: str, now_iso: str, now_dt: datetime):
-    """تحديث last_active في Firestore مع تقليل عدد الكتابات"""
-    last_write = LAST_ACTIVE_WRITE_TRACKER.get(user_id)
-    if last_write and (now_dt - last_write).total_seconds() < LAST_ACTIVE_UPDATE_INTERVAL_SECONDS:
-        return
+def _scoped_record(user_id: str) -> Optional[Dict]:
+    """يرجع السجل إذا سبق حلّه في التحديث الجاري"""
+    scope = getattr(UPDATE_SCOPE, "current", None)
+    if scope is None:
+        return None
+    scope.reads += 1
+    if user_id in scope.resolved:
+        return data.get(user_id)
+    return None
 
-    LAST_ACTIVE_WRITE_TRACKER[user_id] = now_dt
-    if not firestore_available():
+
+def _mark_record_resolved(user_id: str, from_firestore: bool = False):
+    scope = getattr(UPDATE_SCOPE, "current", None)
+    if scope is None:
         return
+    scope.resolved.add(user_id)
+    if from_firestore:
+        scope.firestore_reads += 1
 
-    try:
-        db.collection(USERS_COLLECTION).document(user_id).update({"last_active": now_iso})
-    except Exception as e:
-        logger.debug("تعذر تحديث آخر نشاط للمستخدم %s: %s", user_id, e)
 
-# المجموعات (Collections) في Firestore
-USERS_COLLECTION = "users"
-TIPS_COLLECTION = "tips"
-NOTES_COLLECTION = "notes"
-GLOBAL_CONFIG_COLLECTION = "global_config"
-# Collections جديدة للمجتمع والمنافسات
-COMMUNITY_BENEFITS_COLLECTION = "community_benefits"
-COMPETITION_POINTS_COLLECTION = "competition_points"
-COMMUNITY_MEDALS_COLLECTION = "community_medals"
-AUDIO_LIBRARY_COLLECTION = "audio_library"
-AUDIO_LIBRARY_FILE = "audio_library.json"
-BOOK_CATEGORIES_COLLECTION = "book_categories"
-BOOKS_COLLECTION = "books"
+def record_read_metrics() -> Dict:
+    with RECORD_READ_STATS_LOCK:
+        snapshot = {name: dict(stats) for name, stats in RECORD_READ_STATS.items()}
+    for stats in snapshot.values():
+        stats["avg_reads"] = stats["reads"] / stats["updates"] if stats["updates"] else 0.0
+    return snapshot
 
 
-# =================== نهاية Firebase ===================
+# =================== قياس عمليات Firestore وTelegram لكل معالج ===================
 
-# =================== دوال التخزين المحلي (Fallback) ===================
+# handler -> {(metric, op): value}
+HANDLER_METRICS: Dict[str, Dict[Tuple[str, str], float]] = defaultdict(lambda: defaultdict(float))
+HANDLER_METRICS_LOCK = Lock()
+HANDLER_CONTEXT = local()
+SLOW_UPDATES = deque(maxlen=SLOW_UPDATE_LOG_SIZE)
 
-def get_user_record_local_by_id(user_id: int) -> Dict:
-    """مساعدة للحصول على سجل محلي بواسطة ID"""
-    uid = str(user_id)
-    if uid not in data:
-        # إنشاء سجل افتراضي
-        data[uid] = {
-            "user_id": user_id,
-            "first_name": "مستخدم",
-            "username": None,
-            "created_at": datetime.now(timezone.utc).isoformat(),
-            "last_active": datetime.now(timezone.utc).isoformat(),
-            "heart_memos": [],
-            "saved_books": [],
-            "saved_books_updated_at": None,
-        }
-    ensure_medal_defaults(data[uid])
+# اسم الدالة في عميل Firestore -> نوع العملية
+FIRESTORE_OP_KINDS = {
+    "get": "read",
+    "get_all": "read",
+    "stream": "query",
+    "set": "write",
+    "update": "write",
+    "add": "write",
+    "create": "write",
+    "delete": "delete",
+    "commit": "commit",
+}
+FIRESTORE_WRAPPED_TYPES = ("Reference", "Query", "Batch", "Transaction")
+
+
+def _current_handler() -> str:
+    stack = getattr(HANDLER_CONTEXT, "stack", None)
+    return stack[-1] if stack else "background"
+
+
+def _record_metric(handler: str, metric: str, op: str = "", seconds: Optional[float] = None, count: float = 1):
+    with HANDLER_METRICS_LOCK:
+        stats = HANDLER_METRICS[handler]
+        stats[(metric, op)] += count
+        if seconds is not None:
+            stats[(metric + "_seconds", op)] += seconds
+    scope = getattr(UPDATE_SCOPE, "current", None)
+    if scope is not None and metric != "handler":
+        key = f"{metric}.{op}" if op else metric
+        scope.ops[key] = scope.ops.get(key, 0) + count
+
+
+def _enter_handler(name: str):
+    stack = getattr(HANDLER_CONTEXT, "stack", None)
+    if stack is None:
+        stack = HANDLER_CONTEXT.stack = []
+    stack.append(name)
+    scope = getattr(UPDATE_SCOPE, "current", None)
+    if scope is not None:
+        scope.handlers.append(name)
+    return _time.perf_counter()
+
+
+def _exit_handler(name: str, started: float):
+    HANDLER_CONTEXT.stack.pop()
+    _record_metric(name, "handler", seconds=_time.perf_counter() - started)
+
+
+def track_handler(func):
+    """نسب عمليات Firestore/Telegram داخل الدالة إليها (بدون أثر عند تعطيل القياس)"""
+    name = getattr(func, "__name__", type(func).__name__)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not METRICS_ENABLED:
+            return func(*args, **kwargs)
+        started = _enter_handler(name)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _exit_handler(name, started)
+
+    wrapper.tracked_handler = True
+    return wrapper
+
+
+def _unwrap_storage(value):
+    if isinstance(value, InstrumentedStorage):
+        return value._target
+    if isinstance(value, list):
+        return [_unwrap_storage(item) for item in value]
+    return value
+
+
+def _wrap_storage(value):
+    if any(part in type(value).__name__ for part in FIRESTORE_WRAPPED_TYPES):
+        return InstrumentedStorage(value)
+    return value
+
+
+def _counted_stream(iterator, kind: str, handler: str, started: float):
+    docs = 0
+    try:
+        for item in iterator:
+            docs += 1
+            yield item
+    finally:
+        _record_metric(handler, "firestore", kind, seconds=_time.perf_counter() - started)
+        _record_metric(handler, "firestore_docs", kind, count=docs)
+
+
+class InstrumentedStorage:
+    """غلاف حول عميل Firestore ومراجعه: يعدّ العمليات ويقيس زمنها للمعالج الجاري"""
+
+    __slots__ = ("_target",)
+
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+        kind = FIRESTORE_OP_KINDS.get(name)
+        target_type = type(self._target).__name__
+        if kind == "read" and name == "get" and not target_type.endswith("DocumentReference"):
+            kind = "query"
+        elif kind in ("write", "delete") and ("Batch" in target_type or "Transaction" in target_type):
+            # الكتابات داخل الدفعة لا تصل للخادم إلا مع commit
+            kind = "batched_" + kind
+
+        def call(*args, **kwargs):
+            args = tuple(_unwrap_storage(arg) for arg in args)
+            if kind is None:
+                return _wrap_storage(attr(*args, **kwargs))
+            handler = _current_handler()
+            started = _time.perf_counter()
+            result = attr(*args, **kwargs)
+            if name in ("stream", "get_all"):
+                return _counted_stream(result, kind, handler, started)
+            _record_metric(handler, "firestore", kind, seconds=_time.perf_counter() - started)
+            if kind == "query" and isinstance(result, list):
+                _record_metric(handler, "firestore_docs", kind, count=len(result))
+            return _wrap_storage(result)
+
+        return call
+
+
+def _instrument_bot(bot_obj):
+    """عدّ استدعاءات Telegram API وزمنها عبر Bot._post"""
+    original = getattr(bot_obj, "_post", None)
+    if original is None or getattr(original, "tracked_handler", False):
+        return
+
+    def _post(endpoint, *args, **kwargs):
+        handler = _current_handler()
+        started = _time.perf_counter()
+        try:
+            return original(endpoint, *args, **kwargs)
+        except Exception:
+            _record_metric(handler, "telegram_errors", endpoint)
+            raise
+        finally:
+            _record_metric(handler, "telegram", endpoint, seconds=_time.perf_counter() - started)
+
+    _post.tracked_handler = True
+    # Bot من PTB يحذر عند إضافة خصائص جديدة؛ الاستبدال هنا مقصود
+    object.__setattr__(bot_obj, "_post", _post)
+
+
+def instrument_runtime():
+    """تفعيل القياس على المعالجات المسجلة وعميل Firestore والبوت"""
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            if not getattr(handler.callback, "tracked_handler", False):
+                handler.callback = track_handler(handler.callback)
+    if db is not None and not isinstance(db, InstrumentedStorage):
+        set_storage_backend(InstrumentedStorage(db))
+    _instrument_bot(dispatcher.bot)
+    logger.info("📏 تم تفعيل قياس عمليات Firestore/Telegram لكل معالج")
+
+
+def _note_update_duration(update, scope: UpdateScope, elapsed_ms: float):
+    _record_metric(scope.update_type, "update", seconds=elapsed_ms / 1000)
+    if elapsed_ms < SLOW_UPDATE_MS:
+        return
+    entry = {
+        "at": datetime.now(timezone.utc).isoformat(),
+        "update_id": getattr(update, "update_id", None),
+        "update_type": scope.update_type,
+        "handlers": scope.handlers,
+        "duration_ms": round(elapsed_ms, 1),
+        "ops": scope.ops,
+    }
+    SLOW_UPDATES.append(entry)
+    logger.warning(
+        "🐢 تحديث بطيء | %s | %.0fms | handlers=%s | ops=%s",
+        scope.update_type,
+        elapsed_ms,
+        ",".join(scope.handlers) or "-",
+        scope.ops,
+    )
+
+
+PROMETHEUS_METRICS = {
+    "handler": ("suqya_handler_calls_total", "counter", "Handler invocations"),
+    "handler_seconds": ("suqya_handler_seconds_total", "counter", "Time spent inside handlers"),
+    "update": ("suqya_updates_total", "counter", "Updates processed per update type"),
+    "update_seconds": ("suqya_update_seconds_total", "counter", "Update processing time per update type"),
+    "firestore": ("suqya_firestore_ops_total", "counter", "Firestore operations per handler"),
+    "firestore_seconds": ("suqya_firestore_seconds_total", "counter", "Firestore time per handler"),
+    "firestore_docs": ("suqya_firestore_docs_total", "counter", "Documents returned by Firestore reads and queries"),
+    "telegram": ("suqya_telegram_calls_total", "counter", "Telegram API calls per handler"),
+    "telegram_seconds": ("suqya_telegram_seconds_total", "counter", "Telegram API time per handler"),
+    "telegram_errors": ("suqya_telegram_errors_total", "counter", "Failed Telegram API calls per handler"),
+}
+PROMETHEUS_OP_LABELS = {"firestore": "op", "firestore_docs": "op", "telegram": "method", "telegram_errors": "method"}
+
+
+def _prometheus_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def prometheus_metrics() -> str:
+    """نص بصيغة Prometheus لمقاييس المعالجات والطوابير"""
+    with HANDLER_METRICS_LOCK:
+        snapshot = {handler: dict(stats) for handler, stats in HANDLER_METRICS.items()}
+
+    samples: Dict[str, List[str]] = defaultdict(list)
+    for handler, stats in sorted(snapshot.items()):
+        for (metric, op), value in sorted(stats.items()):
+            if metric not in PROMETHEUS_METRICS:
+                continue
+            op_label = PROMETHEUS_OP_LABELS.get(metric.replace("_seconds", ""))
+            owner = "update_type" if metric.startswith("update") else "handler"
+            labels = f'{owner}="{_prometheus_label(handler)}"'
+            if op_label and op:
+                labels += f',{op_label}="{_prometheus_label(op)}"'
+            samples[metric].append(f"{PROMETHEUS_METRICS[metric][0]}{{{labels}}} {value:g}")
+
+    lines = []
+    for metric, (name, kind, help_text) in PROMETHEUS_METRICS.items():
+        if samples.get(metric):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(samples[metric])
+
+    queue_stats = update_queue_metrics()
+    timers = TIMER_WHEEL.metrics()
+    outbox = WRITE_OUTBOX.metrics()
+    startup = startup_metrics()
+    for name, help_text, value in (
+        ("suqya_update_queue_depth", "Updates waiting in the webhook lanes", queue_stats["depth"]),
+        ("suqya_update_queue_capacity", "Total capacity of the webhook lanes", queue_stats["capacity"]),
+        ("suqya_update_queue_last_lag_ms", "Queue lag of the last processed update", queue_stats["last_lag_ms"]),
+        ("suqya_update_queue_max_lag_ms", "Worst queue lag since start", queue_stats["max_lag_ms"]),
+        ("suqya_timers_pending", "Pending timers on the timer wheel", timers["pending"]),
+        ("suqya_outbox_depth", "Firestore writes waiting in the local outbox", outbox["depth"]),
+        ("suqya_outbox_dead", "Outbox writes that gave up after OUTBOX_MAX_ATTEMPTS", outbox["dead"]),
+        ("suqya_startup_ready", "1 once users, bans and settings are loaded", 1 if startup["ready"] else 0),
+    ):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value:g}")
+    for name, kind, help_text, label, values in (
+        ("suqya_update_queue_lane_depth", "gauge", "Updates waiting per lane", "lane",
+         dict(enumerate(queue_stats["depth_per_worker"]))),
+        ("suqya_update_queue_events_total", "counter", "Webhook updates per queue outcome", "event",
+         {event: queue_stats[event] for event in ("enqueued", "processed", "rejected", "failed")}),
+        ("suqya_timers_pending_by_kind", "gauge", "Pending timers per kind", "kind", timers["pending_by_kind"]),
+        ("suqya_timers_total", "counter", "Timers fired or cancelled", "event",
+         {"fired": timers["fired"], "cancelled": timers["cancelled"]}),
+        ("suqya_startup_phase_ms", "gauge", "Duration of each startup phase", "phase", startup["phases_ms"]),
+    ):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for key, value in sorted(values.items()):
+            lines.append(f'{name}{{{label}="{_prometheus_label(key)}"}} {value:g}')
+    lines.append("# HELP suqya_update_queue_lag_ms_total Sum of queue lag over processed updates")
+    lines.append("# TYPE suqya_update_queue_lag_ms_total counter")
+    lines.append(f"suqya_update_queue_lag_ms_total {queue_stats['total_lag_ms']:g}")
+
+    routes = text_route_metrics()
+    reads = record_read_metrics()
+    for name, kind, help_text, label, source, field, scale in (
+        ("suqya_text_route_calls_total", "counter", "Text messages per route", "route", routes, "count", 1),
+        ("suqya_text_route_seconds_total", "counter", "Time spent per text route", "route", routes, "total_ms", 0.001),
+        ("suqya_text_route_max_seconds", "gauge", "Slowest call per text route", "route", routes, "max_ms", 0.001),
+        ("suqya_record_read_updates_total", "counter", "Updates per type seen by the record cache", "update_type", reads, "updates", 1),
+        ("suqya_record_reads_total", "counter", "get_user_record calls per update type", "update_type", reads, "reads", 1),
+        ("suqya_record_firestore_reads_total", "counter", "User record reads that reached Firestore", "update_type", reads, "firestore_reads", 1),
+        ("suqya_record_reads_max", "gauge", "Most user record reads in one update", "update_type", reads, "max_reads", 1),
+    ):
+        if not source:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for key, stats in sorted(source.items()):
+            lines.append(f'{name}{{{label}="{_prometheus_label(key)}"}} {stats[field] * scale:g}')
+    lines.append("# HELP suqya_log_dropped_total Log records dropped by sampling, repeat limit or a full log queue")
+    lines.append("# TYPE suqya_log_dropped_total counter")
+    for reason, value in sorted(LOG_FILTER.dropped_snapshot().items()):
+        lines.append(f'suqya_log_dropped_total{{reason="{reason}"}} {value:g}')
+    for name, help_text, value in (
+        ("suqya_outbox_replayed_total", "Outbox writes replayed to Firestore", outbox["replayed"]),
+        ("suqya_outbox_retries_total", "Failed outbox replay attempts", outbox["retries"]),
+    ):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name} {value:g}")
+    return "\n".join(lines) + "\n"
+
+
+def slow_update_log() -> List[Dict]:
+    return list(SLOW_UPDATES)
+
+
+def _throttled_last_active_update(user_id: str, now_iso: str, now_dt: datetime):
+    """تحديث last_active في Firestore مع تقليل عدد الكتابات"""
+    last_write = LAST_ACTIVE_WRITE_TRACKER.get(user_id)
+    if last_write and (now_dt - last_write).total_seconds() < LAST_ACTIVE_UPDATE_INTERVAL_SECONDS:
+        return
+
+    LAST_ACTIVE_WRITE_TRACKER[user_id] = now_dt
+    if not firestore_available():
+        return
+
+    try:
+        db.collection(USERS_COLLECTION).document(user_id).update({"last_active": now_iso})
+    except Exception as e:
+        logger.debug("تعذر تحديث آخر نشاط للمستخدم %s: %s", user_id, e)
+
+# المجموعات (Collections) في Firestore
+USERS_COLLECTION = "users"
+TIPS_COLLECTION = "tips"
+NOTES_COLLECTION = "notes"
+GLOBAL_CONFIG_COLLECTION = "global_config"
+# Collections جديدة للمجتمع والمنافسات
+COMMUNITY_BENEFITS_COLLECTION = "community_benefits"
+COMPETITION_POINTS_COLLECTION = "competition_points"
+COMMUNITY_MEDALS_COLLECTION = "community_medals"
+AUDIO_LIBRARY_COLLECTION = "audio_library"
+AUDIO_LIBRARY_FILE = "audio_library.json"
+BOOK_CATEGORIES_COLLECTION = "book_categories"
+BOOKS_COLLECTION = "books"
+
+
+# =================== نهاية Firebase ===================
+
+# =================== دوال التخزين المحلي (Fallback) ===================
+
+def get_user_record_local_by_id(user_id: int) -> Dict:
+    """مساعدة للحصول على سجل محلي بواسطة ID"""
+    uid = str(user_id)
+    if uid not in data:
+        # إنشاء سجل افتراضي
+        data[uid] = {
+            "user_id": user_id,
+            "first_name": "مستخدم",
+            "username": None,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "last_active": datetime.now(timezone.utc).isoformat(),
+            "heart_memos": [],
+            "saved_books": [],
+            "saved_books_updated_at": None,
+        }
+    ensure_medal_defaults(data[uid])
     return data[uid]
 
 
@@ -460,6 +1831,8 @@ def get_user_record_local(user: User) -> Dict:
             "course_full_name": None,
             "motivation_on": True,
         }
+        if USER_INDEX_READY:
+            _index_user(user.id, False)
     else:
         record = data[user_id]
         record["first_name"] = user.first_name
@@ -496,8 +1869,8 @@ def get_user_record_local(user: User) -> Dict:
             if field not in record:
                 record[field] = default_value
 
-    ensure_medal_defaults(record)
-    save_data_local()
+    ensure_medal_defaults(data[user_id])
+    save_data_local(user_id)
     return data[user_id]
 
 
@@ -509,7 +1882,7 @@ def update_user_record_local(user_id: int, **kwargs):
     
     data[uid].update(kwargs)
     data[uid]["last_active"] = datetime.now(timezone.utc).isoformat()
-    save_data_local()
+    save_data_local(uid)
 
 
 def get_all_user_ids_local() -> List[int]:
@@ -607,6 +1980,9 @@ DEFAULT_MOTIVATION_MESSAGES = [
 
 GLOBAL_KEY = "_global_config"
 
+TIME_OF_DAY_PATTERN = re.compile(r"^(\d{1,2}):(\d{2})$")
+
+
 def _time_to_minutes(time_str: str) -> int:
     try:
         parts = time_str.split(":")
@@ -626,7 +2002,7 @@ def _normalize_times(raw_times, fallback: List[str]) -> List[str]:
             hour = t
             minute = 0
         elif isinstance(t, str):
-            match = re.match(r"^(\d{1,2}):(\d{2})$", t.strip())
+            match = TIME_OF_DAY_PATTERN.match(t.strip())
             if match:
                 hour = int(match.group(1))
                 minute = int(match.group(2))
@@ -637,36 +2013,143 @@ def _normalize_times(raw_times, fallback: List[str]) -> List[str]:
         if 0 <= hour <= 23 and 0 <= minute <= 59:
             times.append(f"{hour:02d}:{minute:02d}")
 
-    normalized = sorted(set(times), key=_time_to_minutes)
+    # الصيغة HH:MM بأصفار بادئة، فالترتيب النصي هو نفسه الترتيب الزمني
+    normalized = sorted(set(times))
     return normalized or fallback
 
 
-MOTIVATION_TIMES_UTC = []
-MOTIVATION_MESSAGES = []
+# القيم الافتراضية حتى تُحمّل الإعدادات العامة عند بدء التشغيل؛ تُستبدل (لا تُعدّل) عند كل تغيير
+MOTIVATION_TIMES_UTC = DEFAULT_MOTIVATION_TIMES_UTC.copy()
+MOTIVATION_MESSAGES = DEFAULT_MOTIVATION_MESSAGES.copy()
 
 
-def get_global_config():
-    """
-    يرجع (أو ينشئ) الإعدادات العامة للبوت (مثل أوقات الجرعة التحفيزية ورسائلها).
-    تُخزَّن تحت مفتاح خاص في نفس ملف JSON.
-    """
-    cfg = {}
-    changed = False
+# =================== خدمة الإعدادات العامة ===================
 
-    # حاول القراءة من Firestore أولاً
-    if firestore_available():
+
+class ConfigSnapshot(NamedTuple):
+    """نسخة ثابتة من global_config/config؛ تُستبدل كاملة عند التغيير فتُقرأ بلا قفل"""
+
+    version: int
+    data: Mapping
+    loaded_at: float
+
+
+# None حتى أول تحميل؛ القراءة عبر current_config()
+CONFIG_SNAPSHOT: Optional[ConfigSnapshot] = None
+CONFIG_SUBSCRIBERS: List[Callable[[ConfigSnapshot], None]] = []
+CONFIG_REFRESH_LOCK = Lock()
+CONFIG_WATCH = None
+
+
+def _freeze_config(value):
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze_config(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze_config(v) for v in value)
+    return value
+
+
+def _thaw_config(value):
+    if isinstance(value, Mapping):
+        return {k: _thaw_config(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [_thaw_config(v) for v in value]
+    return value
+
+
+def subscribe_config(callback: Callable[[ConfigSnapshot], None]):
+    """تسجيل دالة تُستدعى مع كل نسخة جديدة من الإعدادات (وفوراً إن كانت محملة)"""
+    CONFIG_SUBSCRIBERS.append(callback)
+    if CONFIG_SNAPSHOT is not None:
+        callback(CONFIG_SNAPSHOT)
+
+
+def current_config() -> ConfigSnapshot:
+    """النسخة الحالية من الإعدادات (تُحمّل مرة واحدة عند أول طلب)"""
+    snapshot = CONFIG_SNAPSHOT
+    if snapshot is None:
+        snapshot = refresh_config()
+    return snapshot
+
+
+def _publish_config(cfg: Dict, version: Optional[int] = None) -> ConfigSnapshot:
+    global CONFIG_SNAPSHOT
+    if version is None:
+        version = int(cfg.get("version", 0) or 0)
+    frozen = _freeze_config({k: v for k, v in cfg.items() if k != "version"})
+    previous = CONFIG_SNAPSHOT
+    if previous is not None and previous.version == version and previous.data == frozen:
+        return previous
+    snapshot = ConfigSnapshot(version, frozen, _time.time())
+    CONFIG_SNAPSHOT = snapshot
+    for callback in list(CONFIG_SUBSCRIBERS):
         try:
-            doc_ref = db.collection(GLOBAL_CONFIG_COLLECTION).document("config")
-            doc = doc_ref.get()
-            if doc.exists:
-                cfg = doc.to_dict() or {}
+            callback(snapshot)
         except Exception as e:
-            logger.error(f"❌ خطأ في قراءة الإعدادات العامة من Firestore: {e}")
+            logger.error(f"❌ خطأ في تطبيق الإعدادات العامة الجديدة: {e}")
+    if previous is not None:
+        logger.info("🔄 تم تحديث الإعدادات العامة (version %s → %s)", previous.version, version)
+    return snapshot
 
-    # fallback إلى البيانات المحملة محليًا
-    if not cfg:
-        cfg = data.get(GLOBAL_KEY)
 
+def refresh_config() -> ConfigSnapshot:
+    """قراءة الإعدادات من المصدر ونشرها للمشتركين"""
+    with CONFIG_REFRESH_LOCK:
+        return _publish_config(_fetch_global_config())
+
+
+def _on_config_snapshot(doc_snapshots, changes, read_time):
+    # يُستدعى من خيط مستمع Firestore عند أي تغيير في وثيقة الإعدادات
+    for doc in doc_snapshots:
+        if doc.exists:
+            with CONFIG_REFRESH_LOCK:
+                _publish_config(_with_config_defaults(doc.to_dict() or {})[0])
+
+
+def _poll_config_version(context: CallbackContext = None):
+    """قراءة حقل version فقط؛ القراءة الكاملة عند اختلافه"""
+    if not firestore_available():
+        return
+    try:
+        doc = db.collection(GLOBAL_CONFIG_COLLECTION).document("config").get(field_paths=["version"])
+        version = int(((doc.to_dict() or {}) if doc.exists else {}).get("version", 0) or 0)
+    except Exception as e:
+        logger.warning("⚠️ تعذر فحص نسخة الإعدادات العامة: %s", e)
+        return
+    snapshot = CONFIG_SNAPSHOT
+    if snapshot is None or snapshot.version != version:
+        refresh_config()
+
+
+def start_config_service():
+    """تحميل الإعدادات ثم متابعة تغيّرها (مستمع Firestore، أو فحص دوري للنسخة)"""
+    global CONFIG_WATCH
+    refresh_config()
+    if CONFIG_REFRESH_MODE == "off" or not firestore_available() or CONFIG_WATCH is not None:
+        return
+    if CONFIG_REFRESH_MODE == "listener":
+        try:
+            CONFIG_WATCH = (
+                db.collection(GLOBAL_CONFIG_COLLECTION).document("config").on_snapshot(_on_config_snapshot)
+            )
+            logger.info("✅ متابعة الإعدادات العامة عبر مستمع Firestore")
+            return
+        except Exception as e:
+            logger.warning("⚠️ تعذر تشغيل مستمع الإعدادات، سيتم الفحص الدوري بدلاً منه: %s", e)
+    if job_queue is not None:
+        CONFIG_WATCH = job_queue.run_repeating(
+            _poll_config_version,
+            interval=CONFIG_POLL_SECONDS,
+            first=CONFIG_POLL_SECONDS,
+            name="config_version_poll",
+            job_kwargs={"misfire_grace_time": max(1, int(CONFIG_POLL_SECONDS)), "coalesce": True},
+        )
+        logger.info("✅ فحص نسخة الإعدادات العامة كل %.0f ثانية", CONFIG_POLL_SECONDS)
+
+
+def _with_config_defaults(cfg: Optional[Dict]) -> Tuple[Dict, bool]:
+    """إكمال الحقول الناقصة بالقيم الافتراضية؛ يرجع (الإعدادات، هل تغيرت)"""
+    changed = False
     if not cfg or not isinstance(cfg, dict):
         cfg = {}
         changed = True
@@ -686,31 +2169,103 @@ def get_global_config():
         cfg["benefits"] = []
         changed = True
 
+    return cfg, changed
+
+
+def get_global_config():
+    """
+    يرجع نسخة قابلة للتعديل من الإعدادات العامة للبوت (مثل أوقات الجرعة التحفيزية ورسائلها)
+    من اللقطة المحملة، بدون قراءة Firestore في كل استدعاء.
+    """
+    return _thaw_config(current_config().data)
+
+
+def _fetch_global_config():
+    """
+    يقرأ (أو ينشئ) الإعدادات العامة من Firestore،
+    أو من مفتاح خاص في نفس ملف JSON عند عدم توفره.
+    """
+    cfg = {}
+    changed = False
+
+    # حاول القراءة من Firestore أولاً
+    if firestore_available():
+        try:
+            doc_ref = db.collection(GLOBAL_CONFIG_COLLECTION).document("config")
+            doc = doc_ref.get()
+            if doc.exists:
+                cfg = doc.to_dict() or {}
+        except Exception as e:
+            logger.error(f"❌ خطأ في قراءة الإعدادات العامة من Firestore: {e}")
+
+    # fallback إلى البيانات المحملة محليًا (أو المخزن المحلي إن لم تُحمّل بعد؛ المرحلتان تعملان بالتوازي)
+    if not cfg:
+        cfg = data.get(GLOBAL_KEY)
+    if not cfg and not firestore_available():
+        try:
+            cfg = LOCAL_STORE.get(GLOBAL_KEY)
+        except Exception as e:
+            logger.error(f"❌ خطأ في قراءة الإعدادات العامة من المخزن المحلي: {e}")
+
+    cfg, changed = _with_config_defaults(cfg)
     data[GLOBAL_KEY] = cfg
 
     if changed:
-        save_global_config(cfg)
+        version = save_global_config(cfg, publish=False)
+        if version is not None and firestore_available():
+            cfg["version"] = version
 
     return cfg
 
 
-def save_global_config(cfg: Dict):
-    """حفظ الإعدادات العامة في Firestore أو محليًا عند عدم توفره"""
+@firestore.transactional
+def _save_config_transaction(transaction, doc_ref, cfg: Dict) -> int:
+    """كتابة الإعدادات مع version = المخزنة + 1، فتطابق النسخة المنشورة محلياً ما تقرؤه النسخ الأخرى"""
+    snap = doc_ref.get(transaction=transaction)
+    version = int(((snap.to_dict() or {}) if snap.exists else {}).get("version", 0) or 0) + 1
+    transaction.set(doc_ref, dict(cfg, version=version), merge=True)
+    return version
+
+
+def save_global_config(cfg: Dict, publish: bool = True) -> Optional[int]:
+    """حفظ الإعدادات العامة في Firestore (مع زيادة version) أو محليًا عند عدم توفره؛ يرجع النسخة الجديدة (None إذا فشل الحفظ)"""
+    cfg = {k: v for k, v in cfg.items() if k != "version"}
     data[GLOBAL_KEY] = cfg
+    version = (CONFIG_SNAPSHOT.version if CONFIG_SNAPSHOT else 0) + 1
 
     if firestore_available():
         try:
-            db.collection(GLOBAL_CONFIG_COLLECTION).document("config").set(cfg, merge=True)
-            logger.info("✅ تم حفظ الإعدادات العامة في Firestore")
+            doc_ref = db.collection(GLOBAL_CONFIG_COLLECTION).document("config")
+            version = _save_config_transaction(db.transaction(), doc_ref, cfg)
+            logger.info("✅ تم حفظ الإعدادات العامة في Firestore (version %s)", version)
         except Exception as e:
             logger.error(f"❌ خطأ في حفظ الإعدادات العامة في Firestore: {e}")
+            # النسخة المخزنة غير معروفة، فلا تُنشر نسخة مخمنة قد تخالف ما يقرؤه المستمع/الفحص الدوري
+            return None
     else:
-        save_data()
+        save_data(GLOBAL_KEY)
+
+    if publish:
+        with CONFIG_REFRESH_LOCK:
+            _publish_config(cfg, version)
+    return version
+
+
+def update_global_config(**changes):
+    """تعديل حقول من الإعدادات العامة انطلاقاً من اللقطة الحالية ثم حفظها ونشرها"""
+    cfg = get_global_config()
+    cfg.update(changes)
+    save_global_config(cfg)
+
+
+def _apply_motivation_config(snapshot: ConfigSnapshot):
+    """أوقات ورسائل الجرعة التحفيزية: قوائم جديدة تُستبدل كاملة (القراءة بلا قفل)"""
+    global MOTIVATION_TIMES_UTC, MOTIVATION_MESSAGES
+    MOTIVATION_TIMES_UTC = list(snapshot.data["motivation_times"])
+    MOTIVATION_MESSAGES = list(snapshot.data["motivation_messages"])
 
 
-_global_cfg = get_global_config()
-MOTIVATION_TIMES_UTC = _global_cfg["motivation_times"]
-MOTIVATION_MESSAGES = _global_cfg["motivation_messages"]
+subscribe_config(_apply_motivation_config)
 
 
 # =================== نصوص الأذكار ===================
@@ -936,6 +2491,51 @@ def get_benefits():
     """يرجع قائمة الفوائد من Firestore أو الإعدادات العامة"""
     return get_benefits_from_firestore()
 
+
+def get_benefit_by_id(benefit_id: int) -> Optional[Dict]:
+    """جلب فائدة واحدة بالرقم بدل قراءة كل الفوائد"""
+    if not firestore_available():
+        return next((b for b in get_benefits() if b.get("id") == benefit_id), None)
+
+    try:
+        docs = (
+            db.collection(COMMUNITY_BENEFITS_COLLECTION)
+            .where("id", "==", benefit_id)
+            .limit(1)
+            .stream()
+        )
+        for doc in docs:
+            benefit_data = doc.to_dict()
+            benefit_data["firestore_id"] = doc.id
+            return benefit_data
+    except Exception as e:
+        logger.error(f"❌ خطأ في قراءة الفائدة {benefit_id} من Firestore: {e}")
+    return None
+
+
+def get_top_benefits(limit: int) -> List[Dict]:
+    """أعلى الفوائد إعجاباً مرتبة تنازلياً (استعلام محدود بدل فرز كل الفوائد)"""
+    if not firestore_available():
+        benefits = get_benefits()
+        return sorted(benefits, key=lambda b: b.get("likes_count", 0), reverse=True)[:limit]
+
+    try:
+        docs = (
+            db.collection(COMMUNITY_BENEFITS_COLLECTION)
+            .order_by("likes_count", direction=firestore.Query.DESCENDING)
+            .limit(limit)
+            .stream()
+        )
+        benefits = []
+        for doc in docs:
+            benefit_data = doc.to_dict()
+            benefit_data["firestore_id"] = doc.id
+            benefits.append(benefit_data)
+        return benefits
+    except Exception as e:
+        logger.error(f"❌ خطأ في قراءة أفضل الفوائد من Firestore: {e}")
+        return []
+
 def save_benefits(benefits_list):
     """حفظ قائمة الفوائد - يتم الحفظ في Firestore مباشرة"""
     if not firestore_available():
@@ -964,21 +2564,33 @@ def get_user_record(user, update_last_active: bool = True):
     ينشئ أو يرجع سجل المستخدم من Firestore
     """
     user_id = str(user.id)
+
+    # داخل نفس التحديث: السجل المحلول أول مرة يُشارك مع باقي المعالجين
+    scoped_record = _scoped_record(user_id)
+    if scoped_record is not None:
+        return scoped_record
+
     now_dt = datetime.now(timezone.utc)
     now_iso = now_dt.isoformat()
 
     # محاولة استخدام الكاش لتجنب قراءات Firestore المتكررة في نفس الجلسة
     cached_record = data.get(user_id)
-    if cached_record and _is_cache_fresh(user_id, now_dt):
+    # السجل المحلي هو الأحدث ما دامت له كتابات في الطابور لم تصل Firestore بعد
+    if cached_record and (
+        _is_cache_fresh(user_id, now_dt) or WRITE_OUTBOX.has_pending(f"{USERS_COLLECTION}/{user_id}")
+    ):
         cached_record["last_active"] = now_iso
         if update_last_active:
             _throttled_last_active_update(user_id, now_iso, now_dt)
         ensure_medal_defaults(cached_record)
+        _mark_record_resolved(user_id)
         return cached_record
     
     if not firestore_available():
         logger.warning("Firestore غير متوفر، استخدام التخزين المحلي")
-        return get_user_record_local(user)
+        record = get_user_record_local(user)
+        _mark_record_resolved(user_id)
+        return record
     
     try:
         # قراءة من Firestore
@@ -1007,7 +2619,11 @@ def get_user_record(user, update_last_active: bool = True):
             # إضافة المستخدم إلى data المحلي
             ensure_medal_defaults(record)
             _remember_cache(user_id, record, now_dt)
+            _mark_record_resolved(user_id, from_firestore=True)
             logger.debug("قراءة بيانات المستخدم %s من Firestore", user_id)
+            # نقاط مُنحت والسجل غير مخزن: المستوى يُحسب الآن بدل قراءة إضافية وقت المنح
+            if int(record.get("points", 0) or 0) // 20 > (record.get("level", 0) or 0):
+                update_level_and_medals(int(user_id), record)
             return record
         else:
             # إنشاء سجل جديد
@@ -1044,6 +2660,7 @@ def get_user_record(user, update_last_active: bool = True):
             # إضافة المستخدم إلى data المحلي
             ensure_medal_defaults(new_record)
             _remember_cache(user_id, new_record, now_dt)
+            _mark_record_resolved(user_id, from_firestore=True)
             logger.info(f"✅ تم إنشاء مستخدم جديد {user_id} في Firestore")
             return new_record
             
@@ -1061,21 +2678,19 @@ def update_user_record(user_id: int, **kwargs):
         return update_user_record_local(user_id, **kwargs)
     
     try:
-        doc_ref = db.collection(USERS_COLLECTION).document(user_id_str)
-        
         # إضافة last_active تلقائياً
         kwargs["last_active"] = datetime.now(timezone.utc).isoformat()
         
-        # تحديث في Firestore
-        doc_ref.update(kwargs)
+        # تحديث في Firestore (أو في طابور الكتابات عند الفشل؛ يُعاد لاحقاً بالترتيب)
+        written = write_through_outbox("update", f"{USERS_COLLECTION}/{user_id_str}", kwargs)
 
         # تحديث data المحلي أيضاً
         if user_id_str in data:
             data[user_id_str].update(kwargs)
             _remember_cache(user_id_str, data[user_id_str], datetime.now(timezone.utc))
-        else:
+        elif written:
             # إذا لم يكن في data، قراءته من Firestore
-            doc = doc_ref.get()
+            doc = db.collection(USERS_COLLECTION).document(user_id_str).get()
             if doc.exists:
                 _remember_cache(user_id_str, doc.to_dict(), datetime.now(timezone.utc))
 
@@ -1094,14 +2709,100 @@ def get_all_user_ids():
 
 def get_active_user_ids():
     """يرجع قائمة المستخدمين النشطين (غير المحظورين)"""
-    return [int(uid) for uid, rec in data.items() 
-            if uid != GLOBAL_KEY and not rec.get("is_banned", False)]
+    if not USER_INDEX_READY:
+        rebuild_user_index()
+    with USER_INDEX_LOCK:
+        return list(ACTIVE_USER_IDS)
 
 
 def get_banned_user_ids():
     """يرجع قائمة المستخدمين المحظورين"""
-    return [int(uid) for uid, rec in data.items() 
-            if uid != GLOBAL_KEY and rec.get("is_banned", False)]
+    if not USER_INDEX_READY:
+        rebuild_user_index()
+    with USER_INDEX_LOCK:
+        return sorted(BANNED_USER_IDS)
+
+
+# =================== فهرس المحظورين والمستخدمين النشطين ===================
+
+# يُبنى مرة واحدة من data ثم يُحدَّث عند الحظر/فك الحظر وعند ظهور مستخدم جديد
+BANNED_USER_IDS = set()
+ACTIVE_USER_IDS: List[int] = []  # مرتبة تصاعدياً
+USER_INDEX_LOCK = Lock()
+USER_INDEX_READY = False
+
+
+def rebuild_user_index():
+    global USER_INDEX_READY
+    banned = set()
+    active = []
+    for uid, rec in list(data.items()):
+        if uid == GLOBAL_KEY or not str(uid).isdigit():
+            continue
+        if (rec or {}).get("is_banned", False):
+            banned.add(int(uid))
+        else:
+            active.append(int(uid))
+    active.sort()
+    with USER_INDEX_LOCK:
+        BANNED_USER_IDS.clear()
+        BANNED_USER_IDS.update(banned)
+        ACTIVE_USER_IDS[:] = active
+        USER_INDEX_READY = True
+    logger.info("✅ فهرس المستخدمين: %s نشط، %s محظور", len(active), len(banned))
+
+
+def _index_user(user_id: int, banned: bool):
+    """تحديث حالة مستخدم واحد في الفهرس"""
+    with USER_INDEX_LOCK:
+        pos = bisect.bisect_left(ACTIVE_USER_IDS, user_id)
+        listed = pos < len(ACTIVE_USER_IDS) and ACTIVE_USER_IDS[pos] == user_id
+        if banned:
+            BANNED_USER_IDS.add(user_id)
+            if listed:
+                del ACTIVE_USER_IDS[pos]
+        else:
+            BANNED_USER_IDS.discard(user_id)
+            if not listed:
+                ACTIVE_USER_IDS.insert(pos, user_id)
+
+
+def is_user_banned(user_id: int) -> bool:
+    return user_id in BANNED_USER_IDS
+
+
+def set_user_ban(user_id: int, **ban_fields):
+    """كتابة حقول الحظر وحدها (بدون last_active: الحظر ليس نشاطاً للمستخدم) ثم تحديث الفهرس"""
+    uid = str(user_id)
+    record = data.get(uid)
+    if record is not None:
+        record.update(ban_fields)
+    if firestore_available():
+        write_through_outbox("update", f"{USERS_COLLECTION}/{uid}", ban_fields)
+    elif record is not None:
+        save_data_local(uid)
+    _index_user(user_id, bool(ban_fields.get("is_banned")))
+
+
+def _drop_banned_updates(update: Update, context: CallbackContext):
+    """إسقاط تحديثات المحظورين قبل أي معالج (عدا /start والرد على رسائل الدعم)"""
+    user = update.effective_user
+    if user is None or user.id not in BANNED_USER_IDS:
+        return
+
+    msg = update.message
+    if msg is not None:
+        if (msg.text or "").strip().startswith("/start"):
+            return
+        reply = msg.reply_to_message
+        if reply and reply.from_user and reply.from_user.id == context.bot.id:
+            return
+    if update.callback_query:
+        try:
+            update.callback_query.answer()
+        except Exception:
+            pass
+    raise DispatcherHandlerStop()
 
 
 def is_admin(user_id: int) -> bool:
@@ -1111,56 +2812,362 @@ def is_admin(user_id: int) -> bool:
 def is_supervisor(user_id: int) -> bool:
     return SUPERVISOR_ID is not None and user_id == SUPERVISOR_ID
 
-# =================== حالات الإدخال ===================
+# =================== مخزن جلسات المستخدمين ===================
 
+# كل حالات الإدخال متعددة الخطوات لمستخدم واحد محفوظة في كائن جلسة واحد
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", 6 * 3600))
+SESSION_SWEEP_SECONDS = int(os.getenv("SESSION_SWEEP_SECONDS", 60))
+SESSION_STORE_FILE = os.getenv("SESSION_STORE_FILE", "")  # فارغ = بدون حفظ على القرص
 
 
-WAITING_QURAN_GOAL = set()
-WAITING_QURAN_ADD_PAGES = set()
+class UserSession:
+    __slots__ = ("states", "payload", "touched_at")
 
-WAITING_TASBIH = set()
-ACTIVE_TASBIH = {}      # user_id -> { "text": str, "target": int, "current": int }
+    def __init__(self):
+        self.states = set()
+        self.payload = {}
+        self.touched_at = _time.monotonic()
 
-# مكتبة الكتب
-WAITING_BOOK_SEARCH = set()
-WAITING_BOOK_CATEGORY_NAME = set()
-WAITING_BOOK_CATEGORY_ORDER = set()
-WAITING_BOOK_ADD_CATEGORY = set()
-WAITING_BOOK_ADD_TITLE = set()
-WAITING_BOOK_ADD_AUTHOR = set()
-WAITING_BOOK_ADD_DESCRIPTION = set()
-WAITING_BOOK_ADD_TAGS = set()
-WAITING_BOOK_ADD_COVER = set()
-WAITING_BOOK_ADD_PDF = set()
-WAITING_BOOK_EDIT_FIELD = set()
-WAITING_BOOK_EDIT_COVER = set()
-WAITING_BOOK_EDIT_PDF = set()
-WAITING_BOOK_ADMIN_SEARCH = set()
-BOOK_CREATION_CONTEXT: Dict[int, Dict] = {}
-BOOK_CATEGORY_EDIT_CONTEXT: Dict[int, Dict] = {}
-BOOK_EDIT_CONTEXT: Dict[int, Dict] = {}
-BOOK_SEARCH_CACHE: Dict[str, Dict] = {}
-BOOK_NAV_CACHE: Dict[str, Dict] = {}
+
+USER_SESSIONS: Dict[int, UserSession] = {}
+SESSION_LOCK = Lock()
+SESSION_LAST_SWEEP = [_time.monotonic()]
+
+
+def _session_for_write(user_id) -> UserSession:
+    session = USER_SESSIONS.get(user_id)
+    if session is None:
+        with SESSION_LOCK:
+            session = USER_SESSIONS.setdefault(user_id, UserSession())
+    now = _time.monotonic()
+    session.touched_at = now
+    if now - SESSION_LAST_SWEEP[0] >= SESSION_SWEEP_SECONDS:
+        SESSION_LAST_SWEEP[0] = now
+        run_after_response(sweep_user_sessions)
+    return session
+
+
+def _session_for_read(user_id) -> Optional[UserSession]:
+    """الجلسة بدون إنشائها؛ القراءة أيضاً تمدد مهلة SESSION_TTL_SECONDS"""
+    session = USER_SESSIONS.get(user_id)
+    if session is not None:
+        session.touched_at = _time.monotonic()
+    return session
+
+
+def _drop_session_if_empty(user_id, session: UserSession):
+    if not session.states and not session.payload:
+        with SESSION_LOCK:
+            if USER_SESSIONS.get(user_id) is session and not session.states and not session.payload:
+                del USER_SESSIONS[user_id]
+
+
+def user_states(user_id) -> frozenset:
+    """حالات الانتظار النشطة للمستخدم (أسماء WAITING_*)"""
+    session = _session_for_read(user_id)
+    return frozenset(session.states) if session is not None else frozenset()
+
+
+def clear_user_session(user_id):
+    """إنهاء كل التدفقات الجارية للمستخدم دفعة واحدة"""
+    with SESSION_LOCK:
+        USER_SESSIONS.pop(user_id, None)
+
+
+def reset_user_states(user_id, names):
+    """إزالة مجموعة من الحالات (وبياناتها) للمستخدم في استدعاء واحد"""
+    session = USER_SESSIONS.get(user_id)
+    if session is None:
+        return
+    session.states.difference_update(names)
+    for name in names:
+        session.payload.pop(name, None)
+    _drop_session_if_empty(user_id, session)
+
+
+def sweep_user_sessions():
+    """حذف الجلسات المهجورة بعد SESSION_TTL_SECONDS ثم حفظ الباقي إن كان الحفظ مفعلاً"""
+    cutoff = _time.monotonic() - SESSION_TTL_SECONDS
+    with SESSION_LOCK:
+        expired = [uid for uid, session in USER_SESSIONS.items() if session.touched_at < cutoff]
+        for uid in expired:
+            del USER_SESSIONS[uid]
+    if expired:
+        logger.info("🧹 تم حذف %s جلسة مستخدم منتهية", len(expired))
+    if SESSION_STORE_FILE:
+        save_user_sessions()
+
+
+def save_user_sessions():
+    snapshot = {}
+    with SESSION_LOCK:
+        items = list(USER_SESSIONS.items())
+    for uid, session in items:
+        payload = {}
+        for name, value in list(session.payload.items()):
+            try:
+                json.dumps(value)
+            except (TypeError, ValueError):
+                # مراجع Firestore ومهام JobQueue لا تُحفظ
+                continue
+            payload[name] = value
+        snapshot[str(uid)] = {"states": sorted(session.states), "payload": payload}
+    try:
+        tmp_path = SESSION_STORE_FILE + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+        os.replace(tmp_path, SESSION_STORE_FILE)
+    except Exception as e:
+        logger.error(f"❌ خطأ في حفظ جلسات المستخدمين: {e}")
+
+
+def load_user_sessions():
+    if not SESSION_STORE_FILE or not os.path.exists(SESSION_STORE_FILE):
+        return
+    try:
+        with open(SESSION_STORE_FILE, "r", encoding="utf-8") as f:
+            snapshot = json.load(f)
+    except Exception as e:
+        logger.error(f"❌ خطأ في قراءة جلسات المستخدمين: {e}")
+        return
+    with SESSION_LOCK:
+        for uid, item in snapshot.items():
+            session = UserSession()
+            session.states = set(item.get("states") or [])
+            session.payload = dict(item.get("payload") or {})
+            USER_SESSIONS[int(uid)] = session
+    logger.info("✅ تم استرجاع %s جلسة مستخدم", len(snapshot))
+
+
+class SessionStateSet(MutableSet):
+    """واجهة set متوافقة مع WAITING_* القديمة، مخزنة داخل جلسة المستخدم"""
+
+    __slots__ = ("name",)
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __contains__(self, user_id) -> bool:
+        session = _session_for_read(user_id)
+        return session is not None and self.name in session.states
+
+    def __iter__(self):
+        for uid, session in list(USER_SESSIONS.items()):
+            if self.name in session.states:
+                yield uid
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def add(self, user_id):
+        _session_for_write(user_id).states.add(self.name)
+
+    def discard(self, user_id):
+        session = USER_SESSIONS.get(user_id)
+        if session is not None and self.name in session.states:
+            session.states.discard(self.name)
+            _drop_session_if_empty(user_id, session)
+
+
+class SessionStateDict(MutableMapping):
+    """واجهة dict متوافقة مع *_CONTEXT القديمة، مخزنة داخل جلسة المستخدم"""
+
+    __slots__ = ("name",)
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __getitem__(self, user_id):
+        session = _session_for_read(user_id)
+        if session is None or self.name not in session.payload:
+            raise KeyError(user_id)
+        return session.payload[self.name]
+
+    def __setitem__(self, user_id, value):
+        _session_for_write(user_id).payload[self.name] = value
+
+    def __delitem__(self, user_id):
+        session = USER_SESSIONS.get(user_id)
+        if session is None or self.name not in session.payload:
+            raise KeyError(user_id)
+        del session.payload[self.name]
+        _drop_session_if_empty(user_id, session)
+
+    def __contains__(self, user_id) -> bool:
+        session = _session_for_read(user_id)
+        return session is not None and self.name in session.payload
+
+    def __iter__(self):
+        for uid, session in list(USER_SESSIONS.items()):
+            if self.name in session.payload:
+                yield uid
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+# =================== جدول توجيه رسائل الدعم ===================
+
+# تُحفظ افتراضياً تحت DATA_DIR حتى تبقى ردود الإدارة على رسائل الدعم تعمل بعد إعادة التشغيل؛ فارغ = ذاكرة فقط
+SUPPORT_ROUTES_FILE = os.getenv("SUPPORT_ROUTES_FILE", _data_path("support_routes.jsonl"))
+STAFF_REPLY_ROUTES_FILE = os.getenv("STAFF_REPLY_ROUTES_FILE", _data_path("staff_reply_routes.jsonl"))
+MESSAGE_ROUTE_CAPACITY = int(os.getenv("MESSAGE_ROUTE_CAPACITY", 20000))
+
+
+class MessageRouteTable:
+    """جدول (chat_id, message_id) -> بيانات التوجيه بحد LRU، يُحفظ في ملف إلحاقي"""
+
+    def __init__(self, path: str, capacity: int):
+        self.path = path
+        self.capacity = max(1, capacity)
+        self._entries: "OrderedDict[Tuple[int, int], object]" = OrderedDict()
+        self._lock = Lock()
+        self._file = None
+        self._lines = 0
+
+    def __setitem__(self, key, value):
+        key = (int(key[0]), int(key[1]))
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+            self._append(key, value)
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def __contains__(self, key) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _append(self, key, value):
+        if not self.path:
+            return
+        try:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(json.dumps({"k": list(key), "v": value}, ensure_ascii=False) + "\n")
+            self._file.flush()
+            self._lines += 1
+            # الملف يُضغط عندما تتجاوز السطور القديمة ضعف السعة
+            if self._lines > 2 * self.capacity:
+                self._compact()
+        except Exception as e:
+            logger.error(f"❌ خطأ في حفظ جدول التوجيه {self.path}: {e}")
+
+    def _compact(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for key, value in self._entries.items():
+                f.write(json.dumps({"k": list(key), "v": value}, ensure_ascii=False) + "\n")
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        os.replace(tmp_path, self.path)
+        self._lines = len(self._entries)
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        lines = 0
+        with self._lock:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            item = json.loads(line)
+                            key = (int(item["k"][0]), int(item["k"][1]))
+                        except (ValueError, KeyError, IndexError, TypeError):
+                            # سطر ناقص من إيقاف مفاجئ
+                            continue
+                        lines += 1
+                        self._entries[key] = item["v"]
+                        self._entries.move_to_end(key)
+                        if len(self._entries) > self.capacity:
+                            self._entries.popitem(last=False)
+            except Exception as e:
+                logger.error(f"❌ خطأ في قراءة جدول التوجيه {self.path}: {e}")
+                return
+            self._lines = lines
+        logger.info("✅ جدول التوجيه %s: %s رسالة", self.path, len(self._entries))
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def load_message_routes():
+    SUPPORT_MSG_MAP.load()
+    STAFF_REPLY_BRIDGE.load()
+
+
+def close_message_routes():
+    SUPPORT_MSG_MAP.close()
+    STAFF_REPLY_BRIDGE.close()
+
+
+atexit.register(close_message_routes)
+
+
+# =================== حالات الإدخال ===================
+
+
+
+WAITING_QURAN_GOAL = SessionStateSet("WAITING_QURAN_GOAL")
+WAITING_QURAN_ADD_PAGES = SessionStateSet("WAITING_QURAN_ADD_PAGES")
+
+WAITING_TASBIH = SessionStateSet("WAITING_TASBIH")
+ACTIVE_TASBIH = SessionStateDict("ACTIVE_TASBIH")      # user_id -> { "text": str, "target": int, "current": int }
+
+# مكتبة الكتب
+WAITING_BOOK_SEARCH = SessionStateSet("WAITING_BOOK_SEARCH")
+WAITING_BOOK_CATEGORY_NAME = SessionStateSet("WAITING_BOOK_CATEGORY_NAME")
+WAITING_BOOK_CATEGORY_ORDER = SessionStateSet("WAITING_BOOK_CATEGORY_ORDER")
+WAITING_BOOK_ADD_CATEGORY = SessionStateSet("WAITING_BOOK_ADD_CATEGORY")
+WAITING_BOOK_ADD_TITLE = SessionStateSet("WAITING_BOOK_ADD_TITLE")
+WAITING_BOOK_ADD_AUTHOR = SessionStateSet("WAITING_BOOK_ADD_AUTHOR")
+WAITING_BOOK_ADD_DESCRIPTION = SessionStateSet("WAITING_BOOK_ADD_DESCRIPTION")
+WAITING_BOOK_ADD_TAGS = SessionStateSet("WAITING_BOOK_ADD_TAGS")
+WAITING_BOOK_ADD_COVER = SessionStateSet("WAITING_BOOK_ADD_COVER")
+WAITING_BOOK_ADD_PDF = SessionStateSet("WAITING_BOOK_ADD_PDF")
+WAITING_BOOK_EDIT_FIELD = SessionStateSet("WAITING_BOOK_EDIT_FIELD")
+WAITING_BOOK_EDIT_COVER = SessionStateSet("WAITING_BOOK_EDIT_COVER")
+WAITING_BOOK_EDIT_PDF = SessionStateSet("WAITING_BOOK_EDIT_PDF")
+WAITING_BOOK_ADMIN_SEARCH = SessionStateSet("WAITING_BOOK_ADMIN_SEARCH")
+BOOK_CREATION_CONTEXT: Dict[int, Dict] = SessionStateDict("BOOK_CREATION_CONTEXT")
+BOOK_CATEGORY_EDIT_CONTEXT: Dict[int, Dict] = SessionStateDict("BOOK_CATEGORY_EDIT_CONTEXT")
+BOOK_EDIT_CONTEXT: Dict[int, Dict] = SessionStateDict("BOOK_EDIT_CONTEXT")
+BOOK_SEARCH_CACHE: Dict[str, Dict] = {}
+BOOK_NAV_CACHE: Dict[str, Dict] = {}
 BOOKS_PAGE_SIZE = 5
 BOOK_SEARCH_PAGE_SIZE = 5
 BOOK_LATEST_LIMIT = 20
 
 # مذكّرات قلبي
-WAITING_MEMO_MENU = set()
-WAITING_MEMO_ADD = set()
-WAITING_MEMO_EDIT_SELECT = set()
-WAITING_MEMO_EDIT_TEXT = set()
-WAITING_MEMO_DELETE_SELECT = set()
-MEMO_EDIT_INDEX = {}
+WAITING_MEMO_MENU = SessionStateSet("WAITING_MEMO_MENU")
+WAITING_MEMO_ADD = SessionStateSet("WAITING_MEMO_ADD")
+WAITING_MEMO_EDIT_SELECT = SessionStateSet("WAITING_MEMO_EDIT_SELECT")
+WAITING_MEMO_EDIT_TEXT = SessionStateSet("WAITING_MEMO_EDIT_TEXT")
+WAITING_MEMO_DELETE_SELECT = SessionStateSet("WAITING_MEMO_DELETE_SELECT")
+MEMO_EDIT_INDEX = SessionStateDict("MEMO_EDIT_INDEX")
 
 # رسائل إلى نفسي
 # دعم / إدارة
-WAITING_SUPPORT_GENDER = set()
-WAITING_SUPPORT = set()
-WAITING_BROADCAST = set()
+WAITING_SUPPORT_GENDER = SessionStateSet("WAITING_SUPPORT_GENDER")
+WAITING_SUPPORT = SessionStateSet("WAITING_SUPPORT")
+WAITING_BROADCAST = SessionStateSet("WAITING_BROADCAST")
 PENDING_BROADCAST_MEDIA: Dict[Tuple[int, str], Dict[str, object]] = {}
-PENDING_BROADCAST_JOBS: Dict[Tuple[int, str], object] = {}
-SUPPORT_MSG_MAP: Dict[Tuple[int, int], int] = {}  # (admin_id, msg_id) -> user_id
+SUPPORT_MSG_MAP = MessageRouteTable(SUPPORT_ROUTES_FILE, MESSAGE_ROUTE_CAPACITY)  # (admin_id, msg_id) -> user_id
 
 # فلاتر مساعدة
 def _user_in_support_session(user) -> bool:
@@ -1184,46 +3191,44 @@ def _user_waiting_lesson_image(message) -> bool:
     return bool(user and user.id in WAITING_LESSON_IMAGE)
 
 # فوائد ونصائح
-WAITING_BENEFIT_TEXT = set()
-WAITING_BENEFIT_EDIT_TEXT = set()
-WAITING_BENEFIT_DELETE_CONFIRM = set()
-BENEFIT_EDIT_ID = {} # user_id -> benefit_id
+WAITING_BENEFIT_TEXT = SessionStateSet("WAITING_BENEFIT_TEXT")
+WAITING_BENEFIT_EDIT_TEXT = SessionStateSet("WAITING_BENEFIT_EDIT_TEXT")
+WAITING_BENEFIT_DELETE_CONFIRM = SessionStateSet("WAITING_BENEFIT_DELETE_CONFIRM")
+BENEFIT_EDIT_ID = SessionStateDict("BENEFIT_EDIT_ID") # user_id -> benefit_id
 
 # إدارة الدورات
-WAITING_NEW_COURSE = set()
-COURSE_CREATION_CONTEXT: Dict[int, Dict] = {}
-WAITING_NEW_LESSON = set()
-LESSON_CREATION_CONTEXT: Dict[int, Dict] = {}
-WAITING_NEW_QUIZ = set()
-QUIZ_CREATION_CONTEXT: Dict[int, Dict] = {}
-WAITING_QUIZ_ANSWER = set()
-ACTIVE_QUIZ_STATE: Dict[int, Dict] = {}
-WAITING_LESSON_TITLE = set()
-WAITING_LESSON_CONTENT = set()
-WAITING_LESSON_AUDIO = set()
-WAITING_LESSON_IMAGE = set()
-WAITING_LESSON_CURRICULUM_NAME = set()
-WAITING_QUIZ_TITLE = set()
-WAITING_QUIZ_QUESTION = set()
-WAITING_QUIZ_ANSWER_TEXT = set()
-WAITING_COURSE_COUNTRY = set()
-WAITING_COURSE_AGE = set()
-WAITING_COURSE_GENDER = set()
-WAITING_COURSE_FULL_NAME = set()
-COURSE_SUBSCRIPTION_CONTEXT: Dict[int, Dict] = {}
-WAITING_PROFILE_EDIT_NAME = set()
-WAITING_PROFILE_EDIT_AGE = set()
-WAITING_PROFILE_EDIT_COUNTRY = set()
-PROFILE_EDIT_CONTEXT: Dict[int, Dict] = {}
+WAITING_NEW_COURSE = SessionStateSet("WAITING_NEW_COURSE")
+COURSE_CREATION_CONTEXT: Dict[int, Dict] = SessionStateDict("COURSE_CREATION_CONTEXT")
+WAITING_NEW_LESSON = SessionStateSet("WAITING_NEW_LESSON")
+LESSON_CREATION_CONTEXT: Dict[int, Dict] = SessionStateDict("LESSON_CREATION_CONTEXT")
+WAITING_NEW_QUIZ = SessionStateSet("WAITING_NEW_QUIZ")
+QUIZ_CREATION_CONTEXT: Dict[int, Dict] = SessionStateDict("QUIZ_CREATION_CONTEXT")
+WAITING_QUIZ_ANSWER = SessionStateSet("WAITING_QUIZ_ANSWER")
+ACTIVE_QUIZ_STATE: Dict[int, Dict] = SessionStateDict("ACTIVE_QUIZ_STATE")
+WAITING_LESSON_TITLE = SessionStateSet("WAITING_LESSON_TITLE")
+WAITING_LESSON_CONTENT = SessionStateSet("WAITING_LESSON_CONTENT")
+WAITING_LESSON_AUDIO = SessionStateSet("WAITING_LESSON_AUDIO")
+WAITING_LESSON_IMAGE = SessionStateSet("WAITING_LESSON_IMAGE")
+WAITING_LESSON_CURRICULUM_NAME = SessionStateSet("WAITING_LESSON_CURRICULUM_NAME")
+WAITING_QUIZ_TITLE = SessionStateSet("WAITING_QUIZ_TITLE")
+WAITING_QUIZ_QUESTION = SessionStateSet("WAITING_QUIZ_QUESTION")
+WAITING_QUIZ_ANSWER_TEXT = SessionStateSet("WAITING_QUIZ_ANSWER_TEXT")
+WAITING_COURSE_COUNTRY = SessionStateSet("WAITING_COURSE_COUNTRY")
+WAITING_COURSE_AGE = SessionStateSet("WAITING_COURSE_AGE")
+WAITING_COURSE_GENDER = SessionStateSet("WAITING_COURSE_GENDER")
+WAITING_COURSE_FULL_NAME = SessionStateSet("WAITING_COURSE_FULL_NAME")
+COURSE_SUBSCRIPTION_CONTEXT: Dict[int, Dict] = SessionStateDict("COURSE_SUBSCRIPTION_CONTEXT")
+WAITING_PROFILE_EDIT_NAME = SessionStateSet("WAITING_PROFILE_EDIT_NAME")
+WAITING_PROFILE_EDIT_AGE = SessionStateSet("WAITING_PROFILE_EDIT_AGE")
+WAITING_PROFILE_EDIT_COUNTRY = SessionStateSet("WAITING_PROFILE_EDIT_COUNTRY")
+PROFILE_EDIT_CONTEXT: Dict[int, Dict] = SessionStateDict("PROFILE_EDIT_CONTEXT")
 # Staff Reply bridge: staff_received_message_id -> routing info
 # IMPORTANT: key must be (chat_id, message_id) لأن message_id مو عالمي
-STAFF_REPLY_BRIDGE: Dict[Tuple[int, int], Dict] = {}
+STAFF_REPLY_BRIDGE = MessageRouteTable(STAFF_REPLY_ROUTES_FILE, MESSAGE_ROUTE_CAPACITY)
 # نظام العرض داخل الدورات (معزول عن الدعم)
-WAITING_COURSE_PRESENTATION_MEDIA: Dict[int, str] = {}
-PRESENTATION_MEDIA_TIMEOUTS: Dict[int, object] = {}
+WAITING_COURSE_PRESENTATION_MEDIA: Dict[int, str] = SessionStateDict("WAITING_COURSE_PRESENTATION_MEDIA")
 # نظام الفائدة داخل الدورات (معزول عن العرض والدعم)
-WAITING_COURSE_BENEFIT_MEDIA: Dict[int, Dict] = {}
-COURSE_BENEFIT_TIMEOUTS: Dict[int, object] = {}
+WAITING_COURSE_BENEFIT_MEDIA: Dict[int, Dict] = SessionStateDict("WAITING_COURSE_BENEFIT_MEDIA")
 
 
 def _lessons_back_keyboard(course_id: str):
@@ -1299,6 +3304,31 @@ def _reset_quiz_creation(user_id: int):
     QUIZ_CREATION_CONTEXT.pop(user_id, None)
 
 
+# الحالات التي يمسحها زر الإلغاء العام (حالات الفوائد لها رسائل خاصة بعده)
+CANCEL_RESET_STATES = (
+    "WAITING_QURAN_GOAL", "WAITING_QURAN_ADD_PAGES",
+    "WAITING_TASBIH", "ACTIVE_TASBIH",
+    "WAITING_MEMO_MENU", "WAITING_MEMO_ADD", "WAITING_MEMO_EDIT_SELECT",
+    "WAITING_MEMO_EDIT_TEXT", "WAITING_MEMO_DELETE_SELECT", "MEMO_EDIT_INDEX",
+    "WAITING_BOOK_SEARCH", "WAITING_BOOK_ADMIN_SEARCH", "WAITING_BOOK_CATEGORY_NAME",
+    "WAITING_BOOK_CATEGORY_ORDER", "WAITING_BOOK_ADD_CATEGORY", "WAITING_BOOK_ADD_TITLE",
+    "WAITING_BOOK_ADD_AUTHOR", "WAITING_BOOK_ADD_DESCRIPTION", "WAITING_BOOK_ADD_TAGS",
+    "WAITING_BOOK_ADD_COVER", "WAITING_BOOK_ADD_PDF", "WAITING_BOOK_EDIT_FIELD",
+    "WAITING_BOOK_EDIT_COVER", "WAITING_BOOK_EDIT_PDF",
+    "BOOK_CREATION_CONTEXT", "BOOK_EDIT_CONTEXT", "BOOK_CATEGORY_EDIT_CONTEXT",
+    "WAITING_SUPPORT_GENDER",
+    "WAITING_BROADCAST", "WAITING_MOTIVATION_ADD", "WAITING_MOTIVATION_DELETE", "WAITING_MOTIVATION_TIMES",
+    "WAITING_COURSE_COUNTRY", "WAITING_COURSE_FULL_NAME", "WAITING_COURSE_AGE",
+    "WAITING_COURSE_GENDER", "COURSE_SUBSCRIPTION_CONTEXT",
+    "WAITING_BAN_USER", "WAITING_UNBAN_USER", "WAITING_BAN_REASON", "BAN_TARGET_ID",
+    "SLEEP_ADHKAR_STATE", "STRUCTURED_ADHKAR_STATE", "AUDIO_USER_STATE",
+    "WAITING_NEW_LESSON", "WAITING_LESSON_TITLE", "WAITING_LESSON_CONTENT", "WAITING_LESSON_AUDIO",
+    "WAITING_LESSON_IMAGE", "WAITING_LESSON_CURRICULUM_NAME", "LESSON_CREATION_CONTEXT",
+    "WAITING_NEW_QUIZ", "WAITING_QUIZ_TITLE", "WAITING_QUIZ_QUESTION", "WAITING_QUIZ_ANSWER_TEXT",
+    "QUIZ_CREATION_CONTEXT",
+)
+
+
 def _get_course_title(course_id: str) -> str:
     course = _course_document(course_id) if course_id else None
     return (course or {}).get("name") or "دورة"
@@ -1440,6 +3470,7 @@ def _update_lesson(
             )
 
         doc_ref.update(update_payload)
+        _invalidate_course_content(COURSE_LESSONS_COLLECTION, lesson_id)
         msg.reply_text(
             "✅ تم تحديث الدرس.",
             reply_markup=_lessons_back_keyboard(course_id),
@@ -1535,6 +3566,7 @@ def _finalize_quiz_creation_from_message(user_id: int, msg):
         if is_edit_mode:
             quiz_payload["updated_at"] = firestore.SERVER_TIMESTAMP
             db.collection(COURSE_QUIZZES_COLLECTION).document(quiz_id).update(quiz_payload)
+            _invalidate_course_content(COURSE_QUIZZES_COLLECTION, quiz_id)
             msg.reply_text(
                 "✅ تم تعديل الاختبار.",
                 reply_markup=_quizzes_back_keyboard(course_id),
@@ -1592,6 +3624,7 @@ def _finalize_quiz_creation_from_callback(user_id: int, query: Update.callback_q
         if is_edit_mode:
             quiz_payload["updated_at"] = firestore.SERVER_TIMESTAMP
             db.collection(COURSE_QUIZZES_COLLECTION).document(quiz_id).update(quiz_payload)
+            _invalidate_course_content(COURSE_QUIZZES_COLLECTION, quiz_id)
             safe_edit_message_text(
                 query,
                 "✅ تم تعديل الاختبار.",
@@ -1740,17 +3773,17 @@ def handle_lesson_image_message(update: Update, context: CallbackContext):
     )
 
 # أذكار النوم
-SLEEP_ADHKAR_STATE = {}  # user_id -> current_index
-STRUCTURED_ADHKAR_STATE = {}  # user_id -> {"category": str, "index": int}
+SLEEP_ADHKAR_STATE = SessionStateDict("SLEEP_ADHKAR_STATE")  # user_id -> current_index
+STRUCTURED_ADHKAR_STATE = SessionStateDict("STRUCTURED_ADHKAR_STATE")  # user_id -> {"category": str, "index": int}
 
 # إدارة الجرعة التحفيزية (من لوحة التحكم)
-WAITING_MOTIVATION_ADD = set()
-WAITING_MOTIVATION_DELETE = set()
-WAITING_MOTIVATION_TIMES = set()
+WAITING_MOTIVATION_ADD = SessionStateSet("WAITING_MOTIVATION_ADD")
+WAITING_MOTIVATION_DELETE = SessionStateSet("WAITING_MOTIVATION_DELETE")
+WAITING_MOTIVATION_TIMES = SessionStateSet("WAITING_MOTIVATION_TIMES")
 
 # مكتبة الصوتيات
 LOCAL_AUDIO_LIBRARY: List[Dict] = []
-AUDIO_USER_STATE: Dict[int, Dict] = {}
+AUDIO_USER_STATE: Dict[int, Dict] = SessionStateDict("AUDIO_USER_STATE")
 
 
 def _load_local_audio_library():
@@ -1786,17 +3819,17 @@ def _persist_local_audio_library():
         logger.error(f"❌ خطأ في حفظ المكتبة الصوتية محليًا: {e}")
 
 # نظام الحظر
-WAITING_BAN_USER = set()
-WAITING_UNBAN_USER = set()
-WAITING_BAN_REASON = set()
-BAN_TARGET_ID = {}  # user_id -> target_user_id
+WAITING_BAN_USER = SessionStateSet("WAITING_BAN_USER")
+WAITING_UNBAN_USER = SessionStateSet("WAITING_UNBAN_USER")
+WAITING_BAN_REASON = SessionStateSet("WAITING_BAN_REASON")
+BAN_TARGET_ID = SessionStateDict("BAN_TARGET_ID")  # user_id -> target_user_id
 
 # إدارة المنافسات والمجتمع
-WAITING_DELETE_USER_POINTS = set()
-WAITING_DELETE_USER_MEDALS = set()
+WAITING_DELETE_USER_POINTS = SessionStateSet("WAITING_DELETE_USER_POINTS")
+WAITING_DELETE_USER_MEDALS = SessionStateSet("WAITING_DELETE_USER_MEDALS")
 # متغيرات التأكيد الجديدة
-WAITING_CONFIRM_RESET_POINTS = set()
-WAITING_CONFIRM_RESET_MEDALS = set()
+WAITING_CONFIRM_RESET_POINTS = SessionStateSet("WAITING_CONFIRM_RESET_POINTS")
+WAITING_CONFIRM_RESET_MEDALS = SessionStateSet("WAITING_CONFIRM_RESET_MEDALS")
 
 # =================== الأزرار ===================
 
@@ -2425,29 +4458,35 @@ def _book_category_sort_key(cat: Dict) -> Tuple:
     )
 
 
+@lru_cache(maxsize=8192)
+def _parse_book_timestamp(raw_value) -> Optional[datetime]:
+    """تحويل created_at النصي/الرقمي (قيم ثابتة تتكرر في كل ترتيب للمكتبة)"""
+    if isinstance(raw_value, str):
+        try:
+            return datetime.fromisoformat(raw_value)
+        except Exception:
+            return None
+    try:
+        return datetime.fromtimestamp(raw_value, tz=timezone.utc)
+    except Exception:
+        return None
+
+
 def _book_created_at_value(raw_value) -> datetime:
     if isinstance(raw_value, datetime):
         return raw_value
+    if isinstance(raw_value, (str, int, float)):
+        return _parse_book_timestamp(raw_value)
     if hasattr(raw_value, "to_datetime"):
         try:
             return raw_value.to_datetime()
         except Exception:
             pass
-    if hasattr(raw_value, "timestamp") and not isinstance(raw_value, (int, float)):
+    if hasattr(raw_value, "timestamp"):
         try:
             return datetime.fromtimestamp(raw_value.timestamp(), tz=timezone.utc)
         except Exception:
             pass
-    if isinstance(raw_value, (int, float)):
-        try:
-            return datetime.fromtimestamp(raw_value, tz=timezone.utc)
-        except Exception:
-            pass
-    if isinstance(raw_value, str):
-        try:
-            return datetime.fromisoformat(raw_value)
-        except Exception:
-            pass
     return None
 
 
@@ -2794,18 +4833,20 @@ def _fetch_books_raw() -> List[Dict]:
 
 def _filter_books_pythonically(books: List[Dict], include_inactive: bool, include_deleted: bool) -> List[Dict]:
     visible = []
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
     for book in books:
-        book_id = book.get("id") or "unknown"
         is_deleted = _as_bool(book.get("is_deleted"), False)
         is_active = _as_bool(book.get("is_active"), True)
         if not include_deleted and is_deleted:
-            logger.info("[BOOKS][RAW_SKIP] %s is_deleted_true", book_id)
+            if debug_enabled:
+                logger.debug("[BOOKS][RAW_SKIP] %s is_deleted_true", book.get("id") or "unknown")
             continue
         if not include_inactive and not is_active:
-            logger.info("[BOOKS][RAW_SKIP] %s is_active_false", book_id)
+            if debug_enabled:
+                logger.debug("[BOOKS][RAW_SKIP] %s is_active_false", book.get("id") or "unknown")
             continue
         visible.append(book)
-    logger.info("[BOOKS][VISIBLE] total=%s", len(visible))
+    logger.debug("[BOOKS][VISIBLE] total=%s", len(visible))
     return visible
 
 
@@ -2821,11 +4862,15 @@ def fetch_books_list(
         category_filter = _normalize_category_id(category_id)
         all_books = _fetch_books_raw()
         if category_filter:
-            logger.info("[BOOKS][CAT_FILTER] wanted=%s total_before=%s", category_filter, len(all_books))
-            sample = [b.get("category_id") for b in all_books[:10]]
-            logger.info("[BOOKS][CAT_FILTER] sample_category_ids=%s", sample)
             filtered = [b for b in all_books if _normalize_category_id(b.get("category_id")) == category_filter]
-            logger.info("[BOOKS][CAT_FILTER] total_after=%s", len(filtered))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "[BOOKS][CAT_FILTER] wanted=%s total_before=%s total_after=%s sample_category_ids=%s",
+                    category_filter,
+                    len(all_books),
+                    len(filtered),
+                    [b.get("category_id") for b in all_books[:10]],
+                )
             all_books = filtered
         books = _filter_books_pythonically(all_books, include_inactive, include_deleted)
         for book in books:
@@ -2837,7 +4882,7 @@ def fetch_books_list(
                     ",".join(missing_required),
                 )
         books = _sort_books_by_created_at(books)
-        logger.info(
+        logger.debug(
             "[BOOKS][LIST] fetched=%s filters=category:%s include_inactive=%s include_deleted=%s",
             len(books),
             category_filter or "all",
@@ -3238,6 +5283,7 @@ def _send_books_list_message(
         update.message.reply_text(text, reply_markup=keyboard)
 
 
+@track_handler
 def show_books_by_category(update: Update, context: CallbackContext, category_id: str, page: int = 0, from_callback: bool = False):
     category = get_book_category(category_id)
     if not category or not category.get("is_active", True):
@@ -3276,6 +5322,7 @@ def show_books_by_category(update: Update, context: CallbackContext, category_id
     )
 
 
+@track_handler
 def show_latest_books(update: Update, context: CallbackContext, page: int = 0, from_callback: bool = False):
     books = fetch_latest_books(limit=BOOK_LATEST_LIMIT)
     logger.info("[BOOKS][LATEST][DISPLAY] page=%s total=%s", page, len(books))
@@ -3384,7 +5431,7 @@ def books_search_text_router(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
     text = (update.message.text or "").strip()
 
-    # اقرأ الحالة من Firestore مباشرة (بدون كاش)
+    # update_user_record يحدّث الكاش مباشرة، فالسجل المخزن يعكس حالة البحث
     rec = get_user_record_by_id(user_id) or {}
 
     # تجاهل نصوص الأدمن أثناء وجوده في وضع إدارة الكتب حتى لا تُعامل كبحث عام
@@ -3418,6 +5465,7 @@ def prompt_book_search(update: Update, context: CallbackContext):
 MAX_CAPTION = 1000
 
 
+@track_handler
 def _send_book_detail(update: Update, context: CallbackContext, book_id: str, route_str: str, from_callback: bool = False):
     book = get_book_by_id(book_id)
     if not book or book.get("is_deleted") or not book.get("is_active", True):
@@ -4488,6 +6536,79 @@ def run_after_response(task, *args, **kwargs):
     Thread(target=_run_deferred_task, args=(task, args, kwargs), daemon=True).start()
 
 
+# =================== إرسال نسخ الطاقم في الخلفية ===================
+
+STAFF_SEND_LANES: Dict[int, ThreadPoolExecutor] = {}
+STAFF_SEND_LOCK = Lock()
+
+
+def _staff_lane(chat_id: int) -> ThreadPoolExecutor:
+    """مسار واحد لكل محادثة من الطاقم: الأدمن والمشرفة بالتوازي، ورسائل كل منهما بالترتيب"""
+    with STAFF_SEND_LOCK:
+        lane = STAFF_SEND_LANES.get(chat_id)
+        if lane is None:
+            lane = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"staff-{chat_id}")
+            STAFF_SEND_LANES[chat_id] = lane
+        return lane
+
+
+def _run_staff_send(chat_id: int, send, on_sent, label: str):
+    try:
+        sent = send(chat_id)
+    except Exception as e:
+        logger.warning(f"{label} failed to {chat_id}: {e}")
+        return
+    if on_sent is None:
+        return
+    for message in sent if isinstance(sent, list) else [sent]:
+        if message is not None:
+            on_sent(chat_id, message)
+
+
+def send_to_staff(targets, send, on_sent=None, label: str = "Staff send"):
+    """send(chat_id) لكل مستلم في الخلفية، ثم on_sent(chat_id, message) لكل رسالة أُرسلت"""
+    for chat_id in dict.fromkeys(t for t in targets if t):
+        _staff_lane(chat_id).submit(_run_staff_send, chat_id, send, on_sent, label)
+
+
+def send_staff_copy(bot, chat_id: int, header: str, payload: Dict) -> List:
+    """إرسال الهيدر مع المحتوى في رسالة واحدة متى سمح نوع الرسالة بتعليق"""
+    msg_type = payload.get("type")
+    if msg_type == "text":
+        text = payload.get("text", "")
+        combined = f"{header}\n\n{text}"
+        if len(combined) <= 4096:
+            return [bot.send_message(chat_id=chat_id, text=combined)]
+        return [
+            bot.send_message(chat_id=chat_id, text=header),
+            bot.send_message(chat_id=chat_id, text=text),
+        ]
+
+    media_senders = {
+        "voice": (bot.send_voice, "voice"),
+        "audio": (bot.send_audio, "audio"),
+        "photo": (bot.send_photo, "photo"),
+        "document": (bot.send_document, "document"),
+    }
+    if msg_type in media_senders:
+        send_media, field = media_senders[msg_type]
+        media = {field: payload.get("file_id")}
+        caption = payload.get("caption") or payload.get("text") or ""
+        combined = f"{header}\n\n{caption}" if caption else header
+        if len(combined) <= MAX_CAPTION:
+            return [send_media(chat_id=chat_id, caption=combined, **media)]
+        return [
+            bot.send_message(chat_id=chat_id, text=header),
+            send_media(chat_id=chat_id, caption=caption or None, **media),
+        ]
+
+    # الفيديو الدائري لا يقبل تعليقاً
+    sent = [bot.send_message(chat_id=chat_id, text=header)]
+    if msg_type == "video_note":
+        sent.append(bot.send_video_note(chat_id=chat_id, video_note=payload.get("file_id")))
+    return sent
+
+
 def defer_last_active_update(user_id: int):
     now_dt = datetime.now(timezone.utc)
     now_iso = now_dt.isoformat()
@@ -4500,7 +6621,7 @@ def ensure_today_quran(record, persist: bool = True) -> bool:
         record["quran_today_date"] = today_str
         record["quran_pages_today"] = 0
         if persist:
-            save_data()
+            save_data(record.get("user_id"))
         return True
     return False
 
@@ -4545,7 +6666,7 @@ def increment_adhkar_count(user_id: int, amount: int = 1):
         return
     record = data[uid]
     record["adhkar_count"] = record.get("adhkar_count", 0) + amount
-    save_data()
+    update_user_record(user_id, adhkar_count=record["adhkar_count"])
 
 
 def increment_tasbih_total(user_id: int, amount: int = 1):
@@ -4554,7 +6675,7 @@ def increment_tasbih_total(user_id: int, amount: int = 1):
         return
     record = data[uid]
     record["tasbih_total"] = record.get("tasbih_total", 0) + amount
-    save_data()
+    update_user_record(user_id, tasbih_total=record["tasbih_total"])
 
 # =================== نظام النقاط / المستويات / الميداليات ===================
 
@@ -4597,14 +6718,23 @@ def get_users_sorted_by_points():
         )
 
 
-def check_rank_improvement(user_id: int, record: dict, context: CallbackContext = None):
-    sorted_users = get_users_sorted_by_points()
-    rank = None
-    for idx, rec in enumerate(sorted_users, start=1):
-        if rec.get("user_id") == user_id:
-            rank = idx
-            break
+def get_rank_for_points(points: int) -> Optional[int]:
+    """ترتيب المستخدم = عدد من نقاطهم أعلى منه + 1 (استعلام count بدل جلب كل المستخدمين)"""
+    if not firestore_available():
+        return 1 + sum(
+            1 for k, r in data.items() if k != GLOBAL_KEY and (r.get("points", 0) or 0) > points
+        )
+
+    try:
+        result = db.collection(USERS_COLLECTION).where("points", ">", points).count().get()
+        return int(result[0][0].value) + 1
+    except Exception as e:
+        logger.error(f"❌ خطأ في حساب ترتيب المستخدم من Firestore: {e}")
+        return None
+
 
+def check_rank_improvement(user_id: int, record: dict, notify: bool = False):
+    rank = get_rank_for_points(int(record.get("points", 0) or 0))
     if rank is None:
         return
 
@@ -4613,33 +6743,13 @@ def check_rank_improvement(user_id: int, record: dict, context: CallbackContext
         return
 
     record["best_rank"] = rank
-    save_data()
+    update_user_record(user_id, best_rank=rank)
 
-    if context is None:
-        return
-
-    try:
-        if rank <= 10:
-            context.bot.send_message(
-                chat_id=user_id,
-                text=(
-                    f"🏅 مبروك! دخلت ضمن أفضل 10 مستخدمين في لوحة الشرف.\n"
-                    f"ترتيبك الحالي: #{rank}"
-                ),
-            )
-        elif rank <= 100:
-            context.bot.send_message(
-                chat_id=user_id,
-                text=(
-                    f"🏆 تهانينا! أصبحت ضمن أفضل 100 مستخدم في المنافسة.\n"
-                    f"ترتيبك الحالي: #{rank}"
-                ),
-            )
-    except Exception as e:
-        logger.error(f"Error sending rank improvement message to {user_id}: {e}")
+    if rank <= 100:
+        publish_event(RankImproved(user_id, rank, notify=notify))
 
 
-def update_level_and_medals(user_id: int, record: dict, context: CallbackContext = None):
+def update_level_and_medals(user_id: int, record: dict, notify: bool = False):
     ensure_medal_defaults(record)
     old_level = record.get("level", 0)
     points = record.get("points", 0)
@@ -4647,7 +6757,7 @@ def update_level_and_medals(user_id: int, record: dict, context: CallbackContext
     new_level = points // 20
 
     if new_level == old_level:
-        check_rank_improvement(user_id, record, context)
+        # الترتيب (استعلام count) لا يُحسب مع كل منح نقاط، بل عند تغير المستوى فقط
         return
 
     record["level"] = new_level
@@ -4660,22 +6770,17 @@ def update_level_and_medals(user_id: int, record: dict, context: CallbackContext
             new_medals.append(name)
 
     record["medals"] = medals
-    save_data()
+    update_user_record(user_id, level=new_level, medals=medals)
 
-    check_rank_improvement(user_id, record, context)
+    check_rank_improvement(user_id, record, notify)
 
-    if context is not None:
-        try:
-            msg = f"🎉 مبروك! وصلت إلى المستوى {new_level}.\n"
-            if new_medals:
-                msg += "وحصلت على الميداليات التالية:\n" + "\n".join(f"- {m}" for m in new_medals)
-            context.bot.send_message(chat_id=user_id, text=msg)
-        except Exception as e:
-            logger.error(f"Error sending level up message to {user_id}: {e}")
+    publish_event(LevelChanged(user_id, old_level, new_level, notify=notify))
+    for medal in new_medals:
+        publish_event(MedalGranted(user_id, medal, notify=notify))
 
 
 def add_points(user_id: int, amount: int, context: CallbackContext = None, reason: str = ""):
-    """إضافة نقاط للمستخدم في Firestore"""
+    """إضافة نقاط للمستخدم في Firestore بكتابة ذرية واحدة دون قراءة"""
     user_id_str = str(user_id)
     
     if not firestore_available():
@@ -4683,44 +6788,204 @@ def add_points(user_id: int, amount: int, context: CallbackContext = None, reaso
         return
     
     try:
-        doc_ref = db.collection(USERS_COLLECTION).document(user_id_str)
-        doc = doc_ref.get()
-        
-        if doc.exists:
-            record = doc.to_dict()
-            current_points = record.get("points", 0)
-            new_points = current_points + amount
-            
-            # تحديث النقاط
-            doc_ref.update({
-                "points": new_points,
-                "last_active": datetime.now(timezone.utc).isoformat()
-            })
-            
-            # تحديث record للمستوى والميداليات
-            record["points"] = new_points
-            data[user_id_str] = record
-            
-            # فحص المستوى ومنح الميداليات
-            update_level_and_medals(user_id, record, context)
-            
-            logger.info(f"✅ تم إضافة {amount} نقطة للمستخدم {user_id} (السبب: {reason}). المجموع: {new_points}")
-            
-            # إرسال إشعار للمستخدم
-            if context and amount > 0:
+        # Increment يمنع ضياع التحديثات عند منح نقاط متزامنة لنفس المستخدم؛
+        # عند فشل Firestore تبقى في طابور الكتابات وتُحتسب محلياً فوراً
+        write_through_outbox("update", f"{USERS_COLLECTION}/{user_id_str}", {
+            "points": firestore.Increment(amount),
+            "last_active": datetime.now(timezone.utc).isoformat()
+        })
+    except Exception as e:
+        logger.error(f"❌ خطأ في إضافة نقاط للمستخدم {user_id}: {e}")
+        return
+
+    new_points = _patch_cached_points(user_id, amount)
+    logger.info(f"✅ تم إضافة {amount} نقطة للمستخدم {user_id} (السبب: {reason}). المجموع: {new_points}")
+
+    # المستوى والميداليات والترتيب والإشعار تتم في ناقل الأحداث
+    publish_event(
+        PointsAwarded(user_id, amount, new_points, reason, notify=context is not None)
+    )
+
+
+def _patch_cached_points(user_id: int, amount: int) -> Optional[int]:
+    """تعديل النقاط في السجل المخزن مكانه وإرجاع المجموع الجديد (أو None إن لم يكن مخزناً)"""
+    record = data.get(str(user_id))
+    if record is None:
+        return None
+    record["points"] = int(record.get("points", 0) or 0) + amount
+    return record["points"]
+
+
+# =================== ناقل أحداث النقاط / المستويات / الترتيب ===================
+
+
+class PointsAwarded(NamedTuple):
+    user_id: int
+    amount: int
+    new_points: Optional[int]
+    reason: str = ""
+    notify: bool = True
+
+
+class LevelChanged(NamedTuple):
+    user_id: int
+    old_level: int
+    new_level: int
+    notify: bool = True
+
+
+class RankImproved(NamedTuple):
+    user_id: int
+    rank: int
+    notify: bool = True
+
+
+class MedalGranted(NamedTuple):
+    user_id: int
+    medal: str
+    notify: bool = True
+
+
+EVENT_HANDLERS: Dict[type, List] = defaultdict(list)
+EVENT_QUEUES: List[queue.Queue] = []
+EVENT_BUS_LOCK = Lock()
+
+
+def subscribe_event(event_type: type, handler):
+    EVENT_HANDLERS[event_type].append(handler)
+
+
+def publish_event(event):
+    """إضافة حدث للطابور فقط؛ المعالجة والإشعارات تتم في العمال"""
+    if not EVENT_QUEUES:
+        _start_event_workers()
+    # نفس المستخدم دائماً على نفس العامل للحفاظ على ترتيب أحداثه ودمج إشعاراته
+    EVENT_QUEUES[int(event.user_id) % len(EVENT_QUEUES)].put_nowait(event)
+
+
+def _start_event_workers():
+    with EVENT_BUS_LOCK:
+        if EVENT_QUEUES:
+            return
+        queues = [queue.Queue() for _ in range(max(1, EVENT_BUS_WORKERS))]
+        for idx, q in enumerate(queues):
+            Thread(target=_event_worker, args=(q,), name=f"event-bus-{idx}", daemon=True).start()
+        EVENT_QUEUES.extend(queues)
+
+
+def _event_worker(q: queue.Queue):
+    # user_id -> إشعارات مؤجلة تُدمج خلال نافذة قصيرة
+    pending: Dict[int, Dict] = {}
+    while True:
+        timeout = None
+        if pending:
+            next_due = min(item["due"] for item in pending.values())
+            timeout = max(0.0, next_due - _time.monotonic())
+        try:
+            event = q.get(timeout=timeout)
+        except queue.Empty:
+            event = None
+
+        if event is not None:
+            for handler in EVENT_HANDLERS.get(type(event), []):
                 try:
-                    context.bot.send_message(
-                        chat_id=user_id,
-                        text=f"🎉 رائع! حصلت على {amount} نقطة\n{reason}\n\nمجموع نقاطك الآن: {new_points} 🌟"
-                    )
+                    handler(event)
                 except Exception as e:
-                    logger.error(f"خطأ في إرسال إشعار النقاط: {e}")
-                    
+                    logger.error("❌ خطأ في معالجة الحدث %s: %s", type(event).__name__, e)
+            if event.notify:
+                _coalesce_notification(pending, event)
+
+        now = _time.monotonic()
+        for user_id in [uid for uid, item in pending.items() if item["due"] <= now]:
+            _send_coalesced_notification(user_id, pending.pop(user_id))
+
+
+def _coalesce_notification(pending: Dict[int, Dict], event):
+    item = pending.get(event.user_id)
+    if item is None:
+        item = {
+            "due": _time.monotonic() + EVENT_NOTIFY_WINDOW_SECONDS,
+            "points": 0,
+            "total": None,
+            "reasons": [],
+            "level": None,
+            "level_medals": [],
+            "medals": [],
+            "rank": None,
+        }
+        pending[event.user_id] = item
+
+    if isinstance(event, PointsAwarded):
+        if event.amount > 0:
+            item["points"] += event.amount
+            item["total"] = event.new_points
+            if event.reason and event.reason not in item["reasons"]:
+                item["reasons"].append(event.reason)
+    elif isinstance(event, LevelChanged):
+        item["level"] = event.new_level
+    elif isinstance(event, MedalGranted):
+        if item["level"] is not None and event.medal in {name for _, name in LEVEL_MEDAL_RULES}:
+            item["level_medals"].append(event.medal)
+        else:
+            item["medals"].append(event.medal)
+    elif isinstance(event, RankImproved):
+        if item["rank"] is None or event.rank < item["rank"]:
+            item["rank"] = event.rank
+
+
+def _send_coalesced_notification(user_id: int, item: Dict):
+    parts = []
+    if item["points"] > 0:
+        msg = f"🎉 رائع! حصلت على {item['points']} نقطة\n" + "، ".join(item["reasons"])
+        # المجموع غير معروف إذا لم يكن سجل المستخدم مخزناً وقت المنح
+        if item["total"] is not None:
+            msg += f"\n\nمجموع نقاطك الآن: {item['total']} 🌟"
+        parts.append(msg)
+    if item["level"] is not None:
+        msg = f"🎉 مبروك! وصلت إلى المستوى {item['level']}.\n"
+        if item["level_medals"]:
+            msg += "وحصلت على الميداليات التالية:\n" + "\n".join(f"- {m}" for m in item["level_medals"])
+        parts.append(msg.strip())
+    for medal in item["medals"]:
+        msg = f"تهانينا! 🎉\nلقد حصلت على وسام جديد: {medal}"
+        if medal == MEDAL_TOP_BENEFIT:
+            msg += "\nأحد فوائدك وصل إلى قائمة أفضل 10 فوائد. استمر في المشاركة! 🤍"
+        parts.append(msg)
+    rank = item["rank"]
+    if rank is not None:
+        if rank <= 10:
+            parts.append(f"🏅 مبروك! دخلت ضمن أفضل 10 مستخدمين في لوحة الشرف.\nترتيبك الحالي: #{rank}")
+        else:
+            parts.append(f"🏆 تهانينا! أصبحت ضمن أفضل 100 مستخدم في المنافسة.\nترتيبك الحالي: #{rank}")
+
+    if not parts or dispatcher is None:
+        return
+    try:
+        dispatcher.bot.send_message(chat_id=user_id, text="\n\n".join(parts))
     except Exception as e:
-        logger.error(f"❌ خطأ في إضافة نقاط للمستخدم {user_id}: {e}")
+        logger.error(f"خطأ في إرسال إشعار النقاط/المستوى إلى {user_id}: {e}")
+
+
+def _on_points_awarded(event: PointsAwarded):
+    """
+    فحص المستوى والميداليات والترتيب بعد منح النقاط.
+    السجل المشترك يُعدّل على مسار المستخدم وليس في عامل الناقل، فلا يتداخل مع تحديثاته؛
+    الناقل يبقى للإشعارات فقط.
+    """
+    if event.new_points is None:
+        # السجل غير مخزن: لا نقرأه هنا؛ المستوى يُصحح عند قراءته التالية (get_user_record)
+        return
+    run_on_user_lane(event.user_id, _apply_points_awarded, event.user_id, event.notify)
 
 
+def _apply_points_awarded(user_id: int, notify: bool):
+    record = data.get(str(user_id))
+    if record is None:
+        return
+    update_level_and_medals(user_id, record, notify)
+
 
+subscribe_event(PointsAwarded, _on_points_awarded)
 
 
 def save_note(user_id: int, note_text: str):
@@ -4739,8 +7004,11 @@ def save_note(user_id: int, note_text: str):
             "created_at": datetime.now(timezone.utc).isoformat()
         }
         
-        db.collection(USERS_COLLECTION).document(user_id_str).collection("heart_memos").add(note_data)
-        logger.info(f"✅ تم حفظ مذكرة قلبي للمستخدم {user_id} في Firestore")
+        # معرف الوثيقة يُحدد هنا حتى لا تتكرر المذكرة إذا أُعيدت من طابور الكتابات
+        note_id = uuid4().hex
+        path = f"{USERS_COLLECTION}/{user_id_str}/heart_memos/{note_id}"
+        if write_through_outbox("set", path, note_data, key=note_id):
+            logger.info(f"✅ تم حفظ مذكرة قلبي للمستخدم {user_id} في Firestore")
         
     except Exception as e:
         logger.error(f"❌ خطأ في حفظ المذكرة للمستخدم {user_id}: {e}")
@@ -4771,6 +7039,49 @@ def save_benefit(benefit_data: Dict):
         return None
 
 
+# حالات الانتظار التي يقطعها /start (جلسة الدعم والدورات لا تتأثر)
+START_RESET_STATES = frozenset(
+    {
+        "WAITING_QURAN_GOAL",
+        "WAITING_QURAN_ADD_PAGES",
+        "WAITING_TASBIH",
+        "WAITING_MEMO_MENU",
+        "WAITING_MEMO_ADD",
+        "WAITING_MEMO_EDIT_SELECT",
+        "WAITING_MEMO_EDIT_TEXT",
+        "WAITING_MEMO_DELETE_SELECT",
+        "WAITING_BOOK_SEARCH",
+        "WAITING_BOOK_ADMIN_SEARCH",
+        "WAITING_BOOK_CATEGORY_NAME",
+        "WAITING_BOOK_CATEGORY_ORDER",
+        "WAITING_BOOK_ADD_CATEGORY",
+        "WAITING_BOOK_ADD_TITLE",
+        "WAITING_BOOK_ADD_AUTHOR",
+        "WAITING_BOOK_ADD_DESCRIPTION",
+        "WAITING_BOOK_ADD_TAGS",
+        "WAITING_BOOK_ADD_COVER",
+        "WAITING_BOOK_ADD_PDF",
+        "WAITING_BOOK_EDIT_FIELD",
+        "WAITING_BOOK_EDIT_COVER",
+        "WAITING_BOOK_EDIT_PDF",
+        "BOOK_CREATION_CONTEXT",
+        "BOOK_EDIT_CONTEXT",
+        "BOOK_CATEGORY_EDIT_CONTEXT",
+        "WAITING_SUPPORT_GENDER",
+        "WAITING_BROADCAST",
+        "WAITING_BENEFIT_TEXT",
+        "WAITING_BENEFIT_EDIT_TEXT",
+        "WAITING_BENEFIT_DELETE_CONFIRM",
+        "WAITING_MOTIVATION_ADD",
+        "WAITING_MOTIVATION_DELETE",
+        "WAITING_MOTIVATION_TIMES",
+        "WAITING_BAN_USER",
+        "WAITING_UNBAN_USER",
+        "WAITING_BAN_REASON",
+    }
+)
+
+
 def start_command(update: Update, context: CallbackContext):
     """معالج أمر /start مع ضمان الإرسال الفوري وتنظيف حالات الانتظار."""
     user = update.effective_user
@@ -4778,42 +7089,7 @@ def start_command(update: Update, context: CallbackContext):
     
     # الخطوة 1: تنظيف جميع حالات الانتظار للمستخدم الحالي
     # هذا يضمن أن /start يقطع أي عملية جارية ويعيد المستخدم للقائمة الرئيسية
-    WAITING_QURAN_GOAL.discard(user_id)
-    WAITING_QURAN_ADD_PAGES.discard(user_id)
-    WAITING_TASBIH.discard(user_id)
-    WAITING_MEMO_MENU.discard(user_id)
-    WAITING_MEMO_ADD.discard(user_id)
-    WAITING_MEMO_EDIT_SELECT.discard(user_id)
-    WAITING_MEMO_EDIT_TEXT.discard(user_id)
-    WAITING_MEMO_DELETE_SELECT.discard(user_id)
-    WAITING_BOOK_SEARCH.discard(user_id)
-    WAITING_BOOK_ADMIN_SEARCH.discard(user_id)
-    WAITING_BOOK_CATEGORY_NAME.discard(user_id)
-    WAITING_BOOK_CATEGORY_ORDER.discard(user_id)
-    WAITING_BOOK_ADD_CATEGORY.discard(user_id)
-    WAITING_BOOK_ADD_TITLE.discard(user_id)
-    WAITING_BOOK_ADD_AUTHOR.discard(user_id)
-    WAITING_BOOK_ADD_DESCRIPTION.discard(user_id)
-    WAITING_BOOK_ADD_TAGS.discard(user_id)
-    WAITING_BOOK_ADD_COVER.discard(user_id)
-    WAITING_BOOK_ADD_PDF.discard(user_id)
-    WAITING_BOOK_EDIT_FIELD.discard(user_id)
-    WAITING_BOOK_EDIT_COVER.discard(user_id)
-    WAITING_BOOK_EDIT_PDF.discard(user_id)
-    BOOK_CREATION_CONTEXT.pop(user_id, None)
-    BOOK_EDIT_CONTEXT.pop(user_id, None)
-    BOOK_CATEGORY_EDIT_CONTEXT.pop(user_id, None)
-    WAITING_SUPPORT_GENDER.discard(user_id)
-    WAITING_BROADCAST.discard(user_id)
-    WAITING_BENEFIT_TEXT.discard(user_id)
-    WAITING_BENEFIT_EDIT_TEXT.discard(user_id)
-    WAITING_BENEFIT_DELETE_CONFIRM.discard(user_id)
-    WAITING_MOTIVATION_ADD.discard(user_id)
-    WAITING_MOTIVATION_DELETE.discard(user_id)
-    WAITING_MOTIVATION_TIMES.discard(user_id)
-    WAITING_BAN_USER.discard(user_id)
-    WAITING_UNBAN_USER.discard(user_id)
-    WAITING_BAN_REASON.discard(user_id)
+    reset_user_states(user_id, START_RESET_STATES)
     
     # الخطوة 2: قراءة أو إنشاء سجل المستخدم
     record = get_user_record(user)
@@ -5032,7 +7308,7 @@ def handle_quran_goal_input(update: Update, context: CallbackContext):
 
     def _persist_quran_goal():
         update_user_record(user.id, quran_pages_goal=record["quran_pages_goal"])
-        save_data()
+        save_data(user.id)
 
     run_after_response(_persist_quran_goal)
 
@@ -5109,7 +7385,7 @@ def handle_quran_add_pages_input(update: Update, context: CallbackContext):
     defer_last_active_update(user_id)
 
     def _persist_quran_pages():
-        save_data()
+        save_data(user_id)
         update_user_record(
             user_id,
             quran_pages_today=record["quran_pages_today"],
@@ -5158,7 +7434,7 @@ def handle_quran_reset_day(update: Update, context: CallbackContext):
 
     def _persist_quran_reset():
         update_user_record(user.id, quran_pages_today=record["quran_pages_today"])
-        save_data()
+        save_data(user.id)
 
     run_after_response(_persist_quran_reset)
 
@@ -5623,7 +7899,7 @@ def handle_memo_add_input(update: Update, context: CallbackContext):
     
     # حفظ في Firestore
     update_user_record(user.id, heart_memos=memos)
-    save_data()
+    save_data(user.id)
     logger.info(f"✅ تم حفظ مذكرة جديدة للمستخدم {user.id} في Firestore")
 
     WAITING_MEMO_ADD.discard(user_id)
@@ -5738,7 +8014,7 @@ def handle_memo_edit_text_input(update: Update, context: CallbackContext):
     
     # حفظ في Firestore
     update_user_record(user.id, heart_memos=record["heart_memos"])
-    save_data()
+    save_data(user.id)
 
     WAITING_MEMO_EDIT_TEXT.discard(user_id)
     MEMO_EDIT_INDEX.pop(user_id, None)
@@ -5814,7 +8090,7 @@ def handle_memo_delete_index_input(update: Update, context: CallbackContext):
     
     # حفظ في Firestore
     update_user_record(user.id, heart_memos=record["heart_memos"])
-    save_data()
+    save_data(user.id)
 
     WAITING_MEMO_DELETE_SELECT.discard(user_id)
 
@@ -6493,21 +8769,18 @@ def handle_top10_benefits(update: Update, context: CallbackContext):
     if record.get("is_banned", False):
         return
 
-    benefits = get_benefits()
+    sorted_benefits = get_top_benefits(10)
     
-    if not benefits:
+    if not sorted_benefits:
         update.message.reply_text(
             "لا توجد فوائد مضافة بعد لتصنيفها. 💡",
             reply_markup=BENEFITS_MENU_KB,
         )
         return
 
-    # ترتيب الفوائد حسب عدد الإعجابات تنازليًا
-    sorted_benefits = sorted(benefits, key=lambda b: b.get("likes_count", 0), reverse=True)
-    
     text = "🏆 أفضل 10 فوائد ونصائح (حسب الإعجابات):\n\n"
     
-    for i, benefit in enumerate(sorted_benefits[:10], start=1):
+    for i, benefit in enumerate(sorted_benefits, start=1):
         text += f"{i}. *{benefit['text']}*\n"
         text += f"   - من: {benefit['first_name']} | الإعجابات: {benefit['likes_count']} 👍\n\n"
         
@@ -6526,21 +8799,18 @@ def handle_top100_benefits(update: Update, context: CallbackContext):
     if record.get("is_banned", False):
         return
 
-    benefits = get_benefits()
+    sorted_benefits = get_top_benefits(100)
     
-    if not benefits:
+    if not sorted_benefits:
         update.message.reply_text(
             "لا توجد فوائد مضافة بعد لتصنيفها. 💡",
             reply_markup=BENEFITS_MENU_KB,
         )
         return
 
-    # ترتيب الفوائد حسب عدد الإعجابات تنازليًا
-    sorted_benefits = sorted(benefits, key=lambda b: b.get("likes_count", 0), reverse=True)
-    
     text = "🏆 أفضل 100 فائدة ونصيحة (حسب الإعجابات):\n\n"
     
-    for i, benefit in enumerate(sorted_benefits[:100], start=1):
+    for i, benefit in enumerate(sorted_benefits, start=1):
         text += f"{i}. *{benefit['text']}*\n"
         text += f"   - من: {benefit['first_name']} | الإعجابات: {benefit['likes_count']} 👍\n\n"
         
@@ -6555,15 +8825,12 @@ def check_and_award_medal(context: CallbackContext):
     """
     دالة تفحص أفضل 10 فوائد وتمنح الوسام لصاحبها إذا لم يكن لديه.
     """
-    benefits = get_benefits()
-    if not benefits:
+    top_benefits = get_top_benefits(10)
+    if not top_benefits:
         return
 
-    # ترتيب الفوائد حسب عدد الإعجابات تنازليًا
-    sorted_benefits = sorted(benefits, key=lambda b: b.get("likes_count", 0), reverse=True)
-    
     top_10_user_ids = set()
-    for benefit in sorted_benefits[:10]:
+    for benefit in top_benefits:
         top_10_user_ids.add(benefit["user_id"])
         
     for user_id in top_10_user_ids:
@@ -6576,19 +8843,10 @@ def check_and_award_medal(context: CallbackContext):
             if MEDAL_TOP_BENEFIT not in medals:
                 medals.append(MEDAL_TOP_BENEFIT)
                 record["medals"] = medals
-                save_data()
+                update_user_record(int(user_id), medals=medals)
 
-                # إرسال رسالة تهنئة
-                try:
-                    context.bot.send_message(
-                        chat_id=user_id,
-                        text=f"تهانينا! 🎉\n"
-                             f"لقد حصلت على وسام جديد: *{MEDAL_TOP_BENEFIT}*\n"
-                             f"أحد فوائدك وصل إلى قائمة أفضل 10 فوائد. استمر في المشاركة! 🤍",
-                        parse_mode="Markdown",
-                    )
-                except Exception as e:
-                    logger.error(f"Error sending medal message to {user_id}: {e}")
+                # رسالة التهنئة تُرسل من ناقل الأحداث
+                publish_event(MedalGranted(int(user_id), MEDAL_TOP_BENEFIT))
 
 
 def handle_admin_delete_benefit_callback(update: Update, context: CallbackContext):
@@ -6635,6 +8893,7 @@ def handle_admin_delete_benefit_callback(update: Update, context: CallbackContex
     )
 
 
+@track_handler
 def handle_like_benefit_callback(update: Update, context: CallbackContext):
     """معالجة الإعجاب بالفائدة مع حفظ صحيح في Firestore"""
     query = update.callback_query
@@ -6648,17 +8907,8 @@ def handle_like_benefit_callback(update: Update, context: CallbackContext):
             query.answer("خطأ في تحديد الفائدة.")
             return
 
-        benefits = get_benefits()
-        benefit_index = -1
-        benefit = None
-        firestore_id = None
-        
-        for i, b in enumerate(benefits):
-            if b.get("id") == benefit_id:
-                benefit_index = i
-                benefit = b
-                firestore_id = b.get("firestore_id")
-                break
+        benefit = get_benefit_by_id(benefit_id)
+        firestore_id = benefit.get("firestore_id") if benefit else None
         
         if benefit is None:
             query.answer("هذه الفائدة لم تعد موجودة.")
@@ -6680,22 +8930,18 @@ def handle_like_benefit_callback(update: Update, context: CallbackContext):
         benefit["likes_count"] = benefit.get("likes_count", 0) + 1
         benefit["liked_by"] = liked_by
         
-        # 2. حفظ التغييرات في Firestore بشكل مباشر
+        # 2. حفظ الإعجاب في وثيقة الفائدة وحدها (Increment/ArrayUnion لتفادي تضارب الإعجابات المتزامنة)
         if firestore_id and firestore_available():
             try:
                 update_benefit_in_firestore(firestore_id, {
-                    "likes_count": benefit["likes_count"],
-                    "liked_by": liked_by
+                    "likes_count": firestore.Increment(1),
+                    "liked_by": firestore.ArrayUnion([user_id])
                 })
                 logger.info(f"✅ تم حفظ الإعجاب للفائدة {benefit_id} في Firestore")
             except Exception as e:
                 logger.error(f"❌ خطأ في حفظ الإعجاب في Firestore: {e}")
         
-        # 3. تحديث قائمة الفوائد المحلية
-        benefits[benefit_index] = benefit
-        save_benefits(benefits)
-        
-        # 4. تحديث زر الإعجاب
+        # 3. تحديث زر الإعجاب
         new_likes_count = benefit["likes_count"]
         new_button_text = f"✅ أعجبتني ({new_likes_count})"
         
@@ -6713,8 +8959,8 @@ def handle_like_benefit_callback(update: Update, context: CallbackContext):
             
         query.answer(f"تم الإعجاب! الفائدة لديها الآن {new_likes_count} إعجاب.")
         
-        # 5. فحص ومنح الوسام
-        check_and_award_medal(context)
+        # 4. فحص ومنح الوسام بعد الرد
+        run_after_response(check_and_award_medal, context)
 
 
 # =================== الاشعارات / الجرعة التحفيزية للمستخدم ===================
@@ -6755,7 +9001,7 @@ def handle_motivation_on(update: Update, context: CallbackContext):
     
     # حفظ في Firestore
     update_user_record(user.id, motivation_on=record["motivation_on"])
-    save_data()
+    save_data(user.id)
 
     update.message.reply_text(
         "تم تشغيل الجرعة التحفيزية ✨\n"
@@ -6777,7 +9023,7 @@ def handle_motivation_off(update: Update, context: CallbackContext):
     
     # حفظ في Firestore
     update_user_record(user.id, motivation_on=record["motivation_on"])
-    save_data()
+    save_data(user.id)
 
     update.message.reply_text(
         "تم إيقاف الجرعة التحفيزية 😴\n"
@@ -7042,11 +9288,7 @@ def handle_admin_motivation_add_input(update: Update, context: CallbackContext):
         )
         return
 
-    MOTIVATION_MESSAGES.append(text)
-
-    cfg = get_global_config()
-    cfg["motivation_messages"] = MOTIVATION_MESSAGES
-    save_global_config(cfg)
+    update_global_config(motivation_messages=MOTIVATION_MESSAGES + [text])
 
     WAITING_MOTIVATION_ADD.discard(user_id)
 
@@ -7108,11 +9350,9 @@ def handle_admin_motivation_delete_input(update: Update, context: CallbackContex
         )
         return
 
-    deleted = MOTIVATION_MESSAGES.pop(idx)
-
-    cfg = get_global_config()
-    cfg["motivation_messages"] = MOTIVATION_MESSAGES
-    save_global_config(cfg)
+    messages = list(MOTIVATION_MESSAGES)
+    deleted = messages.pop(idx)
+    update_global_config(motivation_messages=messages)
 
     WAITING_MOTIVATION_DELETE.discard(user_id)
 
@@ -7176,12 +9416,7 @@ def handle_admin_motivation_times_input(update: Update, context: CallbackContext
         )
         return
 
-    global MOTIVATION_TIMES_UTC
-    MOTIVATION_TIMES_UTC = times
-
-    cfg = get_global_config()
-    cfg["motivation_times"] = MOTIVATION_TIMES_UTC
-    save_global_config(cfg)
+    update_global_config(motivation_times=times)
 
     WAITING_MOTIVATION_TIMES.discard(user_id)
 
@@ -7558,11 +9793,13 @@ def handle_unban_user_id_input(update: Update, context: CallbackContext):
             return
 
         # فك الحظر
-        target_record["is_banned"] = False
-        target_record["banned_by"] = None
-        target_record["banned_at"] = None
-        target_record["ban_reason"] = None
-        save_data()
+        set_user_ban(
+            target_id,
+            is_banned=False,
+            banned_by=None,
+            banned_at=None,
+            ban_reason=None,
+        )
 
         WAITING_UNBAN_USER.discard(user_id)
 
@@ -7628,11 +9865,13 @@ def handle_ban_reason_input(update: Update, context: CallbackContext):
         return
 
     # تطبيق الحظر
-    target_record["is_banned"] = True
-    target_record["banned_by"] = user_id
-    target_record["banned_at"] = datetime.now(timezone.utc).isoformat()
-    target_record["ban_reason"] = text
-    save_data()
+    set_user_ban(
+        target_id,
+        is_banned=True,
+        banned_by=user_id,
+        banned_at=datetime.now(timezone.utc).isoformat(),
+        ban_reason=text,
+    )
 
     WAITING_BAN_REASON.discard(user_id)
     BAN_TARGET_ID.pop(user_id, None)
@@ -7998,37 +10237,32 @@ def _queue_broadcast_media_group(user_id: int, message, context: CallbackContext
     if not entry["caption"] and message.caption:
         entry["caption"] = message.caption
 
-    existing_job = PENDING_BROADCAST_JOBS.get(key)
-    if existing_job:
-        existing_job.schedule_removal()
-
-    job = context.job_queue.run_once(
+    # كل صورة جديدة في الألبوم تؤجل الإرسال ثانية أخرى؛ الإرسال نفسه طويل فيخرج من خيط النبضة
+    TIMER_WHEEL.schedule(
+        ("broadcast_group",) + key,
+        1.0,
+        run_after_response,
         _flush_broadcast_media_group,
-        when=1.0,
-        context={"user_id": user_id, "media_group_id": media_group_id},
+        context.bot,
+        user_id,
+        media_group_id,
     )
-    PENDING_BROADCAST_JOBS[key] = job
 
 
-def _flush_broadcast_media_group(context: CallbackContext) -> None:
-    job_context = context.job.context if context.job else {}
-    user_id = job_context.get("user_id")
-    media_group_id = job_context.get("media_group_id")
+def _flush_broadcast_media_group(bot, user_id: int, media_group_id: str) -> None:
     if not user_id or not media_group_id:
         return
+    key = (user_id, media_group_id)
     if user_id not in WAITING_BROADCAST:
-        PENDING_BROADCAST_MEDIA.pop((user_id, media_group_id), None)
-        PENDING_BROADCAST_JOBS.pop((user_id, media_group_id), None)
+        PENDING_BROADCAST_MEDIA.pop(key, None)
         return
-    key = (user_id, media_group_id)
     entry = PENDING_BROADCAST_MEDIA.pop(key, None)
-    PENDING_BROADCAST_JOBS.pop(key, None)
     if not entry:
         return
     media_items = entry.get("items") or []
     caption = entry.get("caption") or ""
     if not media_items:
-        context.bot.send_message(
+        bot.send_message(
             chat_id=user_id,
             text="❌ لم يتم العثور على صور صالحة. الرجاء إعادة الإرسال كـ Photo.",
             reply_markup=CANCEL_KB,
@@ -8036,13 +10270,13 @@ def _flush_broadcast_media_group(context: CallbackContext) -> None:
         return
     user_ids = get_active_user_ids()
     sent, failed = _broadcast_send_media_group(
-        context.bot,
+        bot,
         user_ids,
         media_items,
         caption,
     )
     WAITING_BROADCAST.discard(user_id)
-    context.bot.send_message(
+    bot.send_message(
         chat_id=user_id,
         text=(
             f"✅ تم إرسال الرسالة إلى {sent} مستخدم.\n"
@@ -8056,9 +10290,7 @@ def _clear_broadcast_pending(user_id: int) -> None:
     keys = [key for key in PENDING_BROADCAST_MEDIA if key[0] == user_id]
     for key in keys:
         PENDING_BROADCAST_MEDIA.pop(key, None)
-        job = PENDING_BROADCAST_JOBS.pop(key, None)
-        if job:
-            job.schedule_removal()
+        TIMER_WHEEL.cancel(("broadcast_group",) + key)
 
 
 def handle_admin_broadcast_start(update: Update, context: CallbackContext):
@@ -8259,16 +10491,20 @@ def forward_support_to_admin(user, text: str, context: CallbackContext):
         f"محتوى الرسالة:\n{text}"
     )
 
+    def remember(chat_id, sent):
+        _remember_support_message(chat_id, sent, user.id)
+
     if ADMIN_ID is not None:
-        try:
-            sent = context.bot.send_message(
-                chat_id=ADMIN_ID,
+        send_to_staff(
+            [ADMIN_ID],
+            lambda chat_id: context.bot.send_message(
+                chat_id=chat_id,
                 text=admin_msg,
                 parse_mode="Markdown",
-            )
-            _remember_support_message(ADMIN_ID, sent, user.id)
-        except Exception as e:
-            logger.error(f"Error sending support message to admin: {e}")
+            ),
+            on_sent=remember,
+            label="Support message to admin",
+        )
 
     if gender == "female" and SUPERVISOR_ID is not None:
         supervisor_msg = (
@@ -8279,14 +10515,12 @@ def forward_support_to_admin(user, text: str, context: CallbackContext):
             "الجنس: أنثى\n\n"
             f"محتوى الرسالة:\n{text}"
         )
-        try:
-            sent = context.bot.send_message(
-                chat_id=SUPERVISOR_ID,
-                text=supervisor_msg,
-            )
-            _remember_support_message(SUPERVISOR_ID, sent, user.id)
-        except Exception as e:
-            logger.error(f"Error sending support message to supervisor: {e}")
+        send_to_staff(
+            [SUPERVISOR_ID],
+            lambda chat_id: context.bot.send_message(chat_id=chat_id, text=supervisor_msg),
+            on_sent=remember,
+            label="Support message to supervisor",
+        )
 
 
 def _support_confirmation_text(gender: Optional[str], session_open: bool) -> str:
@@ -8425,6 +10659,7 @@ def handle_support_admin_reply_any(update: Update, context: CallbackContext):
                                 "lesson_id": t.get("lesson_id"),
                                 "lesson_title": t.get("lesson_title"),
                                 "curriculum_section": t.get("curriculum_section"),
+                                "user_chat_id": t.get("user_chat_id") or target_chat_id,
                             }
                             if job_queue:
                                 _schedule_course_benefit_timeout(
@@ -8528,7 +10763,8 @@ def handle_support_admin_reply_any(update: Update, context: CallbackContext):
             msg.reply_text("⚠️ نوع الرسالة غير مدعوم.")
             return
 
-        _reopen_user_mode_after_staff_reply()
+        # حالة المتعلم تُعدّل على مساره هو لا على مسار المشرف
+        run_on_user_lane(target_user_id, _reopen_user_mode_after_staff_reply)
         msg.reply_text("✅ تم إرسال الرد للمتعلم.")
         if (
             sent_to_user
@@ -8581,9 +10817,10 @@ def handle_support_admin_reply_any(update: Update, context: CallbackContext):
 
     user = sender
 
-    target_id = _extract_target_id_from_support_message(msg.reply_to_message)
+    target_id = SUPPORT_MSG_MAP.get((user.id, msg.reply_to_message.message_id))
     if not target_id:
-        target_id = SUPPORT_MSG_MAP.get((user.id, msg.reply_to_message.message_id))
+        # رسائل أقدم من الجدول: نستخرج ID من نص الرسالة
+        target_id = _extract_target_id_from_support_message(msg.reply_to_message)
     if not target_id:
         return
 
@@ -8747,12 +10984,12 @@ def handle_support_photo(update: Update, context: CallbackContext):
         else:
             targets = [ADMIN_ID] if ADMIN_ID else []
 
-        for admin_id in targets:
-            try:
-                sent = context.bot.send_document(chat_id=admin_id, document=best_file_id, caption=text)
-                _remember_support_message(admin_id, sent, user_id)
-            except Exception as e:
-                logger.exception("Support image-document forward failed", exc_info=e)
+        send_to_staff(
+            targets,
+            lambda chat_id: context.bot.send_document(chat_id=chat_id, document=best_file_id, caption=text),
+            on_sent=lambda chat_id, sent: _remember_support_message(chat_id, sent, user_id),
+            label="Support image-document forward",
+        )
 
         update.message.reply_text(
             _support_confirmation_text(record.get("gender"), True),
@@ -8776,12 +11013,12 @@ def handle_support_photo(update: Update, context: CallbackContext):
     else:
         targets = [ADMIN_ID] if ADMIN_ID else []
 
-    for admin_id in targets:
-        try:
-            sent = context.bot.send_photo(chat_id=admin_id, photo=best_photo.file_id, caption=text)
-            _remember_support_message(admin_id, sent, user_id)
-        except Exception as e:
-            logger.warning(f"Support photo forward failed to {admin_id}: {e}")
+    send_to_staff(
+        targets,
+        lambda chat_id: context.bot.send_photo(chat_id=chat_id, photo=best_photo.file_id, caption=text),
+        on_sent=lambda chat_id, sent: _remember_support_message(chat_id, sent, user_id),
+        label="Support photo forward",
+    )
 
     update.message.reply_text(
         _support_confirmation_text(record.get("gender"), True),
@@ -8820,15 +11057,14 @@ def handle_support_audio(update: Update, context: CallbackContext):
     else:
         targets = [ADMIN_ID] if ADMIN_ID else []
 
-    for admin_id in targets:
-        try:
-            if update.message.voice:
-                sent = context.bot.send_voice(chat_id=admin_id, voice=audio.file_id, caption=text)
-            else:
-                sent = context.bot.send_audio(chat_id=admin_id, audio=audio.file_id, caption=text)
-            _remember_support_message(admin_id, sent, user_id)
-        except Exception as e:
-            logger.warning(f"Support audio forward failed to {admin_id}: {e}")
+    send_audio = context.bot.send_voice if update.message.voice else context.bot.send_audio
+    field = "voice" if update.message.voice else "audio"
+    send_to_staff(
+        targets,
+        lambda chat_id: send_audio(chat_id=chat_id, caption=text, **{field: audio.file_id}),
+        on_sent=lambda chat_id, sent: _remember_support_message(chat_id, sent, user_id),
+        label="Support audio forward",
+    )
 
     update.message.reply_text(
         _support_confirmation_text(record.get("gender"), True),
@@ -8867,16 +11103,12 @@ def handle_support_video(update: Update, context: CallbackContext):
     else:
         targets = [ADMIN_ID] if ADMIN_ID else []
 
-    for admin_id in targets:
-        try:
-            sent = context.bot.send_video(
-                chat_id=admin_id,
-                video=video.file_id,
-                caption=text
-            )
-            _remember_support_message(admin_id, sent, user_id)
-        except Exception as e:
-            logger.warning(f"Support video forward failed to {admin_id}: {e}")
+    send_to_staff(
+        targets,
+        lambda chat_id: context.bot.send_video(chat_id=chat_id, video=video.file_id, caption=text),
+        on_sent=lambda chat_id, sent: _remember_support_message(chat_id, sent, user_id),
+        label="Support video forward",
+    )
 
     update.message.reply_text(
         _support_confirmation_text(record.get("gender"), True),
@@ -8914,12 +11146,14 @@ def handle_support_video_note(update: Update, context: CallbackContext):
     else:
         targets = [ADMIN_ID] if ADMIN_ID else []
 
-    for admin_id in targets:
-        try:
-            context.bot.send_message(chat_id=admin_id, text=text)
-            context.bot.send_video_note(chat_id=admin_id, video_note=video_note.file_id)
-        except Exception as e:
-            logger.warning(f"Support video note forward failed to {admin_id}: {e}")
+    send_to_staff(
+        targets,
+        lambda chat_id: send_staff_copy(
+            context.bot, chat_id, text, {"type": "video_note", "file_id": video_note.file_id}
+        ),
+        on_sent=lambda chat_id, sent: _remember_support_message(chat_id, sent, user_id),
+        label="Support video note forward",
+    )
 
     update.message.reply_text(
         _support_confirmation_text(record.get("gender"), True),
@@ -8930,22 +11164,32 @@ def handle_support_video_note(update: Update, context: CallbackContext):
 # =================== دوال جديدة للميزات المطلوبة ===================
 
 # حالات الانتظار الجديدة
-WAITING_MANAGE_POINTS_USER_ID = set()
-WAITING_MANAGE_POINTS_ACTION = {}  # user_id -> target_user_id
-WAITING_MANAGE_POINTS_VALUE = set()
+WAITING_MANAGE_POINTS_USER_ID = SessionStateSet("WAITING_MANAGE_POINTS_USER_ID")
+WAITING_MANAGE_POINTS_ACTION = SessionStateDict("WAITING_MANAGE_POINTS_ACTION")  # user_id -> target_user_id
+WAITING_MANAGE_POINTS_VALUE = SessionStateSet("WAITING_MANAGE_POINTS_VALUE")
 
 def get_user_record_by_id(user_id: int) -> Dict:
     """الحصول على سجل المستخدم بناءً على المعرف"""
     user_id_str = str(user_id)
+    scoped_record = _scoped_record(user_id_str)
+    if scoped_record is not None:
+        return scoped_record
     if not firestore_available():
         return data.get(user_id_str)
+
+    now_dt = datetime.now(timezone.utc)
+    cached_record = data.get(user_id_str)
+    if cached_record and _is_cache_fresh(user_id_str, now_dt):
+        _mark_record_resolved(user_id_str)
+        return cached_record
     try:
         doc_ref = db.collection(USERS_COLLECTION).document(user_id_str)
         doc = doc_ref.get()
         if doc.exists:
             record = doc.to_dict()
-            data[user_id_str] = record
             ensure_medal_defaults(record)
+            _remember_cache(user_id_str, record, now_dt)
+            _mark_record_resolved(user_id_str, from_firestore=True)
             return record
         return None
     except Exception as e:
@@ -8989,6 +11233,147 @@ def handle_supervisor_new_users(update: Update, context: CallbackContext):
     else:
         update.message.reply_text(message, reply_markup=SUPERVISOR_PANEL_KB, parse_mode="Markdown")
 
+# =================== إدخالات إدارة الكتب النصية ===================
+
+def handle_book_category_name_input(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    msg = update.message
+    text = (msg.text or "").strip()
+    ctx = BOOK_CATEGORY_EDIT_CONTEXT.get(user_id, {})
+    name = text.strip()
+    if not name:
+        msg.reply_text("الرجاء إدخال اسم تصنيف صالح.", reply_markup=CANCEL_KB)
+        return
+    mode = ctx.get("mode")
+    if mode == "create":
+        ctx["name"] = name
+        BOOK_CATEGORY_EDIT_CONTEXT[user_id] = ctx
+        WAITING_BOOK_CATEGORY_NAME.discard(user_id)
+        WAITING_BOOK_CATEGORY_ORDER.add(user_id)
+        msg.reply_text("أرسل ترتيب العرض (رقم). اكتب تخطي للإبقاء على الترتيب الافتراضي.", reply_markup=CANCEL_KB)
+    elif mode == "rename" and ctx.get("category_id"):
+        slug_value = re.sub(r"\s+", "-", name.lower())
+        update_book_category(ctx["category_id"], name=name, slug=slug_value)
+        WAITING_BOOK_CATEGORY_NAME.discard(user_id)
+        BOOK_CATEGORY_EDIT_CONTEXT.pop(user_id, None)
+        msg.reply_text("تم تحديث اسم التصنيف.", reply_markup=BOOKS_ADMIN_MENU_KB)
+        open_book_categories_admin(update, context)
+    else:
+        WAITING_BOOK_CATEGORY_NAME.discard(user_id)
+        BOOK_CATEGORY_EDIT_CONTEXT.pop(user_id, None)
+        msg.reply_text("تم إلغاء العملية.", reply_markup=BOOKS_ADMIN_MENU_KB)
+
+
+def handle_book_category_order_input(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    msg = update.message
+    text = (msg.text or "").strip()
+    ctx = BOOK_CATEGORY_EDIT_CONTEXT.get(user_id, {})
+    order_val = 0
+    normalized = text.strip().lower()
+    if normalized not in {"تخطي", "skip", ""}:
+        try:
+            order_val = int(text)
+        except Exception:
+            msg.reply_text("الرجاء إدخال رقم صحيح للترتيب أو اكتب تخطي.", reply_markup=CANCEL_KB)
+            return
+    mode = ctx.get("mode")
+    if mode == "create" and ctx.get("name"):
+        slug_value = re.sub(r"\s+", "-", ctx.get("name").lower())
+        cat_id = save_book_category(ctx.get("name"), order_val, created_by=user_id)
+        WAITING_BOOK_CATEGORY_ORDER.discard(user_id)
+        BOOK_CATEGORY_EDIT_CONTEXT.pop(user_id, None)
+        if cat_id:
+            msg.reply_text(f"تم إنشاء التصنيف بنجاح (ID: {cat_id}).", reply_markup=BOOKS_ADMIN_MENU_KB)
+        else:
+            msg.reply_text("تعذر إنشاء التصنيف حالياً.", reply_markup=BOOKS_ADMIN_MENU_KB)
+        open_book_categories_admin(update, context)
+    elif mode == "order" and ctx.get("category_id"):
+        update_book_category(ctx["category_id"], order=order_val)
+        WAITING_BOOK_CATEGORY_ORDER.discard(user_id)
+        BOOK_CATEGORY_EDIT_CONTEXT.pop(user_id, None)
+        msg.reply_text("تم تحديث ترتيب التصنيف.", reply_markup=BOOKS_ADMIN_MENU_KB)
+        open_book_categories_admin(update, context)
+    else:
+        WAITING_BOOK_CATEGORY_ORDER.discard(user_id)
+        BOOK_CATEGORY_EDIT_CONTEXT.pop(user_id, None)
+        msg.reply_text("تم إلغاء العملية.", reply_markup=BOOKS_ADMIN_MENU_KB)
+
+
+def handle_book_add_title_input(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    msg = update.message
+    text = (msg.text or "").strip()
+    ctx = BOOK_CREATION_CONTEXT.get(user_id, {})
+    ctx["title"] = text
+    BOOK_CREATION_CONTEXT[user_id] = ctx
+    WAITING_BOOK_ADD_TITLE.discard(user_id)
+    WAITING_BOOK_ADD_AUTHOR.add(user_id)
+    msg.reply_text("أرسل اسم المؤلف:", reply_markup=CANCEL_KB)
+
+
+def handle_book_add_category_input(update: Update, context: CallbackContext):
+    update.message.reply_text("اختر التصنيف من الأزرار المعروضة.", reply_markup=CANCEL_KB)
+
+
+def handle_book_add_author_input(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    msg = update.message
+    text = (msg.text or "").strip()
+    ctx = BOOK_CREATION_CONTEXT.get(user_id, {})
+    ctx["author"] = text
+    BOOK_CREATION_CONTEXT[user_id] = ctx
+    WAITING_BOOK_ADD_AUTHOR.discard(user_id)
+    WAITING_BOOK_ADD_DESCRIPTION.add(user_id)
+    msg.reply_text("أرسل وصفًا مختصرًا (أو اكتب تخطي لتجاوز الوصف):", reply_markup=CANCEL_KB)
+
+
+def handle_book_add_description_input(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    msg = update.message
+    text = (msg.text or "").strip()
+    ctx = BOOK_CREATION_CONTEXT.get(user_id, {})
+    if text.strip().lower() in {"تخطي", "skip"}:
+        ctx["description"] = ""
+    else:
+        ctx["description"] = text
+    BOOK_CREATION_CONTEXT[user_id] = ctx
+    WAITING_BOOK_ADD_DESCRIPTION.discard(user_id)
+    WAITING_BOOK_ADD_TAGS.add(user_id)
+    msg.reply_text("أرسل الكلمات المفتاحية مفصولة بفواصل (أو اكتب تخطي):", reply_markup=CANCEL_KB)
+
+
+def handle_book_add_tags_input(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    msg = update.message
+    text = (msg.text or "").strip()
+    ctx = BOOK_CREATION_CONTEXT.get(user_id, {})
+    if text.strip().lower() in {"تخطي", "skip"}:
+        ctx["tags"] = []
+    else:
+        ctx["tags"] = _parse_tags_input(text)
+    BOOK_CREATION_CONTEXT[user_id] = ctx
+    WAITING_BOOK_ADD_TAGS.discard(user_id)
+    WAITING_BOOK_ADD_COVER.add(user_id)
+    msg.reply_text("أرسل صورة الغلاف (اختياري) أو اكتب تخطي:", reply_markup=CANCEL_KB)
+
+
+def handle_book_add_cover_input(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    msg = update.message
+    text = (msg.text or "").strip()
+    if text.strip().lower() in {"تخطي", "skip"}:
+        WAITING_BOOK_ADD_COVER.discard(user_id)
+        WAITING_BOOK_ADD_PDF.add(user_id)
+        msg.reply_text("أرسل ملف الـ PDF للكتاب (إجباري):", reply_markup=CANCEL_KB)
+    else:
+        msg.reply_text("أرسل صورة غلاف صالحة أو اكتب تخطي.", reply_markup=CANCEL_KB)
+
+
+def handle_book_add_pdf_input(update: Update, context: CallbackContext):
+    update.message.reply_text("أرسل ملف الـ PDF للكتاب.", reply_markup=CANCEL_KB)
+
+
 # =================== هاندلر الرسالل ===================
 
 
@@ -8999,8 +11384,8 @@ def handle_text(update: Update, context: CallbackContext):
     msg = update.message
     text = (msg.text or "").strip()
 
+    # سجل المستخدم يُقرأ مرة واحدة لكل تحديث (update_user_record يحدّث الكاش نفسه)
     record = get_user_record(user) or {}
-    fresh_record = get_user_record_by_id(user_id) or record
     in_admin_books_mode = _ensure_is_admin_or_supervisor(user_id) and context.user_data.get("books_admin_mode")
 
     if user_id in WAITING_BOOK_EDIT_FIELD:
@@ -9045,7 +11430,7 @@ def handle_text(update: Update, context: CallbackContext):
         return
 
     # ✅ بحث مكتبة طالب العلم: يعتمد على Firestore
-    if not in_admin_books_mode and (user_id in WAITING_BOOK_SEARCH or fresh_record.get("book_search_waiting", False)):
+    if not in_admin_books_mode and (user_id in WAITING_BOOK_SEARCH or record.get("book_search_waiting", False)):
         WAITING_BOOK_SEARCH.discard(user_id)
         logger.info("[BOOKS][SEARCH_ROUTE] user=%s text=%r", user_id, text)
         handle_book_search_input(update, context)
@@ -9069,1153 +11454,946 @@ def handle_text(update: Update, context: CallbackContext):
     main_kb = user_main_keyboard(user_id)
     support_session_active = user_id in WAITING_SUPPORT
 
-    # بيانات التسجيل في الدورات
-    if user_id in WAITING_COURSE_COUNTRY:
-        if text == BTN_CANCEL:
-            _reset_course_subscription_flow(user_id)
-            msg.reply_text("تم إلغاء التسجيل في الدورة.", reply_markup=COURSES_USER_MENU_KB)
+    # حالات إدخال الدورات والملف الشخصي والدعم (جدول TEXT_INPUT_STATE_ROUTES)
+    route = _resolve_input_state_route(text, user_states(user_id))
+    if route is not None and _run_text_route(route[0], route[1], update, context) is not False:
+        return
+
+    # رد المستخدم على ردود الدعم
+    if (
+        not is_admin(user_id)
+        and not is_supervisor(user_id)
+        and msg.reply_to_message
+        and msg.reply_to_message.from_user.id == context.bot.id
+    ):
+        original = (msg.reply_to_message.text or msg.reply_to_message.caption or "").strip()
+        if (
+            original.startswith("💌 رد من الدعم")
+            or original.startswith("📢 رسالة من الدعم")
+            or original.startswith("💌 رد من المشرفة")
+            or "رسالتك وصلت للدعم" in original
+        ):
+            if user_id in WAITING_SUPPORT:
+                forward_support_to_admin(user, text, context)
+                msg.reply_text(
+                    _support_confirmation_text(record.get("gender"), True),
+                    reply_markup=SUPPORT_SESSION_KB,
+                )
+            else:
+                msg.reply_text(
+                    "للتواصل مع الدعم اضغط على زر التواصل مع الدعم فقط.",
+                    reply_markup=main_kb,
+                )
             return
 
-        COURSE_SUBSCRIPTION_CONTEXT.setdefault(user_id, {})["country"] = text
-        WAITING_COURSE_COUNTRY.discard(user_id)
-        saved_name = _get_saved_course_full_name(user_id)
-        if saved_name:
-            COURSE_SUBSCRIPTION_CONTEXT[user_id]["full_name"] = saved_name
-            WAITING_COURSE_AGE.add(user_id)
+    if text == BTN_SUPPORT_END:
+        if user_id in WAITING_SUPPORT:
+            WAITING_SUPPORT.discard(user_id)
+            WAITING_SUPPORT_GENDER.discard(user_id)
             msg.reply_text(
-                "كم عمرك؟",
-                reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BTN_CANCEL)]], resize_keyboard=True),
+                "تم إنهاء التواصل مع الدعم ✅",
+                reply_markup=main_kb,
             )
         else:
-            WAITING_COURSE_FULL_NAME.add(user_id)
             msg.reply_text(
-                "ادخل اسمك الكامل الذي توده أن يظهر على الشهادة",
-                reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BTN_CANCEL)]], resize_keyboard=True),
+                "لا توجد محادثة دعم مفتوحة حالياً.",
+                reply_markup=main_kb,
             )
         return
 
-    if user_id in WAITING_COURSE_FULL_NAME:
-        if text == BTN_CANCEL:
-            _reset_course_subscription_flow(user_id)
-            msg.reply_text("تم إلغاء التسجيل في الدورة.", reply_markup=COURSES_USER_MENU_KB)
-            return
-
-        full_name_value = text.strip()
-        if not full_name_value:
-            msg.reply_text(
-                "⚠️ الرجاء إدخال اسم كامل صالح.",
-                reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BTN_CANCEL)]], resize_keyboard=True),
+    # زر إلغاء عام
+    if text == BTN_CANCEL:
+        if support_session_active:
+            update.message.reply_text(
+                "جلسة الدعم ما زالت مفتوحة. اضغط «🔚 إنهاء التواصل» لإغلاقها.",
+                reply_markup=SUPPORT_SESSION_KB,
             )
             return
-
-        ctx = COURSE_SUBSCRIPTION_CONTEXT.setdefault(user_id, {})
-        ctx["full_name"] = full_name_value
-        WAITING_COURSE_FULL_NAME.discard(user_id)
-        if ctx.get("age") is not None and ctx.get("gender"):
-            WAITING_COURSE_AGE.discard(user_id)
-            WAITING_COURSE_GENDER.discard(user_id)
-            _finalize_course_subscription(user, context)
-        elif ctx.get("age") is not None:
-            WAITING_COURSE_AGE.discard(user_id)
-            WAITING_COURSE_GENDER.add(user_id)
-            msg.reply_text("اختر الجنس:", reply_markup=GENDER_KB)
-        else:
-            WAITING_COURSE_AGE.add(user_id)
-            msg.reply_text(
-                "كم عمرك؟",
-                reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BTN_CANCEL)]], resize_keyboard=True),
+        # إزالة المستخدم من جميع حالات الانتظار وبياناتها دفعة واحدة
+        reset_user_states(user_id, CANCEL_RESET_STATES)
+        _clear_broadcast_pending(user_id)
+        update_user_record(user_id, book_search_waiting=False, book_search_waiting_at=None)
+        
+        # حالة خاصة: إلغاء تعديل الفائدة (المشكلة 1)
+        if user_id in WAITING_BENEFIT_EDIT_TEXT:
+            WAITING_BENEFIT_EDIT_TEXT.discard(user_id)
+            BENEFIT_EDIT_ID.pop(user_id, None)
+            update.message.reply_text(
+                "❌ تم إلغاء التعديل.\nعدنا لقسم مجتمع الفوائد و النصائح.",
+                reply_markup=BENEFITS_MENU_KB,
             )
-        return
-
-    if user_id in WAITING_COURSE_AGE:
-        if text == BTN_CANCEL:
-            _reset_course_subscription_flow(user_id)
-            msg.reply_text("تم إلغاء التسجيل في الدورة.", reply_markup=COURSES_USER_MENU_KB)
             return
-
-        if not text.isdigit():
-            msg.reply_text(
-                "⚠️ أرسل عمرك كرقم صحيح.",
-                reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BTN_CANCEL)]], resize_keyboard=True),
+        
+        # حالة خاصة: إلغاء إضافة فائدة
+        if user_id in WAITING_BENEFIT_TEXT:
+            WAITING_BENEFIT_TEXT.discard(user_id)
+            update.message.reply_text(
+                "تم إلغاء إضافة الفائدة.",
+                reply_markup=BENEFITS_MENU_KB,
             )
             return
-
-        age_val = int(text)
-        if age_val <= 0 or age_val > 120:
-            msg.reply_text(
-                "⚠️ الرجاء إدخال عمر صالح.",
-                reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BTN_CANCEL)]], resize_keyboard=True),
+            
+        # حالة خاصة: إلغاء تأكيد حذف الفائدة
+        if user_id in WAITING_BENEFIT_DELETE_CONFIRM:
+            WAITING_BENEFIT_DELETE_CONFIRM.discard(user_id)
+            BENEFIT_EDIT_ID.pop(user_id, None)
+            update.message.reply_text(
+                "تم إلغاء عملية الحذف.",
+                reply_markup=BENEFITS_MENU_KB,
             )
             return
-
-        COURSE_SUBSCRIPTION_CONTEXT.setdefault(user_id, {})["age"] = age_val
-        WAITING_COURSE_AGE.discard(user_id)
-        WAITING_COURSE_GENDER.add(user_id)
-        msg.reply_text("اختر الجنس:", reply_markup=GENDER_KB)
+        
+        # إذا كان الإلغاء من أي مكان آخر، نعود للقائمة الرئيسية
+        main_kb = user_main_keyboard(user_id)
+        update.message.reply_text(
+            "تم الإلغاء. عدنا للقائمة الرئيسية.",
+            reply_markup=main_kb,
+        )
         return
 
-    if user_id in WAITING_COURSE_GENDER:
-        if text == BTN_CANCEL:
-            _reset_course_subscription_flow(user_id)
-            msg.reply_text("تم إلغاء التسجيل في الدورة.", reply_markup=COURSES_USER_MENU_KB)
-            return
+    if user_id in WAITING_SUPPORT:
+        forward_support_to_admin(user, text, context)
 
-        if text == BTN_GENDER_MALE:
-            COURSE_SUBSCRIPTION_CONTEXT.setdefault(user_id, {})["gender"] = "male"
-        elif text == BTN_GENDER_FEMALE:
-            COURSE_SUBSCRIPTION_CONTEXT.setdefault(user_id, {})["gender"] = "female"
-        else:
-            msg.reply_text("رجاءً اختر من الأزرار الموجودة 👇", reply_markup=GENDER_KB)
-            return
+        msg.reply_text(
+            _support_confirmation_text(record.get("gender"), True),
+            reply_markup=SUPPORT_SESSION_KB,
+        )
+        return
 
-        WAITING_COURSE_GENDER.discard(user_id)
-        _finalize_course_subscription(user, context)
+    # التوجيه حسب حالة الجلسة ثم حسب نص الزر
+    route = _resolve_text_route(text, user_states(user_id))
+    if route is not None:
+        _run_text_route(route[0], route[1], update, context)
         return
 
-    if user_id in WAITING_PROFILE_EDIT_NAME:
-        if text == BTN_CANCEL:
-            _reset_profile_edit_flow(user_id)
-            msg.reply_text("تم إلغاء تعديل البيانات.", reply_markup=user_main_keyboard(user_id))
-            return
+    # أي نص آخر
+    if not support_session_active and not is_admin(user_id) and not is_supervisor(user_id):
+        msg.reply_text(
+            "رسالتك لم تُرسل للدعم. إذا أردت التواصل مع الدعم اضغط زر (تواصل مع الدعم ✉️).",
+            reply_markup=SUPPORT_PROMPT_KB,
+        )
 
-        name_value = text.strip()
-        if not name_value:
-            msg.reply_text(
-                "⚠️ الرجاء إدخال اسم كامل صالح.",
-                reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BTN_CANCEL)]], resize_keyboard=True),
-            )
-            return
+# =================== حالات إدخال الدورات والملف الشخصي ===================
+
+def handle_course_country_input(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    msg = update.message
+    text = (msg.text or "").strip()
 
-        PROFILE_EDIT_CONTEXT.setdefault(user_id, {})["full_name"] = name_value
-        WAITING_PROFILE_EDIT_NAME.discard(user_id)
-        WAITING_PROFILE_EDIT_AGE.add(user_id)
-        current_age = PROFILE_EDIT_CONTEXT[user_id].get("age")
-        age_hint = f"العمر الحالي: {current_age}" if current_age is not None else "العمر غير محدد"
+    COURSE_SUBSCRIPTION_CONTEXT.setdefault(user_id, {})["country"] = text
+    WAITING_COURSE_COUNTRY.discard(user_id)
+    saved_name = _get_saved_course_full_name(user_id)
+    if saved_name:
+        COURSE_SUBSCRIPTION_CONTEXT[user_id]["full_name"] = saved_name
+        WAITING_COURSE_AGE.add(user_id)
         msg.reply_text(
-            f"{age_hint}\n\nكم عمرك الآن؟",
+            "كم عمرك؟",
+            reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BTN_CANCEL)]], resize_keyboard=True),
+        )
+    else:
+        WAITING_COURSE_FULL_NAME.add(user_id)
+        msg.reply_text(
+            "ادخل اسمك الكامل الذي توده أن يظهر على الشهادة",
             reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BTN_CANCEL)]], resize_keyboard=True),
         )
-        return
-
-    if user_id in WAITING_PROFILE_EDIT_AGE:
-        if text == BTN_CANCEL:
-            _reset_profile_edit_flow(user_id)
-            msg.reply_text("تم إلغاء تعديل البيانات.", reply_markup=user_main_keyboard(user_id))
-            return
 
-        if not text.isdigit():
-            msg.reply_text(
-                "⚠️ أرسل عمرك كرقم صحيح.",
-                reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BTN_CANCEL)]], resize_keyboard=True),
-            )
-            return
 
-        age_val = int(text)
-        if age_val <= 0 or age_val > 120:
-            msg.reply_text(
-                "⚠️ الرجاء إدخال عمر صالح.",
-                reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BTN_CANCEL)]], resize_keyboard=True),
-            )
-            return
+def handle_course_full_name_input(update: Update, context: CallbackContext):
+    user = update.effective_user
+    user_id = user.id
+    msg = update.message
+    text = (msg.text or "").strip()
 
-        PROFILE_EDIT_CONTEXT.setdefault(user_id, {})["age"] = age_val
-        WAITING_PROFILE_EDIT_AGE.discard(user_id)
-        WAITING_PROFILE_EDIT_COUNTRY.add(user_id)
-        current_country = PROFILE_EDIT_CONTEXT[user_id].get("country") or "غير محدد"
+    full_name_value = text.strip()
+    if not full_name_value:
         msg.reply_text(
-            f"الدولة الحالية: {current_country}\n\nاكتب دولتك الآن.",
+            "⚠️ الرجاء إدخال اسم كامل صالح.",
             reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BTN_CANCEL)]], resize_keyboard=True),
         )
         return
 
-    if user_id in WAITING_PROFILE_EDIT_COUNTRY:
-        if text == BTN_CANCEL:
-            _reset_profile_edit_flow(user_id)
-            msg.reply_text("تم إلغاء تعديل البيانات.", reply_markup=user_main_keyboard(user_id))
-            return
-
-        country_val = text.strip()
-        if not country_val:
-            msg.reply_text(
-                "⚠️ الرجاء إدخال اسم دولة صحيح.",
-                reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BTN_CANCEL)]], resize_keyboard=True),
-            )
-            return
-
-        PROFILE_EDIT_CONTEXT.setdefault(user_id, {})["country"] = country_val
-        WAITING_PROFILE_EDIT_COUNTRY.discard(user_id)
-        _finalize_profile_edit(user_id, msg.chat_id, context)
-        return
+    ctx = COURSE_SUBSCRIPTION_CONTEXT.setdefault(user_id, {})
+    ctx["full_name"] = full_name_value
+    WAITING_COURSE_FULL_NAME.discard(user_id)
+    if ctx.get("age") is not None and ctx.get("gender"):
+        WAITING_COURSE_AGE.discard(user_id)
+        WAITING_COURSE_GENDER.discard(user_id)
+        _finalize_course_subscription(user, context)
+    elif ctx.get("age") is not None:
+        WAITING_COURSE_AGE.discard(user_id)
+        WAITING_COURSE_GENDER.add(user_id)
+        msg.reply_text("اختر الجنس:", reply_markup=GENDER_KB)
+    else:
+        WAITING_COURSE_AGE.add(user_id)
+        msg.reply_text(
+            "كم عمرك؟",
+            reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BTN_CANCEL)]], resize_keyboard=True),
+        )
 
-    # إجابات الاختبارات الخاصة بالدورات
-    if user_id in WAITING_QUIZ_ANSWER:
-        if _complete_quiz_answer(user_id, text, update, context):
-            return
 
-    # إنشاء دورة جديدة
-    if user_id in WAITING_NEW_COURSE:
-        if not (is_admin(user_id) or is_supervisor(user_id)):
-            _reset_course_creation(user_id)
-            msg.reply_text(
-                "❌ ليس لديك صلاحية لإنشاء الدورات.",
-                reply_markup=COURSES_ADMIN_MENU_KB,
-            )
-            return
+def handle_course_age_input(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    msg = update.message
+    text = (msg.text or "").strip()
 
-        if text == BTN_CANCEL:
-            _reset_course_creation(user_id)
-            msg.reply_text("تم الإلغاء بنجاح", reply_markup=COURSES_ADMIN_MENU_KB)
-            return
+    if not text.isdigit():
+        msg.reply_text(
+            "⚠️ أرسل عمرك كرقم صحيح.",
+            reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BTN_CANCEL)]], resize_keyboard=True),
+        )
+        return
 
-        course_name = text.strip()
-        if not course_name:
-            msg.reply_text(
-                "⚠️ اسم الدورة لا يمكن أن يكون فارغاً.",
-                reply_markup=_course_creation_keyboard(),
-            )
-            return
+    age_val = int(text)
+    if age_val <= 0 or age_val > 120:
+        msg.reply_text(
+            "⚠️ الرجاء إدخال عمر صالح.",
+            reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BTN_CANCEL)]], resize_keyboard=True),
+        )
+        return
 
-        if len(course_name) < COURSE_NAME_MIN_LENGTH:
-            msg.reply_text(
-                f"⚠️ اسم الدورة قصير جداً. الحد الأدنى {COURSE_NAME_MIN_LENGTH} حروف.",
-                reply_markup=_course_creation_keyboard(),
-            )
-            return
+    COURSE_SUBSCRIPTION_CONTEXT.setdefault(user_id, {})["age"] = age_val
+    WAITING_COURSE_AGE.discard(user_id)
+    WAITING_COURSE_GENDER.add(user_id)
+    msg.reply_text("اختر الجنس:", reply_markup=GENDER_KB)
 
-        if len(course_name) > COURSE_NAME_MAX_LENGTH:
-            msg.reply_text(
-                f"⚠️ اسم الدورة طويل جداً. الحد الأقصى {COURSE_NAME_MAX_LENGTH} حرفاً.",
-                reply_markup=_course_creation_keyboard(),
-            )
-            return
 
-        normalized = course_name.lower()
-        try:
-            existing = list(
-                db.collection(COURSES_COLLECTION)
-                .where("name_lower", "==", normalized)
-                .stream()
-            )
-            if not existing:
-                existing = list(
-                    db.collection(COURSES_COLLECTION)
-                    .where("name", "==", course_name)
-                    .stream()
-                )
-            if existing:
-                msg.reply_text(
-                    "⚠️ توجد دورة بنفس الاسم بالفعل. استخدم اسماً مختلفاً.",
-                    reply_markup=_course_creation_keyboard(),
-                )
-                return
+def handle_course_gender_input(update: Update, context: CallbackContext):
+    user = update.effective_user
+    user_id = user.id
+    msg = update.message
+    text = (msg.text or "").strip()
 
-            db.collection(COURSES_COLLECTION).add(
-                {
-                    "name": course_name,
-                    "name_lower": normalized,
-                    "description": COURSE_CREATION_CONTEXT.get(user_id, {}).get(
-                        "description", ""
-                    ),
-                    "status": "active",
-                    "created_at": firestore.SERVER_TIMESTAMP,
-                }
-            )
-            _broadcast_course_update(
-                msg.bot,
-                (
-                    "📚 تم إطلاق دورة جديدة: "
-                    f"«{course_name}».\nيمكنكم العثور عليها في قسم «الدورات» ثم الاشتراك فيها من هناك."
-                ),
-            )
-            _reset_course_creation(user_id)
-            msg.reply_text(
-                f"✅ تم إنشاء دورة ({course_name}) بنجاح",
-                reply_markup=COURSES_ADMIN_MENU_KB,
-            )
-        except Exception as e:
-            logger.error(f"خطأ في إنشاء الدورة: {e}")
-            _reset_course_creation(user_id)
-            msg.reply_text(
-                "❌ تعذر إنشاء الدورة حالياً.",
-                reply_markup=COURSES_ADMIN_MENU_KB,
-            )
+    if text == BTN_GENDER_MALE:
+        COURSE_SUBSCRIPTION_CONTEXT.setdefault(user_id, {})["gender"] = "male"
+    elif text == BTN_GENDER_FEMALE:
+        COURSE_SUBSCRIPTION_CONTEXT.setdefault(user_id, {})["gender"] = "female"
+    else:
+        msg.reply_text("رجاءً اختر من الأزرار الموجودة 👇", reply_markup=GENDER_KB)
         return
 
-    # إنشاء درس جديد
-    if user_id in WAITING_LESSON_TITLE:
-        ctx = LESSON_CREATION_CONTEXT.get(user_id, {}) or {}
-        course_id = ctx.get("course_id")
-        lesson_id = ctx.get("lesson_id")
-        edit_action = ctx.get("edit_action")
-        if text == BTN_CANCEL:
-            _reset_lesson_creation(user_id)
-            msg.reply_text("تم الإلغاء.", reply_markup=_lessons_back_keyboard(course_id))
-            return
+    WAITING_COURSE_GENDER.discard(user_id)
+    _finalize_course_subscription(user, context)
 
-        if edit_action == "edit_title":
-            try:
-                doc_ref = db.collection(COURSE_LESSONS_COLLECTION).document(lesson_id)
-                if not doc_ref.get().exists:
-                    msg.reply_text("❌ الدرس غير موجود.", reply_markup=_lessons_back_keyboard(course_id))
-                else:
-                    doc_ref.update(
-                        {
-                            "title": text,
-                            "updated_at": firestore.SERVER_TIMESTAMP,
-                        }
-                    )
-                    msg.reply_text("✅ تم تعديل العنوان.", reply_markup=_lessons_back_keyboard(course_id))
-            except Exception as e:
-                logger.error(f"خطأ في تعديل عنوان الدرس: {e}")
-                msg.reply_text("❌ تعذر تعديل العنوان حالياً.", reply_markup=_lessons_back_keyboard(course_id))
-            finally:
-                _reset_lesson_creation(user_id)
-            return
 
-        LESSON_CREATION_CONTEXT.setdefault(user_id, {})["title"] = text
-        WAITING_LESSON_TITLE.discard(user_id)
-        lesson_type_kb = InlineKeyboardMarkup(
-            [
-                [InlineKeyboardButton("📝 نص", callback_data=f"COURSES:lesson_type_text_{course_id}")],
-                [InlineKeyboardButton("🔊 ملف صوتي", callback_data=f"COURSES:lesson_type_audio_{course_id}")],
-                [InlineKeyboardButton("🔗 رابط", callback_data=f"COURSES:lesson_type_link_{course_id}")],
-                [InlineKeyboardButton("🖼️ صورة", callback_data=f"COURSES:lesson_type_image_{course_id}")],
-                [InlineKeyboardButton("🔙 رجوع", callback_data=f"COURSES:lessons_{course_id}")],
-            ]
+def handle_profile_edit_name_input(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    msg = update.message
+    text = (msg.text or "").strip()
+
+    name_value = text.strip()
+    if not name_value:
+        msg.reply_text(
+            "⚠️ الرجاء إدخال اسم كامل صالح.",
+            reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BTN_CANCEL)]], resize_keyboard=True),
         )
-        msg.reply_text("اختر نوع محتوى الدرس:", reply_markup=lesson_type_kb)
         return
 
-    if user_id in WAITING_LESSON_CONTENT:
-        ctx = LESSON_CREATION_CONTEXT.get(user_id, {}) or {}
-        course_id = ctx.get("course_id")
-        content_type = ctx.get("content_type")
-        title = ctx.get("title")
-        lesson_id = ctx.get("lesson_id")
-        edit_action = ctx.get("edit_action")
-        if text == BTN_CANCEL:
-            _reset_lesson_creation(user_id)
-            msg.reply_text("تم الإلغاء.", reply_markup=_lessons_back_keyboard(course_id))
-            return
-
-        if not course_id or not title or content_type not in {"text", "link"}:
-            _reset_lesson_creation(user_id)
-            msg.reply_text("❌ البيانات غير مكتملة.", reply_markup=COURSES_ADMIN_MENU_KB)
-            return
-
-        if edit_action == "edit_content":
-            if not lesson_id:
-                _reset_lesson_creation(user_id)
-                msg.reply_text("❌ الدرس غير معروف.", reply_markup=COURSES_ADMIN_MENU_KB)
-                return
-            _update_lesson(
-                user_id,
-                lesson_id,
-                course_id,
-                title,
-                content_type,
-                msg,
-                content_value=text,
-            )
-        else:
-            _save_lesson(user_id, course_id, title, content_type, msg, text)
-        return
+    PROFILE_EDIT_CONTEXT.setdefault(user_id, {})["full_name"] = name_value
+    WAITING_PROFILE_EDIT_NAME.discard(user_id)
+    WAITING_PROFILE_EDIT_AGE.add(user_id)
+    current_age = PROFILE_EDIT_CONTEXT[user_id].get("age")
+    age_hint = f"العمر الحالي: {current_age}" if current_age is not None else "العمر غير محدد"
+    msg.reply_text(
+        f"{age_hint}\n\nكم عمرك الآن؟",
+        reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BTN_CANCEL)]], resize_keyboard=True),
+    )
 
-    if user_id in WAITING_LESSON_CURRICULUM_NAME:
-        ctx = LESSON_CREATION_CONTEXT.get(user_id, {}) or {}
-        course_id = ctx.get("course_id")
-        lesson_id = ctx.get("lesson_id")
-        if text == BTN_CANCEL:
-            _reset_lesson_creation(user_id)
-            msg.reply_text("تم الإلغاء.", reply_markup=_lessons_back_keyboard(course_id))
-            return
-        try:
-            db.collection(COURSE_LESSONS_COLLECTION).document(lesson_id).update(
-                {"curriculum_section": text, "updated_at": firestore.SERVER_TIMESTAMP}
-            )
-            msg.reply_text("✅ تم حفظ باب المقرر للدرس.", reply_markup=_lessons_back_keyboard(course_id))
-        except Exception as e:
-            logger.error(f"خطأ في حفظ باب المقرر: {e}")
-            msg.reply_text("❌ تعذر الحفظ حالياً.", reply_markup=_lessons_back_keyboard(course_id))
-        finally:
-            _reset_lesson_creation(user_id)
-        return
 
-    # إنشاء اختبار جديد
-    if user_id in WAITING_QUIZ_TITLE:
-        course_id = QUIZ_CREATION_CONTEXT.get(user_id, {}).get("course_id")
-        if text == BTN_CANCEL:
-            _reset_quiz_creation(user_id)
-            msg.reply_text("تم الإلغاء.", reply_markup=_quizzes_back_keyboard(course_id))
-            return
+def handle_profile_edit_age_input(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    msg = update.message
+    text = (msg.text or "").strip()
 
-        QUIZ_CREATION_CONTEXT.setdefault(user_id, {})["title"] = text
-        WAITING_QUIZ_TITLE.discard(user_id)
-        WAITING_QUIZ_QUESTION.add(user_id)
+    if not text.isdigit():
         msg.reply_text(
-            "✏️ اكتب سؤال الاختبار الآن.",
-            reply_markup=_quizzes_back_keyboard(course_id),
+            "⚠️ أرسل عمرك كرقم صحيح.",
+            reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BTN_CANCEL)]], resize_keyboard=True),
         )
         return
 
-    if user_id in WAITING_QUIZ_QUESTION:
-        course_id = QUIZ_CREATION_CONTEXT.get(user_id, {}).get("course_id")
-        if text == BTN_CANCEL:
-            _reset_quiz_creation(user_id)
-            msg.reply_text("تم الإلغاء.", reply_markup=_quizzes_back_keyboard(course_id))
-            return
-
-        QUIZ_CREATION_CONTEXT.setdefault(user_id, {})["question"] = text
-        QUIZ_CREATION_CONTEXT.setdefault(user_id, {}).setdefault("answers", [])
-        WAITING_QUIZ_QUESTION.discard(user_id)
-        WAITING_QUIZ_ANSWER_TEXT.add(user_id)
+    age_val = int(text)
+    if age_val <= 0 or age_val > 120:
         msg.reply_text(
-            "اكتب الإجابة الأولى.",
-            reply_markup=_quizzes_back_keyboard(course_id),
+            "⚠️ الرجاء إدخال عمر صالح.",
+            reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BTN_CANCEL)]], resize_keyboard=True),
         )
         return
 
-    if user_id in WAITING_QUIZ_ANSWER_TEXT:
-        course_id = QUIZ_CREATION_CONTEXT.get(user_id, {}).get("course_id")
-        if text == BTN_CANCEL:
-            _reset_quiz_creation(user_id)
-            msg.reply_text("تم الإلغاء.", reply_markup=_quizzes_back_keyboard(course_id))
-            return
+    PROFILE_EDIT_CONTEXT.setdefault(user_id, {})["age"] = age_val
+    WAITING_PROFILE_EDIT_AGE.discard(user_id)
+    WAITING_PROFILE_EDIT_COUNTRY.add(user_id)
+    current_country = PROFILE_EDIT_CONTEXT[user_id].get("country") or "غير محدد"
+    msg.reply_text(
+        f"الدولة الحالية: {current_country}\n\nاكتب دولتك الآن.",
+        reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BTN_CANCEL)]], resize_keyboard=True),
+    )
 
-        ctx = QUIZ_CREATION_CONTEXT.setdefault(user_id, {})
-        ctx.setdefault("answers", []).append({"text": text})
-        WAITING_QUIZ_ANSWER_TEXT.discard(user_id)
 
-        if len(ctx.get("answers", [])) >= 4:
-            _finalize_quiz_creation_from_message(user_id, msg)
-            return
+def handle_profile_edit_country_input(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    msg = update.message
+    text = (msg.text or "").strip()
 
-        options_kb = InlineKeyboardMarkup(
-            [
-                [InlineKeyboardButton("➕ إضافة إجابة أخرى", callback_data=f"COURSES:quiz_more_{course_id}")],
-                [InlineKeyboardButton("✅ إنهاء", callback_data=f"COURSES:quiz_finish_{course_id}")],
-            ]
-        )
+    country_val = text.strip()
+    if not country_val:
         msg.reply_text(
-            "تم حفظ الإجابة. اختر التالي أو أضف إجابة أخرى.",
-            reply_markup=options_kb,
+            "⚠️ الرجاء إدخال اسم دولة صحيح.",
+            reply_markup=ReplyKeyboardMarkup([[KeyboardButton(BTN_CANCEL)]], resize_keyboard=True),
         )
         return
-    # تحديد الجنس للدعم
-    if user_id in WAITING_SUPPORT_GENDER:
-        if text == BTN_GENDER_MALE:
-            record["gender"] = "male"
-            update_user_record(user.id, gender="male")
-            save_data()
-            WAITING_SUPPORT_GENDER.discard(user_id)
-            _open_support_session(update, user_id)
-            return
-        elif text == BTN_GENDER_FEMALE:
-            record["gender"] = "female"
-            update_user_record(user.id, gender="female")
-            save_data()
-            WAITING_SUPPORT_GENDER.discard(user_id)
-            _open_support_session(update, user_id)
-            return
-        elif text == BTN_CANCEL:
-            WAITING_SUPPORT_GENDER.discard(user_id)
-            msg.reply_text(
-                "تم الإلغاء. عدنا للقائمة الرئيسية.",
-                reply_markup=main_kb,
-            )
-            return
-        else:
-            msg.reply_text(
-                "رجاءً اختر من الأزرار الموجودة 👇",
-                reply_markup=GENDER_KB,
-            )
-            return
 
-    # رد المستخدم على ردود الدعم
-    if (
-        not is_admin(user_id)
-        and not is_supervisor(user_id)
-        and msg.reply_to_message
-        and msg.reply_to_message.from_user.id == context.bot.id
-    ):
-        original = (msg.reply_to_message.text or msg.reply_to_message.caption or "").strip()
-        if (
-            original.startswith("💌 رد من الدعم")
-            or original.startswith("📢 رسالة من الدعم")
-            or original.startswith("💌 رد من المشرفة")
-            or "رسالتك وصلت للدعم" in original
-        ):
-            if user_id in WAITING_SUPPORT:
-                forward_support_to_admin(user, text, context)
-                msg.reply_text(
-                    _support_confirmation_text(record.get("gender"), True),
-                    reply_markup=SUPPORT_SESSION_KB,
-                )
-            else:
-                msg.reply_text(
-                    "للتواصل مع الدعم اضغط على زر التواصل مع الدعم فقط.",
-                    reply_markup=main_kb,
-                )
-            return
+    PROFILE_EDIT_CONTEXT.setdefault(user_id, {})["country"] = country_val
+    WAITING_PROFILE_EDIT_COUNTRY.discard(user_id)
+    _finalize_profile_edit(user_id, msg.chat_id, context)
 
-    if text == BTN_SUPPORT_END:
-        if user_id in WAITING_SUPPORT:
-            WAITING_SUPPORT.discard(user_id)
-            WAITING_SUPPORT_GENDER.discard(user_id)
-            msg.reply_text(
-                "تم إنهاء التواصل مع الدعم ✅",
-                reply_markup=main_kb,
-            )
-        else:
-            msg.reply_text(
-                "لا توجد محادثة دعم مفتوحة حالياً.",
-                reply_markup=main_kb,
-            )
-        return
 
-    # زر إلغاء عام
-    if text == BTN_CANCEL:
-        if support_session_active:
-            update.message.reply_text(
-                "جلسة الدعم ما زالت مفتوحة. اضغط «🔚 إنهاء التواصل» لإغلاقها.",
-                reply_markup=SUPPORT_SESSION_KB,
-            )
-            return
-        # إزالة المستخدم من جميع حالات الانتظار
-        WAITING_QURAN_GOAL.discard(user_id)
-        WAITING_QURAN_ADD_PAGES.discard(user_id)
-        WAITING_TASBIH.discard(user_id)
-        ACTIVE_TASBIH.pop(user_id, None)
-        WAITING_MEMO_MENU.discard(user_id)
-        WAITING_MEMO_ADD.discard(user_id)
-        WAITING_MEMO_EDIT_SELECT.discard(user_id)
-        WAITING_MEMO_EDIT_TEXT.discard(user_id)
-        WAITING_MEMO_DELETE_SELECT.discard(user_id)
-        MEMO_EDIT_INDEX.pop(user_id, None)
-        WAITING_BOOK_SEARCH.discard(user_id)
-        WAITING_BOOK_ADMIN_SEARCH.discard(user_id)
-        WAITING_BOOK_CATEGORY_NAME.discard(user_id)
-        WAITING_BOOK_CATEGORY_ORDER.discard(user_id)
-        WAITING_BOOK_ADD_CATEGORY.discard(user_id)
-        WAITING_BOOK_ADD_TITLE.discard(user_id)
-        WAITING_BOOK_ADD_AUTHOR.discard(user_id)
-        WAITING_BOOK_ADD_DESCRIPTION.discard(user_id)
-        WAITING_BOOK_ADD_TAGS.discard(user_id)
-        WAITING_BOOK_ADD_COVER.discard(user_id)
-        WAITING_BOOK_ADD_PDF.discard(user_id)
-        WAITING_BOOK_EDIT_FIELD.discard(user_id)
-        WAITING_BOOK_EDIT_COVER.discard(user_id)
-        WAITING_BOOK_EDIT_PDF.discard(user_id)
-        BOOK_CREATION_CONTEXT.pop(user_id, None)
-        BOOK_EDIT_CONTEXT.pop(user_id, None)
-        BOOK_CATEGORY_EDIT_CONTEXT.pop(user_id, None)
-        WAITING_SUPPORT_GENDER.discard(user_id)
-        _clear_broadcast_pending(user_id)
-        WAITING_BROADCAST.discard(user_id)
-        WAITING_MOTIVATION_ADD.discard(user_id)
-        WAITING_MOTIVATION_DELETE.discard(user_id)
-        WAITING_MOTIVATION_TIMES.discard(user_id)
-        _reset_course_subscription_flow(user_id)
-        WAITING_BAN_USER.discard(user_id)
-        WAITING_UNBAN_USER.discard(user_id)
-        WAITING_BAN_REASON.discard(user_id)
-        BAN_TARGET_ID.pop(user_id, None)
-        SLEEP_ADHKAR_STATE.pop(user_id, None)
-        STRUCTURED_ADHKAR_STATE.pop(user_id, None)
-        AUDIO_USER_STATE.pop(user_id, None)
-        _reset_lesson_creation(user_id)
-        _reset_quiz_creation(user_id)
-        update_user_record(user_id, book_search_waiting=False, book_search_waiting_at=None)
-        
-        # حالة خاصة: إلغاء تعديل الفائدة (المشكلة 1)
-        if user_id in WAITING_BENEFIT_EDIT_TEXT:
-            WAITING_BENEFIT_EDIT_TEXT.discard(user_id)
-            BENEFIT_EDIT_ID.pop(user_id, None)
-            update.message.reply_text(
-                "❌ تم إلغاء التعديل.\nعدنا لقسم مجتمع الفوائد و النصائح.",
-                reply_markup=BENEFITS_MENU_KB,
-            )
-            return
-        
-        # حالة خاصة: إلغاء إضافة فائدة
-        if user_id in WAITING_BENEFIT_TEXT:
-            WAITING_BENEFIT_TEXT.discard(user_id)
-            update.message.reply_text(
-                "تم إلغاء إضافة الفائدة.",
-                reply_markup=BENEFITS_MENU_KB,
-            )
-            return
-            
-        # حالة خاصة: إلغاء تأكيد حذف الفائدة
-        if user_id in WAITING_BENEFIT_DELETE_CONFIRM:
-            WAITING_BENEFIT_DELETE_CONFIRM.discard(user_id)
-            BENEFIT_EDIT_ID.pop(user_id, None)
-            update.message.reply_text(
-                "تم إلغاء عملية الحذف.",
-                reply_markup=BENEFITS_MENU_KB,
-            )
-            return
-        
-        # إذا كان الإلغاء من أي مكان آخر، نعود للقائمة الرئيسية
-        main_kb = user_main_keyboard(user_id)
-        update.message.reply_text(
-            "تم الإلغاء. عدنا للقائمة الرئيسية.",
-            reply_markup=main_kb,
+def handle_new_course_name_input(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    msg = update.message
+    text = (msg.text or "").strip()
+
+    if not (is_admin(user_id) or is_supervisor(user_id)):
+        _reset_course_creation(user_id)
+        msg.reply_text(
+            "❌ ليس لديك صلاحية لإنشاء الدورات.",
+            reply_markup=COURSES_ADMIN_MENU_KB,
         )
         return
 
-    if user_id in WAITING_SUPPORT:
-        forward_support_to_admin(user, text, context)
-
+    course_name = text.strip()
+    if not course_name:
         msg.reply_text(
-            _support_confirmation_text(record.get("gender"), True),
-            reply_markup=SUPPORT_SESSION_KB,
+            "⚠️ اسم الدورة لا يمكن أن يكون فارغاً.",
+            reply_markup=_course_creation_keyboard(),
         )
         return
 
-    # حالات ورد القرآن
-    if user_id in WAITING_QURAN_GOAL:
-        handle_quran_goal_input(update, context)
+    if len(course_name) < COURSE_NAME_MIN_LENGTH:
+        msg.reply_text(
+            f"⚠️ اسم الدورة قصير جداً. الحد الأدنى {COURSE_NAME_MIN_LENGTH} حروف.",
+            reply_markup=_course_creation_keyboard(),
+        )
         return
 
-    if user_id in WAITING_QURAN_ADD_PAGES:
-        handle_quran_add_pages_input(update, context)
+    if len(course_name) > COURSE_NAME_MAX_LENGTH:
+        msg.reply_text(
+            f"⚠️ اسم الدورة طويل جداً. الحد الأقصى {COURSE_NAME_MAX_LENGTH} حرفاً.",
+            reply_markup=_course_creation_keyboard(),
+        )
         return
 
-    # حالة السبحة
-    if user_id in WAITING_TASBIH:
-        if text == BTN_TASBIH_TICK:
-            handle_tasbih_tick(update, context)
-            return
-        elif text == BTN_TASBIH_END:
-            handle_tasbih_end(update, context)
-            return
-        else:
-            handle_tasbih_tick(update, context)
+    normalized = course_name.lower()
+    try:
+        existing = list(
+            db.collection(COURSES_COLLECTION)
+            .where("name_lower", "==", normalized)
+            .stream()
+        )
+        if not existing:
+            existing = list(
+                db.collection(COURSES_COLLECTION)
+                .where("name", "==", course_name)
+                .stream()
+            )
+        if existing:
+            msg.reply_text(
+                "⚠️ توجد دورة بنفس الاسم بالفعل. استخدم اسماً مختلفاً.",
+                reply_markup=_course_creation_keyboard(),
+            )
             return
 
-    # مذكّرات قلبي
-    if user_id in WAITING_MEMO_ADD:
-        handle_memo_add_input(update, context)
-        return
-
-    if user_id in WAITING_MEMO_EDIT_SELECT:
-        handle_memo_edit_index_input(update, context)
-        return
-
-    if user_id in WAITING_MEMO_EDIT_TEXT:
-        handle_memo_edit_text_input(update, context)
-        return
-
-    if user_id in WAITING_MEMO_DELETE_SELECT:
-        handle_memo_delete_index_input(update, context)
-        return
+        db.collection(COURSES_COLLECTION).add(
+            {
+                "name": course_name,
+                "name_lower": normalized,
+                "description": COURSE_CREATION_CONTEXT.get(user_id, {}).get(
+                    "description", ""
+                ),
+                "status": "active",
+                "created_at": firestore.SERVER_TIMESTAMP,
+            }
+        )
+        _broadcast_course_update(
+            msg.bot,
+            (
+                "📚 تم إطلاق دورة جديدة: "
+                f"«{course_name}».\nيمكنكم العثور عليها في قسم «الدورات» ثم الاشتراك فيها من هناك."
+            ),
+        )
+        _reset_course_creation(user_id)
+        msg.reply_text(
+            f"✅ تم إنشاء دورة ({course_name}) بنجاح",
+            reply_markup=COURSES_ADMIN_MENU_KB,
+        )
+    except Exception as e:
+        logger.error(f"خطأ في إنشاء الدورة: {e}")
+        _reset_course_creation(user_id)
+        msg.reply_text(
+            "❌ تعذر إنشاء الدورة حالياً.",
+            reply_markup=COURSES_ADMIN_MENU_KB,
+        )
 
-    # مكتبة الكتب - حالات الإدخال النصي
-    if user_id in WAITING_BOOK_ADMIN_SEARCH:
-        handle_admin_book_search_input(update, context)
-        return
 
-    if user_id in WAITING_BOOK_CATEGORY_NAME:
-        ctx = BOOK_CATEGORY_EDIT_CONTEXT.get(user_id, {})
-        name = text.strip()
-        if not name:
-            msg.reply_text("الرجاء إدخال اسم تصنيف صالح.", reply_markup=CANCEL_KB)
-            return
-        mode = ctx.get("mode")
-        if mode == "create":
-            ctx["name"] = name
-            BOOK_CATEGORY_EDIT_CONTEXT[user_id] = ctx
-            WAITING_BOOK_CATEGORY_NAME.discard(user_id)
-            WAITING_BOOK_CATEGORY_ORDER.add(user_id)
-            msg.reply_text("أرسل ترتيب العرض (رقم). اكتب تخطي للإبقاء على الترتيب الافتراضي.", reply_markup=CANCEL_KB)
-        elif mode == "rename" and ctx.get("category_id"):
-            slug_value = re.sub(r"\s+", "-", name.lower())
-            update_book_category(ctx["category_id"], name=name, slug=slug_value)
-            WAITING_BOOK_CATEGORY_NAME.discard(user_id)
-            BOOK_CATEGORY_EDIT_CONTEXT.pop(user_id, None)
-            msg.reply_text("تم تحديث اسم التصنيف.", reply_markup=BOOKS_ADMIN_MENU_KB)
-            open_book_categories_admin(update, context)
-        else:
-            WAITING_BOOK_CATEGORY_NAME.discard(user_id)
-            BOOK_CATEGORY_EDIT_CONTEXT.pop(user_id, None)
-            msg.reply_text("تم إلغاء العملية.", reply_markup=BOOKS_ADMIN_MENU_KB)
-        return
+def handle_lesson_title_input(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    msg = update.message
+    text = (msg.text or "").strip()
 
-    if user_id in WAITING_BOOK_CATEGORY_ORDER:
-        ctx = BOOK_CATEGORY_EDIT_CONTEXT.get(user_id, {})
-        order_val = 0
-        normalized = text.strip().lower()
-        if normalized not in {"تخطي", "skip", ""}:
-            try:
-                order_val = int(text)
-            except Exception:
-                msg.reply_text("الرجاء إدخال رقم صحيح للترتيب أو اكتب تخطي.", reply_markup=CANCEL_KB)
-                return
-        mode = ctx.get("mode")
-        if mode == "create" and ctx.get("name"):
-            slug_value = re.sub(r"\s+", "-", ctx.get("name").lower())
-            cat_id = save_book_category(ctx.get("name"), order_val, created_by=user_id)
-            WAITING_BOOK_CATEGORY_ORDER.discard(user_id)
-            BOOK_CATEGORY_EDIT_CONTEXT.pop(user_id, None)
-            if cat_id:
-                msg.reply_text(f"تم إنشاء التصنيف بنجاح (ID: {cat_id}).", reply_markup=BOOKS_ADMIN_MENU_KB)
+    ctx = LESSON_CREATION_CONTEXT.get(user_id, {}) or {}
+    course_id = ctx.get("course_id")
+    lesson_id = ctx.get("lesson_id")
+    edit_action = ctx.get("edit_action")
+    if edit_action == "edit_title":
+        try:
+            doc_ref = db.collection(COURSE_LESSONS_COLLECTION).document(lesson_id)
+            if not doc_ref.get().exists:
+                msg.reply_text("❌ الدرس غير موجود.", reply_markup=_lessons_back_keyboard(course_id))
             else:
-                msg.reply_text("تعذر إنشاء التصنيف حالياً.", reply_markup=BOOKS_ADMIN_MENU_KB)
-            open_book_categories_admin(update, context)
-        elif mode == "order" and ctx.get("category_id"):
-            update_book_category(ctx["category_id"], order=order_val)
-            WAITING_BOOK_CATEGORY_ORDER.discard(user_id)
-            BOOK_CATEGORY_EDIT_CONTEXT.pop(user_id, None)
-            msg.reply_text("تم تحديث ترتيب التصنيف.", reply_markup=BOOKS_ADMIN_MENU_KB)
-            open_book_categories_admin(update, context)
-        else:
-            WAITING_BOOK_CATEGORY_ORDER.discard(user_id)
-            BOOK_CATEGORY_EDIT_CONTEXT.pop(user_id, None)
-            msg.reply_text("تم إلغاء العملية.", reply_markup=BOOKS_ADMIN_MENU_KB)
-        return
-
-    if user_id in WAITING_BOOK_ADD_TITLE:
-        ctx = BOOK_CREATION_CONTEXT.get(user_id, {})
-        ctx["title"] = text
-        BOOK_CREATION_CONTEXT[user_id] = ctx
-        WAITING_BOOK_ADD_TITLE.discard(user_id)
-        WAITING_BOOK_ADD_AUTHOR.add(user_id)
-        msg.reply_text("أرسل اسم المؤلف:", reply_markup=CANCEL_KB)
-        return
-
-    if user_id in WAITING_BOOK_ADD_CATEGORY:
-        msg.reply_text("اختر التصنيف من الأزرار المعروضة.", reply_markup=CANCEL_KB)
-        return
-
-    if user_id in WAITING_BOOK_ADD_AUTHOR:
-        ctx = BOOK_CREATION_CONTEXT.get(user_id, {})
-        ctx["author"] = text
-        BOOK_CREATION_CONTEXT[user_id] = ctx
-        WAITING_BOOK_ADD_AUTHOR.discard(user_id)
-        WAITING_BOOK_ADD_DESCRIPTION.add(user_id)
-        msg.reply_text("أرسل وصفًا مختصرًا (أو اكتب تخطي لتجاوز الوصف):", reply_markup=CANCEL_KB)
-        return
-
-    if user_id in WAITING_BOOK_ADD_DESCRIPTION:
-        ctx = BOOK_CREATION_CONTEXT.get(user_id, {})
-        if text.strip().lower() in {"تخطي", "skip"}:
-            ctx["description"] = ""
-        else:
-            ctx["description"] = text
-        BOOK_CREATION_CONTEXT[user_id] = ctx
-        WAITING_BOOK_ADD_DESCRIPTION.discard(user_id)
-        WAITING_BOOK_ADD_TAGS.add(user_id)
-        msg.reply_text("أرسل الكلمات المفتاحية مفصولة بفواصل (أو اكتب تخطي):", reply_markup=CANCEL_KB)
-        return
-
-    if user_id in WAITING_BOOK_ADD_TAGS:
-        ctx = BOOK_CREATION_CONTEXT.get(user_id, {})
-        if text.strip().lower() in {"تخطي", "skip"}:
-            ctx["tags"] = []
-        else:
-            ctx["tags"] = _parse_tags_input(text)
-        BOOK_CREATION_CONTEXT[user_id] = ctx
-        WAITING_BOOK_ADD_TAGS.discard(user_id)
-        WAITING_BOOK_ADD_COVER.add(user_id)
-        msg.reply_text("أرسل صورة الغلاف (اختياري) أو اكتب تخطي:", reply_markup=CANCEL_KB)
-        return
-
-    if user_id in WAITING_BOOK_ADD_COVER:
-        if text.strip().lower() in {"تخطي", "skip"}:
-            WAITING_BOOK_ADD_COVER.discard(user_id)
-            WAITING_BOOK_ADD_PDF.add(user_id)
-            msg.reply_text("أرسل ملف الـ PDF للكتاب (إجباري):", reply_markup=CANCEL_KB)
-        else:
-            msg.reply_text("أرسل صورة غلاف صالحة أو اكتب تخطي.", reply_markup=CANCEL_KB)
-        return
-
-    if user_id in WAITING_BOOK_ADD_PDF:
-        msg.reply_text("أرسل ملف الـ PDF للكتاب.", reply_markup=CANCEL_KB)
-        return
-
-    # إدارة الجرعة التحفيزية
-    if user_id in WAITING_MOTIVATION_ADD:
-        handle_admin_motivation_add_input(update, context)
-        return
-
-    if user_id in WAITING_MOTIVATION_DELETE:
-        handle_admin_motivation_delete_input(update, context)
-        return
-
-    if user_id in WAITING_MOTIVATION_TIMES:
-        handle_admin_motivation_times_input(update, context)
-        return
-
-    # حذف نقاط وميداليات
-    if user_id in WAITING_DELETE_USER_POINTS:
-        handle_delete_user_points_input(update, context)
-        return
-
-    if user_id in WAITING_DELETE_USER_MEDALS:
-        handle_delete_user_medals_input(update, context)
-        return
-
-    # نظام الحظر
-    if user_id in WAITING_BAN_USER:
-        handle_ban_user_id_input(update, context)
-        return
-
-    if user_id in WAITING_UNBAN_USER:
-        handle_unban_user_id_input(update, context)
-        return
-
-    if user_id in WAITING_BAN_REASON:
-        handle_ban_reason_input(update, context)
+                doc_ref.update(
+                    {
+                        "title": text,
+                        "updated_at": firestore.SERVER_TIMESTAMP,
+                    }
+                )
+                _invalidate_course_content(COURSE_LESSONS_COLLECTION, lesson_id)
+                msg.reply_text("✅ تم تعديل العنوان.", reply_markup=_lessons_back_keyboard(course_id))
+        except Exception as e:
+            logger.error(f"خطأ في تعديل عنوان الدرس: {e}")
+            msg.reply_text("❌ تعذر تعديل العنوان حالياً.", reply_markup=_lessons_back_keyboard(course_id))
+        finally:
+            _reset_lesson_creation(user_id)
         return
 
-    # رسالة جماعية
-    if user_id in WAITING_BROADCAST:
-        handle_admin_broadcast_input(update, context)
-        return
+    LESSON_CREATION_CONTEXT.setdefault(user_id, {})["title"] = text
+    WAITING_LESSON_TITLE.discard(user_id)
+    lesson_type_kb = InlineKeyboardMarkup(
+        [
+            [InlineKeyboardButton("📝 نص", callback_data=f"COURSES:lesson_type_text_{course_id}")],
+            [InlineKeyboardButton("🔊 ملف صوتي", callback_data=f"COURSES:lesson_type_audio_{course_id}")],
+            [InlineKeyboardButton("🔗 رابط", callback_data=f"COURSES:lesson_type_link_{course_id}")],
+            [InlineKeyboardButton("🖼️ صورة", callback_data=f"COURSES:lesson_type_image_{course_id}")],
+            [InlineKeyboardButton("🔙 رجوع", callback_data=f"COURSES:lessons_{course_id}")],
+        ]
+    )
+    msg.reply_text("اختر نوع محتوى الدرس:", reply_markup=lesson_type_kb)
 
-    # فوائد ونصائح
-    if user_id in WAITING_BENEFIT_TEXT:
-        handle_add_benefit_text(update, context)
-        return
 
-    if user_id in WAITING_BENEFIT_EDIT_TEXT:
-        handle_edit_benefit_text(update, context)
-        return
+def handle_lesson_content_input(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    msg = update.message
+    text = (msg.text or "").strip()
 
-    # أذكار النوم
-    if text == BTN_SLEEP_ADHKAR_NEXT:
-        handle_sleep_adhkar_next(update, context)
+    ctx = LESSON_CREATION_CONTEXT.get(user_id, {}) or {}
+    course_id = ctx.get("course_id")
+    content_type = ctx.get("content_type")
+    title = ctx.get("title")
+    lesson_id = ctx.get("lesson_id")
+    edit_action = ctx.get("edit_action")
+    if not course_id or not title or content_type not in {"text", "link"}:
+        _reset_lesson_creation(user_id)
+        msg.reply_text("❌ البيانات غير مكتملة.", reply_markup=COURSES_ADMIN_MENU_KB)
         return
 
-    if text == BTN_SLEEP_ADHKAR_BACK:
-        handle_sleep_adhkar_back(update, context)
-        return
+    if edit_action == "edit_content":
+        if not lesson_id:
+            _reset_lesson_creation(user_id)
+            msg.reply_text("❌ الدرس غير معروف.", reply_markup=COURSES_ADMIN_MENU_KB)
+            return
+        _update_lesson(
+            user_id,
+            lesson_id,
+            course_id,
+            title,
+            content_type,
+            msg,
+            content_value=text,
+        )
+    else:
+        _save_lesson(user_id, course_id, title, content_type, msg, text)
 
-    # مكتبة الصوتيات
-    if text == BTN_AUDIO_LIBRARY:
-        open_audio_library_menu(update, context)
-        return
 
-    if text in AUDIO_SECTION_BY_BUTTON:
-        open_audio_section(update, context, AUDIO_SECTION_BY_BUTTON[text])
-        return
+def handle_lesson_curriculum_name_input(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    msg = update.message
+    text = (msg.text or "").strip()
 
-    if text == BTN_AUDIO_BACK:
-        open_audio_library_menu(update, context)
-        return
+    ctx = LESSON_CREATION_CONTEXT.get(user_id, {}) or {}
+    course_id = ctx.get("course_id")
+    lesson_id = ctx.get("lesson_id")
+    try:
+        db.collection(COURSE_LESSONS_COLLECTION).document(lesson_id).update(
+            {"curriculum_section": text, "updated_at": firestore.SERVER_TIMESTAMP}
+        )
+        _invalidate_course_content(COURSE_LESSONS_COLLECTION, lesson_id)
+        msg.reply_text("✅ تم حفظ باب المقرر للدرس.", reply_markup=_lessons_back_keyboard(course_id))
+    except Exception as e:
+        logger.error(f"خطأ في حفظ باب المقرر: {e}")
+        msg.reply_text("❌ تعذر الحفظ حالياً.", reply_markup=_lessons_back_keyboard(course_id))
+    finally:
+        _reset_lesson_creation(user_id)
 
-    # الأزرار الرئيسية
-    if text == BTN_ADHKAR_MAIN:
-        open_adhkar_menu(update, context)
-        return
 
-    if text == BTN_QURAN_MAIN:
-        open_quran_menu(update, context)
-        return
+def handle_quiz_title_input(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    msg = update.message
+    text = (msg.text or "").strip()
 
-    if text == BTN_LESSONS_MAIN:
-        _open_course_shortcut(update, context, "lessons")
-        return
+    course_id = QUIZ_CREATION_CONTEXT.get(user_id, {}).get("course_id")
+    QUIZ_CREATION_CONTEXT.setdefault(user_id, {})["title"] = text
+    WAITING_QUIZ_TITLE.discard(user_id)
+    WAITING_QUIZ_QUESTION.add(user_id)
+    msg.reply_text(
+        "✏️ اكتب سؤال الاختبار الآن.",
+        reply_markup=_quizzes_back_keyboard(course_id),
+    )
 
-    if text == BTN_QUIZZES_MAIN:
-        _open_course_shortcut(update, context, "quizzes")
-        return
 
-    if text == BTN_TASBIH_MAIN:
-        open_tasbih_menu(update, context)
-        return
+def handle_quiz_question_input(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    msg = update.message
+    text = (msg.text or "").strip()
 
-    if text == BTN_BOOKS_MAIN:
-        _mark_admin_books_mode(context, False)
-        open_books_home(update, context)
-        return
+    course_id = QUIZ_CREATION_CONTEXT.get(user_id, {}).get("course_id")
+    QUIZ_CREATION_CONTEXT.setdefault(user_id, {})["question"] = text
+    QUIZ_CREATION_CONTEXT.setdefault(user_id, {}).setdefault("answers", [])
+    WAITING_QUIZ_QUESTION.discard(user_id)
+    WAITING_QUIZ_ANSWER_TEXT.add(user_id)
+    msg.reply_text(
+        "اكتب الإجابة الأولى.",
+        reply_markup=_quizzes_back_keyboard(course_id),
+    )
 
-    if text == BTN_MEMOS_MAIN:
-        open_memos_menu(update, context)
-        return
 
-    if text == BTN_BOOKS_ADMIN:
-        open_books_admin_menu(update, context)
-        return
+def handle_quiz_answer_text_input(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    msg = update.message
+    text = (msg.text or "").strip()
 
-    if text == BTN_STATS:
-        open_stats_menu(update, context)
-        return
+    course_id = QUIZ_CREATION_CONTEXT.get(user_id, {}).get("course_id")
+    ctx = QUIZ_CREATION_CONTEXT.setdefault(user_id, {})
+    ctx.setdefault("answers", []).append({"text": text})
+    WAITING_QUIZ_ANSWER_TEXT.discard(user_id)
 
-    if text == BTN_STATS_ONLY:
-        send_stats_overview(update, context)
+    if len(ctx.get("answers", [])) >= 4:
+        _finalize_quiz_creation_from_message(user_id, msg)
         return
 
-    if text == BTN_MEDALS_ONLY or text == BTN_MEDALS:
-        open_medals_overview(update, context)
-        return
+    options_kb = InlineKeyboardMarkup(
+        [
+            [InlineKeyboardButton("➕ إضافة إجابة أخرى", callback_data=f"COURSES:quiz_more_{course_id}")],
+            [InlineKeyboardButton("✅ إنهاء", callback_data=f"COURSES:quiz_finish_{course_id}")],
+        ]
+    )
+    msg.reply_text(
+        "تم حفظ الإجابة. اختر التالي أو أضف إجابة أخرى.",
+        reply_markup=options_kb,
+    )
 
-    if text == BTN_STATS_BACK_MAIN:
-        msg.reply_text(
-            "عدنا إلى القائمة الرئيسية.",
-            reply_markup=user_main_keyboard(user_id),
-        )
-        return
 
-    if text == BTN_SUPPORT:
-        handle_contact_support(update, context)
-        return
+def handle_quiz_answer_input(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    text = (update.message.text or "").strip()
+    # False: لا يوجد اختبار نشط فيكمل النص طريقه في handle_text
+    return _complete_quiz_answer(user_id, text, update, context)
 
-    if text == BTN_COMP_MAIN:
-        open_comp_menu(update, context)
-        return
 
-    if text == BTN_COURSES_SECTION:
-        open_courses_menu(update, context)
-        return
+def handle_support_gender_input(update: Update, context: CallbackContext):
+    user = update.effective_user
+    user_id = user.id
+    text = (update.message.text or "").strip()
 
-    if text == BTN_MANAGE_COURSES:
-        open_courses_admin_menu(update, context)
+    if text == BTN_GENDER_MALE:
+        gender = "male"
+    elif text == BTN_GENDER_FEMALE:
+        gender = "female"
+    else:
+        update.message.reply_text(
+            "رجاءً اختر من الأزرار الموجودة 👇",
+            reply_markup=GENDER_KB,
+        )
         return
 
-    if text == BTN_BENEFITS_MAIN:
-        open_benefits_menu(update, context)
-        return
+    record = get_user_record(user)
+    record["gender"] = gender
+    update_user_record(user_id, gender=gender)
+    save_data(user_id)
+    WAITING_SUPPORT_GENDER.discard(user_id)
+    _open_support_session(update, user_id, gender)
 
-    if text == BTN_NOTIFICATIONS_MAIN:
-        open_notifications_menu(update, context)
-        return
 
-    if text == BTN_BOOKS_MANAGE_CATEGORIES:
-        open_book_categories_admin(update, context)
-        return
+# ---- إلغاء حالات الإدخال (زر الإلغاء داخل كل تدفق) ----
 
-    if text == BTN_BOOKS_ADD_BOOK:
-        start_add_book_flow(update, context)
-        return
+def _cancel_course_subscription_input(update: Update, context: CallbackContext):
+    _reset_course_subscription_flow(update.effective_user.id)
+    update.message.reply_text("تم إلغاء التسجيل في الدورة.", reply_markup=COURSES_USER_MENU_KB)
 
-    if text == BTN_BOOKS_MANAGE_BOOKS:
-        open_books_admin_list(update, context)
-        return
 
-    if text == BTN_BOOKS_BACKFILL:
-        _run_books_backfill_for_admin(update, context)
-        return
+def _cancel_profile_edit_input(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    _reset_profile_edit_flow(user_id)
+    update.message.reply_text("تم إلغاء تعديل البيانات.", reply_markup=user_main_keyboard(user_id))
 
-    if text == BTN_BACK_MAIN:
-        _mark_admin_books_mode(context, False)
-        STRUCTURED_ADHKAR_STATE.pop(user_id, None)
-        msg.reply_text(
-            "عدنا إلى القائمة الرئيسية.",
-            reply_markup=main_kb,
-        )
-        return
 
-    # قوائم الأذكار
-    if text == BTN_ADHKAR_NEXT:
-        handle_structured_adhkar_next(update, context)
-        return
-    if text == BTN_ADHKAR_DONE:
-        handle_structured_adhkar_done(update, context)
-        return
-    if text == BTN_ADHKAR_PREV:
-        handle_structured_adhkar_prev(update, context)
-        return
-    if text == BTN_ADHKAR_BACK_MENU:
-        handle_structured_adhkar_back_to_menu(update, context)
-        return
-    if text == BTN_ADHKAR_BACK_MAIN:
-        handle_structured_adhkar_back_main(update, context)
-        return
-    if text == BTN_ADHKAR_MORNING:
-        send_morning_adhkar(update, context)
+def _cancel_new_course_input(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    if not (is_admin(user_id) or is_supervisor(user_id)):
+        # فحص الصلاحية يسبق الإلغاء كما في المعالج نفسه
+        handle_new_course_name_input(update, context)
         return
+    _reset_course_creation(user_id)
+    update.message.reply_text("تم الإلغاء بنجاح", reply_markup=COURSES_ADMIN_MENU_KB)
 
-    if text == BTN_ADHKAR_EVENING:
-        send_evening_adhkar(update, context)
-        return
 
-    if text == BTN_ADHKAR_GENERAL:
-        send_general_adhkar(update, context)
-        return
+def _cancel_lesson_creation_input(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    course_id = (LESSON_CREATION_CONTEXT.get(user_id, {}) or {}).get("course_id")
+    _reset_lesson_creation(user_id)
+    update.message.reply_text("تم الإلغاء.", reply_markup=_lessons_back_keyboard(course_id))
 
-    if text == BTN_ADHKAR_SLEEP:
-        start_sleep_adhkar(update, context)
-        return
 
-    # ورد القرآن
-    if text == BTN_QURAN_SET_GOAL:
-        handle_quran_set_goal(update, context)
-        return
+def _cancel_quiz_creation_input(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    course_id = QUIZ_CREATION_CONTEXT.get(user_id, {}).get("course_id")
+    _reset_quiz_creation(user_id)
+    update.message.reply_text("تم الإلغاء.", reply_markup=_quizzes_back_keyboard(course_id))
 
-    if text == BTN_QURAN_ADD_PAGES:
-        handle_quran_add_pages_start(update, context)
-        return
 
-    if text == BTN_QURAN_STATUS:
-        handle_quran_status(update, context)
-        return
+def _cancel_support_gender_input(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    WAITING_SUPPORT_GENDER.discard(user_id)
+    update.message.reply_text(
+        "تم الإلغاء. عدنا للقائمة الرئيسية.",
+        reply_markup=user_main_keyboard(user_id),
+    )
 
-    if text == BTN_QURAN_RESET_DAY:
-        handle_quran_reset_day(update, context)
-        return
 
-    # السبحة: اختيار الذكر
-    for dhikr, count in TASBIH_ITEMS:
-        label = f"{dhikr} ({count})"
-        if text == label:
-            start_tasbih_for_choice(update, context, text)
-            return
+# =================== موجّه الرسائل النصية ===================
+
+# حالات الإدخال التي تسبق ردود الدعم وزر الإلغاء العام: (الحالة، المعالج، معالج الإلغاء)
+TEXT_INPUT_STATE_ROUTES = ()
+# حالات الإدخال التي تسبق أزرار القوائم، بترتيب الأولوية
+TEXT_STATE_ROUTES = ()
+# حالات الإدخال التي تأتي بعد أزرار القوائم (تأكيدات التصفير)
+TEXT_LATE_STATE_ROUTES = ()
+# نص الزر -> المعالج
+TEXT_BUTTON_ROUTES: Dict[str, Callable] = {}
+
+# أسماء القائمة الرئيسية بدون الرموز (MAIN_MENU_BUTTON_TEXTS)
+TEXT_BUTTON_ALIASES = {
+    "أذكاري": BTN_ADHKAR_MAIN,
+    "وردي القرآني": BTN_QURAN_MAIN,
+    "الدروس": BTN_LESSONS_MAIN,
+    "الاختبارات": BTN_QUIZZES_MAIN,
+    "قسم الدورات": BTN_COURSES_SECTION,
+    "مكتبة طالب العلم": BTN_BOOKS_MAIN,
+    "مكتبة صوتية": BTN_AUDIO_LIBRARY,
+    "المنافسات و المجتمع": BTN_COMP_MAIN,
+    "احصائياتي": BTN_STATS,
+    "إحصائياتي": BTN_STATS,
+    "الاشعارات": BTN_NOTIFICATIONS_MAIN,
+    "تواصل مع الدعم": BTN_SUPPORT,
+    "لوحة التحكم": BTN_ADMIN_PANEL,
+}
 
-    # مذكّرات قلبي
-    if text == BTN_MEMO_ADD:
-        handle_memo_add_start(update, context)
-        return
+TEXT_ROUTE_STATS: Dict[str, Dict] = {}
+TEXT_ROUTE_STATS_LOCK = Lock()
 
-    if text == BTN_MEMO_EDIT:
-        handle_memo_edit_select(update, context)
-        return
 
-    if text == BTN_MEMO_DELETE:
-        handle_memo_delete_select(update, context)
-        return
+def _route_tasbih_input(update: Update, context: CallbackContext):
+    if (update.message.text or "").strip() == BTN_TASBIH_END:
+        handle_tasbih_end(update, context)
+    else:
+        handle_tasbih_tick(update, context)
 
-    if text == BTN_MEMO_BACK:
-        msg.reply_text(
-            "تم الرجوع للقائمة الرئيسية.",
-            reply_markup=main_kb,
-        )
-        return
 
-    # فوائد ونصائح
-    if text == BTN_BENEFIT_ADD:
-        handle_add_benefit_start(update, context)
-        return
+def _route_tasbih_choice(update: Update, context: CallbackContext):
+    start_tasbih_for_choice(update, context, (update.message.text or "").strip())
 
-    if text == BTN_BENEFIT_VIEW:
-        handle_view_benefits(update, context)
-        return
 
-    if text == BTN_BENEFIT_TOP10:
-        handle_top10_benefits(update, context)
-        return
+def _route_audio_section(update: Update, context: CallbackContext):
+    text = (update.message.text or "").strip()
+    open_audio_section(update, context, AUDIO_SECTION_BY_BUTTON[text])
 
-    if text == BTN_BENEFIT_TOP100:
-        handle_top100_benefits(update, context)
-        return
 
-    if text == BTN_MY_BENEFITS:
-        handle_my_benefits(update, context)
-        return
+def _route_lessons_main(update: Update, context: CallbackContext):
+    _open_course_shortcut(update, context, "lessons")
 
-    # المنافسات
-    if text == BTN_MY_PROFILE:
-        handle_my_profile(update, context)
-        return
 
-    if text == BTN_TOP10:
-        handle_top10(update, context)
-        return
+def _route_quizzes_main(update: Update, context: CallbackContext):
+    _open_course_shortcut(update, context, "quizzes")
 
-    if text == BTN_TOP100:
-        handle_top100(update, context)
-        return
 
-    # الجرعة التحفيزية للمستخدم
-    if text == BTN_MOTIVATION_ON:
-        handle_motivation_on(update, context)
-        return
+def _route_books_main(update: Update, context: CallbackContext):
+    _mark_admin_books_mode(context, False)
+    open_books_home(update, context)
 
-    if text == BTN_MOTIVATION_OFF:
-        handle_motivation_off(update, context)
-        return
 
-    # لوحة التحكم (أدمن / مشرفة)
-    if text == BTN_ADMIN_PANEL:
-        handle_admin_panel(update, context)
-        return
+def _route_stats_back_main(update: Update, context: CallbackContext):
+    update.message.reply_text(
+        "عدنا إلى القائمة الرئيسية.",
+        reply_markup=user_main_keyboard(update.effective_user.id),
+    )
 
-    if text == BTN_ADMIN_USERS_COUNT:
-        handle_admin_users_count(update, context)
-        return
 
-    if text == BTN_ADMIN_USERS_LIST:
-        handle_admin_users_list(update, context)
-        return
+def _route_back_main(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    _mark_admin_books_mode(context, False)
+    STRUCTURED_ADHKAR_STATE.pop(user_id, None)
+    update.message.reply_text(
+        "عدنا إلى القائمة الرئيسية.",
+        reply_markup=user_main_keyboard(user_id),
+    )
 
-    if text == BTN_ADMIN_BROADCAST:
-        handle_admin_broadcast_start(update, context)
-        return
 
-    if text == BTN_ADMIN_RANKINGS:
-        handle_admin_rankings(update, context)
-        return
+def _route_memo_back(update: Update, context: CallbackContext):
+    update.message.reply_text(
+        "تم الرجوع للقائمة الرئيسية.",
+        reply_markup=user_main_keyboard(update.effective_user.id),
+    )
 
-    if text == BTN_ADMIN_BAN_USER:
-        handle_admin_ban_user(update, context)
-        return
 
-    if text == BTN_ADMIN_UNBAN_USER:
-        handle_admin_unban_user(update, context)
-        return
+def _route_admin_manage_competition(update: Update, context: CallbackContext):
+    update.message.reply_text(
+        "🔹 التحكم في المنافسات والمجتمع:\n"
+        "اختر العملية المطلوبة:",
+        reply_markup=ADMIN_COMPETITION_KB,
+    )
 
-    if text == BTN_ADMIN_BANNED_LIST:
-        handle_admin_banned_list(update, context)
-        return
 
-    if text == BTN_ADMIN_MOTIVATION_MENU:
-        open_admin_motivation_menu(update, context)
-        return
+def _build_text_routes():
+    """بناء جداول التوجيه مرة واحدة بعد تعريف كل المعالجات"""
+    global TEXT_INPUT_STATE_ROUTES, TEXT_STATE_ROUTES, TEXT_LATE_STATE_ROUTES, TEXT_BUTTON_ROUTES
+
+    input_state_routes = (
+        # التسجيل في الدورات
+        ("WAITING_COURSE_COUNTRY", handle_course_country_input, _cancel_course_subscription_input),
+        ("WAITING_COURSE_FULL_NAME", handle_course_full_name_input, _cancel_course_subscription_input),
+        ("WAITING_COURSE_AGE", handle_course_age_input, _cancel_course_subscription_input),
+        ("WAITING_COURSE_GENDER", handle_course_gender_input, _cancel_course_subscription_input),
+        # تعديل الملف الشخصي
+        ("WAITING_PROFILE_EDIT_NAME", handle_profile_edit_name_input, _cancel_profile_edit_input),
+        ("WAITING_PROFILE_EDIT_AGE", handle_profile_edit_age_input, _cancel_profile_edit_input),
+        ("WAITING_PROFILE_EDIT_COUNTRY", handle_profile_edit_country_input, _cancel_profile_edit_input),
+        # إجابات الاختبارات (بدون اختبار نشط يكمل النص طريقه)
+        ("WAITING_QUIZ_ANSWER", handle_quiz_answer_input, None),
+        # إنشاء الدورات والدروس والاختبارات
+        ("WAITING_NEW_COURSE", handle_new_course_name_input, _cancel_new_course_input),
+        ("WAITING_LESSON_TITLE", handle_lesson_title_input, _cancel_lesson_creation_input),
+        ("WAITING_LESSON_CONTENT", handle_lesson_content_input, _cancel_lesson_creation_input),
+        ("WAITING_LESSON_CURRICULUM_NAME", handle_lesson_curriculum_name_input, _cancel_lesson_creation_input),
+        ("WAITING_QUIZ_TITLE", handle_quiz_title_input, _cancel_quiz_creation_input),
+        ("WAITING_QUIZ_QUESTION", handle_quiz_question_input, _cancel_quiz_creation_input),
+        ("WAITING_QUIZ_ANSWER_TEXT", handle_quiz_answer_text_input, _cancel_quiz_creation_input),
+        # تحديد الجنس قبل فتح جلسة الدعم
+        ("WAITING_SUPPORT_GENDER", handle_support_gender_input, _cancel_support_gender_input),
+    )
 
-    if text == BTN_ADMIN_MOTIVATION_LIST:
-        handle_admin_motivation_list(update, context)
-        return
+    state_routes = (
+        # ورد القرآن
+        ("WAITING_QURAN_GOAL", handle_quran_goal_input),
+        ("WAITING_QURAN_ADD_PAGES", handle_quran_add_pages_input),
+        # السبحة
+        ("WAITING_TASBIH", _route_tasbih_input),
+        # مذكّرات قلبي
+        ("WAITING_MEMO_ADD", handle_memo_add_input),
+        ("WAITING_MEMO_EDIT_SELECT", handle_memo_edit_index_input),
+        ("WAITING_MEMO_EDIT_TEXT", handle_memo_edit_text_input),
+        ("WAITING_MEMO_DELETE_SELECT", handle_memo_delete_index_input),
+        # مكتبة الكتب
+        ("WAITING_BOOK_ADMIN_SEARCH", handle_admin_book_search_input),
+        ("WAITING_BOOK_CATEGORY_NAME", handle_book_category_name_input),
+        ("WAITING_BOOK_CATEGORY_ORDER", handle_book_category_order_input),
+        ("WAITING_BOOK_ADD_TITLE", handle_book_add_title_input),
+        ("WAITING_BOOK_ADD_CATEGORY", handle_book_add_category_input),
+        ("WAITING_BOOK_ADD_AUTHOR", handle_book_add_author_input),
+        ("WAITING_BOOK_ADD_DESCRIPTION", handle_book_add_description_input),
+        ("WAITING_BOOK_ADD_TAGS", handle_book_add_tags_input),
+        ("WAITING_BOOK_ADD_COVER", handle_book_add_cover_input),
+        ("WAITING_BOOK_ADD_PDF", handle_book_add_pdf_input),
+        # الجرعة التحفيزية
+        ("WAITING_MOTIVATION_ADD", handle_admin_motivation_add_input),
+        ("WAITING_MOTIVATION_DELETE", handle_admin_motivation_delete_input),
+        ("WAITING_MOTIVATION_TIMES", handle_admin_motivation_times_input),
+        # نظام الحظر
+        ("WAITING_BAN_USER", handle_ban_user_id_input),
+        ("WAITING_UNBAN_USER", handle_unban_user_id_input),
+        ("WAITING_BAN_REASON", handle_ban_reason_input),
+        # رسالة جماعية
+        ("WAITING_BROADCAST", handle_admin_broadcast_input),
+        # فوائد ونصائح
+        ("WAITING_BENEFIT_TEXT", handle_add_benefit_text),
+        ("WAITING_BENEFIT_EDIT_TEXT", handle_edit_benefit_text),
+    )
 
-    if text == BTN_ADMIN_MOTIVATION_ADD:
-        handle_admin_motivation_add_start(update, context)
-        return
+    button_routes = [
+        # أذكار النوم
+        (BTN_SLEEP_ADHKAR_NEXT, handle_sleep_adhkar_next),
+        (BTN_SLEEP_ADHKAR_BACK, handle_sleep_adhkar_back),
+        # مكتبة الصوتيات
+        (BTN_AUDIO_LIBRARY, open_audio_library_menu),
+    ]
+    button_routes += [(label, _route_audio_section) for label in AUDIO_SECTION_BY_BUTTON]
+    button_routes += [
+        (BTN_AUDIO_BACK, open_audio_library_menu),
+        # الأزرار الرئيسية
+        (BTN_ADHKAR_MAIN, open_adhkar_menu),
+        (BTN_QURAN_MAIN, open_quran_menu),
+        (BTN_LESSONS_MAIN, _route_lessons_main),
+        (BTN_QUIZZES_MAIN, _route_quizzes_main),
+        (BTN_TASBIH_MAIN, open_tasbih_menu),
+        (BTN_BOOKS_MAIN, _route_books_main),
+        (BTN_MEMOS_MAIN, open_memos_menu),
+        (BTN_BOOKS_ADMIN, open_books_admin_menu),
+        (BTN_STATS, open_stats_menu),
+        (BTN_STATS_ONLY, send_stats_overview),
+        (BTN_MEDALS_ONLY, open_medals_overview),
+        (BTN_MEDALS, open_medals_overview),
+        (BTN_STATS_BACK_MAIN, _route_stats_back_main),
+        (BTN_SUPPORT, handle_contact_support),
+        (BTN_COMP_MAIN, open_comp_menu),
+        (BTN_COURSES_SECTION, open_courses_menu),
+        (BTN_MANAGE_COURSES, open_courses_admin_menu),
+        (BTN_BENEFITS_MAIN, open_benefits_menu),
+        (BTN_NOTIFICATIONS_MAIN, open_notifications_menu),
+        (BTN_BOOKS_MANAGE_CATEGORIES, open_book_categories_admin),
+        (BTN_BOOKS_ADD_BOOK, start_add_book_flow),
+        (BTN_BOOKS_MANAGE_BOOKS, open_books_admin_list),
+        (BTN_BOOKS_BACKFILL, _run_books_backfill_for_admin),
+        (BTN_BACK_MAIN, _route_back_main),
+        # قوائم الأذكار
+        (BTN_ADHKAR_NEXT, handle_structured_adhkar_next),
+        (BTN_ADHKAR_DONE, handle_structured_adhkar_done),
+        (BTN_ADHKAR_PREV, handle_structured_adhkar_prev),
+        (BTN_ADHKAR_BACK_MENU, handle_structured_adhkar_back_to_menu),
+        (BTN_ADHKAR_BACK_MAIN, handle_structured_adhkar_back_main),
+        (BTN_ADHKAR_MORNING, send_morning_adhkar),
+        (BTN_ADHKAR_EVENING, send_evening_adhkar),
+        (BTN_ADHKAR_GENERAL, send_general_adhkar),
+        (BTN_ADHKAR_SLEEP, start_sleep_adhkar),
+        # ورد القرآن
+        (BTN_QURAN_SET_GOAL, handle_quran_set_goal),
+        (BTN_QURAN_ADD_PAGES, handle_quran_add_pages_start),
+        (BTN_QURAN_STATUS, handle_quran_status),
+        (BTN_QURAN_RESET_DAY, handle_quran_reset_day),
+    ]
+    # السبحة: اختيار الذكر
+    button_routes += [(f"{dhikr} ({count})", _route_tasbih_choice) for dhikr, count in TASBIH_ITEMS]
+    button_routes += [
+        # مذكّرات قلبي
+        (BTN_MEMO_ADD, handle_memo_add_start),
+        (BTN_MEMO_EDIT, handle_memo_edit_select),
+        (BTN_MEMO_DELETE, handle_memo_delete_select),
+        (BTN_MEMO_BACK, _route_memo_back),
+        # فوائد ونصائح
+        (BTN_BENEFIT_ADD, handle_add_benefit_start),
+        (BTN_BENEFIT_VIEW, handle_view_benefits),
+        (BTN_BENEFIT_TOP10, handle_top10_benefits),
+        (BTN_BENEFIT_TOP100, handle_top100_benefits),
+        (BTN_MY_BENEFITS, handle_my_benefits),
+        # المنافسات
+        (BTN_MY_PROFILE, handle_my_profile),
+        (BTN_TOP10, handle_top10),
+        (BTN_TOP100, handle_top100),
+        # الجرعة التحفيزية للمستخدم
+        (BTN_MOTIVATION_ON, handle_motivation_on),
+        (BTN_MOTIVATION_OFF, handle_motivation_off),
+        # لوحة التحكم (أدمن / مشرفة)
+        (BTN_ADMIN_PANEL, handle_admin_panel),
+        (BTN_ADMIN_USERS_COUNT, handle_admin_users_count),
+        (BTN_ADMIN_USERS_LIST, handle_admin_users_list),
+        (BTN_ADMIN_BROADCAST, handle_admin_broadcast_start),
+        (BTN_ADMIN_RANKINGS, handle_admin_rankings),
+        (BTN_ADMIN_BAN_USER, handle_admin_ban_user),
+        (BTN_ADMIN_UNBAN_USER, handle_admin_unban_user),
+        (BTN_ADMIN_BANNED_LIST, handle_admin_banned_list),
+        (BTN_ADMIN_MOTIVATION_MENU, open_admin_motivation_menu),
+        (BTN_ADMIN_MOTIVATION_LIST, handle_admin_motivation_list),
+        (BTN_ADMIN_MOTIVATION_ADD, handle_admin_motivation_add_start),
+        (BTN_ADMIN_MOTIVATION_DELETE, handle_admin_motivation_delete_start),
+        (BTN_ADMIN_MOTIVATION_TIMES, handle_admin_motivation_times_start),
+        (BTN_ADMIN_MANAGE_COMPETITION, _route_admin_manage_competition),
+        # أزرار التأكيد
+        (BTN_ADMIN_RESET_POINTS, handle_admin_confirm_reset_points),
+        (BTN_ADMIN_RESET_MEDALS, handle_admin_confirm_reset_medals),
+    ]
 
-    if text == BTN_ADMIN_MOTIVATION_DELETE:
-        handle_admin_motivation_delete_start(update, context)
-        return
+    routes: Dict[str, Callable] = {}
+    # أول تطابق هو الذي يفوز، كما في سلسلة الشروط السابقة
+    for label, handler in button_routes:
+        routes.setdefault(label, handler)
+    for alias, label in TEXT_BUTTON_ALIASES.items():
+        if label in routes:
+            routes.setdefault(alias, routes[label])
+
+    TEXT_LATE_STATE_ROUTES = (
+        ("WAITING_CONFIRM_RESET_POINTS", handle_confirm_reset_points_input),
+        ("WAITING_CONFIRM_RESET_MEDALS", handle_confirm_reset_medals_input),
+    )
+    TEXT_INPUT_STATE_ROUTES = input_state_routes
+    TEXT_BUTTON_ROUTES = routes
+    TEXT_STATE_ROUTES = state_routes
 
-    if text == BTN_ADMIN_MOTIVATION_TIMES:
-        handle_admin_motivation_times_start(update, context)
-        return
 
-    if text == BTN_ADMIN_MANAGE_COMPETITION:
-        update.message.reply_text(
-            "🔹 التحكم في المنافسات والمجتمع:\n"
-            "اختر العملية المطلوبة:",
-            reply_markup=ADMIN_COMPETITION_KB,
-        )
-        return
+def _resolve_text_route(text: str, states) -> Optional[Tuple[str, Callable]]:
+    """يرجع (اسم المسار، المعالج) أو None إذا لم يطابق النص أي مسار"""
+    if not TEXT_BUTTON_ROUTES:
+        _build_text_routes()
 
-    # معالجات الأزرار الجديدة للتأكيد
-    if text == BTN_ADMIN_RESET_POINTS:
-        handle_admin_confirm_reset_points(update, context)
-        return
+    if states:
+        for name, handler in TEXT_STATE_ROUTES:
+            if name in states:
+                return name, handler
 
-    if text == BTN_ADMIN_RESET_MEDALS:
-        handle_admin_confirm_reset_medals(update, context)
-        return
+    handler = TEXT_BUTTON_ROUTES.get(text)
+    if handler is not None:
+        return handler.__name__, handler
 
-    # معالجات الإدخال للتأكيد
-    if user_id in WAITING_CONFIRM_RESET_POINTS:
-        handle_confirm_reset_points_input(update, context)
-        return
+    if states:
+        for name, handler in TEXT_LATE_STATE_ROUTES:
+            if name in states:
+                return name, handler
+    return None
 
-    if user_id in WAITING_CONFIRM_RESET_MEDALS:
-        handle_confirm_reset_medals_input(update, context)
-        return
 
+def _resolve_input_state_route(text: str, states) -> Optional[Tuple[str, Callable]]:
+    """مسار حالة الإدخال الأولى النشطة؛ زر الإلغاء يذهب لمعالج الإلغاء الخاص بالتدفق"""
+    if not states:
+        return None
+    if not TEXT_BUTTON_ROUTES:
+        _build_text_routes()
+    for name, handler, cancel_handler in TEXT_INPUT_STATE_ROUTES:
+        if name in states:
+            if text == BTN_CANCEL and cancel_handler is not None:
+                return f"{name}:cancel", cancel_handler
+            return name, handler
+    return None
 
 
+def _run_text_route(name: str, handler: Callable, update: Update, context: CallbackContext):
+    started = _time.perf_counter()
+    tracked = METRICS_ENABLED and not getattr(handler, "tracked_handler", False)
+    if tracked:
+        handler_started = _enter_handler(handler.__name__)
+    try:
+        return handler(update, context)
+    finally:
+        if tracked:
+            _exit_handler(handler.__name__, handler_started)
+        elapsed_ms = (_time.perf_counter() - started) * 1000
+        with TEXT_ROUTE_STATS_LOCK:
+            stats = TEXT_ROUTE_STATS.setdefault(name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            stats["count"] += 1
+            stats["total_ms"] += elapsed_ms
+            stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
 
 
+def text_route_metrics() -> Dict:
+    with TEXT_ROUTE_STATS_LOCK:
+        snapshot = {name: dict(stats) for name, stats in TEXT_ROUTE_STATS.items()}
+    for stats in snapshot.values():
+        stats["avg_ms"] = stats["total_ms"] / stats["count"] if stats["count"] else 0.0
+    return snapshot
 
-    # أي نص آخر
-    if not support_session_active and not is_admin(user_id) and not is_supervisor(user_id):
-        msg.reply_text(
-            "رسالتك لم تُرسل للدعم. إذا أردت التواصل مع الدعم اضغط زر (تواصل مع الدعم ✉️).",
-            reply_markup=SUPPORT_PROMPT_KB,
-        )
 
 # =================== دوال إدارة المنافسات والمجتمع ===================
 
@@ -10422,8 +12600,18 @@ ARABIC_LETTER_NORMALIZATION = str.maketrans({
     "ة": "ه",
     "ـ": "",
 })
+# ترجمة واحدة للهاشتاق: توحيد الحروف + حذف التشكيل والعلامات الزخرفية + حذف "_"
+HASHTAG_TRANSLATION = {
+    **ARABIC_LETTER_NORMALIZATION,
+    **{code: None for start, end in ((0x064B, 0x065F), (0x0617, 0x061A), (0x06D6, 0x06ED)) for code in range(start, end + 1)},
+    ord("_"): None,
+}
+# أي رمز غير حرف/رقم (إيموجي، علامات، مسافات)
+HASHTAG_STRIP_PATTERN = re.compile(r"[^\w\u0600-\u06FF]+")
+HASHTAG_PATTERN = re.compile(r"#\S+")
 
 
+@lru_cache(maxsize=4096)
 def _normalize_hashtag(tag: str) -> str:
     """Normalize hashtags for robust matching across Arabic variants."""
 
@@ -10433,13 +12621,8 @@ def _normalize_hashtag(tag: str) -> str:
     text = tag.strip().lstrip("#")
     # إزالة العلامات الشائعة الملاصقة للهاشتاق
     text = text.rstrip(".,،؛؛!！?？✨⭐️🌟🥇🥈🥉🎖️🏅")
-    # إزالة التشكيل والعلامات الزخرفية
-    text = re.sub(r"[\u064B-\u065F\u0617-\u061A\u06D6-\u06ED]", "", text)
-    text = text.translate(ARABIC_LETTER_NORMALIZATION)
-    text = text.replace("_", " ")
-    # إزالة أي رموز غير حروف/أرقام/مسافات (مثل الإيموجي أو الرموز الأخرى)
-    text = re.sub(r"[^\w\s\u0600-\u06FF]", "", text)
-    text = re.sub(r"\s+", "", text)
+    text = text.translate(HASHTAG_TRANSLATION)
+    text = HASHTAG_STRIP_PATTERN.sub("", text)
     return text.lower()
 
 
@@ -10456,10 +12639,10 @@ def extract_hashtags_from_message(message) -> Tuple[List[str], List[str]]:
             except Exception:
                 continue
 
-    text_based_hashtags = re.findall(r"#\S+", (message.caption or message.text or ""))
+    text_based_hashtags = HASHTAG_PATTERN.findall(message.caption or message.text or "")
     hashtags.extend(text_based_hashtags)
 
-    normalized = [_normalize_hashtag(tag) for tag in hashtags if _normalize_hashtag(tag)]
+    normalized = [tag for tag in map(_normalize_hashtag, hashtags) if tag]
     logger.debug(
         "🏷️ تم استخراج هاشتاقات من الرسالة | raw=%s | normalized=%s",
         hashtags,
@@ -10483,7 +12666,7 @@ def _match_audio_section(hashtags: List[str]) -> str:
 
 def _audio_title_from_message(message) -> str:
     caption = message.caption or message.text or ""
-    caption = re.sub(r"#\S+", "", caption)
+    caption = HASHTAG_PATTERN.sub("", caption)
 
     audio_obj = getattr(message, "audio", None)
     doc_obj = getattr(message, "document", None)
@@ -11277,51 +13460,116 @@ def error_handler(update: Update, context: CallbackContext):
     logger.exception("Unhandled error: %s", context.error, exc_info=context.error)
 
 
+# =================== مراحل بدء التشغيل ===================
+
+# يُفتح بعد تحميل المستخدمين وفهرس الحظر والإعدادات؛ معالجة التحديثات تنتظره
+STARTUP_READY = Event()
+# اسم المرحلة -> المدة بالملي ثانية (suqya_startup_phase_ms في /metrics)
+STARTUP_PHASES: Dict[str, float] = {}
+STARTUP_LOCK = Lock()
+
+
+def _record_startup_phase(name: str, started: float):
+    elapsed_ms = (_time.perf_counter() - started) * 1000
+    with STARTUP_LOCK:
+        STARTUP_PHASES[name] = round(elapsed_ms, 1)
+    logger.info("⏱️ مرحلة بدء التشغيل %s: %.0fms", name, elapsed_ms)
+
+
+def _run_startup_phase(name: str, func, *args):
+    started = _time.perf_counter()
+    try:
+        return func(*args)
+    except Exception as e:
+        logger.warning("⚠️ فشلت مرحلة بدء التشغيل %s: %s", name, e)
+        return None
+    finally:
+        _record_startup_phase(name, started)
+
+
+def startup_metrics() -> Dict:
+    with STARTUP_LOCK:
+        phases = dict(STARTUP_PHASES)
+    return {"ready": STARTUP_READY.is_set(), "phases_ms": phases}
+
+
+def wait_for_startup(timeout: Optional[float] = None) -> bool:
+    """انتظار انتهاء مرحلة التحميل (لأدوات القياس والاختبار اليدوي)"""
+    return STARTUP_READY.wait(timeout)
+
+
+def _load_users_phase():
+    global data
+    loaded = load_data()
+    # الإعدادات العامة قد تكون حُمّلت بالتوازي في القاموس السابق
+    if GLOBAL_KEY in data and GLOBAL_KEY not in loaded:
+        loaded[GLOBAL_KEY] = data[GLOBAL_KEY]
+    data = loaded
+    logger.info(f"✅ تم تحميل {len([k for k in data if k != GLOBAL_KEY])} مستخدم في الذاكرة")
+    rebuild_user_index()
+
+    # تمييز البيانات المحملة على أنها محدثة حديثًا لتجنب قراءات Firestore المكررة فور التشغيل
+    preload_time = datetime.now(timezone.utc)
+    for uid in data:
+        if str(uid) == str(GLOBAL_KEY):
+            continue
+        USER_CACHE_TIMESTAMPS[uid] = preload_time
+
+    # عدم ترحيل بيانات Firestore عند كل تشغيل لمنع الكتابة فوق البيانات الحالية
+    if db is not None and not DATA_LOADED_FROM_FIRESTORE:
+        logger.info("جاري ترحيل البيانات من التخزين المحلي إلى Firestore...")
+        migrate_data_to_firestore()
+
+
+def _load_sessions_phase():
+    # استرجاع جلسات المستخدمين المحفوظة (إن كان SESSION_STORE_FILE مفعلاً)
+    load_user_sessions()
+    load_message_routes()
+
+
+def _warm_up():
+    """المرحلة الثانية: تحميل المستخدمين والإعدادات والجلسات بالتوازي ثم فتح البوابة"""
+    started = _time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, STARTUP_WORKERS), thread_name_prefix="startup") as pool:
+            users = pool.submit(_run_startup_phase, "users", _load_users_phase)
+            if not firestore_available():
+                # بدون Firestore تُقرأ الإعدادات من نفس الملف المحلي للمستخدمين
+                users.result()
+            pool.submit(_run_startup_phase, "config", start_config_service)
+            # تحميل المكتبة الصوتية من التخزين المحلي عند الحاجة
+            pool.submit(_run_startup_phase, "audio_library", _load_local_audio_library)
+            pool.submit(_run_startup_phase, "sessions", _load_sessions_phase)
+            # إعادة كتابات Firestore المعلقة من التشغيل السابق
+            pool.submit(_run_startup_phase, "outbox", start_outbox_drainer)
+            # تنظيف مكتبة الصوتيات لضمان عدم تكرار نفس المقطع في أكثر من قسم
+            pool.submit(_run_startup_phase, "audio_reconcile", reconcile_audio_library_uniqueness)
+    finally:
+        STARTUP_READY.set()
+        _record_startup_phase("warm_up", started)
+
+    # فحص تشخيصي فقط؛ لا يؤخر معالجة التحديثات
+    if dispatcher is not None:
+        _run_startup_phase("storage_channel_check", _ensure_storage_channel_admin, dispatcher.bot)
+
+
 def start_bot():
-    """بدء البوت"""
+    """بدء البوت: تسجيل المعالجات والمهام فوراً، والتحميل في الخلفية (_warm_up)"""
     global IS_RUNNING, job_queue, dispatcher
-    global data
     
     if not BOT_TOKEN:
         raise RuntimeError("❌ BOT_TOKEN غير موجود!")
     
     logger.info("🚀 بدء تهيئة البوت...")
+    STARTUP_READY.clear()
     
     try:
-        logger.info("🔄 جارٍ تحميل بيانات المستخدمين...")
-        data = load_data()
-        logger.info(f"✅ تم تحميل {len([k for k in data if k != GLOBAL_KEY])} مستخدم في الذاكرة")
-
-        # تحميل المكتبة الصوتية من التخزين المحلي عند الحاجة
-        _load_local_audio_library()
-
-        # تمييز البيانات المحملة على أنها محدثة حديثًا لتجنب قراءات Firestore المكررة فور التشغيل
-        preload_time = datetime.now(timezone.utc)
-        for uid in data:
-            if str(uid) == str(GLOBAL_KEY):
-                continue
-            USER_CACHE_TIMESTAMPS[uid] = preload_time
-
-        # عدم ترحيل بيانات Firestore عند كل تشغيل لمنع الكتابة فوق البيانات الحالية
-        if db is not None and not DATA_LOADED_FROM_FIRESTORE:
-            logger.info("جاري ترحيل البيانات من التخزين المحلي إلى Firestore...")
-            try:
-                migrate_data_to_firestore()
-            except Exception as e:
-                logger.warning(f"⚠️ خطأ في الترحيل: {e}")
-
-        # تنظيف مكتبة الصوتيات لضمان عدم تكرار نفس المقطع في أكثر من قسم
-        try:
-            reconcile_audio_library_uniqueness()
-        except Exception as e:
-            logger.warning(f"⚠️ تعذر تنظيف مكتبة الصوتيات: {e}")
-
-        try:
-            _ensure_storage_channel_admin(dispatcher.bot)
-        except Exception as e:
-            logger.warning("⚠️ تعذر التأكد من صلاحيات قناة التخزين: %s", e)
+        _run_startup_phase("storage", connect_storage)
 
+        phase_started = _time.perf_counter()
         logger.info("جاري تسجيل المعالجات...")
+        # فلتر المحظورين قبل كل المجموعات الأخرى
+        dispatcher.add_handler(TypeHandler(Update, _drop_banned_updates), group=-2)
         dispatcher.add_handler(CommandHandler("start", start_command))
         dispatcher.add_handler(CommandHandler("help", help_command))
         dispatcher.add_handler(CommandHandler("menu", menu_command))
@@ -11604,7 +13852,12 @@ def start_bot():
         )
         
         logger.info("✅ تم تسجيل جميع المعالجات")
+        if METRICS_ENABLED:
+            instrument_runtime()
+        _install_dispatch_lanes()
+        _record_startup_phase("handlers", phase_started)
         
+        phase_started = _time.perf_counter()
         logger.info("جاري تشغيل المهام اليومية...")
         
         try:
@@ -11646,11 +13899,15 @@ def start_bot():
             logger.warning(f"⚠️ خطأ في جدولة التصفير اليومي: {e}")
         
         logger.info("✅ تم تشغيل المهام اليومية")
+        _record_startup_phase("jobs", phase_started)
         
     except Exception as e:
         logger.error(f"❌ خطأ في البوت: {e}", exc_info=True)
         raise
 
+    # المعالجات جاهزة: يمكن إعداد Webhook واستقبال التحديثات الآن، ومعالجتها تنتظر التحميل
+    Thread(target=_warm_up, name="startup-warm-up", daemon=True).start()
+
 
 # =================== قسم الدورات - Handlers الفعلية ===================
 
@@ -11667,9 +13924,150 @@ COURSE_BENEFIT_CONTEXT_TYPE = "course_benefit"
 COURSE_BENEFIT_THREADS_COLLECTION = "course_benefit_threads"
 COURSE_BENEFIT_MESSAGES_COLLECTION = "course_benefit_messages"
 
-COURSE_NAME_MIN_LENGTH = 3
-COURSE_NAME_MAX_LENGTH = 60
-COURSE_LEADERBOARD_PAGE_SIZE = 10
+COURSE_NAME_MIN_LENGTH = 3
+COURSE_NAME_MAX_LENGTH = 60
+COURSE_LEADERBOARD_PAGE_SIZE = 10
+COURSE_PARTICIPANTS_PAGE_SIZE = 20
+COURSE_CONTENT_CACHE_TTL_SECONDS = int(os.getenv("COURSE_CONTENT_CACHE_TTL_SECONDS", 300))
+QUIZ_SESSION_TTL_SECONDS = int(os.getenv("QUIZ_SESSION_TTL_SECONDS", 600))
+
+# (collection, doc_id) -> (وقت الجلب, بيانات الوثيقة أو None)
+COURSE_CONTENT_CACHE: Dict[Tuple[str, str], Tuple[float, Optional[Dict]]] = {}
+
+# =================== فهرس ترتيب الدورات ===================
+
+# course_id -> {"keys": [(-points, user_id)], "entries": {user_id: {...}}}
+COURSE_LEADERBOARD_INDEX: Dict[str, Dict] = {}
+COURSE_LEADERBOARD_LOCK = Lock()
+# course_id -> رقم يزيد مع كل تحديث؛ البناء الذي تغيّر الرقم أثناءه لا يُعتمد
+COURSE_LEADERBOARD_VERSIONS: Dict[str, int] = {}
+COURSE_LEADERBOARD_BUILD_ATTEMPTS = 3
+
+
+def _course_rank_key(points, user_id) -> Tuple[int, int]:
+    try:
+        uid = int(user_id)
+    except (TypeError, ValueError):
+        uid = 0
+    return (-(int(points or 0)), uid)
+
+
+def _build_course_leaderboard(course_id: str) -> Dict:
+    entries = {}
+    for doc in (
+        db.collection(COURSE_SUBSCRIPTIONS_COLLECTION)
+        .where("course_id", "==", course_id)
+        .stream()
+    ):
+        sub = doc.to_dict() or {}
+        _, uid = _course_rank_key(0, sub.get("user_id"))
+        entries[uid] = {
+            "user_id": uid,
+            "full_name": sub.get("full_name"),
+            "username": sub.get("username"),
+            "points": int(sub.get("points", 0) or 0),
+        }
+    return {
+        "keys": sorted(_course_rank_key(e["points"], uid) for uid, e in entries.items()),
+        "entries": entries,
+    }
+
+
+def _load_course_leaderboard(course_id: str) -> Dict:
+    """بناء فهرس ترتيب الدورة مرة واحدة ثم تحديثه تدريجياً"""
+    for _ in range(COURSE_LEADERBOARD_BUILD_ATTEMPTS):
+        with COURSE_LEADERBOARD_LOCK:
+            index = COURSE_LEADERBOARD_INDEX.get(course_id)
+            if index is not None:
+                return index
+            version = COURSE_LEADERBOARD_VERSIONS.setdefault(course_id, 0)
+
+        index = _build_course_leaderboard(course_id)
+        with COURSE_LEADERBOARD_LOCK:
+            # تحديث وصل أثناء القراءة قد لا يظهر في النتيجة، فنعيد البناء بدل اعتماد فهرس قديم
+            if COURSE_LEADERBOARD_VERSIONS.get(course_id, 0) == version:
+                # قد يكون خيط آخر بنى الفهرس في الأثناء؛ نعتمد الأسبق
+                index = COURSE_LEADERBOARD_INDEX.setdefault(course_id, index)
+                logger.info(
+                    "[COURSES][RANK] تم بناء فهرس ترتيب الدورة %s (%s مشارك)",
+                    course_id,
+                    len(index["entries"]),
+                )
+                return index
+
+    # تحديثات متواصلة: نعرض آخر بناء دون حفظه، ويُعاد البناء في الطلب التالي
+    logger.warning("[COURSES][RANK] لم يستقر فهرس ترتيب الدورة %s؛ لن يُحفظ", course_id)
+    return index
+
+
+def _course_leaderboard_apply(
+    course_id: str,
+    user_id: int,
+    points_delta: int = 0,
+    full_name: Optional[str] = None,
+    username: Optional[str] = None,
+):
+    """تحديث موضع مشارك في فهرس الترتيب (إن كان الفهرس محمّلاً)"""
+    if not course_id:
+        return
+    _, uid = _course_rank_key(0, user_id)
+    with COURSE_LEADERBOARD_LOCK:
+        COURSE_LEADERBOARD_VERSIONS[course_id] = COURSE_LEADERBOARD_VERSIONS.get(course_id, 0) + 1
+        index = COURSE_LEADERBOARD_INDEX.get(course_id)
+        if index is None:
+            # سيُبنى الفهرس من Firestore عند أول طلب، فلا داعي لتحديثه الآن
+            return
+        keys = index["keys"]
+        entry = index["entries"].get(uid)
+        if entry is None:
+            entry = {"user_id": uid, "full_name": None, "username": None, "points": 0}
+            index["entries"][uid] = entry
+        else:
+            old_key = _course_rank_key(entry["points"], uid)
+            pos = bisect.bisect_left(keys, old_key)
+            if pos < len(keys) and keys[pos] == old_key:
+                keys.pop(pos)
+
+        entry["points"] = int(entry.get("points", 0) or 0) + int(points_delta or 0)
+        if full_name:
+            entry["full_name"] = full_name
+        if username:
+            entry["username"] = username
+        bisect.insort(keys, _course_rank_key(entry["points"], uid))
+
+
+def _course_leaderboard_rename(user_id: int, full_name: str):
+    """تحديث الاسم المعروض للمشارك في كل الفهارس المحمّلة"""
+    _, uid = _course_rank_key(0, user_id)
+    with COURSE_LEADERBOARD_LOCK:
+        for course_id in COURSE_LEADERBOARD_VERSIONS:
+            COURSE_LEADERBOARD_VERSIONS[course_id] += 1
+        for index in COURSE_LEADERBOARD_INDEX.values():
+            entry = index["entries"].get(uid)
+            if entry is not None:
+                entry["full_name"] = full_name
+
+
+def _course_leaderboard_drop(course_id: str):
+    with COURSE_LEADERBOARD_LOCK:
+        COURSE_LEADERBOARD_VERSIONS[course_id] = COURSE_LEADERBOARD_VERSIONS.get(course_id, 0) + 1
+        COURSE_LEADERBOARD_INDEX.pop(course_id, None)
+
+
+def _course_leaderboard_page(course_id: str, page: int, page_size: int) -> Tuple[List[Dict], int, int, int]:
+    """إرجاع (عناصر الصفحة، العدد الكلي، الصفحة الحالية، عدد الصفحات)"""
+    index = _load_course_leaderboard(course_id)
+    with COURSE_LEADERBOARD_LOCK:
+        keys = index["keys"]
+        total_entries = len(keys)
+        total_pages = max(1, (total_entries + page_size - 1) // page_size)
+        current_page = max(1, min(page, total_pages))
+        start_index = (current_page - 1) * page_size
+        page_items = [
+            dict(index["entries"][uid])
+            for _, uid in keys[start_index:start_index + page_size]
+        ]
+    return page_items, total_entries, current_page, total_pages
 
 # =================== لوحات المفاتيح للدورات ===================
 
@@ -11733,6 +14131,69 @@ def _ensure_subscription(user_id: int, course_id: str):
     return sub_doc.to_dict(), sub_ref
 
 
+def _get_course_content(collection: str, doc_id: str) -> Optional[Dict]:
+    """قراءة درس أو اختبار من كاش محتوى الدورات (مع مهلة صلاحية)"""
+    key = (collection, doc_id)
+    now = _time.monotonic()
+    cached = COURSE_CONTENT_CACHE.get(key)
+    if cached is not None and now - cached[0] < COURSE_CONTENT_CACHE_TTL_SECONDS:
+        return dict(cached[1]) if cached[1] is not None else None
+
+    doc = db.collection(collection).document(doc_id).get()
+    value = doc.to_dict() if doc.exists else None
+    COURSE_CONTENT_CACHE[key] = (now, value)
+    return dict(value) if value is not None else None
+
+
+def _invalidate_course_content(collection: str, doc_id: str):
+    COURSE_CONTENT_CACHE.pop((collection, doc_id), None)
+
+
+def _quiz_session_subscription(user_id: int, quiz_id: str, course_id: str):
+    """اشتراك المستخدم المحفوظ طوال جلسة الاختبار لتجنب قراءته مع كل خطوة"""
+    state = ACTIVE_QUIZ_STATE.get(user_id) or {}
+    if (
+        state.get("quiz_id") == quiz_id
+        and state.get("subscription_ref") is not None
+        and _time.monotonic() - state.get("started_at", 0) < QUIZ_SESSION_TTL_SECONDS
+    ):
+        return state.get("subscription"), state["subscription_ref"]
+
+    subscription, sub_ref = _ensure_subscription(user_id, course_id)
+    if subscription:
+        ACTIVE_QUIZ_STATE[user_id] = {
+            **state,
+            "quiz_id": quiz_id,
+            "course_id": course_id,
+            "subscription": subscription,
+            "subscription_ref": sub_ref,
+            "started_at": _time.monotonic(),
+        }
+    return subscription, sub_ref
+
+
+def _commit_quiz_completion(user_id: int, course_id: str, quiz_id: str, sub_ref, notify: bool):
+    """تسجيل إكمال الاختبار ونقاط الدورة، ثم نقاط المستخدم عبر طابور الكتابات"""
+    sub_ref.update(
+        {
+            "points": firestore.Increment(POINTS_PER_QUIZ_COMPLETION),
+            "completed_quizzes": firestore.ArrayUnion([quiz_id]),
+        }
+    )
+    # ليست في نفس الدفعة: وثيقة مستخدم غير موجودة لا تُفشل تسجيل الاختبار، بل تذهب كتابتها للموقوفات
+    write_through_outbox("update", f"{USERS_COLLECTION}/{user_id}", {
+        "points": firestore.Increment(POINTS_PER_QUIZ_COMPLETION),
+        "last_active": datetime.now(timezone.utc).isoformat(),
+    })
+
+    ACTIVE_QUIZ_STATE.pop(user_id, None)
+    _course_leaderboard_apply(course_id, user_id, POINTS_PER_QUIZ_COMPLETION)
+    new_points = _patch_cached_points(user_id, POINTS_PER_QUIZ_COMPLETION)
+    publish_event(
+        PointsAwarded(user_id, POINTS_PER_QUIZ_COMPLETION, new_points, "إكمال اختبار", notify=notify)
+    )
+
+
 def _get_saved_course_full_name(user_id: int) -> str:
     record = get_user_record_by_id(user_id) or {}
     saved_name = (record.get("course_full_name") or "").strip()
@@ -11771,24 +14232,27 @@ def _user_attended_lesson(user_id: int, course_id: str, lesson_id: str) -> bool:
     return lesson_id in attended_lessons
 
 
+SESSION_MEDIA_TIMEOUT_SECONDS = timedelta(minutes=10).total_seconds()
+
+
 def _cancel_presentation_media_timeout(user_id: int):
-    job = PRESENTATION_MEDIA_TIMEOUTS.pop(user_id, None)
-    if job:
-        try:
-            job.schedule_removal()
-        except Exception:
-            pass
+    TIMER_WHEEL.cancel(("presentation_timeout", user_id))
+
+
+def _presentation_media_timeout(data: Dict):
+    # تعديل حالة المستخدم يتم على مساره حتى لا يتداخل مع رسالة يعالجها الآن
+    bot = dispatcher.bot if dispatcher else None
+    hand_off_timer_task(data.get("user_id"), _expire_presentation_media, data, bot)
 
 
-def _presentation_media_timeout(context: CallbackContext):
-    data = context.job.context or {}
+def _expire_presentation_media(data: Dict, bot):
     user_id = data.get("user_id")
     chat_id = data.get("chat_id")
     WAITING_COURSE_PRESENTATION_MEDIA.pop(user_id, None)
-    PRESENTATION_MEDIA_TIMEOUTS.pop(user_id, None)
+    PRESENTATION_THREAD_META.pop(user_id, None)
     if chat_id:
         try:
-            context.bot.send_message(
+            bot.send_message(
                 chat_id=chat_id,
                 text="⏳ انتهت مهلة العَرْض، افتحه من جديد إذا احتجت.",
             )
@@ -11797,37 +14261,33 @@ def _presentation_media_timeout(context: CallbackContext):
 
 
 def _schedule_presentation_media_timeout(user_id: int, chat_id: int, thread_id: str):
-    if not job_queue:
-        return
-    _cancel_presentation_media_timeout(user_id)
-    job = job_queue.run_once(
+    TIMER_WHEEL.schedule(
+        ("presentation_timeout", user_id),
+        SESSION_MEDIA_TIMEOUT_SECONDS,
         _presentation_media_timeout,
-        when=timedelta(minutes=10),
-        context={"user_id": user_id, "chat_id": chat_id, "thread_id": thread_id},
+        {"user_id": user_id, "chat_id": chat_id, "thread_id": thread_id},
     )
-    PRESENTATION_MEDIA_TIMEOUTS[user_id] = job
 
 
 def _clear_presentation_states(user_id: int):
     WAITING_COURSE_PRESENTATION_MEDIA.pop(user_id, None)
+    PRESENTATION_THREAD_META.pop(user_id, None)
     _cancel_presentation_media_timeout(user_id)
 
 def _cancel_course_benefit_timeout(user_id: int):
-    job = COURSE_BENEFIT_TIMEOUTS.pop(user_id, None)
-    if job:
-        try:
-            job.schedule_removal()
-        except Exception:
-            pass
+    TIMER_WHEEL.cancel(("benefit_timeout", user_id))
+
 
+def _course_benefit_timeout(data: Dict):
+    bot = dispatcher.bot if dispatcher else None
+    hand_off_timer_task(data.get("user_id"), _expire_course_benefit, data, bot)
 
-def _course_benefit_timeout(context: CallbackContext):
-    data = context.job.context or {}
+
+def _expire_course_benefit(data: Dict, bot):
     user_id = data.get("user_id")
     chat_id = data.get("chat_id")
     thread_id = data.get("thread_id") or data.get("session_id")
     WAITING_COURSE_BENEFIT_MEDIA.pop(user_id, None)
-    COURSE_BENEFIT_TIMEOUTS.pop(user_id, None)
     if thread_id:
         try:
             db.collection(COURSE_BENEFIT_THREADS_COLLECTION).document(thread_id).update(
@@ -11837,7 +14297,7 @@ def _course_benefit_timeout(context: CallbackContext):
             logger.debug("[BENEFIT] Failed to mark thread timeout %s: %s", thread_id, e)
     if chat_id:
         try:
-            context.bot.send_message(
+            bot.send_message(
                 chat_id=chat_id,
                 text="⏳ انتهت مهلة الفائدة، افتحها مجدداً إذا احتجت.",
             )
@@ -11846,20 +14306,17 @@ def _course_benefit_timeout(context: CallbackContext):
 
 
 def _schedule_course_benefit_timeout(user_id: int, chat_id: int, session_id: str):
-    if not job_queue:
-        return
-    _cancel_course_benefit_timeout(user_id)
-    job = job_queue.run_once(
+    TIMER_WHEEL.schedule(
+        ("benefit_timeout", user_id),
+        SESSION_MEDIA_TIMEOUT_SECONDS,
         _course_benefit_timeout,
-        when=timedelta(minutes=10),
-        context={
+        {
             "user_id": user_id,
             "chat_id": chat_id,
             "session_id": session_id,
             "thread_id": session_id,
         },
     )
-    COURSE_BENEFIT_TIMEOUTS[user_id] = job
 
 
 def _clear_benefit_states(user_id: int):
@@ -12555,6 +15012,7 @@ def _finalize_course_subscription(user: User, context: CallbackContext):
             "gender": gender,
         }
         sub_ref.set(sub_data)
+        _course_leaderboard_apply(course_id, user_id, 0, full_name_value, user.username)
         update_user_record(
             user_id,
             country=country,
@@ -12640,6 +15098,7 @@ def _finalize_profile_edit(user_id: int, chat_id: int, context: CallbackContext)
             batch.commit()
         except Exception as e:
             logger.warning(f"تعذر تحديث بيانات الاشتراك للدورات: {e}")
+        _course_leaderboard_rename(user_id, full_name)
 
         context.bot.send_message(
             chat_id=chat_id,
@@ -12799,14 +15258,13 @@ def user_view_lesson(query: Update.callback_query, context: CallbackContext, les
         waiting_thread_id = WAITING_COURSE_PRESENTATION_MEDIA.get(user_id)
         if waiting_thread_id:
             if firestore_available():
-                thread_doc = db.collection(COURSE_PRESENTATIONS_THREADS_COLLECTION).document(waiting_thread_id).get()
-                if thread_doc.exists:
-                    thread = thread_doc.to_dict() or {}
-                    if (
-                        thread.get("lesson_id") == lesson_id
-                        and thread.get("status") == "open"
-                    ):
-                        presentation_thread_id = waiting_thread_id
+                thread = _load_presentation_thread(user_id, waiting_thread_id)
+                if (
+                    thread
+                    and thread.get("lesson_id") == lesson_id
+                    and thread.get("status") == "open"
+                ):
+                    presentation_thread_id = waiting_thread_id
             else:
                 presentation_thread_id = waiting_thread_id
 
@@ -12983,6 +15441,7 @@ def user_view_lesson(query: Update.callback_query, context: CallbackContext, les
     )
 
 
+@track_handler
 def register_lesson_attendance(
     query: Update.callback_query, context: CallbackContext, user_id: int, lesson_id: str
 ):
@@ -12995,28 +15454,32 @@ def register_lesson_attendance(
         )
         return
 
-    lesson_doc = db.collection(COURSE_LESSONS_COLLECTION).document(lesson_id).get()
-    if not lesson_doc.exists:
+    lesson = _get_course_content(COURSE_LESSONS_COLLECTION, lesson_id)
+    if not lesson:
         safe_edit_message_text(query, "❌ الدرس غير موجود.", reply_markup=COURSES_USER_MENU_KB)
         return
 
-    lesson = lesson_doc.to_dict()
     course_id = lesson.get("course_id")
-    logger.info(
+    logger.debug(
         "🟢 ATTEND_START | user_id=%s | course_id=%s | lesson_id=%s",
         user_id,
         course_id,
         lesson_id,
     )
-    sub_id = _subscription_document_id(user_id, course_id)
-    sub_ref = db.collection(COURSE_SUBSCRIPTIONS_COLLECTION).document(sub_id)
-    logger.info("📄 SUB_DOC_REF | path=%s", sub_ref.path)
-    sub_doc = sub_ref.get()
-    logger.info("📄 SUB_DOC_EXISTS=%s", sub_doc.exists)
-    if sub_doc.exists:
-        logger.info("📄 SUB_DATA_KEYS=%s", list((sub_doc.to_dict() or {}).keys()))
+    sub_ref = db.collection(COURSE_SUBSCRIPTIONS_COLLECTION).document(
+        _subscription_document_id(user_id, course_id)
+    )
+    user_ref = db.collection(USERS_COLLECTION).document(str(user_id))
 
-    if not sub_doc.exists:
+    _clear_attendance_confirmation(context, query.message.chat_id)
+    try:
+        status, new_points = _attend_lesson_transaction(db.transaction(), sub_ref, user_ref, lesson_id)
+    except Exception:
+        logger.error("❌ ATTEND_UPDATE_FAIL", exc_info=True)
+        query.answer("❌ تعذر تسجيل الحضور حالياً.", show_alert=True)
+        return
+
+    if status == "not_subscribed":
         safe_edit_message_text(
             query,
             "❌ يجب التسجيل في الدورة أولاً لتسجيل الحضور.",
@@ -13024,17 +15487,7 @@ def register_lesson_attendance(
         )
         return
 
-    subscription = sub_doc.to_dict() or {}
-    attended_lessons = subscription.get("lessons_attended") or []
-    logger.info(
-        "🧾 ATTEND_STATE | lesson_id=%s | attended_type=%s | attended_len=%s | attended_sample=%s",
-        lesson_id,
-        type(attended_lessons).__name__,
-        len(attended_lessons),
-        attended_lessons[:5] if isinstance(attended_lessons, list) else str(attended_lessons)[:200],
-    )
-    _clear_attendance_confirmation(context, query.message.chat_id)
-    if lesson_id in attended_lessons:
+    if status == "already":
         logger.info("🟡 ATTEND_ALREADY | user_id=%s | lesson_id=%s", user_id, lesson_id)
         query.answer("✅ تم تسجيل حضورك مسبقًا.", show_alert=True)
         try:
@@ -13046,41 +15499,173 @@ def register_lesson_attendance(
             pass
         return
 
+    logger.info(
+        "✅ ATTEND_UPDATE_OK | user_id=%s | course_id=%s | lesson_id=%s | points=%s",
+        user_id,
+        course_id,
+        lesson_id,
+        new_points,
+        extra={"user_id": user_id, "course_id": course_id, "lesson_id": lesson_id, "points": new_points},
+    )
+    confirmation_text = "✅ تم تسجيل حضورك بنجاح."
+    if lesson.get("has_presentation"):
+        confirmation_text += "\n🎙️ يمكنك الآن فتح العَرْض لهذا الدرس."
+    query.answer(confirmation_text, show_alert=True)
     try:
-        logger.info("✏️ ATTEND_UPDATE_TRY | lesson_id=%s", lesson_id)
-        sub_ref.update(
+        confirmation_message = query.message.reply_text("✅ تم تسجيل حضورك بنجاح.")
+        context.user_data["attendance_confirmation_msg_id"] = (
+            confirmation_message.message_id
+        )
+    except Exception:
+        pass
+
+    _course_leaderboard_apply(course_id, user_id, POINTS_PER_LESSON_ATTENDANCE)
+    cached_record = data.get(str(user_id))
+    if cached_record is not None and new_points is not None:
+        cached_record["points"] = new_points
+    # المستوى والميداليات والترتيب تُحسب في ناقل الأحداث حتى لا تؤخر المستخدم
+    publish_event(PointsAwarded(user_id, POINTS_PER_LESSON_ATTENDANCE, new_points, "حضور درس"))
+
+
+@firestore.transactional
+def _attend_lesson_transaction(transaction, sub_ref, user_ref, lesson_id: str):
+    """تسجيل الحضور ونقاط الدورة ونقاط المستخدم في معاملة واحدة"""
+    snapshots = {snap.reference.path: snap for snap in transaction.get_all([sub_ref, user_ref])}
+    sub_snap = snapshots.get(sub_ref.path)
+    user_snap = snapshots.get(user_ref.path)
+    if sub_snap is None or not sub_snap.exists:
+        return "not_subscribed", None
+
+    attended_lessons = (sub_snap.to_dict() or {}).get("lessons_attended") or []
+    if lesson_id in attended_lessons:
+        return "already", None
+
+    transaction.update(
+        sub_ref,
+        {
+            "lessons_attended": firestore.ArrayUnion([lesson_id]),
+            "points": firestore.Increment(POINTS_PER_LESSON_ATTENDANCE),
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        },
+    )
+    new_points = None
+    if user_snap is not None and user_snap.exists:
+        new_points = int((user_snap.to_dict() or {}).get("points", 0) or 0) + POINTS_PER_LESSON_ATTENDANCE
+        transaction.update(
+            user_ref,
             {
-                "lessons_attended": firestore.ArrayUnion([lesson_id]),
                 "points": firestore.Increment(POINTS_PER_LESSON_ATTENDANCE),
-                "updated_at": firestore.SERVER_TIMESTAMP,
-            }
-        )
-        fresh = sub_ref.get().to_dict() or {}
-        logger.info(
-            "✅ ATTEND_UPDATE_OK | points=%s | lessons_attended_len=%s",
-            fresh.get("points"),
-            len(fresh.get("lessons_attended") or []),
-        )
-        confirmation_text = "✅ تم تسجيل حضورك بنجاح."
-        if lesson.get("has_presentation"):
-            confirmation_text += "\n🎙️ يمكنك الآن فتح العَرْض لهذا الدرس."
-        query.answer(confirmation_text, show_alert=True)
+                "last_active": datetime.now(timezone.utc).isoformat(),
+            },
+        )
+    return "ok", new_points
+
+
+# =================== ذاكرة جلسات العرض/الفائدة وتخزين رسائلها على دفعات ===================
+
+THREAD_WRITE_FLUSH_SECONDS = float(os.getenv("THREAD_WRITE_FLUSH_SECONDS", 5))
+THREAD_TOUCH_DEBOUNCE_SECONDS = float(os.getenv("THREAD_TOUCH_DEBOUNCE_SECONDS", 60))
+THREAD_WRITE_MAX_PENDING = 200  # أقل من حد الـ 500 عملية في الدفعة الواحدة
+
+# بيانات جلسة العرض المفتوحة تُحفظ عند الفتح بدل قراءتها مع كل رسالة
+PRESENTATION_THREAD_META: Dict[int, Dict] = SessionStateDict("PRESENTATION_THREAD_META")
+THREAD_META_FIELDS = (
+    "user_id",
+    "user_name",
+    "user_username",
+    "user_gender",
+    "course_id",
+    "course_title",
+    "lesson_id",
+    "lesson_title",
+    "curriculum_section",
+    "admin_mirror_enabled",
+    "user_chat_id",
+    "status",
+)
+
+THREAD_WRITE_BUFFER: List[Tuple[str, str, Dict]] = []  # (collection, doc_id, payload)
+THREAD_TOUCH_PENDING = set()  # (collection, thread_id)
+THREAD_TOUCHED_AT: Dict[Tuple[str, str], float] = {}
+THREAD_WRITE_LOCK = Lock()
+THREAD_FLUSH_TIMER_KEY = ("thread_writes_flush",)
+
+
+def _thread_meta(thread_id: str, thread: Dict) -> Dict:
+    meta = {name: thread[name] for name in THREAD_META_FIELDS if name in thread}
+    meta["thread_id"] = thread_id
+    return meta
+
+
+def _load_presentation_thread(user_id: int, thread_id: str) -> Optional[Dict]:
+    """بيانات جلسة العرض من ذاكرة الجلسة، أو قراءة واحدة من Firestore (بعد رد الطاقم أو إعادة التشغيل)"""
+    meta = PRESENTATION_THREAD_META.get(user_id)
+    if meta and meta.get("thread_id") == thread_id:
+        return meta
+    thread_doc = db.collection(COURSE_PRESENTATIONS_THREADS_COLLECTION).document(thread_id).get()
+    if not thread_doc.exists:
+        PRESENTATION_THREAD_META.pop(user_id, None)
+        return None
+    meta = _thread_meta(thread_id, thread_doc.to_dict() or {})
+    PRESENTATION_THREAD_META[user_id] = meta
+    return meta
+
+
+def _queue_thread_write(collection: str, payload: Dict, thread_collection: Optional[str] = None, thread_id: Optional[str] = None):
+    """إضافة رسالة لدفعة الكتابة التالية، مع تحديث last_message_at للجلسة مرة كل فترة"""
+    with THREAD_WRITE_LOCK:
+        # معرف الوثيقة يُحدد هنا حتى لا تتكرر الرسالة إذا أُعيدت من طابور الكتابات
+        THREAD_WRITE_BUFFER.append((collection, uuid4().hex, payload))
+        if thread_collection and thread_id:
+            key = (thread_collection, thread_id)
+            now = _time.monotonic()
+            if now - THREAD_TOUCHED_AT.get(key, float("-inf")) >= THREAD_TOUCH_DEBOUNCE_SECONDS:
+                THREAD_TOUCHED_AT[key] = now
+                THREAD_TOUCH_PENDING.add(key)
+        flush_now = len(THREAD_WRITE_BUFFER) + len(THREAD_TOUCH_PENDING) >= THREAD_WRITE_MAX_PENDING
+        if not flush_now and not TIMER_WHEEL.is_pending(THREAD_FLUSH_TIMER_KEY):
+            TIMER_WHEEL.schedule(THREAD_FLUSH_TIMER_KEY, THREAD_WRITE_FLUSH_SECONDS, run_after_response, flush_thread_writes)
+    if flush_now:
+        run_after_response(flush_thread_writes)
+
+
+def flush_thread_writes():
+    with THREAD_WRITE_LOCK:
+        messages = list(THREAD_WRITE_BUFFER)
+        touches = list(THREAD_TOUCH_PENDING)
+        THREAD_WRITE_BUFFER.clear()
+        THREAD_TOUCH_PENDING.clear()
+        TIMER_WHEEL.cancel(THREAD_FLUSH_TIMER_KEY)
+    if not (messages or touches):
+        return
+
+    if firestore_available():
         try:
-            confirmation_message = query.message.reply_text("✅ تم تسجيل حضورك بنجاح.")
-            context.user_data["attendance_confirmation_msg_id"] = (
-                confirmation_message.message_id
-            )
-        except Exception:
-            pass
-        add_points(
-            user_id,
-            POINTS_PER_LESSON_ATTENDANCE,
-            context,
-            reason="حضور درس",
-        )
-    except Exception as e:
-        logger.error("❌ ATTEND_UPDATE_FAIL", exc_info=True)
-        query.answer("❌ تعذر تسجيل الحضور حالياً.", show_alert=True)
+            batch = db.batch()
+            for collection, doc_id, payload in messages:
+                batch.set(db.collection(collection).document(doc_id), payload)
+            for collection, thread_id in touches:
+                batch.set(
+                    db.collection(collection).document(thread_id),
+                    {"last_message_at": firestore.SERVER_TIMESTAMP},
+                    merge=True,
+                )
+            batch.commit()
+            logger.debug("💾 دفعة رسائل الجلسات: %s رسالة، %s جلسة", len(messages), len(touches))
+            return
+        except Exception as e:
+            logger.error(f"Error flushing session messages: {e}")
+
+    # فشلت الدفعة (أو Firestore غير متاح): الرسائل تُحفظ في طابور الكتابات وتُعاد لاحقاً بدل ضياعها
+    for collection, doc_id, payload in messages:
+        WRITE_OUTBOX.enqueue("set", f"{collection}/{doc_id}", payload, key=doc_id)
+    for collection, thread_id in touches:
+        WRITE_OUTBOX.enqueue("merge", f"{collection}/{thread_id}", {"last_message_at": firestore.SERVER_TIMESTAMP})
+    logger.warning("📮 دفعة رسائل الجلسات في طابور الكتابات: %s رسالة، %s جلسة", len(messages), len(touches))
+
+
+# الرسائل التي لم تُكتب بعد تُكتب عند الإيقاف؛ تُسجل بعد WRITE_OUTBOX.close فتعمل قبله
+atexit.register(flush_thread_writes)
 
 
 def _build_presentation_header(thread: Dict, thread_id: str) -> str:
@@ -13156,13 +15741,12 @@ def _store_presentation_message(
         "context_type": COURSE_PRESENTATION_CONTEXT_TYPE,
         "created_at": firestore.SERVER_TIMESTAMP,
     }
-    try:
-        db.collection(COURSE_PRESENTATION_MESSAGES_COLLECTION).add(message_payload)
-        db.collection(COURSE_PRESENTATIONS_THREADS_COLLECTION).document(thread_id).update(
-            {"last_message_at": firestore.SERVER_TIMESTAMP}
-        )
-    except Exception as e:
-        logger.error(f"Error storing presentation message: {e}")
+    _queue_thread_write(
+        COURSE_PRESENTATION_MESSAGES_COLLECTION,
+        message_payload,
+        COURSE_PRESENTATIONS_THREADS_COLLECTION,
+        thread_id,
+    )
 
 
 def _build_benefit_header(thread: Dict, thread_id: str) -> str:
@@ -13205,10 +15789,7 @@ def _store_course_benefit(context: Dict, message_id: int, incoming_payload: Dict
         "context_type": COURSE_BENEFIT_CONTEXT_TYPE,
         "created_at": firestore.SERVER_TIMESTAMP,
     }
-    try:
-        db.collection(COURSE_BENEFITS_COLLECTION).add(doc_payload)
-    except Exception as e:
-        logger.error(f"Error storing course benefit: {e}")
+    _queue_thread_write(COURSE_BENEFITS_COLLECTION, doc_payload)
 
 
 def _store_benefit_message(
@@ -13230,13 +15811,12 @@ def _store_benefit_message(
         "context_type": COURSE_BENEFIT_CONTEXT_TYPE,
         "created_at": firestore.SERVER_TIMESTAMP,
     }
-    try:
-        db.collection(COURSE_BENEFIT_MESSAGES_COLLECTION).add(message_payload)
-        db.collection(COURSE_BENEFIT_THREADS_COLLECTION).document(thread_id).update(
-            {"last_message_at": firestore.SERVER_TIMESTAMP}
-        )
-    except Exception as e:
-        logger.error(f"Error storing benefit message: {e}")
+    _queue_thread_write(
+        COURSE_BENEFIT_MESSAGES_COLLECTION,
+        message_payload,
+        COURSE_BENEFIT_THREADS_COLLECTION,
+        thread_id,
+    )
 
 
 def _extract_benefit_payload(message) -> Optional[Dict]:
@@ -13342,6 +15922,7 @@ def handle_course_presentation_open(
             return
 
     WAITING_COURSE_PRESENTATION_MEDIA[user_id] = thread_id
+    PRESENTATION_THREAD_META[user_id] = _thread_meta(thread_id, thread_data)
     if query.message:
         _schedule_presentation_media_timeout(user_id, query.message.chat_id, thread_id)
     target_label = "للأدمن" if (record.get("gender") == "male") else "للمشرفة"
@@ -13399,6 +15980,7 @@ def handle_course_presentation_close(
     thread_doc = thread_ref.get()
     if not thread_doc.exists:
         WAITING_COURSE_PRESENTATION_MEDIA.pop(resolved_user_id, None)
+        PRESENTATION_THREAD_META.pop(resolved_user_id, None)
         if query:
             query.answer("⚠️ هذه الجلسة غير متاحة الآن.", show_alert=True)
         elif chat_id:
@@ -13413,6 +15995,7 @@ def handle_course_presentation_close(
 
     _cancel_presentation_media_timeout(resolved_user_id)
     WAITING_COURSE_PRESENTATION_MEDIA.pop(resolved_user_id, None)
+    PRESENTATION_THREAD_META.pop(resolved_user_id, None)
     try:
         thread_ref.update(
             {"status": "closed", "last_message_at": firestore.SERVER_TIMESTAMP}
@@ -13512,8 +16095,8 @@ def handle_course_presentation_user_media(update: Update, context: CallbackConte
         )
         return
 
-    thread_doc = db.collection(COURSE_PRESENTATIONS_THREADS_COLLECTION).document(thread_id).get()
-    if not thread_doc.exists:
+    thread = _load_presentation_thread(user.id, thread_id)
+    if thread is None:
         update.message.reply_text(
             "❌ لم يتم العثور على جلسة العَرْض. افتحها مجدداً من الدرس.",
             reply_markup=PRESENTATION_SESSION_KB,
@@ -13521,7 +16104,6 @@ def handle_course_presentation_user_media(update: Update, context: CallbackConte
         WAITING_COURSE_PRESENTATION_MEDIA.pop(user.id, None)
         return
 
-    thread = thread_doc.to_dict() or {}
     header = _build_presentation_header(thread, thread_id)
     _cancel_presentation_media_timeout(user.id)
 
@@ -13536,71 +16118,29 @@ def handle_course_presentation_user_media(update: Update, context: CallbackConte
         user_gender == "male" or thread.get("admin_mirror_enabled", True)
     )
 
-    def _send_presentation_to_staff(target_id: int):
-        sent_header = None
-        sent_payload = None
-        caption = payload.get("caption")
-        msg_type = payload.get("type")
-        try:
-            sent_header = context.bot.send_message(chat_id=target_id, text=header)
-            if msg_type == "text":
-                sent_payload = context.bot.send_message(
-                    chat_id=target_id, text=payload.get("text", "")
-                )
-            elif msg_type == "voice":
-                sent_payload = context.bot.send_voice(
-                    chat_id=target_id,
-                    voice=payload.get("file_id"),
-                    caption=caption,
-                )
-            elif msg_type == "audio":
-                sent_payload = context.bot.send_audio(
-                    chat_id=target_id,
-                    audio=payload.get("file_id"),
-                    caption=caption,
-                )
-            elif msg_type == "photo":
-                sent_payload = context.bot.send_photo(
-                    chat_id=target_id,
-                    photo=payload.get("file_id"),
-                    caption=caption,
-                )
-            elif msg_type == "video_note":
-                sent_payload = context.bot.send_video_note(
-                    chat_id=target_id, video_note=payload.get("file_id")
-                )
-            elif msg_type == "document":
-                sent_payload = context.bot.send_document(
-                    chat_id=target_id,
-                    document=payload.get("file_id"),
-                    caption=caption,
-                )
-        except Exception as e:
-            logger.error(f"Error sending presentation to staff {target_id}: {e}")
-            return
-
-        # ✅ لازم نخزن على الهيدر + على المحتوى (لأن المشرفة ممكن تعمل Reply على أي واحد)
-        def _bridge_store(m):
-            if not m:
-                return
-            STAFF_REPLY_BRIDGE[(target_id, m.message_id)] = {
-                "kind": "presentation",
-                "thread_id": thread_id,
-                "user_chat_id": thread.get("user_chat_id") or user.id,
-                "user_id": thread.get("user_id") or user.id,
-                "course_id": thread.get("course_id"),
-                "lesson_id": thread.get("lesson_id"),
-                "user_gender": thread.get("user_gender"),
-            }
-
-        _bridge_store(sent_header)
-        _bridge_store(sent_payload)
+    bridge_info = {
+        "kind": "presentation",
+        "thread_id": thread_id,
+        "user_chat_id": thread.get("user_chat_id") or user.id,
+        "user_id": thread.get("user_id") or user.id,
+        "course_id": thread.get("course_id"),
+        "lesson_id": thread.get("lesson_id"),
+        "user_gender": thread.get("user_gender"),
+    }
 
-    if send_to_supervisor:
-        _send_presentation_to_staff(SUPERVISOR_ID)
+    # ✅ نخزن لكل رسالة مرسلة (الهيدر + المحتوى عند فصلهما) لأن المشرفة ممكن تعمل Reply على أي واحد
+    def _bridge_store(target_id, m):
+        STAFF_REPLY_BRIDGE[(target_id, m.message_id)] = bridge_info
 
-    if mirror_to_admin:
-        _send_presentation_to_staff(admin_target)
+    send_to_staff(
+        [
+            SUPERVISOR_ID if send_to_supervisor else None,
+            admin_target if mirror_to_admin else None,
+        ],
+        lambda target_id: send_staff_copy(context.bot, target_id, header, payload),
+        on_sent=_bridge_store,
+        label="Presentation forward",
+    )
 
     target_label = "الأدمن" if user_gender == "male" else "المشرفة"
     update.message.reply_text(
@@ -13740,6 +16280,7 @@ def handle_course_benefit_open(
         "lesson_id": lesson_id,
         "lesson_title": thread_data.get("lesson_title"),
         "curriculum_section": thread_data.get("curriculum_section"),
+        "user_chat_id": thread_data.get("user_chat_id") or callback_chat_id or user_id,
     }
 
     if callback_chat_id is not None:
@@ -13888,16 +16429,21 @@ def handle_course_benefit_user_message(update: Update, context: CallbackContext)
         )
         return
 
-    thread_doc = db.collection(COURSE_BENEFIT_THREADS_COLLECTION).document(thread_id).get()
-    if not thread_doc.exists:
-        update.message.reply_text(
-            "❌ جلسة الفائدة غير متاحة. افتحها من الدرس مرة أخرى.",
-            reply_markup=BENEFIT_SESSION_KB,
-        )
-        _clear_benefit_states(user.id)
-        return
-
-    thread_data = thread_doc.to_dict() or {}
+    if ctx.get("user_chat_id"):
+        # بيانات الجلسة حُفظت في السياق عند فتحها، فلا حاجة لقراءة الجلسة مع كل رسالة
+        thread_data = ctx
+    else:
+        thread_doc = db.collection(COURSE_BENEFIT_THREADS_COLLECTION).document(thread_id).get()
+        if not thread_doc.exists:
+            update.message.reply_text(
+                "❌ جلسة الفائدة غير متاحة. افتحها من الدرس مرة أخرى.",
+                reply_markup=BENEFIT_SESSION_KB,
+            )
+            _clear_benefit_states(user.id)
+            return
+        thread_data = thread_doc.to_dict() or {}
+        ctx["user_chat_id"] = thread_data.get("user_chat_id") or update.message.chat_id
+        WAITING_COURSE_BENEFIT_MEDIA[user.id] = ctx
 
     _cancel_course_benefit_timeout(user.id)
 
@@ -13907,65 +16453,47 @@ def handle_course_benefit_user_message(update: Update, context: CallbackContext)
     user_gender = ctx.get("user_gender")
     header = _build_benefit_header(thread_data, thread_id)
 
-    def _send_benefit_to_staff(target_id: int):
-        sent_header = None
-        sent_payload = None
-        try:
-            sent_header = context.bot.send_message(chat_id=target_id, text=header)
-            if payload.get("type") == "photo":
-                sent_payload = context.bot.send_photo(
-                    chat_id=target_id,
-                    photo=payload.get("file_id"),
-                    caption=payload.get("caption") or payload.get("text"),
-                )
-            elif payload.get("type") == "text":
-                sent_payload = context.bot.send_message(
-                    chat_id=target_id, text=payload.get("text", "")
-                )
-        except Exception as e:
-            logger.error(f"Error sending benefit to staff {target_id}: {e}")
-            return
-
-        # ✅ نفس الشيء: نخزن للهيدر + للرسالة نفسها
-        def _bridge_store(m):
-            if not m:
-                return
-            STAFF_REPLY_BRIDGE[(target_id, m.message_id)] = {
-                "kind": "benefit",
-                "thread_id": thread_id,
-                "user_chat_id": thread_data.get("user_chat_id")
-                or ctx.get("user_id"),
-                "user_id": thread_data.get("user_id") or ctx.get("user_id"),
-                "course_id": ctx.get("course_id"),
-                "lesson_id": ctx.get("lesson_id"),
-                "user_gender": thread_data.get("user_gender") or ctx.get("user_gender"),
-            }
+    bridge_info = {
+        "kind": "benefit",
+        "thread_id": thread_id,
+        "user_chat_id": thread_data.get("user_chat_id") or ctx.get("user_id"),
+        "user_id": thread_data.get("user_id") or ctx.get("user_id"),
+        "course_id": ctx.get("course_id"),
+        "lesson_id": ctx.get("lesson_id"),
+        "user_gender": thread_data.get("user_gender") or ctx.get("user_gender"),
+    }
 
-        _bridge_store(sent_header)
-        _bridge_store(sent_payload)
+    # ✅ نفس الشيء: نخزن لكل رسالة مرسلة للطاقم
+    def _bridge_store(target_id, m):
+        STAFF_REPLY_BRIDGE[(target_id, m.message_id)] = bridge_info
 
     send_to_supervisor = user_gender != "male" and SUPERVISOR_ID
-    if send_to_supervisor:
-        _send_benefit_to_staff(SUPERVISOR_ID)
-
-    if ADMIN_ID:
-        _send_benefit_to_staff(ADMIN_ID)
+    send_to_staff(
+        [SUPERVISOR_ID if send_to_supervisor else None, ADMIN_ID],
+        lambda target_id: send_staff_copy(context.bot, target_id, header, payload),
+        on_sent=_bridge_store,
+        label="Benefit forward",
+    )
 
-    try:
-        sub, sub_ref = _ensure_subscription(user.id, ctx.get("course_id"))
-        if sub is not None:
-            sub_ref.set(
-                {
-                    "last_benefit": {
-                        "lesson_id": ctx.get("lesson_id"),
-                        "curriculum_section": ctx.get("curriculum_section"),
-                        "updated_at": firestore.SERVER_TIMESTAMP,
+    # آخر فائدة للاشتراك تُسجل مرة واحدة لكل جلسة
+    if not ctx.get("last_benefit_saved"):
+        try:
+            sub, sub_ref = _ensure_subscription(user.id, ctx.get("course_id"))
+            if sub is not None:
+                sub_ref.set(
+                    {
+                        "last_benefit": {
+                            "lesson_id": ctx.get("lesson_id"),
+                            "curriculum_section": ctx.get("curriculum_section"),
+                            "updated_at": firestore.SERVER_TIMESTAMP,
+                        },
                     },
-                },
-                merge=True,
-            )
-    except Exception as e:
-        logger.error(f"Error updating benefit metadata: {e}")
+                    merge=True,
+                )
+            ctx["last_benefit_saved"] = True
+            WAITING_COURSE_BENEFIT_MEDIA[user.id] = ctx
+        except Exception as e:
+            logger.error(f"Error updating benefit metadata: {e}")
 
     update.message.reply_text(
         "✅ تم استلام الفائدة. يمكنك إرسال فائدة أخرى أو الخروج.",
@@ -14061,14 +16589,14 @@ def user_points(query: Update.callback_query, user_id: int, course_id: str):
 
 
 def start_quiz_flow(query: Update.callback_query, user_id: int, quiz_id: str):
-    doc = db.collection(COURSE_QUIZZES_COLLECTION).document(quiz_id).get()
-    if not doc.exists:
+    quiz = _get_course_content(COURSE_QUIZZES_COLLECTION, quiz_id)
+    if not quiz:
         safe_edit_message_text(query, "❌ الاختبار غير موجود.", reply_markup=COURSES_USER_MENU_KB)
         return
 
-    quiz = doc.to_dict()
     course_id = quiz.get("course_id")
-    subscription, sub_ref = _ensure_subscription(user_id, course_id)
+    ACTIVE_QUIZ_STATE.pop(user_id, None)
+    subscription, sub_ref = _quiz_session_subscription(user_id, quiz_id, course_id)
     if not subscription:
         safe_edit_message_text(query, "❌ يجب التسجيل في الدورة أولاً.", reply_markup=COURSES_USER_MENU_KB)
         return
@@ -14126,14 +16654,13 @@ def start_quiz_flow(query: Update.callback_query, user_id: int, quiz_id: str):
 
 
 def handle_quiz_answer_selection(query: Update.callback_query, user_id: int, quiz_id: str, option_idx: str):
-    doc = db.collection(COURSE_QUIZZES_COLLECTION).document(quiz_id).get()
-    if not doc.exists:
+    quiz = _get_course_content(COURSE_QUIZZES_COLLECTION, quiz_id)
+    if not quiz:
         safe_edit_message_text(query, "❌ الاختبار غير موجود.", reply_markup=COURSES_USER_MENU_KB)
         return
 
-    quiz = doc.to_dict()
     course_id = quiz.get("course_id")
-    subscription, sub_ref = _ensure_subscription(user_id, course_id)
+    subscription, sub_ref = _quiz_session_subscription(user_id, quiz_id, course_id)
     if not sub_ref:
         safe_edit_message_text(query, "❌ يجب التسجيل في الدورة أولاً.", reply_markup=COURSES_USER_MENU_KB)
         return
@@ -14167,12 +16694,7 @@ def handle_quiz_answer_selection(query: Update.callback_query, user_id: int, qui
 
     points = POINTS_PER_QUIZ_COMPLETION
     try:
-        sub_ref.update(
-            {
-                "points": firestore.Increment(points),
-                "completed_quizzes": firestore.ArrayUnion([quiz_id]),
-            }
-        )
+        _commit_quiz_completion(user_id, course_id, quiz_id, sub_ref, notify=False)
         safe_edit_message_text(
             query,
             f"✅ تم تسجيل إجابتك. (+{points} نقاط)",
@@ -14186,7 +16708,6 @@ def handle_quiz_answer_selection(query: Update.callback_query, user_id: int, qui
                 ]
             ),
         )
-        add_points(user_id, points, None, reason="إكمال اختبار")
     except Exception as e:
         logger.error(f"خطأ في تحديث نقاط الاختبار: {e}")
         safe_edit_message_text(query, "⚠️ تعذر حفظ النتيجة حالياً.", reply_markup=COURSES_USER_MENU_KB)
@@ -14210,12 +16731,7 @@ def _complete_quiz_answer(user_id: int, answer_text: str, update: Update, contex
 
     if user_answer == correct_answer:
         try:
-            sub_ref.update(
-                {
-                    "points": firestore.Increment(POINTS_PER_QUIZ_COMPLETION),
-                    "completed_quizzes": firestore.ArrayUnion([state.get("quiz_id")]),
-                }
-            )
+            _commit_quiz_completion(user_id, course_id, state.get("quiz_id"), sub_ref, notify=True)
             update.message.reply_text(
                 "✅ إجابة صحيحة! تمت إضافة نقاط الاختبار إلى رصيدك.",
                 reply_markup=InlineKeyboardMarkup(
@@ -14229,7 +16745,6 @@ def _complete_quiz_answer(user_id: int, answer_text: str, update: Update, contex
                     ]
                 ),
             )
-            add_points(user_id, POINTS_PER_QUIZ_COMPLETION, context, reason="إكمال اختبار")
         except Exception as e:
             logger.error(f"خطأ في تحديث نقاط الاختبار: {e}")
             update.message.reply_text("⚠️ تعذر حفظ النتيجة حالياً. حاول لاحقاً.")
@@ -14476,6 +16991,7 @@ def _admin_toggle_curriculum_section(query: Update.callback_query, lesson_id: st
             lesson_doc.reference.update(
                 {"curriculum_section": firestore.DELETE_FIELD, "updated_at": firestore.SERVER_TIMESTAMP}
             )
+            _invalidate_course_content(COURSE_LESSONS_COLLECTION, lesson_id)
             safe_edit_message_text(
                 query,
                 "✅ تم تعطيل باب المقرر لهذا الدرس.",
@@ -14517,6 +17033,7 @@ def _admin_toggle_lesson_presentation(query: Update.callback_query, lesson_id: s
         db.collection(COURSE_LESSONS_COLLECTION).document(lesson_id).update(
             {"has_presentation": not current, "updated_at": firestore.SERVER_TIMESTAMP}
         )
+        _invalidate_course_content(COURSE_LESSONS_COLLECTION, lesson_id)
         _admin_open_lesson_edit_menu(query, lesson_id)
     except Exception as e:
         logger.error(f"خطأ في تبديل حالة العرض: {e}")
@@ -14561,6 +17078,7 @@ def _admin_delete_lesson(query: Update.callback_query, lesson_id: str):
     course_id = lesson_doc.to_dict().get("course_id")
     try:
         db.collection(COURSE_LESSONS_COLLECTION).document(lesson_id).delete()
+        _invalidate_course_content(COURSE_LESSONS_COLLECTION, lesson_id)
         _admin_show_lessons_panel(query, course_id)
     except Exception as e:
         logger.error(f"خطأ في حذف الدرس: {e}")
@@ -14715,6 +17233,7 @@ def _admin_delete_quiz(query: Update.callback_query, quiz_id: str):
     course_id = quiz_doc.to_dict().get("course_id")
     try:
         db.collection(COURSE_QUIZZES_COLLECTION).document(quiz_id).delete()
+        _invalidate_course_content(COURSE_QUIZZES_COLLECTION, quiz_id)
         _admin_show_quizzes_panel(query, course_id)
     except Exception as e:
         logger.error(f"خطأ في حذف الاختبار: {e}")
@@ -14814,15 +17333,13 @@ def admin_archive_manage(query: Update.callback_query, context: CallbackContext)
         safe_edit_message_text(query, "❌ حدث خطأ. حاول مرة أخرى.", reply_markup=COURSES_ADMIN_MENU_KB)
 
 
-def admin_statistics_course(query: Update.callback_query, course_id: str):
+def admin_statistics_course(query: Update.callback_query, course_id: str, page: int = 1):
     try:
-        subs = list(
-            db.collection(COURSE_SUBSCRIPTIONS_COLLECTION)
-            .where("course_id", "==", course_id)
-            .stream()
+        course = _course_document(course_id) or {}
+        page_items, total_entries, current_page, total_pages = _course_leaderboard_page(
+            course_id, page, COURSE_PARTICIPANTS_PAGE_SIZE
         )
-        course = _course_document(course_id)
-        if not subs:
+        if not total_entries:
             safe_edit_message_text(
                 query,
                 "لا يوجد مشاركون في هذه الدورة.",
@@ -14843,25 +17360,43 @@ def admin_statistics_course(query: Update.callback_query, course_id: str):
                 )
             ]
         ]
-        for sub in subs:
-            data = sub.to_dict()
-            user_name = data.get("full_name") or data.get("username") or str(data.get("user_id"))
-            points = data.get("points", 0)
+        for item in page_items:
+            user_name = item.get("full_name") or item.get("username") or str(item.get("user_id"))
+            points = item.get("points", 0)
             button_label = f"{user_name} | نقاط: {points}"
             keyboard.append(
                 [
                     InlineKeyboardButton(
                         button_label,
-                        callback_data=f"COURSES:stats_user_{course_id}_{data.get('user_id')}",
+                        callback_data=f"COURSES:stats_user_{course_id}_{item.get('user_id')}",
                     )
                 ]
             )
 
+        nav_buttons = []
+        if current_page > 1:
+            nav_buttons.append(
+                InlineKeyboardButton(
+                    "⬅️ السابق",
+                    callback_data=f"COURSES:stats_page_{course_id}_{current_page - 1}",
+                )
+            )
+        if current_page < total_pages:
+            nav_buttons.append(
+                InlineKeyboardButton(
+                    "➡️ التالي",
+                    callback_data=f"COURSES:stats_page_{course_id}_{current_page + 1}",
+                )
+            )
+        if nav_buttons:
+            keyboard.append(nav_buttons)
+
         keyboard.append([InlineKeyboardButton("🔙 رجوع", callback_data="COURSES:statistics")])
         keyboard.append([InlineKeyboardButton("⬅️ لوحة الإدارة", callback_data="COURSES:admin_back")])
         safe_edit_message_text(
             query,
-            f"📊 مشاركو دورة {course.get('name', 'دورة')}",
+            f"📊 مشاركو دورة {course.get('name', 'دورة')} ({total_entries})\n"
+            f"صفحة {current_page}/{total_pages}",
             reply_markup=InlineKeyboardMarkup(keyboard),
         )
     except Exception as e:
@@ -14926,14 +17461,11 @@ def admin_course_leaderboard(query: Update.callback_query, course_id: str, page:
             safe_edit_message_text(query, "❌ الدورة غير موجودة.", reply_markup=COURSES_ADMIN_MENU_KB)
             return
 
-        subs = [
-            doc.to_dict()
-            for doc in db.collection(COURSE_SUBSCRIPTIONS_COLLECTION)
-            .where("course_id", "==", course_id)
-            .stream()
-        ]
+        page_items, total_entries, current_page, total_pages = _course_leaderboard_page(
+            course_id, page, COURSE_LEADERBOARD_PAGE_SIZE
+        )
 
-        if not subs:
+        if not total_entries:
             safe_edit_message_text(
                 query,
                 "لا يوجد مشاركون في هذه الدورة.",
@@ -14946,20 +17478,7 @@ def admin_course_leaderboard(query: Update.callback_query, course_id: str, page:
             )
             return
 
-        sorted_subs = sorted(
-            subs,
-            key=lambda item: (
-                -(item.get("points", 0) or 0),
-                item.get("user_id", 0),
-            ),
-        )
-
-        total_entries = len(sorted_subs)
-        total_pages = (total_entries + COURSE_LEADERBOARD_PAGE_SIZE - 1) // COURSE_LEADERBOARD_PAGE_SIZE
-        current_page = max(1, min(page, total_pages))
         start_index = (current_page - 1) * COURSE_LEADERBOARD_PAGE_SIZE
-        end_index = start_index + COURSE_LEADERBOARD_PAGE_SIZE
-        page_items = sorted_subs[start_index:end_index]
 
         lines = [f"🏆 ترتيب دورة {course.get('name', 'دورة')}", ""]
         for rank, item in enumerate(page_items, start=start_index + 1):
@@ -15135,6 +17654,14 @@ def handle_courses_callback(update: Update, context: CallbackContext):
         elif data.startswith("COURSES:stats_course_"):
             course_id = data.replace("COURSES:stats_course_", "")
             admin_statistics_course(query, course_id)
+        elif data.startswith("COURSES:stats_page_"):
+            payload = data.replace("COURSES:stats_page_", "")
+            course_id, _, page_str = payload.rpartition("_")
+            try:
+                page = int(page_str)
+            except ValueError:
+                course_id, page = payload, 1
+            admin_statistics_course(query, course_id, page)
         elif data.startswith("COURSES:stats_user_"):
             payload = data.replace("COURSES:stats_user_", "")
             if "_" in payload:
@@ -15192,7 +17719,7 @@ def handle_courses_callback(update: Update, context: CallbackContext):
             user_view_lesson(query, context, lesson_id, user_id)
         elif data.startswith("COURSES:attend_"):
             lesson_id = data.replace("COURSES:attend_", "")
-            logger.info("✅ ATTEND_CALLBACK_HIT | data=%s | user_id=%s", data, user_id)
+            logger.debug("✅ ATTEND_CALLBACK_HIT | data=%s | user_id=%s", data, user_id)
             register_lesson_attendance(query, context, user_id, lesson_id)
         elif data.startswith("COURSE:BEN:OPEN:"):
             parts = data.split(":", 4)
@@ -15425,6 +17952,7 @@ def handle_courses_callback(update: Update, context: CallbackContext):
             except Exception as e:
                 logger.error(f"خطأ في حذف اشتراكات الدورة: {e}")
             db.collection(COURSES_COLLECTION).document(course_id).delete()
+            _course_leaderboard_drop(course_id)
             safe_edit_message_text(query, "✅ تم حذف الدورة بنجاح", reply_markup=COURSES_ADMIN_MENU_KB)
 
     except Exception as e:
@@ -15439,12 +17967,9 @@ if __name__ == "__main__":
     logger.info("🚀 بدء سُقيا الكوثر")
     logger.info("=" * 50)
     
-    # تهيئة Firebase/Firestore مرة واحدة
-    initialize_firebase()
-    
     # تهيئة Updater و Dispatcher و job_queue مرة واحدة
     try:
-        updater = Updater(BOT_TOKEN, use_context=True, request_kwargs=REQUEST_KWARGS)
+        updater = build_updater()
         dispatcher = updater.dispatcher
         job_queue = updater.job_queue
     except Exception as e:
@@ -2,19 +2,40 @@
 """
 سكربت لترحيل البيانات من JSON المحلي إلى Firebase Firestore
 يتم تشغيله مرة واحدة فقط بعد تثبيت Firebase
+
+- يقرأ الملف تدريجياً (مستخدماً بعد مستخدم) بدل تحميله كاملاً في الذاكرة.
+- يكتب على دفعات (حتى 500 عملية) تُرسل بالتوازي من عدة خيوط.
+- معرفات الوثائق ثابتة لكل سجل (مفتاح idempotency)، فإعادة التشغيل لا تكرر المذكرات أو الرسائل.
+- يحفظ نقطة استئناف في ملف checkpoint؛ إعادة التشغيل تتخطى المستخدمين المكتملين.
+
+    python migrate.py                      # ترحيل suqya_users.json
+    python migrate.py --file other.json --workers 16
+    python migrate.py --reset              # تجاهل نقطة الاستئناف والبدء من الأول
+    python migrate.py --backfill-books     # (أو BACKFILL_BOOKS=1) استكمال حقول الكتب فقط
 """
 
 import os
 import json
+import time
+import shutil
+import hashlib
 import logging
+import argparse
+import threading
 import firebase_admin
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from firebase_admin import credentials, firestore
 from datetime import datetime, timezone
-from typing import Any, Optional
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 # إعدادات
 DATA_FILE = "suqya_users.json"
 SECRETS_PATH = "/etc/secrets"
+CHECKPOINT_FILE = os.getenv("MIGRATE_CHECKPOINT_FILE", "migrate_checkpoint.json")
+MAX_BATCH_OPS = 500  # حد Firestore لعمليات الدفعة الواحدة
+MIGRATE_WORKERS = int(os.getenv("MIGRATE_WORKERS", 8))
+MIGRATE_COMMIT_RETRIES = int(os.getenv("MIGRATE_COMMIT_RETRIES", 4))
+PROGRESS_INTERVAL_SECONDS = 5
 
 # إعداد التسجيل
 logging.basicConfig(level=logging.INFO)
@@ -24,140 +45,408 @@ def initialize_firebase():
     """تهيئة اتصال Firebase"""
     try:
         firebase_files = []
-        
+
         if os.path.exists(SECRETS_PATH):
             for file in os.listdir(SECRETS_PATH):
                 if file.startswith("soqya-") and file.endswith(".json"):
                     firebase_files.append(os.path.join(SECRETS_PATH, file))
-        
+
         if firebase_files:
             cred_path = firebase_files[0]
             logger.info(f"تم العثور على ملف Firebase: {cred_path}")
-            
+
             if not firebase_admin._apps:
                 cred = credentials.Certificate(cred_path)
                 firebase_admin.initialize_app(cred)
                 logger.info("✅ تم تهيئة Firebase بنجاح")
             else:
                 logger.info("✅ Firebase مفعل بالفعل")
-                
+
             return firestore.client()
         else:
             logger.error("❌ لم يتم العثور على ملف Firebase")
             return None
-            
+
     except Exception as e:
         logger.error(f"❌ خطأ في تهيئة Firebase: {e}")
         return None
 
-def load_local_data():
-    """تحميل البيانات المحلية"""
-    if not os.path.exists(DATA_FILE):
-        logger.error(f"❌ ملف البيانات {DATA_FILE} غير موجود")
+
+# ================================================
+#  قراءة JSON تدريجياً
+# ================================================
+
+# أحرف قد تكمل رقماً مقطوعاً عند حدود الجزء المقروء
+NUMBER_CONTINUATION_CHARS = frozenset("0123456789.eE+-")
+
+
+def iter_json_object(path: str, chunk_size: int = 1 << 16) -> Iterator[Tuple[str, Any]]:
+    """
+    يرجع أزواج (المفتاح، القيمة) من كائن JSON في أعلى الملف واحداً تلو الآخر،
+    فلا يبقى في الذاكرة إلا المستخدم الحالي وجزء صغير من الملف.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buffer = ""
+        pos = 0
+        eof = False
+
+        def fill() -> bool:
+            nonlocal buffer, pos, eof
+            if eof:
+                return False
+            chunk = f.read(chunk_size)
+            if not chunk:
+                eof = True
+                return False
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            return True
+
+        def skip_whitespace():
+            nonlocal pos
+            while True:
+                while pos < len(buffer) and buffer[pos] in " \t\r\n":
+                    pos += 1
+                if pos < len(buffer) or not fill():
+                    return
+
+        def expect(chars: str) -> str:
+            skip_whitespace()
+            if pos >= len(buffer) or buffer[pos] not in chars:
+                found = buffer[pos] if pos < len(buffer) else "EOF"
+                raise ValueError(f"JSON غير صالح: متوقع {chars!r} ووجد {found!r}")
+            return buffer[pos]
+
+        def decode():
+            nonlocal pos
+            skip_whitespace()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, pos)
+                    # الرقم لا يكتمل إلا بعد رؤية حرف لا يمكن أن يكمله (مثل "3." ثم "75")
+                    complete = end < len(buffer) and (
+                        isinstance(value, bool)
+                        or not isinstance(value, (int, float))
+                        or buffer[end] not in NUMBER_CONTINUATION_CHARS
+                    )
+                    if complete or eof:
+                        pos = end
+                        return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                if not fill():
+                    value, pos = decoder.raw_decode(buffer, pos)
+                    return value
+
+        expect("{")
+        pos += 1
+        if expect('}"') == "}":
+            return
+        while True:
+            key = decode()
+            expect(":")
+            pos += 1
+            value = decode()
+            yield key, value
+            if expect(",}") == "}":
+                return
+            pos += 1
+
+
+# ================================================
+#  مفاتيح idempotency ونقطة الاستئناف
+# ================================================
+
+def idempotency_key(kind: str, owner: Any, index: int, payload: Any) -> str:
+    """معرف وثيقة ثابت للسجل نفسه في كل تشغيل (النوع + المالك + الترتيب + المحتوى)"""
+    raw = json.dumps([kind, str(owner), index, payload], ensure_ascii=False, sort_keys=True, default=str)
+    return f"migr_{hashlib.sha1(raw.encode('utf-8')).hexdigest()[:24]}"
+
+
+def _source_fingerprint(path: str) -> Dict[str, Any]:
+    stat = os.stat(path)
+    return {"source": os.path.abspath(path), "size": stat.st_size, "mtime": int(stat.st_mtime)}
+
+
+def load_checkpoint(path: str, fingerprint: Dict[str, Any]) -> Dict[str, Any]:
+    """نقطة الاستئناف صالحة فقط لنفس ملف البيانات (نفس الحجم ووقت التعديل)"""
+    if not os.path.exists(path):
         return {}
-    
     try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(path, "r", encoding="utf-8") as f:
+            checkpoint = json.load(f)
     except Exception as e:
-        logger.error(f"❌ خطأ في تحميل البيانات: {e}")
+        logger.warning(f"⚠️ تعذر قراءة نقطة الاستئناف {path}: {e}")
+        return {}
+    if checkpoint.get("fingerprint") != fingerprint:
+        logger.warning("⚠️ ملف البيانات تغير منذ آخر تشغيل، سيتم البدء من الأول")
         return {}
+    return checkpoint
 
-def migrate_users(db, data):
-    """ترحيل بيانات المستخدمين"""
-    users_ref = db.collection("users")
-    migrated = 0
-    
-    for user_id_str, user_data in data.items():
-        if user_id_str == "GLOBAL_KEY":
-            continue
-            
-        try:
+
+def save_checkpoint(path: str, checkpoint: Dict[str, Any]):
+    # كتابة ذرية: ملف مؤقت ثم استبدال، حتى لا تفسد نقطة الاستئناف عند الانقطاع
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+# ================================================
+#  الكتابة على دفعات متوازية
+# ================================================
+
+class BulkWriter:
+    """
+    يجمع العمليات في دفعات حتى MAX_BATCH_OPS ويرسلها من مجموعة خيوط.
+    كل عملية تنتمي لسجل (رقم ترتيبه في الملف)؛ السجل يكتمل عند نجاح كل دفعاته،
+    وwatermark = عدد السجلات المكتملة المتتالية من البداية (ما يُحفظ في نقطة الاستئناف).
+    """
+
+    def __init__(self, db, workers: int, batch_size: int = MAX_BATCH_OPS, start_index: int = 0, on_progress=None):
+        self.db = db
+        self.batch_size = max(1, min(batch_size, MAX_BATCH_OPS))
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="migrate")
+        self.max_in_flight = max(1, workers) * 2
+        self.in_flight = set()
+        self.on_progress = on_progress
+        self.lock = threading.Lock()
+        self.ops: List[Tuple[str, str, Dict, str, int]] = []
+        # سجل -> عدد الدفعات غير المكتملة التي تحتوي عملياته
+        self.pending: Dict[int, int] = {}
+        self.sealed = set()  # سجلات أُضيفت كل عملياتها
+        self.buffered = set()  # سجلات لها عمليات في الدفعة التي لم تُرسل بعد
+        self.failed = set()
+        self.watermark = start_index
+        self.stats = {"records": 0, "ops": 0, "batches": 0, "retries": 0, "failed_batches": 0}
+        self.started = time.monotonic()
+
+    def add_record(self, index: int, operations: List[Tuple[str, str, Dict, str]]):
+        """operations: (collection, doc_id, data, "set"|"update")"""
+        with self.lock:
+            self.pending.setdefault(index, 0)
+        for collection, doc_id, payload, op in operations:
+            if index not in self.buffered:
+                with self.lock:
+                    self.buffered.add(index)
+            self.ops.append((collection, doc_id, payload, op, index))
+            if len(self.ops) >= self.batch_size:
+                self._submit()
+        with self.lock:
+            self.sealed.add(index)
+            self.stats["records"] += 1
+            self._advance()
+
+    def _submit(self):
+        ops, self.ops = self.ops, []
+        records = {op[4] for op in ops}
+        with self.lock:
+            for index in records:
+                self.pending[index] = self.pending.get(index, 0) + 1
+            self.buffered.clear()
+        # حد للدفعات المعلقة حتى لا تتراكم في الذاكرة أسرع من الإرسال
+        while len(self.in_flight) >= self.max_in_flight:
+            done, _ = wait(self.in_flight, return_when=FIRST_COMPLETED)
+            self.in_flight -= done
+        future = self.pool.submit(self._commit, ops, records)
+        self.in_flight.add(future)
+
+    def _commit(self, ops, records):
+        ok = False
+        for attempt in range(MIGRATE_COMMIT_RETRIES + 1):
+            try:
+                batch = self.db.batch()
+                for collection, doc_id, payload, op, _ in ops:
+                    ref = self.db.collection(collection).document(doc_id)
+                    if op == "update":
+                        batch.update(ref, payload)
+                    else:
+                        batch.set(ref, payload)
+                batch.commit()
+                ok = True
+                break
+            except Exception as e:
+                if attempt >= MIGRATE_COMMIT_RETRIES:
+                    logger.error(f"❌ فشلت دفعة من {len(ops)} عملية بعد {attempt + 1} محاولات: {e}")
+                    break
+                with self.lock:
+                    self.stats["retries"] += 1
+                # العمليات بمعرفات ثابتة، فإعادة الدفعة كاملة آمنة
+                time.sleep(min(30, 0.5 * 2 ** attempt))
+
+        with self.lock:
+            self.stats["batches"] += 1
+            if ok:
+                self.stats["ops"] += len(ops)
+            else:
+                self.stats["failed_batches"] += 1
+                self.failed.update(records)
+            for index in records:
+                self.pending[index] -= 1
+            self._advance()
+        if self.on_progress:
+            self.on_progress(self)
+
+    def _advance(self):
+        # يُستدعى تحت القفل
+        while (
+            self.watermark in self.sealed
+            and self.pending.get(self.watermark) == 0
+            and self.watermark not in self.buffered
+            and self.watermark not in self.failed
+        ):
+            self.pending.pop(self.watermark, None)
+            self.sealed.discard(self.watermark)
+            self.watermark += 1
+
+    def close(self):
+        if self.ops:
+            self._submit()
+        wait(self.in_flight)
+        self.in_flight.clear()
+        self.pool.shutdown(wait=True)
+
+    def throughput(self) -> Dict[str, float]:
+        elapsed = max(1e-6, time.monotonic() - self.started)
+        with self.lock:
+            stats = dict(self.stats)
+        stats["elapsed_s"] = round(elapsed, 2)
+        stats["records_per_s"] = round(stats["records"] / elapsed, 1)
+        stats["ops_per_s"] = round(stats["ops"] / elapsed, 1)
+        return stats
+
+
+def log_throughput(label: str, stats: Dict[str, float]):
+    logger.info(
+        "📈 %s: %s سجل، %s عملية في %s دفعة خلال %.1f ث (%.1f سجل/ث، %.1f عملية/ث)، إعادة محاولة %s، دفعات فاشلة %s",
+        label,
+        stats["records"],
+        stats["ops"],
+        stats["batches"],
+        stats["elapsed_s"],
+        stats["records_per_s"],
+        stats["ops_per_s"],
+        stats["retries"],
+        stats["failed_batches"],
+    )
+
+
+# ================================================
+#  تحويل السجلات إلى عمليات
+# ================================================
+
+def build_user_operations(user_id_str: str, user_data: Dict) -> List[Tuple[str, str, Dict, str]]:
+    """عمليات مستخدم واحد: وثيقة المستخدم + مذكراته + رسائله (بمعرفات ثابتة)"""
+    user_id = int(user_id_str)
+    user_data = dict(user_data)
+    # إضافة معرف المستخدم إذا لم يكن موجوداً
+    user_data["user_id"] = user_id
+    operations = []
+
+    # معالجة المذكرات
+    heart_memos = user_data.pop("heart_memos", None)
+    if heart_memos and isinstance(heart_memos, list):
+        for idx, memo_text in enumerate(heart_memos):
+            if isinstance(memo_text, str) and memo_text.strip():
+                note_data = {
+                    "user_id": user_id,
+                    "text": memo_text.strip(),
+                    "created_at": user_data.get("created_at", ""),
+                    "updated_at": user_data.get("last_active", ""),
+                }
+                operations.append(("notes", idempotency_key("note", user_id, idx, note_data["text"]), note_data, "set"))
+
+    # معالجة الرسائل
+    letters = user_data.pop("letters_to_self", None)
+    if letters and isinstance(letters, list):
+        for idx, letter in enumerate(letters):
+            if isinstance(letter, dict) and letter.get("content"):
+                letter = dict(letter, user_id=user_id)
+                operations.append(("letters", idempotency_key("letter", user_id, idx, letter.get("content")), letter, "set"))
+
+    # حفظ بيانات المستخدم
+    operations.append(("users", user_id_str, user_data, "set"))
+    return operations
+
+
+def migrate_users(db, path: str, checkpoint: Dict[str, Any], checkpoint_path: str, workers: int, batch_size: int):
+    """ترحيل بيانات المستخدمين؛ يرجع (عدد المستخدمين المرحّلين، قيمة GLOBAL_KEY)"""
+    start_index = int(checkpoint.get("users_done", 0))
+    if start_index:
+        logger.info(f"⏩ استئناف: تخطي أول {start_index} سجل مكتمل")
+
+    last_saved = {"at": time.monotonic(), "watermark": start_index}
+
+    def on_progress(writer: BulkWriter):
+        now = time.monotonic()
+        with writer.lock:
+            watermark = writer.watermark
+        if now - last_saved["at"] < PROGRESS_INTERVAL_SECONDS or watermark == last_saved["watermark"]:
+            return
+        with checkpoint_lock:
+            last_saved.update(at=now, watermark=watermark)
+            checkpoint["users_done"] = watermark
+            save_checkpoint(checkpoint_path, checkpoint)
+        log_throughput("تقدم المستخدمين", writer.throughput())
+
+    checkpoint_lock = threading.Lock()
+    writer = BulkWriter(db, workers, batch_size, start_index=start_index, on_progress=on_progress)
+    global_config = None
+    skipped = 0
+    try:
+        for index, (user_id_str, user_data) in enumerate(iter_json_object(path)):
+            if user_id_str == "GLOBAL_KEY":
+                global_config = user_data
+            if index < start_index:
+                continue
             # تحقق من صحة البيانات
-            if not isinstance(user_data, dict):
+            if user_id_str == "GLOBAL_KEY" or not isinstance(user_data, dict) or not str(user_id_str).isdigit():
+                writer.add_record(index, [])
+                skipped += 1
                 continue
-                
-            # إضافة معرف المستخدم إذا لم يكن موجوداً
-            user_data["user_id"] = int(user_id_str)
-            
-            # معالجة المذكرات
-            heart_memos = user_data.get("heart_memos", [])
-            if heart_memos and isinstance(heart_memos, list):
-                notes_ref = db.collection("notes")
-                for memo_text in heart_memos:
-                    if memo_text and memo_text.strip():
-                        note_data = {
-                            "user_id": int(user_id_str),
-                            "text": memo_text.strip(),
-                            "created_at": user_data.get("created_at", ""),
-                            "updated_at": user_data.get("last_active", "")
-                        }
-                        notes_ref.add(note_data)
-                
-                # إزالة المذكرات من بيانات المستخدم
-                user_data.pop("heart_memos", None)
-            
-            # معالجة الرسائل
-            letters = user_data.get("letters_to_self", [])
-            if letters and isinstance(letters, list):
-                letters_ref = db.collection("letters")
-                for letter in letters:
-                    if isinstance(letter, dict) and letter.get("content"):
-                        letter["user_id"] = int(user_id_str)
-                        letters_ref.add(letter)
-                
-                # إزالة الرسائل من بيانات المستخدم
-                user_data.pop("letters_to_self", None)
-            
-            # حفظ بيانات المستخدم
-            users_ref.document(user_id_str).set(user_data)
-            migrated += 1
-            
-            if migrated % 10 == 0:
-                logger.info(f"تم ترحيل {migrated} مستخدم...")
-                
-        except Exception as e:
-            logger.error(f"خطأ في ترحيل المستخدم {user_id_str}: {e}")
-    
-    return migrated
-
-def migrate_benefits(db, data):
+            writer.add_record(index, build_user_operations(user_id_str, user_data))
+    finally:
+        writer.close()
+        with checkpoint_lock:
+            checkpoint["users_done"] = writer.watermark
+            save_checkpoint(checkpoint_path, checkpoint)
+
+    stats = writer.throughput()
+    log_throughput("المستخدمون", stats)
+    if writer.failed:
+        logger.error(f"❌ {len(writer.failed)} سجل لم يكتمل؛ أعد التشغيل للاستئناف من السجل {writer.watermark}")
+    return stats["records"] - skipped - len(writer.failed), global_config, not writer.failed
+
+
+def migrate_benefits(db, global_config: Optional[Dict], workers: int, batch_size: int):
     """ترحيل الفوائد والنصائح"""
-    if "GLOBAL_KEY" not in data:
-        return 0
-    
-    global_config = data["GLOBAL_KEY"]
-    benefits = global_config.get("benefits", [])
-    
+    benefits = (global_config or {}).get("benefits", [])
     if not benefits:
         return 0
-    
-    tips_ref = db.collection("tips")
+
+    writer = BulkWriter(db, workers, batch_size)
     migrated = 0
-    
-    for benefit in benefits:
-        try:
-            if isinstance(benefit, dict) and benefit.get("text"):
-                tips_ref.add(benefit)
-                migrated += 1
-        except Exception as e:
-            logger.error(f"خطأ في ترحيل الفائدة: {e}")
-    
-    return migrated
-
-def migrate_global_config(db, data):
+    for idx, benefit in enumerate(benefits):
+        if isinstance(benefit, dict) and benefit.get("text"):
+            writer.add_record(idx, [("tips", idempotency_key("tip", benefit.get("user_id"), idx, benefit.get("text")), benefit, "set")])
+            migrated += 1
+    writer.close()
+    log_throughput("الفوائد", writer.throughput())
+    return migrated - len(writer.failed)
+
+def migrate_global_config(db, global_config: Optional[Dict]):
     """ترحيل الإعدادات العامة"""
-    if "GLOBAL_KEY" not in data:
+    if not global_config:
         return
-    
-    global_config = data["GLOBAL_KEY"]
-    
+
     config_data = {
         "motivation_hours": global_config.get("motivation_hours", [6, 9, 12, 15, 18, 21]),
         "motivation_messages": global_config.get("motivation_messages", []),
         "benefits": []  # الفوائد محفوظة منفصلة الآن
     }
-    
+
     try:
         db.collection("global_config").document("config").set(config_data)
         logger.info("✅ تم ترحيل الإعدادات العامة")
@@ -212,105 +501,144 @@ def _normalize_timestamp(value: Any) -> Optional[datetime]:
     return None
 
 
-def backfill_books_defaults(db) -> Optional[int]:
-    """ملء الحقول الناقصة أو الخاطئة للكتب القديمة."""
+def _book_default_updates(data: Dict) -> Dict:
+    updates = {}
+
+    current_is_deleted = data.get("is_deleted")
+    normalized_deleted = _normalize_bool(current_is_deleted, False)
+    if current_is_deleted != normalized_deleted or not isinstance(current_is_deleted, bool):
+        updates["is_deleted"] = normalized_deleted
+
+    current_is_active = data.get("is_active")
+    normalized_active = _normalize_bool(current_is_active, True)
+    if current_is_active != normalized_active or not isinstance(current_is_active, bool):
+        updates["is_active"] = normalized_active
+
+    current_created = data.get("created_at")
+    normalized_created = _normalize_timestamp(current_created)
+    fallback_created = _normalize_timestamp(data.get("updated_at")) or firestore.SERVER_TIMESTAMP
+    needs_created = current_created in (None, "") or normalized_created is None
+    needs_created = needs_created or not isinstance(current_created, datetime) or (
+        isinstance(current_created, datetime) and current_created.tzinfo is None
+    )
+    if needs_created:
+        updates["created_at"] = fallback_created if normalized_created is None else normalized_created
+
+    if updates:
+        updates["updated_at"] = firestore.SERVER_TIMESTAMP
+    return updates
+
+
+def backfill_books_defaults(db, workers: int = MIGRATE_WORKERS, batch_size: int = MAX_BATCH_OPS) -> Optional[int]:
+    """ملء الحقول الناقصة أو الخاطئة للكتب القديمة (على دفعات؛ إعادة التشغيل لا تعدّل إلا ما بقي ناقصاً)."""
     try:
-        books_ref = db.collection("books")
-        docs = books_ref.stream()
+        docs = db.collection("books").stream()
     except Exception as e:
         logger.error(f"❌ تعذر قراءة كتب Firestore: {e}")
         return None
 
+    writer = BulkWriter(db, workers, batch_size)
     updated = 0
     total = 0
     for doc in docs:
-        total += 1
-        data = doc.to_dict() or {}
-        updates = {}
-
-        current_is_deleted = data.get("is_deleted")
-        normalized_deleted = _normalize_bool(current_is_deleted, False)
-        if current_is_deleted != normalized_deleted or not isinstance(current_is_deleted, bool):
-            updates["is_deleted"] = normalized_deleted
-
-        current_is_active = data.get("is_active")
-        normalized_active = _normalize_bool(current_is_active, True)
-        if current_is_active != normalized_active or not isinstance(current_is_active, bool):
-            updates["is_active"] = normalized_active
-
-        current_created = data.get("created_at")
-        normalized_created = _normalize_timestamp(current_created)
-        fallback_created = _normalize_timestamp(data.get("updated_at")) or firestore.SERVER_TIMESTAMP
-        needs_created = current_created in (None, "") or normalized_created is None
-        needs_created = needs_created or not isinstance(current_created, datetime) or (
-            isinstance(current_created, datetime) and current_created.tzinfo is None
-        )
-        if needs_created:
-            updates["created_at"] = fallback_created if normalized_created is None else normalized_created
-
+        updates = _book_default_updates(doc.to_dict() or {})
         if updates:
-            updates["updated_at"] = firestore.SERVER_TIMESTAMP
-            try:
-                books_ref.document(doc.id).update(updates)
-                updated += 1
-                logger.info("✅ تم تحديث كتاب %s بالحقول الافتراضية", doc.id)
-            except Exception as e:
-                logger.error("❌ خطأ في تحديث كتاب %s: %s", doc.id, e)
+            writer.add_record(total, [("books", doc.id, updates, "update")])
+            updated += 1
+        total += 1
+    writer.close()
 
+    log_throughput("الكتب", writer.throughput())
+    updated -= len(writer.failed)
     logger.info("📚 فحص %s كتاب، تم تحديث %s منها", total, updated)
     return updated
 
-def create_backup(data):
-    """إنشاء نسخة احتياطية من البيانات"""
+def create_backup(path: str):
+    """إنشاء نسخة احتياطية من ملف البيانات (نسخ مباشر بدون تحميله في الذاكرة)"""
     try:
-        backup_file = f"{DATA_FILE}.backup"
-        with open(backup_file, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        backup_file = f"{path}.backup"
+        shutil.copyfile(path, backup_file)
         logger.info(f"✅ تم إنشاء نسخة احتياطية في {backup_file}")
     except Exception as e:
         logger.error(f"خطأ في إنشاء النسخة الاحتياطية: {e}")
 
-def main():
-    """الدالة الرئيسية للترحيل"""
-    logger.info("🚀 بدء عملية ترحيل البيانات إلى Firebase Firestore...")
 
-    # تهيئة Firebase
-    db = initialize_firebase()
-    if not db:
-        return
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="ترحيل suqya_users.json إلى Firestore")
+    parser.add_argument("--file", default=DATA_FILE)
+    parser.add_argument("--checkpoint", default=CHECKPOINT_FILE)
+    parser.add_argument("--workers", type=int, default=MIGRATE_WORKERS)
+    parser.add_argument("--batch-size", type=int, default=MAX_BATCH_OPS)
+    parser.add_argument("--reset", action="store_true", help="تجاهل نقطة الاستئناف")
+    parser.add_argument(
+        "--backfill-books",
+        action="store_true",
+        default=os.getenv("BACKFILL_BOOKS", "").strip().lower() in {"1", "true", "yes"},
+    )
+    return parser.parse_args(argv)
+
+
+def run_migration(db, args) -> bool:
+    if not os.path.exists(args.file):
+        logger.error(f"❌ ملف البيانات {args.file} غير موجود")
+        return False
+
+    fingerprint = _source_fingerprint(args.file)
+    checkpoint = {} if args.reset else load_checkpoint(args.checkpoint, fingerprint)
+    checkpoint["fingerprint"] = fingerprint
+
+    # إنشاء نسخة احتياطية (مرة واحدة لكل ملف)
+    if not checkpoint.get("backup_done"):
+        create_backup(args.file)
+        checkpoint["backup_done"] = True
+        save_checkpoint(args.checkpoint, checkpoint)
 
-    backfill_only = os.getenv("BACKFILL_BOOKS", "").strip().lower() in {"1", "true", "yes"}
-    if backfill_only:
-        logger.info("🛠 تشغيل مهمة استكمال حقول الكتب الناقصة فقط (BACKFILL_BOOKS=1)")
-        backfill_books_defaults(db)
-        return
-    
-    # تحميل البيانات المحلية
-    data = load_local_data()
-    if not data:
-        return
-    
-    # إنشاء نسخة احتياطية
-    create_backup(data)
-    
     # ترحيل البيانات
     logger.info("📤 ترحيل بيانات المستخدمين...")
-    users_migrated = migrate_users(db, data)
-    
-    logger.info("📤 ترحيل الفوائد والنصائح...")
-    benefits_migrated = migrate_benefits(db, data)
-    
-    logger.info("📤 ترحيل الإعدادات العامة...")
-    migrate_global_config(db, data)
-    
+    started = time.monotonic()
+    users_migrated, global_config, users_ok = migrate_users(
+        db, args.file, checkpoint, args.checkpoint, args.workers, args.batch_size
+    )
+    if not users_ok:
+        return False
+
+    benefits_migrated = 0
+    if not checkpoint.get("global_done"):
+        logger.info("📤 ترحيل الفوائد والنصائح...")
+        benefits_migrated = migrate_benefits(db, global_config, args.workers, args.batch_size)
+
+        logger.info("📤 ترحيل الإعدادات العامة...")
+        migrate_global_config(db, global_config)
+        checkpoint["global_done"] = True
+        save_checkpoint(args.checkpoint, checkpoint)
+
     # النتيجة النهائية
     logger.info("=" * 50)
     logger.info("✅ عملية الترحيل اكتملت بنجاح!")
     logger.info(f"📊 تم ترحيل {users_migrated} مستخدم")
     logger.info(f"📊 تم ترحيل {benefits_migrated} فائدة/نصيحة")
+    logger.info(f"⏱️ المدة الكلية {time.monotonic() - started:.1f} ثانية")
     logger.info("=" * 50)
-    logger.info("⚠️ يمكنك الآن حذف ملف suqya_users.json بعد التأكد من عمل البوت")
-    logger.info("ℹ️ تم حفظ نسخة احتياطية في suqya_users.json.backup")
+    logger.info(f"⚠️ يمكنك الآن حذف ملف {args.file} بعد التأكد من عمل البوت")
+    logger.info(f"ℹ️ تم حفظ نسخة احتياطية في {args.file}.backup")
+    return True
+
+def main(argv=None):
+    """الدالة الرئيسية للترحيل"""
+    args = parse_args(argv)
+    logger.info("🚀 بدء عملية ترحيل البيانات إلى Firebase Firestore...")
+
+    # تهيئة Firebase
+    db = initialize_firebase()
+    if not db:
+        return
+
+    if args.backfill_books:
+        logger.info("🛠 تشغيل مهمة استكمال حقول الكتب الناقصة فقط (BACKFILL_BOOKS=1)")
+        backfill_books_defaults(db, args.workers, args.batch_size)
+        return
+
+    run_migration(db, args)
 
 if __name__ == "__main__":
     main()
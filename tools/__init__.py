@@ -0,0 +1 @@
+"""أدوات قياس الأداء: بدائل Firestore وTelegram في الذاكرة ومولد الحمل"""
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+قياس أداء الدوال البحتة في المسار الساخن (الهاشتاقات، الأوقات، ترتيب الكتب، الترقيم، نص الورد).
+
+يقارن النتائج بملف baseline ويفشل (exit 1) إذا تجاوزت أي دالة حدها المسموح.
+المقارنة مصححة بعمل معايرة ثابت حتى لا يظهر بطء الجهاز المشترك كتراجع.
+
+    python -m tools.bench_helpers                      # مقارنة بالـ baseline
+    python -m tools.bench_helpers --update-baseline    # حفظ القياسات الحالية كـ baseline
+    python -m tools.bench_helpers --only hashtag       # تشغيل جزء من القياسات
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import timeit
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Tuple
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("SESSION_STORE_FILE", "")
+os.environ.setdefault("LOCAL_STORE_FILE", ":memory:")
+os.environ.setdefault("OUTBOX_FILE", ":memory:")
+os.environ.setdefault("SUPPORT_ROUTES_FILE", "")
+os.environ.setdefault("STAFF_REPLY_ROUTES_FILE", "")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from telegram import Chat, Message, MessageEntity  # noqa: E402
+
+import bot  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+DEFAULT_THRESHOLD = 0.5  # نسبة التباطؤ المسموحة (بعد المعايرة) قبل اعتباره تراجعاً
+
+HASHTAGS = [
+    "#فوائد_الصيام✨",
+    "#السِّيرةُ_النَّبويّة",
+    "#دورة_التجويد🌟",
+    "#أذكار_الصباح",
+    "#إحياء_علوم_الدين",
+    "#تفسير_سورة_البقرة 🥇",
+    "#مختصر_صحيح_البخاري،",
+    "#الفقه_الميسّر!",
+    "#quran_tafseer",
+    "#درس_١٢_العقيدة_الطحاوية",
+]
+
+CAPTIONS = [
+    "تفسير سورة الكهف - المجلس الثالث\n#تفسير_سورة_الكهف #دروس_صوتية ✨",
+    "شرح الأربعين النووية | الحديث ١٥\n#الأربعين_النووية #شرح_الحديث #دروس_صوتية",
+    "#السِّيرةُ_النَّبويّة الحلقة 7 🌟",
+    "محاضرة بدون هاشتاق",
+    "#أذكار_الصباح #أذكار_المساء #حصن_المسلم #تلاوات",
+]
+
+
+def _message_with_caption(caption: str) -> Message:
+    entities = []
+    offset = 0
+    while True:
+        start = caption.find("#", offset)
+        if start < 0:
+            break
+        end = start
+        while end < len(caption) and not caption[end].isspace():
+            end += 1
+        # Telegram يحسب الإزاحات بوحدات UTF-16؛ كل الحروف هنا داخل BMP ما عدا الإيموجي
+        entities.append(MessageEntity(MessageEntity.HASHTAG, start, end - start))
+        offset = end
+    return Message(
+        message_id=1,
+        date=datetime.now(timezone.utc),
+        chat=Chat(-1001, Chat.CHANNEL),
+        caption=caption,
+        caption_entities=entities,
+    )
+
+
+def _books(count: int, rng: random.Random) -> List[Dict]:
+    now = datetime.now(timezone.utc)
+    books = []
+    for i in range(count):
+        created = now - timedelta(minutes=rng.randrange(0, 60 * 24 * 365))
+        # خليط من الأشكال الموجودة فعلاً في Firestore: datetime ونص ISO وطابع زمني رقمي
+        form = i % 3
+        created_at = created if form == 0 else created.isoformat() if form == 1 else created.timestamp()
+        books.append({"id": f"book{i}", "title": f"كتاب {i}", "category_id": "cat", "created_at": created_at})
+    rng.shuffle(books)
+    return books
+
+
+def build_cases() -> Dict[str, Tuple[Callable[[], object], int]]:
+    """اسم القياس -> (دالة بدون وسائط، عدد العمليات داخلها)"""
+    rng = random.Random(7)
+    normalize_uncached = getattr(bot._normalize_hashtag, "__wrapped__", bot._normalize_hashtag)
+    messages = [_message_with_caption(c) for c in CAPTIONS]
+    books_small = _books(50, rng)
+    books_large = _books(1000, rng)
+    items = [{"id": i} for i in range(1000)]
+    raw_times = ["20:00", "6:30", "06:30", 9, "25:00", "12:5", "13:45 ", "07:15", "21:30", 23]
+    minutes_inputs = ["00:00", "06:30", "23:59", "12:00", "bad"]
+    today = datetime.now(timezone.utc).date().isoformat()
+    quran_records = [
+        {"quran_today_date": today, "quran_pages_goal": 20, "quran_pages_today": 7},
+        {"quran_today_date": today, "quran_pages_goal": 10, "quran_pages_today": 12},
+        {"quran_today_date": today, "quran_pages_goal": None},
+    ]
+
+    return {
+        # بدون الكاش: أول مرة يظهر فيها الهاشتاق (الحالة التي يقيسها التحسين فعلاً)
+        "hashtag.normalize": (lambda: [normalize_uncached(t) for t in HASHTAGS], len(HASHTAGS)),
+        # تكرار الهاشتاق نفسه (إصابة الكاش)
+        "hashtag.normalize_cached": (lambda: [bot._normalize_hashtag(t) for t in HASHTAGS], len(HASHTAGS)),
+        "hashtag.extract": (lambda: [bot.extract_hashtags_from_message(m) for m in messages], len(messages)),
+        "times.normalize": (lambda: bot._normalize_times(raw_times, ["20:00"]), 1),
+        "times.to_minutes": (lambda: [bot._time_to_minutes(t) for t in minutes_inputs], len(minutes_inputs)),
+        "books.created_at_value": (
+            lambda: [bot._book_created_at_value(b["created_at"]) for b in books_small],
+            len(books_small),
+        ),
+        "books.sort_50": (lambda: bot._sort_books_by_created_at(books_small), 1),
+        "books.sort_1000": (lambda: bot._sort_books_by_created_at(books_large), 1),
+        "paginate.1000": (lambda: [bot._paginate_items(items, page, 10) for page in range(0, 100, 7)], 15),
+        "quran.status_text": (
+            lambda: [bot.format_quran_status_text(r, persist=False) for r in quran_records],
+            len(quran_records),
+        ),
+    }
+
+
+def measure(func: Callable[[], object], ops: int, repeat: int) -> float:
+    """أفضل زمن (ns لكل عملية) من عدة تكرارات؛ الأفضل أقل تأثراً بضجيج الجهاز"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()  # عدد الدورات الذي يستغرق 0.2 ثانية على الأقل
+    best = min(timer.repeat(repeat=repeat, number=number))
+    return best / number / ops * 1e9
+
+
+def _calibration_workload():
+    # عمل بايثون ثابت (قواميس ونصوص) لمعايرة سرعة الجهاز الحالية
+    table = {}
+    for i in range(200):
+        key = "k%d" % i
+        table[key] = key.upper() + str(i * 7)
+    return sorted(table.values())
+
+
+def calibrate(repeat: int) -> float:
+    """زمن عمل ثابت؛ تُقسم عليه النتائج حتى تصلح المقارنة بين أجهزة وأحمال مختلفة"""
+    return measure(_calibration_workload, 1, repeat)
+
+
+def load_baseline(path: str) -> Dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Microbenchmarks لدوال المسار الساخن في bot.py")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--only", help="تشغيل القياسات التي يحتوي اسمها على هذا النص")
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--threshold", type=float, help="تجاوز حد التباطؤ لكل القياسات")
+    args = parser.parse_args(argv)
+
+    baseline = load_baseline(args.baseline)
+    baseline_results = baseline.get("results", {})
+    results: Dict[str, float] = {}
+    regressions = []
+    calibrations = []
+
+    print(f"{'benchmark':<26}{'ns/op':>12}{'baseline':>12}{'speed':>7}{'change':>9}  status")
+    for name, (func, ops) in build_cases().items():
+        if args.only and args.only not in name:
+            continue
+        # المعايرة بجوار كل قياس لأن حمل الجهاز يتغير أثناء التشغيل
+        calibration = calibrate(args.repeat)
+        calibrations.append(calibration)
+        speed_ratio = calibration / baseline["calibration_ns"] if baseline.get("calibration_ns") else 1.0
+        value = measure(func, ops, args.repeat)
+        results[name] = round(value, 1)
+        reference = baseline_results.get(name)
+        if not reference:
+            print(f"{name:<26}{value:>12.1f}{'-':>12}{'-':>7}{'-':>9}  new")
+            continue
+        threshold = args.threshold if args.threshold is not None else baseline.get("thresholds", {}).get(name, DEFAULT_THRESHOLD)
+        change = value / (reference["ns_per_op"] * speed_ratio) - 1
+        status = "ok"
+        if change > threshold:
+            status = f"REGRESSION (> {threshold:.0%})"
+            regressions.append(name)
+        elif change < -threshold:
+            status = "faster"
+        print(f"{name:<26}{value:>12.1f}{reference['ns_per_op']:>12.1f}{speed_ratio:>7.2f}{change:>+9.1%}  {status}")
+
+    if args.update_baseline:
+        merged = dict(baseline_results)
+        merged.update({name: {"ns_per_op": value} for name, value in results.items()})
+        payload = {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "calibration_ns": round(min(calibrations), 1) if calibrations else baseline.get("calibration_ns"),
+            "recorded_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "thresholds": baseline.get("thresholds", {}),
+            "results": dict(sorted(merged.items())),
+        }
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(payload, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        print(f"baseline saved to {args.baseline}")
+        return 0
+
+    if regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
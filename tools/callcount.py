@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+فحص عدد عمليات Firestore لكل رحلة مستخدم على FakeFirestore.
+
+كل رحلة تُشغّل مرتين بعدد مستخدمين مختلف (صغير وكبير) في عمليتين منفصلتين:
+- يجب ألا تتجاوز القراءات/الكتابات الحد المحدد في JOURNEY_BOUNDS.
+- ويجب ألا تكبر مع عدد المستخدمين؛ أي مسح كامل لمجموعة users في مسار مستخدم واحد يفشل هنا.
+
+    python -m tools.callcount             # exit 1 عند أي تجاوز
+    python -m tools.callcount --verbose   # تفاصيل كل خطوة
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from tools import loadtest
+from tools.loadtest import CATEGORY_ID, COURSE_ID, FIRST_USER_ID, LESSON_ID, UpdateFactory
+
+import bot  # noqa: E402  (loadtest يضبط البيئة قبل استيراد البوت)
+
+SMALL_POPULATION = 5
+LARGE_POPULATION = 80
+BOOKS = 25  # أكثر من صفحة واحدة حتى تعمل "الصفحة 2"
+BENEFITS = 12
+TASBIH_TAPS = 5
+
+# الحدود لكل رحلة كاملة (بما فيها العمل الخلفي الذي تطلقه).
+# reads = قراءات الوثائق + الوثائق المرجعة من الاستعلامات + قراءات count() + لقطات المستمعين، writes = كل set/update/delete ولو داخل دفعة.
+# قوائم الكتب/الفوائد تُقرأ كاملة للعرض والترقيم؛ لذلك حدودها مرتبطة بحجم الكتالوج لا بعدد المستخدمين.
+JOURNEY_BOUNDS = {
+    "library": {"reads": 2 * BOOKS + 10, "writes": 2},
+    "benefits_like": {"reads": BENEFITS + 14, "writes": 2},
+    "course_attend": {"reads": 8, "writes": 4},
+    "tasbih": {"reads": 4, "writes": TASBIH_TAPS + 2},
+}
+
+
+def journey_steps(name: str, uid: int, factory: UpdateFactory) -> List[Tuple[str, Dict]]:
+    prefix = bot.BOOKS_CALLBACK_PREFIX
+    if name == "library":
+        return [
+            ("open_library", factory.text(uid, bot.BTN_BOOKS_MAIN)),
+            ("category", factory.callback(uid, f"{prefix}:cat:{CATEGORY_ID}:0")),
+            ("page_2", factory.callback(uid, f"{prefix}:cat:{CATEGORY_ID}:1")),
+            ("book_detail", factory.callback(uid, f"{prefix}:book:book3")),
+            ("download", factory.callback(uid, f"{prefix}:download:book3")),
+        ]
+    if name == "benefits_like":
+        return [
+            ("open_benefits", factory.text(uid, bot.BTN_BENEFITS_MAIN)),
+            ("view_benefits", factory.text(uid, bot.BTN_BENEFIT_VIEW)),
+            ("like", factory.callback(uid, f"like_benefit_{BENEFITS}")),
+        ]
+    if name == "course_attend":
+        return [
+            ("open_course", factory.callback(uid, f"COURSES:view_{COURSE_ID}")),
+            ("lesson", factory.callback(uid, f"COURSES:view_lesson_{LESSON_ID}")),
+            ("attend", factory.callback(uid, f"COURSES:attend_{LESSON_ID}")),
+        ]
+    if name == "tasbih":
+        dhikr, count = bot.TASBIH_ITEMS[0]
+        steps = [
+            ("open_tasbih", factory.text(uid, bot.BTN_TASBIH_MAIN)),
+            ("choose", factory.text(uid, f"{dhikr} ({count})")),
+        ]
+        return steps + [(f"tap_{i + 1}", factory.text(uid, bot.BTN_TASBIH_TICK)) for i in range(TASBIH_TAPS)]
+    raise ValueError(name)
+
+
+def _totals(ops: Dict[str, Dict[str, int]]) -> Dict[str, int]:
+    merged: Dict[str, int] = {}
+    for counts in ops.values():
+        for op, value in counts.items():
+            merged[op] = merged.get(op, 0) + value
+    return {
+        "reads": merged.get("read", 0)
+        + merged.get("streamed_docs", 0)
+        + merged.get("aggregated_reads", 0)
+        + merged.get("listen_docs", 0),
+        "writes": merged.get("write", 0) + merged.get("delete", 0) + merged.get("batched_writes", 0),
+        "queries": merged.get("query", 0),
+        "commits": merged.get("commit", 0),
+    }
+
+
+def _wait_for_background(baseline_threads: int, timeout: float = 3.0):
+    """انتظار ناقل الأحداث والمهام المؤجلة حتى تُحسب عملياتها على الرحلة"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        idle_bus = all(q.empty() for q in bot.EVENT_QUEUES)
+        if idle_bus and threading.active_count() <= baseline_threads:
+            break
+        time.sleep(0.02)
+    time.sleep(0.05)
+    bot.flush_thread_writes()
+
+
+def run_population(users: int) -> Dict:
+    """تشغيل كل الرحلات لمستخدم واحد ضمن مجتمع بحجم users"""
+    args = loadtest.parse_args(["--users", str(users), "--books", str(BOOKS), "--benefits", str(BENEFITS)])
+    store, _ = loadtest.build_runtime(args)
+    factory = UpdateFactory()
+    uid = FIRST_USER_ID + users - 1
+    # تهيئة الخيوط الدائمة (ناقل الأحداث، عجلة المؤقتات) قبل أخذ عدد الخيوط المرجعي
+    bot._start_event_workers()
+    results = {}
+    for journey in JOURNEY_BOUNDS:
+        baseline_threads = threading.active_count()
+        store.ops.reset()
+        steps = {}
+        for label, payload in journey_steps(journey, uid, factory):
+            before = _totals(store.ops.snapshot())
+            bot.dispatcher.process_update(loadtest.Update.de_json(payload, bot.dispatcher.bot))
+            after = _totals(store.ops.snapshot())
+            steps[label] = {key: after[key] - before[key] for key in after}
+        _wait_for_background(baseline_threads)
+        results[journey] = {"total": _totals(store.ops.snapshot()), "steps": steps}
+    return results
+
+
+def _run_isolated(users: int) -> Dict:
+    # كل حجم في عملية مستقلة: الكاش والفهارس على مستوى الوحدة لا تتسرب بين التشغيلين
+    output = subprocess.run(
+        [sys.executable, "-m", "tools.callcount", "--single", str(users)],
+        check=True,
+        capture_output=True,
+        text=True,
+        env=os.environ.copy(),
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="حدود عمليات Firestore لكل رحلة مستخدم")
+    parser.add_argument("--single", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    if args.single:
+        print(json.dumps(run_population(args.single)))
+        return 0
+
+    small = _run_isolated(SMALL_POPULATION)
+    large = _run_isolated(LARGE_POPULATION)
+    failures = []
+    print(f"{'journey':<16}{'reads':>8}{'writes':>8}{'queries':>9}   bound(r/w)   users {SMALL_POPULATION}->{LARGE_POPULATION}")
+    for journey, bound in JOURNEY_BOUNDS.items():
+        total = large[journey]["total"]
+        small_total = small[journey]["total"]
+        problems = []
+        for key in ("reads", "writes"):
+            if total[key] > bound[key]:
+                problems.append(f"{key} {total[key]} > {bound[key]}")
+            if total[key] > small_total[key]:
+                problems.append(f"{key} grow with users ({small_total[key]} -> {total[key]})")
+        status = "ok" if not problems else "FAIL: " + "; ".join(problems)
+        print(
+            f"{journey:<16}{total['reads']:>8}{total['writes']:>8}{total['queries']:>9}"
+            f"   {bound['reads']:>4}/{bound['writes']:<4}    {status}"
+        )
+        if args.verbose or problems:
+            for label, counts in large[journey]["steps"].items():
+                print(f"    {label:<14} reads={counts['reads']} writes={counts['writes']} queries={counts['queries']}")
+        if problems:
+            failures.append(journey)
+
+    if failures:
+        print(f"{len(failures)} journey(s) over budget: {', '.join(failures)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,540 @@
+"""
+بدائل في الذاكرة لـ Firestore وTelegram Bot لتشغيل bot.py بدون Firebase أو شبكة.
+
+FakeFirestore يطبق الجزء المستخدم في البوت فقط:
+collection/document/get/set/update/delete/stream/where/limit/count/batch/transaction/get_all/on_snapshot
+مع Increment وArrayUnion وArrayRemove وSERVER_TIMESTAMP وDELETE_FIELD.
+"""
+
+import copy
+import random
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+from uuid import uuid4
+
+from firebase_admin import firestore
+from google.api_core.exceptions import NotFound
+from telegram import Chat, Message, MessageId, User
+from telegram.error import RetryAfter
+
+
+# =================== عدّاد العمليات ===================
+
+_OP_LABEL = threading.local()
+
+
+def set_op_label(label: Optional[str]):
+    """تسمية العمليات التي ينفذها الخيط الحالي (نوع التحديث مثلاً)"""
+    _OP_LABEL.value = label
+
+
+def current_op_label() -> str:
+    return getattr(_OP_LABEL, "value", None) or "background"
+
+
+class OpCounter:
+    """عدّ العمليات لكل تسمية: {label: {op: count}}"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+
+    def add(self, op: str, n: int = 1):
+        with self._lock:
+            self.counts[current_op_label()][op] += n
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {label: dict(ops) for label, ops in self.counts.items()}
+
+    def reset(self):
+        with self._lock:
+            self.counts.clear()
+
+
+# =================== قيم Firestore الخاصة ===================
+
+def _split_path(field_path: str) -> List[str]:
+    return field_path.split(".")
+
+
+def _get_field(doc: Dict, field_path: str):
+    value = doc
+    for part in _split_path(field_path):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def _apply_value(current, value):
+    """تطبيق قيمة (أو تحويل مثل Increment) على القيمة الحالية"""
+    if value is firestore.SERVER_TIMESTAMP:
+        return datetime.now(timezone.utc)
+    if isinstance(value, firestore.Increment):
+        base = current if isinstance(current, (int, float)) and not isinstance(current, bool) else 0
+        return base + value.value
+    if isinstance(value, firestore.ArrayUnion):
+        items = list(current) if isinstance(current, list) else []
+        for item in value.values:
+            if item not in items:
+                items.append(item)
+        return items
+    if isinstance(value, firestore.ArrayRemove):
+        items = list(current) if isinstance(current, list) else []
+        return [item for item in items if item not in value.values]
+    if isinstance(value, dict):
+        base = current if isinstance(current, dict) else {}
+        return {k: _apply_value(base.get(k), v) for k, v in value.items() if v is not firestore.DELETE_FIELD}
+    return copy.deepcopy(value)
+
+
+def _set_field(doc: Dict, field_path: str, value):
+    parts = _split_path(field_path)
+    target = doc
+    for part in parts[:-1]:
+        if not isinstance(target.get(part), dict):
+            target[part] = {}
+        target = target[part]
+    if value is firestore.DELETE_FIELD:
+        target.pop(parts[-1], None)
+    else:
+        target[parts[-1]] = _apply_value(target.get(parts[-1]), value)
+
+
+def _merge(doc: Dict, data: Dict):
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(doc.get(key), dict):
+            _merge(doc[key], value)
+        elif value is firestore.DELETE_FIELD:
+            doc.pop(key, None)
+        else:
+            doc[key] = _apply_value(doc.get(key), value)
+
+
+_OPERATORS = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a is not None and a != b,
+    "<": lambda a, b: a is not None and a < b,
+    "<=": lambda a, b: a is not None and a <= b,
+    ">": lambda a, b: a is not None and a > b,
+    ">=": lambda a, b: a is not None and a >= b,
+    "in": lambda a, b: a in b,
+    "not-in": lambda a, b: a is not None and a not in b,
+    "array_contains": lambda a, b: isinstance(a, list) and b in a,
+    "array_contains_any": lambda a, b: isinstance(a, list) and any(x in a for x in b),
+}
+
+
+# =================== Firestore في الذاكرة ===================
+
+class FakeSnapshot:
+    def __init__(self, reference: "FakeDocumentReference", data: Optional[Dict]):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self) -> Optional[Dict]:
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path: str):
+        return _get_field(self._data or {}, field_path)
+
+
+class FakeDocumentReference:
+    def __init__(self, client: "FakeFirestore", path: str):
+        self._client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def collection(self, name: str) -> "FakeCollectionReference":
+        return FakeCollectionReference(self._client, f"{self.path}/{name}")
+
+    def get(self, *args, **kwargs) -> FakeSnapshot:
+        self._client._rpc("read")
+        return self._client._snapshot(self)
+
+    def set(self, data: Dict, merge: bool = False):
+        self._client._rpc("write")
+        self._client._set(self.path, data, merge)
+        self._client._notify([self.path])
+
+    def update(self, data: Dict):
+        self._client._rpc("write")
+        self._client._update(self.path, data)
+        self._client._notify([self.path])
+
+    def delete(self):
+        self._client._rpc("delete")
+        self._client._delete(self.path)
+        self._client._notify([self.path])
+
+    def on_snapshot(self, callback) -> "FakeWatch":
+        """مستمع على الوثيقة: لقطة فورية ثم لقطة بعد كل كتابة عليها"""
+        self._client._rpc("listen")
+        watch = FakeWatch(self._client, self, callback)
+        with self._client._lock:
+            self._client._watches[self.path].append(watch)
+        watch._deliver()
+        return watch
+
+
+class FakeWatch:
+    """مقبض المستمع كما يرجعه on_snapshot؛ unsubscribe يوقفه"""
+
+    def __init__(self, client: "FakeFirestore", ref: FakeDocumentReference, callback):
+        self._client = client
+        self._ref = ref
+        self._callback = callback
+
+    def _deliver(self):
+        # كل لقطة مُسلمة تُحتسب قراءة في Firestore
+        self._client.ops.add("listen_docs")
+        self._callback([self._client._snapshot(self._ref)], [], datetime.now(timezone.utc))
+
+    def unsubscribe(self):
+        with self._client._lock:
+            watches = self._client._watches.get(self._ref.path, [])
+            if self in watches:
+                watches.remove(self)
+
+
+class FakeQuery:
+    def __init__(self, client: "FakeFirestore", path: str, filters=None, limit_to=None, orders=None):
+        self._client = client
+        self._path = path
+        self._filters = list(filters or [])
+        self._limit = limit_to
+        self._orders = list(orders or [])
+
+    def _copy(self, **changes) -> "FakeQuery":
+        state = {"filters": self._filters, "limit_to": self._limit, "orders": self._orders}
+        state.update(changes)
+        return FakeQuery(self._client, self._path, **state)
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        if op_string not in _OPERATORS:
+            raise ValueError(f"unsupported operator {op_string}")
+        return self._copy(filters=self._filters + [(field_path, op_string, value)])
+
+    def order_by(self, field_path: str, direction: str = "ASCENDING"):
+        return self._copy(orders=self._orders + [(field_path, direction)])
+
+    def limit(self, count: int):
+        return self._copy(limit_to=count)
+
+    def stream(self, *args, **kwargs):
+        self._client._rpc("query")
+        docs = self._client._query(self._path, self._filters, self._orders, self._limit)
+        self._client.ops.add("streamed_docs", len(docs))
+        return iter(docs)
+
+    def get(self, *args, **kwargs) -> List[FakeSnapshot]:
+        return list(self.stream())
+
+    def count(self, alias: Optional[str] = None) -> "FakeAggregateQuery":
+        return FakeAggregateQuery(self, alias or "count")
+
+
+class FakeAggregationResult:
+    def __init__(self, alias: str, value: int):
+        self.alias = alias
+        self.value = value
+
+
+class FakeAggregateQuery:
+    """count(): Firestore يحتسب قراءة واحدة لكل 1000 مدخل فهرس (وقراءة على الأقل)"""
+
+    def __init__(self, query: FakeQuery, alias: str):
+        self._query = query
+        self._alias = alias
+
+    def get(self, *args, **kwargs) -> List[List[FakeAggregationResult]]:
+        client = self._query._client
+        client._rpc("aggregate")
+        matches = client._query(self._query._path, self._query._filters, self._query._orders, self._query._limit)
+        client.ops.add("aggregated_reads", max(1, -(-len(matches) // 1000)))
+        return [[FakeAggregationResult(self._alias, len(matches))]]
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, client: "FakeFirestore", path: str):
+        super().__init__(client, path)
+        self.id = path.rsplit("/", 1)[-1]
+
+    def document(self, document_id: Optional[str] = None) -> FakeDocumentReference:
+        return FakeDocumentReference(self._client, f"{self._path}/{document_id or uuid4().hex[:20]}")
+
+    def add(self, data: Dict, document_id: Optional[str] = None):
+        ref = self.document(document_id)
+        ref.set(data)
+        return datetime.now(timezone.utc), ref
+
+    def list_documents(self):
+        return [snap.reference for snap in self._client._query(self._path, [], [], None)]
+
+
+class FakeWriteBatch:
+    """دفعة كتابة: تُحتسب كعملية واحدة عند commit مع عدد الكتابات داخلها"""
+
+    def __init__(self, client: "FakeFirestore"):
+        self._client = client
+        self._ops = []
+
+    def set(self, ref: FakeDocumentReference, data: Dict, merge: bool = False):
+        self._ops.append(("set", ref.path, data, merge))
+
+    def update(self, ref: FakeDocumentReference, data: Dict):
+        self._ops.append(("update", ref.path, data, None))
+
+    def delete(self, ref: FakeDocumentReference):
+        self._ops.append(("delete", ref.path, None, None))
+
+    def commit(self):
+        self._client._rpc("commit")
+        self._client.ops.add("batched_writes", len(self._ops))
+        with self._client._lock:
+            for op, path, payload, merge in self._ops:
+                if op == "set":
+                    self._client._set(path, payload, merge)
+                elif op == "update":
+                    self._client._update(path, payload)
+                else:
+                    self._client._delete(path)
+        self._client._notify([path for _, path, _, _ in self._ops])
+        self._ops = []
+        return []
+
+    def __len__(self):
+        return len(self._ops)
+
+
+class FakeTransaction(FakeWriteBatch):
+    """معاملة متوافقة مع firestore.transactional (محاولة واحدة، بدون تعارضات)"""
+
+    _read_only = False
+    _max_attempts = 1
+
+    def __init__(self, client: "FakeFirestore"):
+        super().__init__(client)
+        self._id = None
+        self.in_progress = False
+
+    def _clean_up(self):
+        self._ops = []
+        self._id = None
+        self.in_progress = False
+
+    def _begin(self, retry_id=None):
+        self._id = uuid4().bytes
+        self.in_progress = True
+
+    def _commit(self):
+        result = self.commit()
+        self._clean_up()
+        return result
+
+    def _rollback(self):
+        self._clean_up()
+
+    def get_all(self, references):
+        return self._client.get_all(references)
+
+    def get(self, ref_or_query):
+        if isinstance(ref_or_query, FakeDocumentReference):
+            return iter([ref_or_query.get()])
+        return ref_or_query.stream()
+
+
+class FakeFirestore:
+    """عميل Firestore في الذاكرة، مع زمن استجابة اختياري لكل طلب"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, seed: Optional[int] = None):
+        self._docs: Dict[str, Dict] = {}
+        self._lock = threading.RLock()
+        self.latency = latency
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self.ops = OpCounter()
+        self._watches: Dict[str, List["FakeWatch"]] = defaultdict(list)
+
+    def _rpc(self, op: str):
+        self.ops.add(op)
+        if self.latency or self.jitter:
+            time.sleep(self.latency + self._random.uniform(0, self.jitter))
+
+    def collection(self, name: str) -> FakeCollectionReference:
+        return FakeCollectionReference(self, name)
+
+    def document(self, path: str) -> FakeDocumentReference:
+        return FakeDocumentReference(self, path)
+
+    def batch(self) -> FakeWriteBatch:
+        return FakeWriteBatch(self)
+
+    def transaction(self, **kwargs) -> FakeTransaction:
+        return FakeTransaction(self)
+
+    def get_all(self, references, *args, **kwargs):
+        self._rpc("read")
+        for ref in references:
+            yield self._snapshot(ref)
+
+    def _notify(self, paths):
+        # خارج القفل، مثل خيط المستمع في Firestore الذي لا يمسك أقفال الكاتب
+        with self._lock:
+            watches = [w for path in dict.fromkeys(paths) for w in self._watches.get(path, [])]
+        for watch in watches:
+            watch._deliver()
+
+    def _snapshot(self, ref: FakeDocumentReference) -> FakeSnapshot:
+        with self._lock:
+            return FakeSnapshot(ref, copy.deepcopy(self._docs.get(ref.path)))
+
+    def _set(self, path: str, data: Dict, merge: bool):
+        with self._lock:
+            if merge and path in self._docs:
+                _merge(self._docs[path], data)
+            else:
+                doc = {}
+                _merge(doc, data)
+                self._docs[path] = doc
+
+    def _update(self, path: str, data: Dict):
+        with self._lock:
+            doc = self._docs.get(path)
+            if doc is None:
+                raise NotFound(f"No document to update: {path}")
+            for field_path, value in data.items():
+                _set_field(doc, field_path, value)
+
+    def _delete(self, path: str):
+        with self._lock:
+            self._docs.pop(path, None)
+
+    def _query(self, path: str, filters, orders, limit_to) -> List[FakeSnapshot]:
+        prefix = path + "/"
+        with self._lock:
+            matches = [
+                (doc_path, doc)
+                for doc_path, doc in self._docs.items()
+                if doc_path.startswith(prefix) and "/" not in doc_path[len(prefix):]
+                and all(_OPERATORS[op](_get_field(doc, field), value) for field, op, value in filters)
+                # مثل Firestore: order_by يستبعد الوثائق التي لا تحتوي الحقل
+                and all(_get_field(doc, field) is not None for field, _ in orders)
+            ]
+            for field, direction in reversed(orders):
+                matches.sort(
+                    key=lambda item: (_get_field(item[1], field) is None, _get_field(item[1], field)),
+                    reverse=str(direction).upper().startswith("DESC"),
+                )
+            if limit_to is not None:
+                matches = matches[:limit_to]
+            return [FakeSnapshot(FakeDocumentReference(self, p), copy.deepcopy(d)) for p, d in matches]
+
+    def seed(self, collection: str, document_id: str, data: Dict):
+        """إضافة وثيقة مباشرة بدون احتسابها في العدّاد"""
+        self._set(f"{collection}/{document_id}", data, merge=False)
+
+    def count_documents(self, collection: str) -> int:
+        prefix = collection + "/"
+        with self._lock:
+            return sum(1 for p in self._docs if p.startswith(prefix) and "/" not in p[len(prefix):])
+
+
+# =================== Telegram Bot وهمي ===================
+
+class FakeBot:
+    """بوت Telegram يسجل الاستدعاءات ويحاكي زمن الشبكة وأخطاء 429"""
+
+    # دوال ترجع True بدل رسالة
+    BOOLEAN_METHODS = {
+        "answer_callback_query",
+        "delete_message",
+        "set_webhook",
+        "delete_webhook",
+        "send_chat_action",
+        "pin_chat_message",
+        "unpin_chat_message",
+    }
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        rate_limit_ratio: float = 0.0,
+        retry_after: float = 1.0,
+        seed: Optional[int] = None,
+    ):
+        self.id = 777000
+        self.username = "suqya_loadtest_bot"
+        self.first_name = "Suqya"
+        self.defaults = None
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._message_id = 1000
+        self.ops = OpCounter()
+        self.calls: List[tuple] = []
+        self.keep_calls = False
+
+    @property
+    def bot(self) -> User:
+        return self.get_me()
+
+    def get_me(self, *args, **kwargs) -> User:
+        return User(self.id, self.first_name, is_bot=True, username=self.username)
+
+    def _next_message_id(self) -> int:
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+    def _call(self, method: str, args, kwargs):
+        self.ops.add(method)
+        if self.keep_calls:
+            with self._lock:
+                self.calls.append((method, args, kwargs))
+        if self.latency or self.jitter:
+            time.sleep(self.latency + self._random.uniform(0, self.jitter))
+        if self.rate_limit_ratio and self._random.random() < self.rate_limit_ratio:
+            self.ops.add("rate_limited")
+            raise RetryAfter(self.retry_after)
+        if method in self.BOOLEAN_METHODS:
+            return True
+        if method == "copy_message":
+            return MessageId(self._next_message_id())
+        chat_id = kwargs.get("chat_id", args[0] if args else 0)
+        if isinstance(chat_id, str) and chat_id.lstrip("-").isdigit():
+            chat_id = int(chat_id)
+        text = kwargs.get("text")
+        if text is None and method == "send_message" and len(args) > 1:
+            text = args[1]
+        return Message(
+            message_id=kwargs.get("message_id") or self._next_message_id(),
+            date=datetime.now(timezone.utc),
+            chat=Chat(chat_id or 0, Chat.PRIVATE),
+            from_user=self.get_me(),
+            text=text,
+            caption=kwargs.get("caption"),
+            bot=self,
+        )
+
+    def __getattr__(self, method: str):
+        if method.startswith("_"):
+            raise AttributeError(method)
+
+        def _method(*args, **kwargs):
+            return self._call(method, args, kwargs)
+
+        _method.__name__ = method
+        return _method
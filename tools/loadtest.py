@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+مولد حمل لـ bot.py بدون Firebase أو Telegram.
+
+يشغل start_bot() على FakeFirestore وFakeBot، ثم يعيد تشغيل تدفق تحديثات مصطنع
+(تسبيح، تصفح الكتب، إعجابات، تسجيل حضور) عبر dispatcher.process_update،
+ويطبع p50/p95/p99 وعدد عمليات Firestore/Telegram لكل نوع تحديث.
+
+مثال:
+    python -m tools.loadtest --users 50 --updates 2000 --db-latency 0.02 --tg-latency 0.05 --rate-limit 0.01
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from queue import Queue
+from typing import Dict, Iterator, List, Tuple
+
+# قبل استيراد البوت: بدون ملفات جانبية، ومعالجة متزامنة حتى يقاس زمن كل تحديث فعلاً
+os.environ.setdefault("BOT_TOKEN", "123456:LOADTEST")
+os.environ.setdefault("DISPATCH_MODE", "direct")
+os.environ.setdefault("SESSION_STORE_FILE", "")
+os.environ.setdefault("LOCAL_STORE_FILE", ":memory:")
+os.environ.setdefault("SUPPORT_ROUTES_FILE", "")
+os.environ.setdefault("STAFF_REPLY_ROUTES_FILE", "")
+os.environ.setdefault("OUTBOX_FILE", ":memory:")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from telegram import Update  # noqa: E402
+from telegram.ext import JobQueue  # noqa: E402
+
+import bot  # noqa: E402
+from tools.fakes import FakeBot, FakeFirestore, set_op_label  # noqa: E402
+
+FIRST_USER_ID = 500000000
+COURSE_ID = "loadtest_course"
+LESSON_ID = "loadtest_lesson"
+CATEGORY_ID = "loadtest_category"
+JOURNEYS = ("tasbih", "books", "likes", "attendance")
+
+
+# =================== تجهيز البيانات ===================
+
+def seed_store(store: FakeFirestore, users: int, books: int, benefits: int):
+    now = datetime.now(timezone.utc)
+    for i in range(users):
+        uid = FIRST_USER_ID + i
+        store.seed(bot.USERS_COLLECTION, str(uid), {
+            "user_id": uid,
+            "first_name": f"user{i}",
+            "username": f"user{i}",
+            "points": 0,
+            "level": 0,
+            "medals": [],
+            "is_banned": False,
+            "gender": "male",
+            "created_at": now.isoformat(),
+            "last_active": now.isoformat(),
+        })
+        store.seed(bot.COURSE_SUBSCRIPTIONS_COLLECTION, bot._subscription_document_id(uid, COURSE_ID), {
+            "course_id": COURSE_ID,
+            "user_id": uid,
+            "full_name": f"user{i}",
+            "username": f"user{i}",
+            "points": 0,
+            "lessons_attended": [],
+        })
+
+    store.seed(bot.BOOK_CATEGORIES_COLLECTION, CATEGORY_ID, {
+        "name": "تصنيف القياس",
+        "order": 1,
+        "is_active": True,
+        "created_at": now,
+    })
+    for i in range(books):
+        store.seed(bot.BOOKS_COLLECTION, f"book{i}", {
+            "title": f"كتاب {i}",
+            "author": "مؤلف",
+            "category_id": CATEGORY_ID,
+            "pdf_file_id": f"pdf{i}",
+            "is_active": True,
+            "is_deleted": False,
+            "created_at": now,
+        })
+
+    for i in range(benefits):
+        store.seed(bot.COMMUNITY_BENEFITS_COLLECTION, f"benefit{i}", {
+            "id": i + 1,
+            "text": f"فائدة {i}",
+            "user_id": FIRST_USER_ID - 1,
+            "first_name": "كاتب",
+            "likes_count": 0,
+            "liked_by": [],
+            "date": now.isoformat(),
+        })
+
+    store.seed(bot.COURSES_COLLECTION, COURSE_ID, {"name": "دورة القياس", "status": "active"})
+    store.seed(bot.COURSE_LESSONS_COLLECTION, LESSON_ID, {
+        "course_id": COURSE_ID,
+        "title": "درس القياس",
+        "has_presentation": False,
+    })
+
+
+def build_runtime(args) -> Tuple[FakeFirestore, FakeBot]:
+    store = FakeFirestore(latency=args.db_latency, jitter=args.db_jitter, seed=args.seed)
+    fake_bot = FakeBot(
+        latency=args.tg_latency,
+        jitter=args.tg_jitter,
+        rate_limit_ratio=args.rate_limit,
+        seed=args.seed,
+    )
+    seed_store(store, args.users, args.books, args.benefits)
+    bot.set_storage_backend(store)
+
+    job_queue = JobQueue()
+    dispatcher = bot.LaneDispatcher(fake_bot, Queue(), workers=0, job_queue=job_queue)
+    job_queue.set_dispatcher(dispatcher)
+    bot.attach_dispatcher(dispatcher, job_queue)
+    bot.start_bot()
+    bot.wait_for_startup()
+    # عدّ التحميل الأولي منفصلاً عن التحديثات
+    store.ops.reset()
+    fake_bot.ops.reset()
+    return store, fake_bot
+
+
+# =================== توليد التحديثات ===================
+
+class UpdateFactory:
+    def __init__(self):
+        self._update_id = 0
+        self._message_id = 0
+        self._lock = threading.Lock()
+
+    def _ids(self) -> Tuple[int, int]:
+        with self._lock:
+            self._update_id += 1
+            self._message_id += 1
+            return self._update_id, self._message_id
+
+    @staticmethod
+    def _user(uid: int) -> Dict:
+        return {"id": uid, "is_bot": False, "first_name": f"user{uid - FIRST_USER_ID}"}
+
+    def text(self, uid: int, text: str) -> Dict:
+        update_id, message_id = self._ids()
+        return {
+            "update_id": update_id,
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": uid, "type": "private"},
+                "from": self._user(uid),
+                "text": text,
+            },
+        }
+
+    def callback(self, uid: int, data: str) -> Dict:
+        update_id, message_id = self._ids()
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "chat_instance": str(uid),
+                "from": self._user(uid),
+                "data": data,
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": uid, "type": "private"},
+                    "from": {"id": 777000, "is_bot": True, "first_name": "Suqya"},
+                    "text": "...",
+                },
+            },
+        }
+
+
+def journey_steps(name: str, uid: int, factory: UpdateFactory, rng: random.Random, args) -> Iterator[Tuple[str, Dict]]:
+    """خطوات رحلة مستخدم واحدة: (التسمية، payload)"""
+    if name == "tasbih":
+        dhikr, count = bot.TASBIH_ITEMS[0]
+        yield "tasbih:open", factory.text(uid, bot.BTN_TASBIH_MAIN)
+        yield "tasbih:choose", factory.text(uid, f"{dhikr} ({count})")
+        for _ in range(args.taps):
+            yield "tasbih:tap", factory.text(uid, bot.BTN_TASBIH_TICK)
+    elif name == "books":
+        prefix = bot.BOOKS_CALLBACK_PREFIX
+        yield "books:open", factory.text(uid, bot.BTN_BOOKS_MAIN)
+        yield "books:category", factory.callback(uid, f"{prefix}:cat:{CATEGORY_ID}:0")
+        yield "books:detail", factory.callback(uid, f"{prefix}:book:book{rng.randrange(max(1, args.books))}")
+    elif name == "likes":
+        yield "likes:like", factory.callback(uid, f"like_benefit_{rng.randrange(max(1, args.benefits)) + 1}")
+    elif name == "attendance":
+        yield "attendance:attend", factory.callback(uid, f"COURSES:attend_{LESSON_ID}")
+
+
+def user_stream(uid: int, factory: UpdateFactory, rng: random.Random, args) -> Iterator[Tuple[str, Dict]]:
+    while True:
+        yield from journey_steps(rng.choice(args.journeys), uid, factory, rng, args)
+
+
+def build_workload(args) -> List[List[Tuple[str, Dict]]]:
+    """تحديثات موزعة على العمال بحسب المستخدم حتى يبقى ترتيب كل مستخدم محفوظاً"""
+    rng = random.Random(args.seed)
+    factory = UpdateFactory()
+    streams = {uid: user_stream(uid, factory, rng, args) for uid in range(FIRST_USER_ID, FIRST_USER_ID + args.users)}
+    lanes: List[List[Tuple[str, Dict]]] = [[] for _ in range(args.workers)]
+    uids = list(streams)
+    for _ in range(args.updates):
+        uid = rng.choice(uids)
+        lanes[uid % args.workers].append(next(streams[uid]))
+    return lanes
+
+
+# =================== التشغيل والتقرير ===================
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q / 100 * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+def run_lane(lane: List[Tuple[str, Dict]], latencies: Dict[str, List[float]], errors: Dict[str, int], lock: threading.Lock):
+    dispatcher = bot.dispatcher
+    for label, payload in lane:
+        update = Update.de_json(payload, dispatcher.bot)
+        set_op_label(label)
+        started = time.perf_counter()
+        try:
+            dispatcher.process_update(update)
+        except Exception:
+            with lock:
+                errors[label] += 1
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        set_op_label(None)
+        with lock:
+            latencies[label].append(elapsed_ms)
+
+
+def run(args) -> Dict:
+    store, fake_bot = build_runtime(args)
+    lanes = build_workload(args)
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors: Dict[str, int] = defaultdict(int)
+    lock = threading.Lock()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=run_lane, args=(lane, latencies, errors, lock)) for lane in lanes if lane]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+    # ما تبقى من كتابات مؤجلة يُحسب تحت background
+    time.sleep(args.drain)
+    bot.flush_thread_writes()
+
+    db_ops = store.ops.snapshot()
+    tg_ops = fake_bot.ops.snapshot()
+    per_type = {}
+    for label in sorted(set(latencies) | set(db_ops) | set(tg_ops)):
+        values = sorted(latencies.get(label, []))
+        count = len(values)
+        per_type[label] = {
+            "count": count,
+            "errors": errors.get(label, 0),
+            "p50_ms": round(_percentile(values, 50), 2),
+            "p95_ms": round(_percentile(values, 95), 2),
+            "p99_ms": round(_percentile(values, 99), 2),
+            "firestore": db_ops.get(label, {}),
+            "firestore_per_update": round(sum(db_ops.get(label, {}).values()) / count, 2) if count else None,
+            "telegram": tg_ops.get(label, {}),
+        }
+    total = sum(len(v) for v in latencies.values())
+    return {
+        "updates": total,
+        "wall_seconds": round(wall, 3),
+        "throughput_per_second": round(total / wall, 1) if wall else 0.0,
+        "per_type": per_type,
+    }
+
+
+def print_report(report: Dict):
+    print(f"updates={report['updates']} wall={report['wall_seconds']}s throughput={report['throughput_per_second']}/s")
+    header = f"{'type':<20}{'count':>7}{'err':>5}{'p50':>9}{'p95':>9}{'p99':>9}{'fs/upd':>8}  firestore / telegram"
+    print(header)
+    print("-" * len(header))
+    for label, row in report["per_type"].items():
+        fs = ",".join(f"{k}={v}" for k, v in sorted(row["firestore"].items())) or "-"
+        tg = ",".join(f"{k}={v}" for k, v in sorted(row["telegram"].items())) or "-"
+        per_update = row["firestore_per_update"] if row["firestore_per_update"] is not None else "-"
+        print(
+            f"{label:<20}{row['count']:>7}{row['errors']:>5}"
+            f"{row['p50_ms']:>9}{row['p95_ms']:>9}{row['p99_ms']:>9}{per_update:>8}  {fs} / {tg}"
+        )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="اختبار حمل bot.py على Firestore وTelegram وهميين")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=4, help="عدد المسارات المتوازية (كل مستخدم في مسار واحد)")
+    parser.add_argument("--journeys", nargs="+", choices=JOURNEYS, default=list(JOURNEYS))
+    parser.add_argument("--taps", type=int, default=10, help="عدد التسبيحات في كل رحلة تسبيح")
+    parser.add_argument("--books", type=int, default=30)
+    parser.add_argument("--benefits", type=int, default=20)
+    parser.add_argument("--db-latency", type=float, default=0.0, help="ثوانٍ لكل طلب Firestore")
+    parser.add_argument("--db-jitter", type=float, default=0.0)
+    parser.add_argument("--tg-latency", type=float, default=0.0, help="ثوانٍ لكل استدعاء Telegram")
+    parser.add_argument("--tg-jitter", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="نسبة استدعاءات Telegram التي ترجع 429")
+    parser.add_argument("--drain", type=float, default=0.5, help="انتظار المهام الخلفية قبل التقرير")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="حفظ التقرير في ملف JSON")
+    args = parser.parse_args(argv)
+    args.workers = max(1, args.workers)
+    return args
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    logging.getLogger().setLevel(os.environ.get("LOG_LEVEL", "WARNING"))
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())